@@ -4,20 +4,46 @@
 
 import os
 import re
+import sys
 import time
 import json
 import base64
 import threading
 import queue
 import logging
-from typing import Optional, Dict, Any, Tuple
+import logging.handlers
+import atexit
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import socket
+import sqlite3
+import tempfile
+import uuid
+import math
+import heapq
+import itertools
+import contextvars
+import random
+import bisect
+import cProfile
+import pstats
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from functools import partial, lru_cache, wraps
+from typing import Optional, Dict, Any, List, Tuple, Callable, Awaitable, AsyncIterator, Iterator, IO, Union, TYPE_CHECKING
 from datetime import datetime
 
-import requests
-from flask import Flask, request, jsonify
-import gradio as gr
-from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
+import httpx
+from io import BytesIO, StringIO
+
+# Flask, Gradio y PIL se importan hasta que algo los usa: un nodo que solo
+# corre workers no paga Gradio, y uno que solo recibe webhooks no paga PIL.
+if TYPE_CHECKING:
+    from PIL import Image
 
 # =========================================================
 # CARGA DE CONFIGURACIÓN DESDE SECRETOS/VARIABLES DE ENTORNO
@@ -39,6 +65,8 @@ def cargar_configuracion() -> Dict[str, Any]:
     config["SAMBANOVA_MODEL"] = os.environ.get("SAMBANOVA_MODEL", "gpt-oss-120b")
     config["SAMBANOVA_TIMEOUT"] = int(os.environ.get("SAMBANOVA_TIMEOUT", "60"))
     config["SAMBANOVA_TEMPERATURE"] = float(os.environ.get("SAMBANOVA_TEMPERATURE", "0.7"))
+    config["SAMBANOVA_STREAM"] = os.environ.get("SAMBANOVA_STREAM", "1").lower() in ("1", "true", "si", "yes")
+    config["SAMBANOVA_CONCURRENCIA"] = int(os.environ.get("SAMBANOVA_CONCURRENCIA", "32"))
     
     # REVE (NÚCLEO VISUAL)
     config["REVE_URL"] = os.environ.get(
@@ -47,8 +75,24 @@ def cargar_configuracion() -> Dict[str, Any]:
     )
     config["REVE_KEY"] = os.environ.get("REVE_API_KEY", "")
     config["REVE_TIMEOUT"] = int(os.environ.get("REVE_TIMEOUT", "120"))
+    config["REVE_DOWNLOAD_TIMEOUT"] = int(os.environ.get("REVE_DOWNLOAD_TIMEOUT", "60"))
     config["REVE_QUALITY"] = os.environ.get("REVE_QUALITY", "high")
     config["REVE_ASPECT_RATIO"] = os.environ.get("REVE_ASPECT_RATIO", "9:16")
+    config["REVE_CONCURRENCIA"] = int(os.environ.get("REVE_CONCURRENCIA", "8"))
+    config["IMAGEN_MAX_BYTES"] = int(os.environ.get("IMAGEN_MAX_BYTES", str(25 * 1024 * 1024)))
+    config["IMAGEN_MAX_PIXELES"] = int(os.environ.get("IMAGEN_MAX_PIXELES", "40000000"))
+    config["IMAGEN_SPOOL_MEMORIA"] = int(os.environ.get("IMAGEN_SPOOL_MEMORIA", str(4 * 1024 * 1024)))
+    config["CACHE_IMAGEN"] = os.environ.get("CACHE_IMAGEN", "1").lower() in ("1", "true", "si", "yes")
+    config["IMAGENES_MAX_POR_ORDEN"] = int(os.environ.get("IMAGENES_MAX_POR_ORDEN", "8"))
+    config["IMAGENES_PARALELO"] = int(os.environ.get("IMAGENES_PARALELO", "3"))
+    
+    # FIRMA BATUTO-ART (CODIFICACIÓN DE SALIDA)
+    config["FIRMA_FORMATO"] = os.environ.get("FIRMA_FORMATO", "PNG").upper()
+    config["FIRMA_PNG_COMPRESION"] = int(os.environ.get("FIRMA_PNG_COMPRESION", "6"))
+    config["FIRMA_CALIDAD"] = int(os.environ.get("FIRMA_CALIDAD", "90"))
+    config["FIRMA_CACHE_SPRITES"] = int(os.environ.get("FIRMA_CACHE_SPRITES", "32"))
+    # Procesos para firmar/codificar (0 = hilos del proceso, comparten el GIL)
+    config["FIRMA_PROCESOS"] = int(os.environ.get("FIRMA_PROCESOS", "0"))
     
     # ELEVENLABS (NÚCLEO VOCAL)
     config["ELEVEN_URL"] = os.environ.get(
@@ -57,12 +101,158 @@ def cargar_configuracion() -> Dict[str, Any]:
     )
     config["ELEVEN_KEY"] = os.environ.get("ELEVEN_API_KEY", "")
     config["ELEVEN_MODEL"] = os.environ.get("ELEVEN_MODEL", "eleven_flash_v2_5")
-    config["ELEVEN_MAX_CHARS"] = int(os.environ.get("ELEVEN_MAX_CHARS", "1000"))
+    config["ELEVEN_MAX_CHARS"] = int(os.environ.get("ELEVEN_MAX_CHARS", "5000"))
+    config["ELEVEN_FRAGMENTO_CHARS"] = int(os.environ.get("ELEVEN_FRAGMENTO_CHARS", "400"))
+    config["ELEVEN_PARALELO"] = int(os.environ.get("ELEVEN_PARALELO", "4"))
+    config["CACHE_VOZ"] = os.environ.get("CACHE_VOZ", "1").lower() in ("1", "true", "si", "yes")
+    config["ELEVEN_TIMEOUT"] = int(os.environ.get("ELEVEN_TIMEOUT", "30"))
+    config["ELEVEN_CONCURRENCIA"] = int(os.environ.get("ELEVEN_CONCURRENCIA", "8"))
+    
+    # CLIENTES HTTP (POOL KEEP-ALIVE POR PROVEEDOR)
+    config["HTTP_POOL_SIZE"] = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+    config["HTTP_MAX_CONNECTIONS"] = int(os.environ.get("HTTP_MAX_CONNECTIONS", "200"))
+    config["HTTP_KEEPALIVE"] = os.environ.get("HTTP_KEEPALIVE", "1").lower() in ("1", "true", "si", "yes")
+    config["HTTP_CONNECT_TIMEOUT"] = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+    
+    # RESILIENCIA POR PROVEEDOR (RITMO, REINTENTOS, DISYUNTOR)
+    config["SAMBANOVA_RPS"] = float(os.environ.get("SAMBANOVA_RPS", "0"))
+    config["REVE_RPS"] = float(os.environ.get("REVE_RPS", "0"))
+    config["ELEVEN_RPS"] = float(os.environ.get("ELEVEN_RPS", "0"))
+    config["PROVEEDOR_REINTENTOS"] = int(os.environ.get("PROVEEDOR_REINTENTOS", "3"))
+    config["PROVEEDOR_BACKOFF_BASE"] = float(os.environ.get("PROVEEDOR_BACKOFF_BASE", "0.5"))
+    config["PROVEEDOR_BACKOFF_MAX"] = float(os.environ.get("PROVEEDOR_BACKOFF_MAX", "20"))
+    config["PROVEEDOR_FALLAS_UMBRAL"] = int(os.environ.get("PROVEEDOR_FALLAS_UMBRAL", "5"))
+    config["PROVEEDOR_ENFRIAMIENTO"] = float(os.environ.get("PROVEEDOR_ENFRIAMIENTO", "30"))
     
     # INFRAESTRUCTURA
     config["OUTPUT_DIR"] = os.environ.get("OUTPUT_DIR", "salida_cainal")
     config["WEBHOOK_PORT"] = int(os.environ.get("WEBHOOK_PORT", "3000"))
+    config["GRADIO_PORT"] = int(os.environ.get("GRADIO_PORT", "7860"))
+    config["MODO"] = os.environ.get("CAINAL_MODO", "all")
+    config["WEBHOOK_LOTE_MAX"] = int(os.environ.get("WEBHOOK_LOTE_MAX", "5000"))
+    # Servidor del webhook: flask (desarrollo, un proceso) o gunicorn (multiproceso)
+    config["WEBHOOK_SERVIDOR"] = os.environ.get("WEBHOOK_SERVIDOR", "flask").lower()
+    config["WEBHOOK_PROCESOS"] = int(os.environ.get("WEBHOOK_PROCESOS", "2"))
+    config["WEBHOOK_HILOS"] = int(os.environ.get("WEBHOOK_HILOS", "8"))
+    # Streams SSE abiertos a la vez por proceso ("stream": true en /webhook):
+    # cada uno ocupa un hilo del servidor mientras dura la orden (0 = sin tope)
+    config["WEBHOOK_STREAMS_MAX"] = int(os.environ.get("WEBHOOK_STREAMS_MAX", "16"))
+    # Modos worker y all: puerto de /metrics, /traces, /providers, /profiler
+    # y /outputs del proceso que atiende las órdenes (0 = sin listener)
+    config["WORKER_ADMIN_PORT"] = int(os.environ.get("WORKER_ADMIN_PORT", "3001"))
+    # Token de las rutas de administración (Authorization: Bearer). Sin token
+    # el puerto público del webhook no las sirve; con token las sirve ahí y
+    # el listener de administración también lo exige
+    config["ADMIN_TOKEN"] = os.environ.get("ADMIN_TOKEN", "")
+    # Modo webhook: listeners de los workers donde buscar una traza o un
+    # perfil que este proceso no tiene (separados por coma)
+    config["WORKER_ADMIN_URLS"] = [
+        url.strip().rstrip("/") for url in os.environ.get("WORKER_ADMIN_URLS", "").split(",") if url.strip()
+    ]
     config["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "INFO")
+    config["ESTADO_REFRESCO"] = float(os.environ.get("ESTADO_REFRESCO", "5"))
+    
+    # LOGGING NO BLOQUEANTE (COLA + HILO ESCRITOR)
+    # Con varios procesos (gunicorn) cada uno escribe su archivo: la rotación
+    # no es segura entre procesos que comparten uno
+    varios_procesos = "gunicorn" in sys.modules or (
+        config["WEBHOOK_SERVIDOR"] == "gunicorn" and config["WEBHOOK_PROCESOS"] > 1
+    )
+    config["LOG_ARCHIVO"] = os.environ.get(
+        "LOG_ARCHIVO", "cainal_operativo.{pid}.log" if varios_procesos else "cainal_operativo.log"
+    )
+    config["LOG_FORMATO"] = os.environ.get("LOG_FORMATO", "json").lower()
+    config["LOG_CONSOLA"] = os.environ.get("LOG_CONSOLA", "1").lower() in ("1", "true", "si", "yes")
+    config["LOG_ROTACION"] = os.environ.get("LOG_ROTACION", "tamano").lower()
+    config["LOG_MAX_BYTES"] = int(os.environ.get("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+    config["LOG_ROTACION_CUANDO"] = os.environ.get("LOG_ROTACION_CUANDO", "midnight")
+    config["LOG_RESPALDOS"] = int(os.environ.get("LOG_RESPALDOS", "5"))
+    config["LOG_MUESTREO"] = float(os.environ.get("LOG_MUESTREO", "1.0"))
+    config["LOG_COLA_MAX"] = int(os.environ.get("LOG_COLA_MAX", "10000"))
+    
+    # TRAZAS POR ORDEN Y PERFILADOR BAJO DEMANDA
+    config["TRAZAS_MAX"] = int(os.environ.get("TRAZAS_MAX", "2000"))
+    config["PERFILADOR_ACTIVO"] = os.environ.get("PERFILADOR_ACTIVO", "0").lower() in ("1", "true", "si", "yes")
+    config["PERFILADOR_MODO"] = os.environ.get("PERFILADOR_MODO", "cprofile").lower()
+    config["PERFILADOR_ORDENES"] = int(os.environ.get("PERFILADOR_ORDENES", "10"))
+    config["PERFILADOR_INTERVALO"] = float(os.environ.get("PERFILADOR_INTERVALO", "0.005"))
+    config["CACHE_DIR"] = os.environ.get("CACHE_DIR", "cache_cainal")
+    config["DATA_DIR"] = os.environ.get("DATA_DIR", "datos_cainal")
+    
+    # COLA DURABLE DE ÓRDENES (SQLITE)
+    config["COLA_DB"] = os.environ.get("COLA_DB", os.path.join(config["DATA_DIR"], "cola.sqlite3"))
+    config["COLA_VISIBILIDAD"] = float(os.environ.get("COLA_VISIBILIDAD", "300"))
+    config["COLA_MAX_INTENTOS"] = int(os.environ.get("COLA_MAX_INTENTOS", "3"))
+    # Cada cuánto un carril revisa si otro proceso encoló (PRAGMA data_version)
+    config["COLA_SONDEO"] = float(os.environ.get("COLA_SONDEO", "0.05"))
+    
+    # CONTROL DE ADMISIÓN Y PRIORIDADES
+    config["COLA_MAX_PENDIENTES"] = int(os.environ.get("COLA_MAX_PENDIENTES", "10000"))
+    config["COLA_RESERVA_PRIORIDAD"] = int(os.environ.get("COLA_RESERVA_PRIORIDAD", "1000"))
+    config["COLA_RETRY_AFTER_MAX"] = int(os.environ.get("COLA_RETRY_AFTER_MAX", "120"))
+    config["WEBHOOK_CLIENTES_PRIORITARIOS"] = {
+        cliente.strip()
+        for cliente in os.environ.get("WEBHOOK_CLIENTES_PRIORITARIOS", "").split(",")
+        if cliente.strip()
+    }
+    
+    # ALMACÉN DE RESULTADOS DE TRABAJOS (/jobs)
+    config["TRABAJOS_DB"] = os.environ.get("TRABAJOS_DB", os.path.join(config["DATA_DIR"], "trabajos.sqlite3"))
+    config["TRABAJOS_RETENCION"] = float(os.environ.get("TRABAJOS_RETENCION", str(7 * 24 * 3600)))
+    
+    # IDEMPOTENCIA DEL WEBHOOK (DUPLICADOS → MISMO TRABAJO)
+    config["IDEMPOTENCIA_DB"] = os.environ.get(
+        "IDEMPOTENCIA_DB", os.path.join(config["DATA_DIR"], "idempotencia.sqlite3")
+    )
+    # Vida de una clave del header Idempotency-Key y de una derivada del payload
+    # (0 = no derivar; se activa a propósito: dos "sí" seguidos son dos órdenes)
+    config["IDEMPOTENCIA_TTL"] = float(os.environ.get("IDEMPOTENCIA_TTL", str(24 * 3600)))
+    config["IDEMPOTENCIA_DERIVADA_TTL"] = float(os.environ.get("IDEMPOTENCIA_DERIVADA_TTL", "0"))
+    # Una reserva sin trabajo asignado (proceso caído a media encolada) se
+    # vuelve a prestar pasados estos segundos, no al vencer la clave
+    config["IDEMPOTENCIA_RESERVA"] = float(os.environ.get("IDEMPOTENCIA_RESERVA", "30"))
+    
+    # ALMACÉN DE SALIDAS (ÍNDICE, DESALOJO Y GALERÍA)
+    config["SALIDAS_DB"] = os.environ.get("SALIDAS_DB", os.path.join(config["DATA_DIR"], "salidas.sqlite3"))
+    config["SALIDAS_MAX_BYTES"] = int(os.environ.get("SALIDAS_MAX_BYTES", str(5 * 1024 ** 3)))
+    config["SALIDAS_RETENCION"] = float(os.environ.get("SALIDAS_RETENCION", str(30 * 24 * 3600)))
+    config["GALERIA_POR_PAGINA"] = int(os.environ.get("GALERIA_POR_PAGINA", "12"))
+    
+    # CACHE DE RESPUESTAS DE TEXTO (LRU EN MEMORIA + DISCO)
+    config["CACHE_TEXTO"] = os.environ.get("CACHE_TEXTO", "1").lower() in ("1", "true", "si", "yes")
+    config["CACHE_TEXTO_TTL"] = int(os.environ.get("CACHE_TEXTO_TTL", "3600"))
+    config["CACHE_TEXTO_MAX_MEMORIA"] = int(os.environ.get("CACHE_TEXTO_MAX_MEMORIA", "1000"))
+    config["CACHE_TEXTO_MAX_DISCO"] = int(os.environ.get("CACHE_TEXTO_MAX_DISCO", "50000"))
+    
+    # SESIONES DE CONVERSACIÓN (MEMORIA CON PRESUPUESTO DE TOKENS)
+    config["SESION_DB"] = os.environ.get("SESION_DB", os.path.join(config["DATA_DIR"], "sesiones.sqlite3"))
+    config["SESION_PRESUPUESTO"] = int(os.environ.get("SESION_PRESUPUESTO", "3000"))
+    config["SESION_RESUMEN_TOKENS"] = int(os.environ.get("SESION_RESUMEN_TOKENS", "600"))
+    config["SESION_TTL"] = float(os.environ.get("SESION_TTL", str(24 * 3600)))
+    config["SESION_MAX_MEMORIA"] = int(os.environ.get("SESION_MAX_MEMORIA", "1000"))
+    
+    # ENTREGA DE RESULTADOS POR CALLBACK (BUZÓN DURABLE)
+    config["CALLBACK_DB"] = os.environ.get("CALLBACK_DB", os.path.join(config["DATA_DIR"], "callbacks.sqlite3"))
+    config["CALLBACK_TIMEOUT"] = float(os.environ.get("CALLBACK_TIMEOUT", "10"))
+    config["CALLBACK_CONCURRENCIA"] = int(os.environ.get("CALLBACK_CONCURRENCIA", "32"))
+    config["CALLBACK_LOTE"] = int(os.environ.get("CALLBACK_LOTE", "50"))
+    config["CALLBACK_ESPERA_LOTE"] = float(os.environ.get("CALLBACK_ESPERA_LOTE", "0.05"))
+    config["CALLBACK_SONDEO"] = float(os.environ.get("CALLBACK_SONDEO", "1"))
+    config["CALLBACK_REINTENTOS"] = int(os.environ.get("CALLBACK_REINTENTOS", "8"))
+    config["CALLBACK_BACKOFF_BASE"] = float(os.environ.get("CALLBACK_BACKOFF_BASE", "1"))
+    config["CALLBACK_BACKOFF_MAX"] = float(os.environ.get("CALLBACK_BACKOFF_MAX", "300"))
+    # Hosts permitidos para callbacks (vacío = cualquier host público; los de la
+    # lista también pueden ser internos: loopback, red privada, link-local)
+    config["CALLBACK_HOSTS"] = {
+        host.strip().lower()
+        for host in os.environ.get("CALLBACK_HOSTS", "").split(",")
+        if host.strip()
+    }
+    
+    # CARRILES DE EJECUCIÓN (WORKERS POR MODALIDAD)
+    config["WORKERS_TEXTO"] = int(os.environ.get("WORKERS_TEXTO", "4"))
+    config["WORKERS_IMAGEN"] = int(os.environ.get("WORKERS_IMAGEN", "2"))
+    config["WORKERS_TEXTO_IMAGEN"] = int(os.environ.get("WORKERS_TEXTO_IMAGEN", "2"))
     
     # PLANTILLAS VISUALES
     config["IMAGE_TEMPLATE"] = os.environ.get(
@@ -83,15 +273,196 @@ CONFIG = cargar_configuracion()
 # SISTEMA DE LOGGING (VISIÓN OPERATIVA)
 # =========================================================
 
-logging.basicConfig(
-    level=getattr(logging, CONFIG["LOG_LEVEL"]),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("cainal_operativo.log"),
-        logging.StreamHandler()
-    ]
-)
+# El hilo que loguea (webhook, worker, portal) solo arma el LogRecord y lo
+# avienta a una cola; el formateo, el JSON y la escritura a disco los hace
+# un hilo escritor aparte (QueueListener). Si la cola se llena el registro
+# se descarta y se cuenta: loguear nunca frena la aceptación de órdenes.
+
+# Loggers de alto volumen: una línea por orden o por petición HTTP. Sus
+# líneas INFO/DEBUG se muestrean (LOG_MUESTREO); WARNING para arriba nunca.
+LOGGERS_MUESTREADOS = ("EL_CAINAL.ordenes", "httpx", "werkzeug")
+
+# Orden que se está atendiendo (orden_id, job_id, carril); lo fija el worker
+CONTEXTO_LOG: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("contexto_log", default=None)
+
+# Se cuentan desde cualquier hilo que loguea: con lock, como Contador
+_ESTADISTICAS_LOG = {"encolados": 0, "descartados": 0, "muestreados": 0}
+_ESTADISTICAS_LOG_LOCK = threading.Lock()
+
+def _contar_log(campo: str) -> None:
+    with _ESTADISTICAS_LOG_LOCK:
+        _ESTADISTICAS_LOG[campo] += 1
+
+class FiltroContexto(logging.Filter):
+    """Pega al registro los ids de la orden y de la traza en curso (hilo que loguea)."""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        contexto = CONTEXTO_LOG.get()
+        if contexto:
+            for campo, valor in contexto.items():
+                if getattr(record, campo, None) is None:
+                    setattr(record, campo, valor)
+        if getattr(record, "trace_id", None) is None:
+            # TRAZA_ACTUAL se define más abajo; al loguear ya existe
+            traza = TRAZA_ACTUAL.get() if "TRAZA_ACTUAL" in globals() else None
+            record.trace_id = traza.id if traza is not None else None
+        return True
+
+class FiltroMuestreo(logging.Filter):
+    """
+    Deja pasar una fracción `tasa` de las líneas de alto volumen. Con traza
+    la decisión es por trace_id (se queda la historia completa de la orden
+    o nada de ella); sin traza es al azar.
+    """
+    
+    def __init__(self, tasa: float, loggers: Tuple[str, ...] = LOGGERS_MUESTREADOS):
+        super().__init__()
+        self.tasa = min(1.0, max(0.0, tasa))
+        self.loggers = loggers
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.tasa >= 1.0 or record.levelno > logging.INFO:
+            return True
+        if not (getattr(record, "alto_volumen", False) or record.name.startswith(self.loggers)):
+            return True
+        traza = getattr(record, "trace_id", None)
+        if traza:
+            umbral = int.from_bytes(hashlib.blake2b(str(traza).encode(), digest_size=4).digest(), "big")
+            pasa = umbral < self.tasa * 0xFFFFFFFF
+        else:
+            pasa = random.random() < self.tasa
+        if not pasa:
+            _contar_log("muestreados")
+        return pasa
+
+class ColaLogHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que NO formatea en el hilo que loguea: el mensaje (%-style)
+    se arma en el hilo escritor. Los argumentos que no son inmutables se
+    pasan a texto aquí para que nadie los cambie mientras esperan en la cola.
+    """
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args:
+            args = record.args if isinstance(record.args, tuple) else (record.args,)
+            if not all(isinstance(a, (str, int, float, bool, type(None))) for a in args):
+                record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            # El traceback se formatea ya: sus frames no deben viajar a otro hilo
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _contar_log("descartados")
+        else:
+            _contar_log("encolados")
+
+class FormatoJSON(logging.Formatter):
+    """Una línea JSON por registro, con los ids de orden/traza cuando hay."""
+    
+    CAMPOS = ("trace_id", "orden_id", "job_id", "carril")
+    
+    def format(self, record: logging.LogRecord) -> str:
+        linea = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+            "hilo": record.threadName,
+        }
+        for campo in self.CAMPOS:
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                linea[campo] = valor
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            linea["error"] = record.exc_text
+        return json.dumps(linea, ensure_ascii=False, default=str)
+
+def _manejador_archivo(ruta: str) -> logging.Handler:
+    """Archivo de log con rotación por tamaño (LOG_ROTACION=tamano) o por tiempo."""
+    directorio = os.path.dirname(ruta)
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+    if CONFIG["LOG_ROTACION"] == "tiempo":
+        return logging.handlers.TimedRotatingFileHandler(
+            ruta, when=CONFIG["LOG_ROTACION_CUANDO"], backupCount=CONFIG["LOG_RESPALDOS"], encoding="utf-8"
+        )
+    return logging.handlers.RotatingFileHandler(
+        ruta, maxBytes=CONFIG["LOG_MAX_BYTES"], backupCount=CONFIG["LOG_RESPALDOS"], encoding="utf-8"
+    )
+
+def configurar_logging() -> logging.handlers.QueueListener:
+    """
+    Cuelga del logger raíz un ColaLogHandler (contexto + muestreo) y arranca
+    el hilo escritor hacia el archivo rotado y la consola.
+    """
+    texto = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    destinos: List[logging.Handler] = []
+    if CONFIG["LOG_ARCHIVO"]:
+        # {pid}: un archivo por proceso (gunicorn, varios workers)
+        archivo = _manejador_archivo(CONFIG["LOG_ARCHIVO"].replace("{pid}", str(os.getpid())))
+        archivo.setFormatter(FormatoJSON() if CONFIG["LOG_FORMATO"] == "json" else texto)
+        destinos.append(archivo)
+    if CONFIG["LOG_CONSOLA"]:
+        consola = logging.StreamHandler()
+        consola.setFormatter(texto)
+        destinos.append(consola)
+    
+    manejador = ColaLogHandler(queue.Queue(CONFIG["LOG_COLA_MAX"]))
+    manejador.addFilter(FiltroContexto())
+    manejador.addFilter(FiltroMuestreo(CONFIG["LOG_MUESTREO"]))
+    
+    raiz = logging.getLogger()
+    for anterior in list(raiz.handlers):
+        raiz.removeHandler(anterior)
+    raiz.addHandler(manejador)
+    raiz.setLevel(getattr(logging, CONFIG["LOG_LEVEL"]))
+    
+    escritor = logging.handlers.QueueListener(manejador.queue, *destinos, respect_handler_level=True)
+    escritor.start()
+    escritor._thread.name = "logging_escritor"
+    return escritor
+
+def estadisticas_logging() -> Dict[str, Any]:
+    with _ESTADISTICAS_LOG_LOCK:
+        conteos = dict(_ESTADISTICAS_LOG)
+    return {**conteos, "en_cola": _ESCRITOR_LOG.queue.qsize() if _ESCRITOR_LOG else 0}
+
+# Hilo escritor del proceso; lo arma preparar_proceso(), no el import
+_ESCRITOR_LOG: Optional[logging.handlers.QueueListener] = None
+
+def _detener_logging() -> None:
+    """Al salir se vacía la cola antes de cerrar el archivo."""
+    if _ESCRITOR_LOG is not None:
+        _ESCRITOR_LOG.stop()
+
+def _reabrir_logging() -> None:
+    """
+    Tras un fork (workers de gunicorn) el hilo escritor no existe en el hijo:
+    se arma una cola y un escritor nuevos. El archivo del padre se queda con
+    el padre: si LOG_ARCHIVO no trae {pid}, el hijo escribe en
+    nombre.<pid>.ext.
+    """
+    global _ESCRITOR_LOG
+    CONFIG["LOG_ARCHIVO"] = archivo_log_por_proceso(CONFIG["LOG_ARCHIVO"])
+    _ESCRITOR_LOG = configurar_logging()
+
+def archivo_log_por_proceso(plantilla: str) -> str:
+    """Plantilla de LOG_ARCHIVO con {pid} (la misma si ya lo trae o si no hay archivo)."""
+    if not plantilla or "{pid}" in plantilla:
+        return plantilla
+    base, extension = os.path.splitext(plantilla)
+    return f"{base}.{{pid}}{extension}"
+
 logger = logging.getLogger("EL_CAINAL")
+# Líneas por orden (se muestrean con LOG_MUESTREO)
+logger_ordenes = logging.getLogger("EL_CAINAL.ordenes")
 
 # =========================================================
 # VALIDACIÓN DE API KEYS AL INICIAR
@@ -167,320 +538,4284 @@ Siempre hacia arriba.
 """
 
 # =========================================================
-# INFRAESTRUCTURA: COLA DE ÓRDENES
+# INFRAESTRUCTURA: MÉTRICAS (FORMATO PROMETHEUS)
 # =========================================================
 
-ORDER_QUEUE = queue.Queue()
+# Límites de las cubetas de latencia, en segundos
+LIMITES_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def _etiquetas_prometheus(nombres: Tuple[str, ...], valores: Tuple[str, ...]) -> str:
+    """{a="x",b="y"} con los valores escapados."""
+    if not nombres:
+        return ""
+    pares = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pares.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(pares) + "}"
+
+class Contador:
+    """Contador monótono de Prometheus, una serie por combinación de etiquetas."""
+    
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Tuple[str, ...] = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._series: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+    
+    def incrementar(self, *valores: str, cantidad: float = 1) -> None:
+        with self._lock:
+            self._series[valores] = self._series.get(valores, 0) + cantidad
+    
+    def exponer(self) -> List[str]:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for valores, total in series:
+            lineas.append(f"{self.nombre}{_etiquetas_prometheus(self.etiquetas, valores)} {total:g}")
+        return lineas
+
+class Histograma:
+    """Histograma acumulativo de Prometheus, una serie por combinación de etiquetas."""
+    
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Tuple[str, ...] = (),
+                 limites: Tuple[float, ...] = LIMITES_LATENCIA):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.limites = limites
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+    
+    def observar(self, valor: float, *valores: str) -> None:
+        indice = bisect.bisect_left(self.limites, valor)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [[0] * (len(self.limites) + 1), 0.0, 0]
+            serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+    
+    def exponer(self) -> List[str]:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self._lock:
+            series = sorted((valores, [list(s[0]), s[1], s[2]]) for valores, s in self._series.items())
+        for valores, (cubetas, suma, cuenta) in series:
+            acumulado = 0
+            for limite, cantidad in zip(self.limites + (float("inf"),), cubetas):
+                acumulado += cantidad
+                le = "+Inf" if limite == float("inf") else f"{limite:g}"
+                etiquetas = _etiquetas_prometheus(self.etiquetas + ("le",), valores + (le,))
+                lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+            etiquetas = _etiquetas_prometheus(self.etiquetas, valores)
+            lineas.append(f"{self.nombre}_sum{etiquetas} {suma:.6f}")
+            lineas.append(f"{self.nombre}_count{etiquetas} {cuenta}")
+        return lineas
+    
+    def promedios(self) -> Dict[Tuple[str, ...], Tuple[int, float]]:
+        """(observaciones, promedio) por combinación de etiquetas, para el panel de estado."""
+        with self._lock:
+            return {valores: (s[2], s[1] / s[2]) for valores, s in self._series.items() if s[2]}
+
+METRICA_PROVEEDOR = Histograma(
+    "cainal_proveedor_latencia_segundos",
+    "Duración de cada llamada a un proveedor, reintentos incluidos.",
+    ("proveedor",)
+)
+METRICA_ORDEN = Histograma(
+    "cainal_orden_latencia_segundos",
+    "Tiempo de una orden desde que se encoló hasta que terminó, por tipo.",
+    ("tipo",)
+)
+METRICA_ESPERA = Histograma(
+    "cainal_cola_espera_segundos",
+    "Tiempo que una orden esperó visible en la cola antes de que un carril la tomara.",
+    ("carril",)
+)
+METRICA_FIRMA = Histograma(
+    "cainal_firma_segundos",
+    "Tiempo de aplicar_firma_batuto (decodificar, firmar y codificar).",
+    limites=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+METRICA_CALLBACK = Histograma(
+    "cainal_callback_envio_segundos",
+    "Duración de cada POST de callback, individual o en lote.",
+    ("modo",)
+)
+METRICA_ORDENES = Contador(
+    "cainal_ordenes_total",
+    "Órdenes terminadas por tipo y resultado.",
+    ("tipo", "resultado")
+)
+METRICA_ERRORES = Contador(
+    "cainal_errores_total",
+    "Fallas por componente y tipo (timeout, connection, internal, circuit_open, too_large).",
+    ("componente", "tipo")
+)
+
+METRICA_IDEMPOTENCIA = Contador(
+    "cainal_webhook_idempotencia_total",
+    "Órdenes del webhook por origen de la clave (header, derivada) y resultado "
+    "(nueva, duplicada, en_curso, conflicto).",
+    ("origen", "resultado")
+)
+METRICA_CALLBACKS = Contador(
+    "cainal_callbacks_total",
+    "Entregas de callback por resultado (entregado, reintento, fallido).",
+    ("resultado",)
+)
+
+def registrar_error(componente: str, tipo: str) -> None:
+    """Cuenta una falla para /metrics."""
+    METRICA_ERRORES.incrementar(componente, tipo)
+
+def tipo_error(e: BaseException) -> str:
+    """Clase de falla de una excepción, con los mismos nombres que el webhook."""
+    if isinstance(e, ProveedorCaido):
+        return "circuit_open"
+    if isinstance(e, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(e, httpx.HTTPError):
+        return "connection"
+    if isinstance(e, ImagenDemasiadoGrande):
+        return "too_large"
+    return "internal"
+
+def _medidor(nombre: str, ayuda: str, tipo: str, muestras: List[Tuple[Dict[str, str], float]]) -> List[str]:
+    """Serie calculada al momento del scrape (gauge o contador ajeno)."""
+    lineas = [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}"]
+    for etiquetas, valor in muestras:
+        lineas.append(f"{nombre}{_etiquetas_prometheus(tuple(etiquetas), tuple(etiquetas.values()))} {valor:g}")
+    return lineas
+
+def exponer_metricas() -> str:
+    """Todas las métricas en formato de texto de Prometheus (0.0.4)."""
+    lineas: List[str] = []
+    for metrica in (METRICA_PROVEEDOR, METRICA_ORDEN, METRICA_ESPERA, METRICA_FIRMA, METRICA_CALLBACK,
+                    METRICA_ORDENES, METRICA_IDEMPOTENCIA, METRICA_CALLBACKS, METRICA_ERRORES):
+        lineas.extend(metrica.exponer())
+    
+    carriles = estado_carriles()
+    lineas.extend(_medidor(
+        "cainal_cola_profundidad", "Órdenes visibles esperando por carril.", "gauge",
+        [({"carril": c}, e["en_cola"]) for c, e in carriles.items()]
+    ))
+    lineas.extend(_medidor(
+        "cainal_carril_activos", "Órdenes en proceso por carril.", "gauge",
+        [({"carril": c}, e["activos"]) for c, e in carriles.items()]
+    ))
+    lineas.extend(_medidor(
+        "cainal_carril_utilizacion", "Fracción de la concurrencia del carril en uso (0-1).", "gauge",
+        [({"carril": c}, e["activos"] / e["workers"] if e["workers"] else 0) for c, e in carriles.items()]
+    ))
+    lineas.extend(_medidor(
+        "cainal_webhook_streams", "Streams SSE de /webhook abiertos en este proceso.", "gauge",
+        [({}, streams_activos())]
+    ))
+    
+    proveedores = estado_proveedores()
+    estados_disyuntor = {"cerrado": 0, "semiabierto": 1, "abierto": 2}
+    lineas.extend(_medidor(
+        "cainal_proveedor_disyuntor", "Estado del disyuntor (0 cerrado, 1 semiabierto, 2 abierto).", "gauge",
+        [({"proveedor": p}, estados_disyuntor[e["disyuntor"]["estado"]]) for p, e in proveedores.items()]
+    ))
+    lineas.extend(_medidor(
+        "cainal_proveedor_en_vuelo", "Llamadas en curso por proveedor (compuerta de prioridad).", "gauge",
+        [({"proveedor": p}, e["compuerta"]["ocupados"]) for p, e in proveedores.items() if e["compuerta"]]
+    ))
+    lineas.extend(_medidor(
+        "cainal_proveedor_reintentos_total", "Reintentos por proveedor.", "counter",
+        [({"proveedor": p}, e["reintentos"]) for p, e in proveedores.items()]
+    ))
+    
+    consultas = []
+    if _CACHE_TEXTO.abierto is not None:
+        texto = _CACHE_TEXTO.abierto.estadisticas()
+        consultas += [
+            ({"cache": "texto", "resultado": "hit_memoria"}, texto["hits_memoria"]),
+            ({"cache": "texto", "resultado": "hit_disco"}, texto["hits_disco"]),
+            ({"cache": "texto", "resultado": "miss"}, texto["misses"]),
+        ]
+    imagen = estadisticas_cache_imagen()
+    consultas += [
+        ({"cache": "imagen", "resultado": "hit"}, imagen["hits"]),
+        ({"cache": "imagen", "resultado": "coalescida"}, imagen["coalescidas"]),
+        ({"cache": "imagen", "resultado": "miss"}, imagen["misses"]),
+    ]
+    voz = estadisticas_cache_voz()
+    consultas += [
+        ({"cache": "voz", "resultado": "hit"}, voz["hits"]),
+        ({"cache": "voz", "resultado": "miss"}, voz["misses"]),
+    ]
+    lineas.extend(_medidor(
+        "cainal_cache_consultas_total", "Consultas a los caches por resultado.", "counter", consultas
+    ))
+    
+    if _IDEMPOTENCIA.abierto is not None:
+        lineas.extend(_medidor(
+            "cainal_idempotencia_claves", "Claves de idempotencia guardadas.", "gauge",
+            [({}, _IDEMPOTENCIA.abierto.estadisticas()["claves"])]
+        ))
+    if _BUZON.abierto is not None:
+        buzon = _BUZON.abierto.estadisticas()
+        lineas.extend(_medidor(
+            "cainal_callbacks_buzon", "Entregas de callback en el buzón por estado.", "gauge",
+            [({"estado": "pendiente"}, buzon["pendientes"]), ({"estado": "fallido"}, buzon["fallidas"])]
+        ))
+    
+    registros = estadisticas_logging()
+    lineas.extend(_medidor(
+        "cainal_log_registros_total", "Registros de log por destino (encolado, descartado por cola llena, muestreado).", "counter",
+        [({"resultado": r}, registros[r]) for r in ("encolados", "descartados", "muestreados")]
+    ))
+    lineas.extend(_medidor(
+        "cainal_log_cola", "Registros de log esperando al hilo escritor.", "gauge", [({}, registros["en_cola"])]
+    ))
+    return "\n".join(lineas) + "\n"
 
 # =========================================================
-# MOTOR DE TEXTO (SAMBANOVA)
+# INFRAESTRUCTURA: TRAZAS Y PERFILADO POR ORDEN
 # =========================================================
 
-def generar_texto_cainal(prompt: str, uso_webhook: bool = False) -> str:
+# Tramos guardados por traza; los que sobran se cuentan pero no se guardan
+MAX_TRAMOS_POR_TRAZA = 500
+
+class Traza:
     """
-    Motor principal de texto con SYSTEM_PROMPT irrompible.
+    Línea de tiempo de una orden: tramos (nombre, inicio, duración, rama)
+    medidos desde que la orden se encoló. Los tramos se agregan desde el loop
+    del núcleo y desde hilos (asyncio.to_thread), por eso llevan lock.
     """
-    # Validar si la API está configurada
-    if not CONFIG["SAMBANOVA_KEY"]:
-        error_msg = "⚠️ SAMBANOVA_API_KEY no configurada. No se puede generar texto."
-        logger.error(error_msg)
-        return error_msg if not uso_webhook else json.dumps({"error": "api_key_missing", "message": error_msg})
     
-    headers = {
-        "Authorization": f"Bearer {CONFIG['SAMBANOVA_KEY']}",
-        "Content-Type": "application/json"
-    }
+    def __init__(self, id_traza: str, orden: str, encolado: Optional[float] = None):
+        ahora, ahora_perf = time.time(), time.perf_counter()
+        self.id = id_traza
+        self.orden = orden
+        self.inicio = encolado if encolado is not None else ahora
+        # Reloj monótono alineado con el inicio en reloj de pared
+        self.inicio_perf = ahora_perf - (ahora - self.inicio)
+        self.fin: Optional[float] = None
+        self.error: Optional[str] = None
+        self.tramos: List[Dict[str, Any]] = []
+        self.omitidos = 0
+        self.perfil: Any = None
+        self._ramas: Dict[int, int] = {}
+        self._lock = threading.Lock()
     
-    payload = {
-        "model": CONFIG["SAMBANOVA_MODEL"],
-        "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": CONFIG["SAMBANOVA_TEMPERATURE"]
-    }
+    def rama(self, clave: int) -> int:
+        """Número chico y estable por tarea/hilo (el 'tid' del formato Chrome)."""
+        with self._lock:
+            return self._ramas.setdefault(clave, len(self._ramas) + 1)
     
-    try:
-        logger.info(f"Solicitando texto a SambaNova: {prompt[:50]}...")
-        response = requests.post(
-            CONFIG["SAMBANOVA_URL"],
-            headers=headers,
-            json=payload,
-            timeout=CONFIG["SAMBANOVA_TIMEOUT"]
-        )
-        response.raise_for_status()
-        
-        resultado = response.json()["choices"][0]["message"]["content"]
-        logger.info("Texto generado exitosamente")
-        return resultado
-        
-    except requests.exceptions.Timeout:
-        error_msg = "⚠️ SambaNova no respondió a tiempo, la red anda lenta."
-        logger.error("Timeout en SambaNova")
-        return error_msg if not uso_webhook else json.dumps({"error": "timeout", "message": error_msg})
-        
-    except requests.exceptions.RequestException as e:
-        error_msg = f"⚠️ Fallo en la conexión con SambaNova: {str(e)}"
-        logger.error(f"Error de conexión SambaNova: {e}")
-        return error_msg if not uso_webhook else json.dumps({"error": "connection", "message": error_msg})
-        
-    except Exception as e:
-        error_msg = f"⚠️ Error interno en el núcleo textual: {str(e)}"
-        logger.error(f"Error inesperado en generar_texto_cainal: {e}")
-        return error_msg if not uso_webhook else json.dumps({"error": "internal", "message": error_msg})
+    def agregar_tramo(self, nombre: str, inicio_perf: float, duracion: float, rama: int,
+                      padre: Optional[int] = None, atributos: Optional[Dict[str, Any]] = None,
+                      id_tramo: Optional[int] = None) -> None:
+        with self._lock:
+            if len(self.tramos) >= MAX_TRAMOS_POR_TRAZA:
+                self.omitidos += 1
+                return
+            self.tramos.append({
+                "id": id_tramo if id_tramo is not None else next(_IDS_TRAMO),
+                "nombre": nombre,
+                "inicio": round(inicio_perf - self.inicio_perf, 6),
+                "duracion": round(duracion, 6),
+                "rama": rama,
+                "padre": padre,
+                "atributos": atributos or {}
+            })
+    
+    def duracion(self) -> float:
+        fin = self.fin if self.fin is not None else time.time()
+        return fin - self.inicio
+    
+    def resumen(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.id,
+            "orden": self.orden[:100],
+            "inicio": datetime.fromtimestamp(self.inicio).isoformat(),
+            "duracion": round(self.duracion(), 6),
+            "terminada": self.fin is not None,
+            "error": self.error
+        }
+    
+    def exportar(self) -> Dict[str, Any]:
+        """Traza completa en JSON."""
+        with self._lock:
+            tramos = [dict(t) for t in self.tramos]
+        datos = self.resumen()
+        datos.update({"tramos": tramos, "tramos_omitidos": self.omitidos})
+        return datos
+    
+    def exportar_chrome(self) -> Dict[str, Any]:
+        """Formato de eventos de Chrome (chrome://tracing, Perfetto)."""
+        with self._lock:
+            tramos = list(self.tramos)
+        pid = os.getpid()
+        eventos = [
+            {
+                "name": t["nombre"],
+                "cat": "cainal",
+                "ph": "X",
+                "ts": round((self.inicio + t["inicio"]) * 1e6),
+                "dur": round(t["duracion"] * 1e6),
+                "pid": pid,
+                "tid": t["rama"],
+                "args": t["atributos"]
+            }
+            for t in tramos
+        ]
+        eventos.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"orden {self.id}"}})
+        return {"traceEvents": eventos, "displayTimeUnit": "ms"}
 
-# =========================================================
-# MOTOR VISUAL (REVE + FIRMA BATUTO-ART)
-# =========================================================
+TRAZA_ACTUAL: contextvars.ContextVar[Optional[Traza]] = contextvars.ContextVar("traza_actual", default=None)
+_TRAMO_ACTUAL: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("tramo_actual", default=None)
+
+_TRAZAS: "OrderedDict[str, Traza]" = OrderedDict()
+_TRAZAS_LOCK = threading.Lock()
+_IDS_TRAMO = itertools.count(1)
 
-def aplicar_firma_batuto(img_data: bytes) -> str:
+def obtener_traza(id_traza: str, orden: str = "", encolado: Optional[float] = None) -> Traza:
     """
-    Aplica firma BATUTO-ART estilo liquid gold a imagen.
+    Traza de una orden, creada la primera vez. Una orden que pasa de carril
+    (texto → texto_con_imagen) sigue en la misma traza.
+    """
+    with _TRAZAS_LOCK:
+        traza = _TRAZAS.get(id_traza)
+        if traza is None:
+            traza = Traza(id_traza, orden, encolado)
+            traza.perfil = PERFILADOR.nuevo_perfil()
+            _TRAZAS[id_traza] = traza
+            while len(_TRAZAS) > CONFIG["TRAZAS_MAX"]:
+                _TRAZAS.popitem(last=False)
+        return traza
+
+def buscar_traza(id_traza: str) -> Optional[Traza]:
+    with _TRAZAS_LOCK:
+        return _TRAZAS.get(id_traza)
+
+def listar_trazas(limite: int = 50, lentas: bool = False) -> List[Dict[str, Any]]:
+    """Resúmenes de las trazas en memoria: las más nuevas o las más lentas primero."""
+    with _TRAZAS_LOCK:
+        trazas = list(_TRAZAS.values())
+    if lentas:
+        trazas.sort(key=lambda t: t.duracion(), reverse=True)
+    else:
+        trazas.reverse()
+    return [t.resumen() for t in trazas[:limite]]
+
+def cerrar_traza(traza: Traza, error: Optional[str] = None) -> None:
     """
+    La orden terminó (o reventó, con `error`): fija la duración y se la
+    ofrece al perfilador.
+    """
+    traza.fin = time.time()
+    traza.error = error
+    PERFILADOR.considerar(traza)
+
+def _clave_rama() -> int:
     try:
-        img = Image.open(BytesIO(img_data)).convert("RGBA")
-        draw = ImageDraw.Draw(img)
-        width, height = img.size
-        
-        # Tamaño de fuente proporcional
-        font_size = max(18, int(width * 0.05))
-        try:
-            # NOTA: Para producción, usar fuente personalizada (ej: graffiti.ttf)
-            # Colocar la fuente en el directorio del proyecto
-            font = ImageFont.truetype("arial.ttf", font_size)
-        except:
-            font = ImageFont.load_default()
-        
-        # Color Liquid Gold con transparencia
-        gold_color = (255, 215, 0, 255)
-        shadow_color = (0, 0, 0, 160)
-        shadow_offset = 2
-        
-        # Margen proporcional
-        margin_x = int(width * 0.02)
-        margin_y = int(height * 0.02)
-        
-        # Sombra
-        draw.text(
-            (margin_x + shadow_offset, margin_y + shadow_offset),
-            "BATUTO-ART",
-            font=font,
-            fill=shadow_color
-        )
-        
-        # Texto principal
-        draw.text(
-            (margin_x, margin_y),
-            "BATUTO-ART",
-            font=font,
-            fill=gold_color
-        )
-        
-        # Guardar con timestamp único
-        timestamp = int(time.time())
-        path = os.path.join(CONFIG["OUTPUT_DIR"], f"cainal_{timestamp}.png")
-        img.save(path, "PNG")
-        
-        logger.info(f"Imagen guardada y firmada: {path}")
-        return path
-        
-    except Exception as e:
-        logger.error(f"Error al aplicar firma BATUTO: {e}")
-        raise
+        tarea = asyncio.current_task()
+    except RuntimeError:
+        tarea = None
+    return id(tarea) if tarea is not None else threading.get_ident()
 
-def generar_imagen_cainal(descripcion: str) -> str:
+class tramo:
     """
-    Genera imagen con REVE y aplica firma BATUTO-ART.
+    Mide un tramo de la traza activa: `with tramo("nombre", clave=valor):`.
+    Sin traza activa no hace nada. Sirve igual en corrutinas que en hilos;
+    en un hilo con la orden perfilada, el tramo también se perfila.
     """
-    if not CONFIG["REVE_KEY"]:
-        logger.error("No hay API key de REVE configurada")
-        return "⚠️ No hay llave REVE registrada, mi rey. Sin API no hay cuadro."
     
-    # Construir prompt visual
-    prompt_visual = CONFIG["IMAGE_TEMPLATE"].replace("{DESC}", descripcion)
+    __slots__ = ("nombre", "atributos", "traza", "id", "inicio", "_ficha", "_perfilando")
     
-    headers = {"Authorization": f"Bearer {CONFIG['REVE_KEY']}"}
-    payload = {
-        "prompt": prompt_visual,
-        "aspect_ratio": CONFIG["REVE_ASPECT_RATIO"],
-        "quality": CONFIG["REVE_QUALITY"]
-    }
+    def __init__(self, nombre: str, **atributos: Any):
+        self.nombre = nombre
+        self.atributos = atributos
     
-    try:
-        logger.info(f"Solicitando imagen a REVE: {descripcion[:50]}...")
-        resp = requests.post(
-            CONFIG["REVE_URL"],
-            headers=headers,
-            json=payload,
-            timeout=CONFIG["REVE_TIMEOUT"]
+    def __enter__(self) -> "tramo":
+        self.traza = TRAZA_ACTUAL.get()
+        if self.traza is None:
+            return self
+        self.id = next(_IDS_TRAMO)
+        self._ficha = _TRAMO_ACTUAL.set(self.id)
+        self._perfilando = self.traza.perfil is not None and threading.current_thread() is not _HILO_LOOP
+        if self._perfilando:
+            self._perfilando = PERFILADOR.entrar(self.traza)
+        self.inicio = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc: Any) -> None:
+        if self.traza is None:
+            return
+        duracion = time.perf_counter() - self.inicio
+        if self._perfilando:
+            PERFILADOR.salir(self.traza)
+        _TRAMO_ACTUAL.reset(self._ficha)
+        if exc[0] is not None:
+            self.atributos["error"] = exc[0].__name__
+        self.traza.agregar_tramo(
+            self.nombre, self.inicio, duracion, self.traza.rama(_clave_rama()),
+            _TRAMO_ACTUAL.get(), self.atributos, self.id
         )
-        resp.raise_for_status()
-        data = resp.json()
-        
-        # Extraer datos de imagen (base64 o URL)
-        image_b64 = data.get("image")
-        image_url = data.get("url")
-        
-        if image_b64:
-            image_bytes = base64.b64decode(image_b64)
-        elif image_url:
-            img_res = requests.get(image_url, timeout=60)
-            img_res.raise_for_status()
-            image_bytes = img_res.content
-        else:
-            logger.error("REVE no devolvió datos de imagen válidos")
-            return "⚠️ El REVE no mandó ni base64 ni URL, puro aire digital."
-        
-        # Aplicar firma y guardar
-        path_final = aplicar_firma_batuto(image_bytes)
-        return path_final
-        
-    except requests.exceptions.Timeout:
-        logger.error("Timeout en REVE")
-        return "⚠️ El REVE se tardó de más, la red anda bien troleada."
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error de conexión REVE: {e}")
-        return f"⚠️ Fallo en la conexión con REVE: {str(e)}"
+
+def trazado(nombre: Optional[str] = None):
+    """Decorador: cada llamada a la función (síncrona o async) es un tramo de la traza activa."""
+    def decorador(funcion):
+        etiqueta = nombre or funcion.__name__
+        if asyncio.iscoroutinefunction(funcion):
+            @wraps(funcion)
+            async def envoltura_async(*args, **kwargs):
+                with tramo(etiqueta):
+                    return await funcion(*args, **kwargs)
+            return envoltura_async
         
-    except Exception as e:
-        logger.error(f"Error inesperado en generar_imagen_cainal: {e}")
-        return f"⚠️ Fallo en la matriz visual: {str(e)}"
+        @wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with tramo(etiqueta):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
 
-# =========================================================
-# MOTOR DE VOZ (ELEVENLABS)
-# =========================================================
+class _PasosPerfilados:
+    """
+    Conduce una corrutina paso a paso con el perfilador de su orden prendido
+    solo mientras ese paso corre. Así, en un loop con muchas órdenes
+    intercaladas, cada perfil ve solo el trabajo de su propia orden.
+    """
+    
+    def __init__(self, corrutina: Awaitable[Any], traza: Traza):
+        self.corrutina = corrutina
+        self.traza = traza
+    
+    def __await__(self):
+        pasos = self.corrutina.__await__()
+        enviar, lanzar = None, None
+        while True:
+            perfilando = PERFILADOR.entrar(self.traza)
+            try:
+                if lanzar is not None:
+                    senal = pasos.throw(lanzar)
+                else:
+                    senal = pasos.send(enviar)
+            except StopIteration as fin:
+                return fin.value
+            finally:
+                if perfilando:
+                    PERFILADOR.salir(self.traza)
+            try:
+                enviar, lanzar = (yield senal), None
+            except BaseException as e:
+                enviar, lanzar = None, e
+
+async def perfilar_async(corrutina: Awaitable[Any], traza: Optional[Traza]) -> Any:
+    """Espera la corrutina; si su orden se está perfilando, paso a paso bajo el perfilador."""
+    if traza is None or traza.perfil is None:
+        return await corrutina
+    return await _PasosPerfilados(corrutina, traza)
 
-def generar_voz_cainal(texto: str) -> Optional[bytes]:
+def _fabrica_tareas(loop: asyncio.AbstractEventLoop, corrutina, context=None, **kwargs) -> asyncio.Task:
     """
-    Genera audio a partir de texto usando ElevenLabs.
+    Task factory del loop del núcleo: las tareas hijas de una orden perfilada
+    (imágenes y voz en paralelo) también corren bajo su perfilador.
+    """
+    traza = context.get(TRAZA_ACTUAL) if context is not None else TRAZA_ACTUAL.get()
+    if traza is not None and traza.perfil is not None:
+        corrutina = perfilar_async(corrutina, traza)
+    # Task() acepta context solo desde Python 3.11; antes el loop nunca lo pasa
+    if context is not None:
+        kwargs["context"] = context
+    return asyncio.Task(corrutina, loop=loop, **kwargs)
+
+class Perfilador:
+    """
+    Perfilado bajo demanda de las N órdenes más lentas, sin redesplegar
+    (POST /profiler). Modos: "cprofile" (deterministico, pstats) y
+    "muestreo" (un hilo toma la pila cada `intervalo` segundos; salida en
+    pilas colapsadas, lista para flamegraph.pl o speedscope).
     """
-    if not CONFIG["ELEVEN_KEY"]:
-        logger.warning("ElevenLabs API key no configurada")
-        return None
     
-    if not texto.strip():
-        logger.warning("Texto vacío para generación de voz")
-        return None
+    MODOS = ("cprofile", "muestreo")
     
-    # Limitar longitud del texto
-    texto_limitado = texto[:CONFIG["ELEVEN_MAX_CHARS"]]
+    def __init__(self, activo: bool, modo: str, ordenes: int, intervalo: float):
+        self.activo = False
+        self.modo = modo if modo in self.MODOS else "cprofile"
+        self.ordenes = ordenes
+        self.intervalo = intervalo
+        self._capturas: List[Tuple[float, str, Dict[str, Any]]] = []
+        self._hilos: Dict[int, Traza] = {}
+        self._muestreador: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        if activo:
+            self.configurar(activo=True)
     
-    headers = {
-        "xi-api-key": CONFIG["ELEVEN_KEY"],
-        "Content-Type": "application/json"
-    }
+    def configurar(self, activo: Optional[bool] = None, modo: Optional[str] = None,
+                   ordenes: Optional[int] = None, intervalo: Optional[float] = None) -> Dict[str, Any]:
+        with self._lock:
+            if modo is not None:
+                if modo not in self.MODOS:
+                    raise ValueError(f"Modo desconocido: {modo} (usa {', '.join(self.MODOS)})")
+                self.modo = modo
+            if ordenes is not None:
+                self.ordenes = max(1, int(ordenes))
+                self._capturas = heapq.nlargest(self.ordenes, self._capturas, key=lambda c: c[0])
+                heapq.heapify(self._capturas)
+            if intervalo is not None:
+                self.intervalo = max(0.001, float(intervalo))
+            if activo is not None:
+                self.activo = bool(activo)
+            arrancar = self.activo and self.modo == "muestreo" and not (
+                self._muestreador and self._muestreador.is_alive()
+            )
+            if arrancar:
+                self._muestreador = threading.Thread(target=self._muestrear, name="perfilador", daemon=True)
+                self._muestreador.start()
+        logger.warning("Perfilador %s (%s, %s órdenes)", 'encendido' if self.activo else 'apagado', self.modo, self.ordenes)
+        return self.estado()
     
-    payload = {
-        "text": texto_limitado,
-        "model_id": CONFIG["ELEVEN_MODEL"]
-    }
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            capturas = [datos["resumen"] for _, _, datos in sorted(self._capturas, key=lambda c: c[0], reverse=True)]
+        return {
+            "activo": self.activo,
+            "modo": self.modo,
+            "ordenes": self.ordenes,
+            "intervalo": self.intervalo,
+            "capturas": capturas
+        }
     
-    try:
-        logger.info(f"Generando voz para texto de {len(texto_limitado)} caracteres")
-        r = requests.post(
-            CONFIG["ELEVEN_URL"],
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-        
-        if r.status_code == 200:
-            logger.info("Voz generada exitosamente")
-            return r.content
-        else:
-            logger.error(f"Error en ElevenLabs: {r.status_code}")
+    def nuevo_perfil(self) -> Any:
+        """Perfil vacío para una orden nueva (None si el perfilador está apagado)."""
+        if not self.activo:
             return None
-            
-    except Exception as e:
-        logger.error(f"Error al generar voz: {e}")
+        if self.modo == "cprofile":
+            return cProfile.Profile()
+        return {}
+    
+    def entrar(self, traza: Traza) -> bool:
+        """Prende el perfil de la orden en este hilo. Regresa False si no se pudo."""
+        perfil = traza.perfil
+        if perfil is None:
+            return False
+        if isinstance(perfil, dict):
+            self._hilos[threading.get_ident()] = traza
+            return True
+        try:
+            perfil.enable()
+        except ValueError:
+            # Python 3.12+: un solo perfilador activo a la vez en todo el proceso
+            return False
+        return True
+    
+    def salir(self, traza: Traza) -> None:
+        if isinstance(traza.perfil, dict):
+            self._hilos.pop(threading.get_ident(), None)
+        else:
+            traza.perfil.disable()
+    
+    def considerar(self, traza: Traza) -> None:
+        """Guarda el perfil de la orden si está entre las N más lentas."""
+        if traza.perfil is None:
+            return
+        duracion = traza.duracion()
+        with self._lock:
+            if len(self._capturas) >= self.ordenes and duracion <= self._capturas[0][0]:
+                return
+        datos = {"resumen": traza.resumen(), "salida": self._formatear(traza.perfil)}
+        with self._lock:
+            heapq.heappush(self._capturas, (duracion, traza.id, datos))
+            while len(self._capturas) > self.ordenes:
+                heapq.heappop(self._capturas)
+    
+    def obtener(self, id_traza: str) -> Optional[str]:
+        with self._lock:
+            for _, id_captura, datos in self._capturas:
+                if id_captura == id_traza:
+                    return datos["salida"]
         return None
+    
+    def _formatear(self, perfil: Any) -> str:
+        if isinstance(perfil, dict):
+            pilas = sorted(perfil.items(), key=lambda par: par[1], reverse=True)
+            return "".join(f"{pila} {muestras}\n" for pila, muestras in pilas)
+        salida = StringIO()
+        try:
+            pstats.Stats(perfil, stream=salida).sort_stats("cumulative").print_stats(40)
+        except TypeError:
+            return "Sin datos de perfil (la orden no llegó a correr bajo el perfilador)\n"
+        return salida.getvalue()
+    
+    def _muestrear(self) -> None:
+        while self.activo and self.modo == "muestreo":
+            marcos = sys._current_frames()
+            for id_hilo, traza in list(self._hilos.items()):
+                marco = marcos.get(id_hilo)
+                if marco is None or not isinstance(traza.perfil, dict):
+                    continue
+                pila = []
+                while marco is not None:
+                    codigo = marco.f_code
+                    pila.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{marco.f_lineno})")
+                    marco = marco.f_back
+                clave = ";".join(reversed(pila))
+                traza.perfil[clave] = traza.perfil.get(clave, 0) + 1
+            time.sleep(self.intervalo)
+
+# Se prende (PERFILADOR_ACTIVO) en preparar_proceso(): el muestreo es un hilo
+PERFILADOR = Perfilador(
+    False,
+    CONFIG["PERFILADOR_MODO"],
+    CONFIG["PERFILADOR_ORDENES"],
+    CONFIG["PERFILADOR_INTERVALO"]
+)
 
 # =========================================================
-# INFRAESTRUCTURA: WORKER Y WEBHOOK
+# INFRAESTRUCTURA: ALMACENES SQLITE COMPARTIDOS
 # =========================================================
 
-def procesar_orden_cainal(orden: str) -> Dict[str, Any]:
+# La cola, los trabajos, la idempotencia, las salidas, las sesiones y el
+# buzón de callbacks viven en archivos SQLite que comparten los procesos
+# (webhook bajo gunicorn, workers): todos se abren igual y se piden por un
+# singleton perezoso que se suelta tras un fork.
+
+class AlmacenSQLite:
     """
-    Procesa una orden individual según su tipo.
+    Base de los almacenes SQLite: conexión en modo WAL y autocommit (las
+    transacciones son BEGIN explícitos), con busy_timeout para esperar el
+    lock de otro proceso; `_lock` serializa la conexión dentro del proceso.
+    Purga amortizada: _contar_escrituras() llama a _purgar() una vez cada
+    PURGA_CADA escrituras, en lugar de purgar en cada una o con otro hilo.
     """
-    resultado = {
-        "orden": orden,
-        "timestamp": datetime.now().isoformat(),
-        "exitoso": False,
-        "tipo": None,
-        "salida": None,
-        "error": None
-    }
     
-    try:
-        if orden.startswith("IMAGEN:"):
-            resultado["tipo"] = "imagen"
-            descripcion = orden.replace("IMAGEN:", "").strip()
-            path_imagen = generar_imagen_cainal(descripcion)
-            
-            if path_imagen and not path_imagen.startswith("⚠️"):
-                resultado["exitoso"] = True
-                resultado["salida"] = path_imagen
-                logger.info(f"Imagen generada: {path_imagen}")
-            else:
-                resultado["error"] = path_imagen
-                logger.error(f"Error al generar imagen: {path_imagen}")
+    PURGA_CADA = 0
+    
+    def __init__(self, ruta: str):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self._db = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._lock = threading.Lock()
+        self._escrituras = 0
+    
+    def _columnas(self, tabla: str) -> set:
+        """Columnas de `tabla` (para migrar archivos de versiones anteriores)."""
+        return {fila[1] for fila in self._db.execute(f"PRAGMA table_info({tabla})")}
+    
+    def _contar_escrituras(self, ahora: float, cantidad: int = 1) -> None:
+        """Cuenta escrituras y purga al cruzar cada múltiplo de PURGA_CADA (con `_lock` tomado)."""
+        antes = self._escrituras
+        self._escrituras += cantidad
+        if self.PURGA_CADA and antes // self.PURGA_CADA != self._escrituras // self.PURGA_CADA:
+            self._purgar(ahora)
+    
+    def purgar(self) -> int:
+        """Purga completa ahora; regresa cuántos registros se borraron."""
+        with self._lock:
+            return self._purgar(time.time())
+    
+    def _purgar(self, ahora: float) -> int:
+        return 0
+
+class Perezoso:
+    """
+    Singleton de proceso que se abre con `fabrica()` la primera vez que se
+    pide. reiniciar() lo suelta (hijo de un fork, pruebas): la siguiente
+    llamada abre uno nuevo con la configuración de ese momento.
+    """
+    
+    def __init__(self, fabrica: Callable[[], Any]):
+        self._fabrica = fabrica
+        self._valor: Any = None
+        self._lock = threading.Lock()
+    
+    def __call__(self) -> Any:
+        with self._lock:
+            if self._valor is None:
+                self._valor = self._fabrica()
+            return self._valor
+    
+    @property
+    def abierto(self) -> Any:
+        """El valor si ya se abrió, o None (sin abrirlo)."""
+        return self._valor
+    
+    def reiniciar(self) -> None:
+        # Tras un fork el lock pudo quedar tomado por un hilo que ya no existe
+        self._lock = threading.Lock()
+        self._valor = None
+
+# =========================================================
+# INFRAESTRUCTURA: COLA DURABLE DE ÓRDENES (SQLITE)
+# =========================================================
+
+# Clases de prioridad: el número menor sale primero de la cola y de las
+# compuertas de los proveedores.
+PRIORIDAD_PORTAL = 0
+PRIORIDAD_CLIENTE = 1
+PRIORIDAD_BULK = 2
+
+class ColaDurable(AlmacenSQLite):
+    """
+    Cola persistente de órdenes en SQLite (modo WAL).
+    
+    - Las escrituras concurrentes se agrupan: un hilo hace commit de todo lo
+      pendiente en una sola transacción y los demás esperan ese commit.
+    - reclamar() esconde la orden durante el timeout de visibilidad y le da
+      un token de reclamo; extender() renueva ese plazo mientras la orden
+      sigue en proceso y confirmar() la borra. Los tres exigen el token: si
+      la visibilidad venció y otro la reclamó, el dueño anterior ya no la
+      toca. Si el proceso muere a medias, la orden vuelve a ser visible y se
+      re-ejecuta.
+    - Dentro de un carril sale primero la prioridad más alta y, entre
+      iguales, la más antigua.
+    - Las órdenes de una misma sesión salen de una en una y en el orden en
+      que llegaron (aunque estén en carriles distintos): la siguiente no se
+      reclama hasta que la anterior se confirma, así dos turnos no leen el
+      mismo historial.
+    - Varios procesos pueden compartir el archivo (webhook bajo gunicorn,
+      varios workers): los carriles ven lo que encola otro proceso en
+      `sondeo` segundos y cada orden reclamada lleva el pid de su dueño.
+    """
+    
+    def __init__(self, ruta: str, visibilidad: float, sondeo: float = 0.05):
+        super().__init__(ruta)
+        self.visibilidad = visibilidad
+        self.sondeo = sondeo
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ordenes ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "carril TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "visible_desde REAL NOT NULL, "
+            "intentos INTEGER NOT NULL DEFAULT 0, "
+            "encolado REAL NOT NULL, "
+            "prioridad INTEGER NOT NULL DEFAULT 2)"
+        )
+        # Migración: colas creadas antes de las clases de prioridad
+        columnas = self._columnas("ordenes")
+        if "prioridad" not in columnas:
+            self._db.execute(f"ALTER TABLE ordenes ADD COLUMN prioridad INTEGER NOT NULL DEFAULT {PRIORIDAD_BULK}")
+        # Migración: colas creadas antes de compartirse entre procesos
+        if "dueno" not in columnas:
+            self._db.execute("ALTER TABLE ordenes ADD COLUMN dueno INTEGER")
+        # Migración: colas creadas antes de los tokens de reclamo
+        if "reclamo" not in columnas:
+            self._db.execute("ALTER TABLE ordenes ADD COLUMN reclamo TEXT")
+        # Migración: colas creadas antes de serializar las sesiones
+        if "sesion" not in columnas:
+            self._db.execute("ALTER TABLE ordenes ADD COLUMN sesion TEXT")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ordenes_sesion ON ordenes(sesion, id) WHERE sesion IS NOT NULL"
+        )
+        self._db.execute("DROP INDEX IF EXISTS idx_ordenes_carril")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ordenes_prioridad ON ordenes(carril, prioridad, id, visible_desde)"
+        )
+        # Acks por segundo de todos los procesos: el webhook (que no confirma)
+        # estima el Retry-After con lo que drenan los workers
+        self._db.execute("CREATE TABLE IF NOT EXISTS acks (segundo INTEGER PRIMARY KEY, total INTEGER NOT NULL)")
+        
+        # Commit agrupado
+        self._grupo = threading.Condition()
+        self._pendientes: List[Tuple[List[Tuple[str, Dict[str, Any], int]], Dict[str, Any]]] = []
+        self._escribiendo = False
+        
+        # Aviso a los despachadores de este proceso (los de otros procesos
+        # se enteran por PRAGMA data_version)
+        self._hay_trabajo = threading.Condition()
+        
+        # Conteo reciente de pendientes (control de admisión) y último ritmo de drenado leído
+        self._conteo_lock = threading.Lock()
+        self._conteo = (0.0, 0)
+        self._conteo_extra = 0
+        self._ritmo = (0.0, 0.0)
+    
+    def encolar(self, carril: str, payload: Dict[str, Any], prioridad: int = PRIORIDAD_BULK) -> int:
+        """Encola una orden y regresa su id (ya persistida al regresar)."""
+        return self.encolar_lote([(carril, payload, prioridad)])[0]
+    
+    def encolar_lote(self, ordenes: List[Tuple[str, Dict[str, Any], int]]) -> List[int]:
+        """
+        Encola varias órdenes (carril, payload, prioridad) de forma atómica y
+        regresa sus ids. Las llamadas simultáneas comparten una sola transacción.
+        """
+        turno: Dict[str, Any] = {"ids": None, "error": None}
+        with self._grupo:
+            self._pendientes.append((ordenes, turno))
+            while turno["ids"] is None and turno["error"] is None:
+                if self._escribiendo:
+                    self._grupo.wait()
+                    continue
+                self._escribiendo = True
+                grupo, self._pendientes = self._pendientes, []
+                self._grupo.release()
+                try:
+                    self._escribir_grupo(grupo)
+                finally:
+                    self._grupo.acquire()
+                    self._escribiendo = False
+                    self._grupo.notify_all()
+        if turno["error"] is not None:
+            raise turno["error"]
+        with self._conteo_lock:
+            self._conteo_extra += len(ordenes)
+        with self._hay_trabajo:
+            self._hay_trabajo.notify_all()
+        return turno["ids"]
+    
+    def _escribir_grupo(self, grupo: List[Tuple[List[Tuple[str, Dict[str, Any], int]], Dict[str, Any]]]) -> None:
+        ahora = time.time()
+        with self._lock:
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                asignados = []
+                for ordenes, turno in grupo:
+                    ids = []
+                    for carril, payload, prioridad in ordenes:
+                        cursor = self._db.execute(
+                            "INSERT INTO ordenes (carril, payload, visible_desde, encolado, prioridad, sesion) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (carril, json.dumps(payload, ensure_ascii=False), ahora, ahora, prioridad,
+                             payload.get("sesion"))
+                        )
+                        ids.append(cursor.lastrowid)
+                    asignados.append((turno, ids))
+                self._db.execute("COMMIT")
+            except Exception as e:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                for _, turno in grupo:
+                    turno["error"] = e
+                return
+        for turno, ids in asignados:
+            turno["ids"] = ids
+    
+    def reclamar(self, carril: str, espera: float = 1.0) -> Optional[Dict[str, Any]]:
+        """
+        Toma la orden visible de mayor prioridad (y más antigua) del carril y
+        la esconde durante el timeout de visibilidad. Espera hasta `espera`
+        segundos si no hay nada.
+        """
+        limite = time.monotonic() + espera
+        while True:
+            version = self._version()
+            orden = self._reclamar_una(carril)
+            if orden is not None:
+                return orden
+            # Reintentar con un aviso de este proceso o un commit de otro
+            while True:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return None
+                with self._hay_trabajo:
+                    if self._hay_trabajo.wait(min(restante, self.sondeo)):
+                        break
+                if self._version() != version:
+                    break
+    
+    def _version(self) -> int:
+        """Cambia cuando otra conexión (otro proceso) hace commit en el archivo."""
+        with self._lock:
+            return self._db.execute("PRAGMA data_version").fetchone()[0]
+    
+    def _reclamar_una(self, carril: str) -> Optional[Dict[str, Any]]:
+        ahora = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Una orden de sesión espera a que salgan las anteriores de esa sesión
+                fila = self._db.execute(
+                    "SELECT id, payload, intentos, encolado, prioridad, visible_desde FROM ordenes AS o "
+                    "WHERE carril = ? AND visible_desde <= ? AND (sesion IS NULL OR NOT EXISTS ("
+                    "SELECT 1 FROM ordenes AS previa WHERE previa.sesion = o.sesion AND previa.id < o.id)) "
+                    "ORDER BY prioridad, id LIMIT 1",
+                    (carril, ahora)
+                ).fetchone()
+                if fila:
+                    reclamo = uuid.uuid4().hex
+                    self._db.execute(
+                        "UPDATE ordenes SET visible_desde = ?, intentos = intentos + 1, dueno = ?, reclamo = ? "
+                        "WHERE id = ?",
+                        (ahora + self.visibilidad, os.getpid(), reclamo, fila[0])
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+        if not fila:
+            return None
+        with self._conteo_lock:
+            self._conteo_extra -= 1
+        orden = json.loads(fila[1])
+        orden.update({
+            "id": fila[0], "intentos": fila[2] + 1, "encolado": fila[3], "prioridad": fila[4],
+            "espera": max(0.0, ahora - fila[5]), "reclamo": reclamo
+        })
+        return orden
+    
+    def extender(self, id_orden: int, reclamo: str) -> bool:
+        """
+        Renueva el timeout de visibilidad de una orden que sigue en proceso.
+        Regresa False si la orden ya no es de este reclamo (venció y la tomó
+        otro, o ya se confirmó o movió).
+        """
+        with self._lock:
+            return self._db.execute(
+                "UPDATE ordenes SET visible_desde = ? WHERE id = ? AND reclamo = ?",
+                (time.time() + self.visibilidad, id_orden, reclamo)
+            ).rowcount > 0
+    
+    def confirmar(self, id_orden: int, reclamo: str) -> bool:
+        """
+        Ack: la orden terminó y sale de la cola. Regresa False (sin borrar
+        nada) si la orden ya no es de este reclamo.
+        """
+        segundo = int(time.time())
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                fila = self._db.execute(
+                    "SELECT sesion FROM ordenes WHERE id = ? AND reclamo = ?", (id_orden, reclamo)
+                ).fetchone()
+                borradas = self._db.execute(
+                    "DELETE FROM ordenes WHERE id = ? AND reclamo = ?", (id_orden, reclamo)
+                ).rowcount
+                if borradas:
+                    self._db.execute(
+                        "INSERT INTO acks (segundo, total) VALUES (?, 1) "
+                        "ON CONFLICT(segundo) DO UPDATE SET total = total + 1",
+                        (segundo,)
+                    )
+                    # Una vez por minuto se tiran los acks de hace 10 min
+                    if segundo % 60 == 0:
+                        self._db.execute("DELETE FROM acks WHERE segundo < ?", (segundo - 600,))
+                self._db.execute("COMMIT")
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+        if borradas and fila[0]:
+            # La siguiente orden de la sesión ya se puede reclamar
+            with self._hay_trabajo:
+                self._hay_trabajo.notify_all()
+        return borradas > 0
+    
+    def ritmo_drenado(self, ventana: float = 60.0, max_edad: float = 1.0) -> float:
+        """
+        Órdenes confirmadas por segundo durante la última ventana, sumando
+        los acks de todos los procesos que comparten la cola. Reutiliza la
+        lectura anterior si tiene menos de `max_edad` segundos.
+        """
+        with self._conteo_lock:
+            instante, ritmo = self._ritmo
+            if time.monotonic() - instante <= max_edad:
+                return ritmo
+        ahora = time.time()
+        with self._lock:
+            recientes, primero = self._db.execute(
+                "SELECT COALESCE(SUM(CASE WHEN segundo > ? THEN total ELSE 0 END), 0), MIN(segundo) FROM acks",
+                (ahora - ventana,)
+            ).fetchone()
+        # Con menos historia que la ventana se divide entre lo que hay
+        ritmo = recientes / max(1.0, min(ventana, ahora - primero)) if primero is not None else 0.0
+        with self._conteo_lock:
+            self._ritmo = (time.monotonic(), ritmo)
+        return ritmo
+    
+    def mover(self, id_orden: int, carril: str, payload: Dict[str, Any], reclamo: str) -> bool:
+        """
+        Pasa una orden reclamada a otro carril en un solo paso (sin ack
+        intermedio). Regresa False si la orden ya no es de este reclamo.
+        """
+        with self._lock:
+            movidas = self._db.execute(
+                "UPDATE ordenes SET carril = ?, payload = ?, visible_desde = ?, intentos = 0, reclamo = NULL "
+                "WHERE id = ? AND reclamo = ?",
+                (carril, json.dumps(payload, ensure_ascii=False), time.time(), id_orden, reclamo)
+            ).rowcount
+        if movidas:
+            with self._hay_trabajo:
+                self._hay_trabajo.notify_all()
+        return movidas > 0
+    
+    def recuperar(self) -> int:
+        """
+        Al arrancar: vuelve visibles las órdenes que estaban en proceso
+        cuando el sistema se cayó. Regresa cuántas se recuperaron.
+        Las que tiene en proceso otro worker vivo (mismo host, otro pid) no
+        se tocan; esas vuelven solas si ese worker muere a medias.
+        """
+        ahora = time.time()
+        with self._lock:
+            duenos = [fila[0] for fila in self._db.execute(
+                "SELECT DISTINCT dueno FROM ordenes WHERE visible_desde > ? AND dueno IS NOT NULL", (ahora,)
+            )]
+            muertos = [d for d in duenos if d == os.getpid() or not _proceso_vivo(d)]
+            marcas = ",".join("?" * len(muertos)) or "NULL"
+            cursor = self._db.execute(
+                f"UPDATE ordenes SET visible_desde = ? WHERE visible_desde > ? "
+                f"AND (dueno IS NULL OR dueno IN ({marcas}))",
+                (ahora, ahora, *muertos)
+            )
+        return cursor.rowcount
+    
+    def profundidad(self) -> Dict[str, int]:
+        """Órdenes visibles (esperando) por carril."""
+        with self._lock:
+            filas = self._db.execute(
+                "SELECT carril, COUNT(*) FROM ordenes WHERE visible_desde <= ? GROUP BY carril",
+                (time.time(),)
+            ).fetchall()
+        return dict(filas)
+    
+    def pendientes(self, max_edad: float = 0.25) -> int:
+        """
+        Total de órdenes esperando, para el control de admisión. Reutiliza un
+        conteo de hasta `max_edad` segundos más lo encolado desde entonces.
+        """
+        with self._conteo_lock:
+            instante, total = self._conteo
+            if time.monotonic() - instante <= max_edad:
+                return total + self._conteo_extra
+        total = sum(self.profundidad().values())
+        with self._conteo_lock:
+            self._conteo = (time.monotonic(), total)
+            self._conteo_extra = 0
+        return total
+
+def _proceso_vivo(pid: int) -> bool:
+    """¿Sigue corriendo el proceso `pid` en este host?"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+_COLA = Perezoso(lambda: ColaDurable(
+    CONFIG["COLA_DB"], visibilidad=CONFIG["COLA_VISIBILIDAD"], sondeo=CONFIG["COLA_SONDEO"]
+))
+
+def obtener_cola() -> ColaDurable:
+    """Regresa la cola durable de órdenes, abriéndola la primera vez."""
+    return _COLA()
+
+# =========================================================
+# INFRAESTRUCTURA: ALMACÉN DE RESULTADOS DE TRABAJOS
+# =========================================================
+
+class AlmacenTrabajos(AlmacenSQLite):
+    """
+    Resultados de las órdenes del webhook, indexados en SQLite.
+    Consulta por id y listado paginado por cursor (ambos sobre índices);
+    los trabajos terminados se purgan al pasar la retención. Cada trabajo
+    guarda el hash del X-Client-Id que lo mandó y el listado es por cliente.
+    """
+    
+    PURGA_CADA = 200
+    
+    def __init__(self, ruta: str, retencion: float):
+        super().__init__(ruta)
+        self.retencion = retencion
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS trabajos ("
+            "id TEXT PRIMARY KEY, "
+            "estado TEXT NOT NULL, "
+            "tipo TEXT, "
+            "orden TEXT NOT NULL, "
+            "salida TEXT, "
+            "error TEXT, "
+            "creado REAL NOT NULL, "
+            "iniciado REAL, "
+            "terminado REAL)"
+        )
+        # Migración: almacenes creados antes de listar por cliente
+        columnas = self._columnas("trabajos")
+        if "cliente" not in columnas:
+            self._db.execute("ALTER TABLE trabajos ADD COLUMN cliente TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_terminado ON trabajos(terminado)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos(estado)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_cliente ON trabajos(cliente, estado)")
+    
+    def crear(self, id_trabajo: str, tipo: str, orden: str, cliente: Optional[str] = None) -> None:
+        """Registra un trabajo recién encolado."""
+        self.crear_lote([(id_trabajo, tipo, orden)], cliente)
+    
+    def crear_lote(self, trabajos: List[Tuple[str, str, str]], cliente: Optional[str] = None) -> None:
+        """Registra varios trabajos del mismo `cliente` (X-Client-Id) en una sola transacción."""
+        ahora = time.time()
+        huella = huella_cliente(cliente)
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO trabajos (id, estado, tipo, orden, creado, cliente) VALUES (?, 'en_cola', ?, ?, ?, ?)",
+                    [(id_trabajo, tipo, orden, ahora, huella) for id_trabajo, tipo, orden in trabajos]
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+    
+    def descartar_lote(self, ids: List[str]) -> None:
+        """
+        Borra trabajos registrados cuyas órdenes no llegaron a la cola (el
+        cliente recibió un error y no conoce esos ids). Solo toca los que
+        siguen 'en_cola'.
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "DELETE FROM trabajos WHERE id = ? AND estado = 'en_cola'", [(id_trabajo,) for id_trabajo in ids]
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+    
+    def iniciar(self, id_trabajo: str) -> None:
+        """Marca el trabajo en proceso (conserva la hora del primer intento)."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE trabajos SET estado = 'procesando', iniciado = COALESCE(iniciado, ?) WHERE id = ?",
+                (time.time(), id_trabajo)
+            )
+    
+    def cerrar(self, id_trabajo: str, resultado: Dict[str, Any]) -> None:
+        """Guarda el resultado final del trabajo."""
+        ahora = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE trabajos SET estado = ?, tipo = ?, salida = ?, error = ?, terminado = ? WHERE id = ?",
+                (
+                    "completado" if resultado["exitoso"] else "fallido",
+                    resultado.get("tipo"),
+                    json.dumps(resultado.get("salida"), ensure_ascii=False),
+                    resultado.get("error"),
+                    ahora,
+                    id_trabajo
+                )
+            )
+            self._contar_escrituras(ahora)
+    
+    def obtener(self, id_trabajo: str) -> Optional[Dict[str, Any]]:
+        """Trabajo por id, o None si no existe (o ya se purgó)."""
+        with self._lock:
+            fila = self._db.execute(
+                "SELECT rowid, * FROM trabajos WHERE id = ?", (id_trabajo,)
+            ).fetchone()
+        return self._a_dict(fila) if fila else None
+    
+    def listar(self, limite: int = 50, cursor: Optional[int] = None, estado: Optional[str] = None,
+               cliente: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        Trabajos del más nuevo al más viejo (solo los de `cliente` si se da).
+        Regresa la página y el cursor de la siguiente (None si ya no hay más).
+        """
+        condiciones, parametros = [], []
+        if cliente is not None:
+            condiciones.append("cliente = ?")
+            parametros.append(huella_cliente(cliente))
+        if cursor is not None:
+            condiciones.append("rowid < ?")
+            parametros.append(cursor)
+        if estado:
+            condiciones.append("estado = ?")
+            parametros.append(estado)
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        with self._lock:
+            filas = self._db.execute(
+                f"SELECT rowid, * FROM trabajos {where} ORDER BY rowid DESC LIMIT ?",
+                (*parametros, limite + 1)
+            ).fetchall()
+        siguiente = filas[limite - 1][0] if len(filas) > limite else None
+        return [self._a_dict(fila) for fila in filas[:limite]], siguiente
+    
+    def _purgar(self, ahora: float) -> int:
+        # Los trabajos terminados fuera de la retención
+        cursor = self._db.execute(
+            "DELETE FROM trabajos WHERE terminado IS NOT NULL AND terminado < ?",
+            (ahora - self.retencion,)
+        )
+        return cursor.rowcount
+    
+    @staticmethod
+    def _a_dict(fila: Tuple[Any, ...]) -> Dict[str, Any]:
+        _, id_trabajo, estado, tipo, orden, salida, error, creado, iniciado, terminado, _ = fila
+        return {
+            "id": id_trabajo,
+            "estado": estado,
+            "tipo": tipo,
+            "orden": orden,
+            "salida": json.loads(salida) if salida else None,
+            "error": error,
+            "creado": datetime.fromtimestamp(creado).isoformat(),
+            "tiempos": {
+                "espera": round(iniciado - creado, 3) if iniciado else None,
+                "proceso": round(terminado - iniciado, 3) if iniciado and terminado else None,
+                "total": round(terminado - creado, 3) if terminado else None
+            }
+        }
+
+def huella_cliente(cliente: Optional[str]) -> Optional[str]:
+    """
+    Hash del X-Client-Id con que se guarda un trabajo (los ids de los
+    clientes prioritarios son secretos; en disco solo queda el hash).
+    """
+    if not cliente:
+        return None
+    return hashlib.sha256(cliente.encode("utf-8")).hexdigest()
+
+_TRABAJOS = Perezoso(lambda: AlmacenTrabajos(CONFIG["TRABAJOS_DB"], retencion=CONFIG["TRABAJOS_RETENCION"]))
+
+def obtener_trabajos() -> AlmacenTrabajos:
+    """Regresa el almacén de trabajos, abriéndolo la primera vez."""
+    return _TRABAJOS()
+
+# =========================================================
+# INFRAESTRUCTURA: IDEMPOTENCIA DEL WEBHOOK
+# =========================================================
+
+# Los reintentos de un cliente (o un emisor "al menos una vez") mandan la
+# misma orden dos veces. Cada orden del webhook reserva una clave: la del
+# header Idempotency-Key (IDEMPOTENCIA_TTL) o, si no manda y el operador lo
+# activó, el hash del payload (IDEMPOTENCIA_DERIVADA_TTL; solo clientes con
+# X-Client-Id y órdenes sin session_id). Mientras la clave viva, un duplicado
+# regresa el trabajo que ya existe en lugar de encolar otra llamada a
+# SambaNova o REVE. Las claves vencidas se purgan solas.
+
+class AlmacenIdempotencia(AlmacenSQLite):
+    """
+    Claves de idempotencia en SQLite (compartidas por los procesos del
+    webhook). La reserva es atómica: de dos peticiones iguales al mismo
+    tiempo solo una encola, la otra ve la clave en curso.
+    """
+    
+    PURGA_CADA = 200
+    
+    def __init__(self, ruta: str):
+        super().__init__(ruta)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS claves ("
+            "clave TEXT PRIMARY KEY, "
+            "huella TEXT NOT NULL, "
+            "job_id TEXT, "
+            "tipo TEXT, "
+            "trace_id TEXT, "
+            "creado REAL NOT NULL, "
+            "expira REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_claves_expira ON claves(expira)")
+    
+    def reservar(self, clave: str, huella: str, ttl: float) -> Optional[Dict[str, Any]]:
+        """
+        Aparta la clave por `ttl` segundos. Regresa None si quedó apartada
+        para esta petición, o la reserva viva que ya existía (job_id None
+        mientras la otra petición sigue encolando). Una reserva que lleva
+        más de IDEMPOTENCIA_RESERVA sin trabajo se da por abandonada.
+        """
+        ahora = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                fila = self._db.execute(
+                    "SELECT huella, job_id, tipo, trace_id, creado FROM claves "
+                    "WHERE clave = ? AND expira > ? AND (job_id IS NOT NULL OR creado > ?)",
+                    (clave, ahora, ahora - CONFIG["IDEMPOTENCIA_RESERVA"])
+                ).fetchone()
+                if fila is None:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO claves (clave, huella, creado, expira) VALUES (?, ?, ?, ?)",
+                        (clave, huella, ahora, ahora + ttl)
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+            if fila is None:
+                self._contar_escrituras(ahora)
+                return None
+        huella_previa, id_trabajo, tipo, traza, creado = fila
+        return {"huella": huella_previa, "job_id": id_trabajo, "tipo": tipo, "trace_id": traza, "creado": creado}
+    
+    def asignar(self, clave: str, id_trabajo: str, tipo: str, id_traza: str) -> None:
+        """Liga la clave reservada con el trabajo que se encoló."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE claves SET job_id = ?, tipo = ?, trace_id = ? WHERE clave = ?",
+                (id_trabajo, tipo, id_traza, clave)
+            )
+    
+    def liberar(self, clave: str) -> None:
+        """Suelta una reserva cuya orden no se pudo encolar (el cliente puede reintentar)."""
+        with self._lock:
+            self._db.execute("DELETE FROM claves WHERE clave = ? AND job_id IS NULL", (clave,))
+    
+    def _purgar(self, ahora: float) -> int:
+        # Las claves vencidas
+        return self._db.execute("DELETE FROM claves WHERE expira <= ?", (ahora,)).rowcount
+    
+    def estadisticas(self) -> Dict[str, int]:
+        """Claves guardadas (vivas y vencidas aún sin purgar)."""
+        with self._lock:
+            return {"claves": self._db.execute("SELECT COUNT(*) FROM claves").fetchone()[0]}
+
+_IDEMPOTENCIA = Perezoso(lambda: AlmacenIdempotencia(CONFIG["IDEMPOTENCIA_DB"]))
+
+def obtener_idempotencia() -> AlmacenIdempotencia:
+    """Regresa el almacén de claves de idempotencia, abriéndolo la primera vez."""
+    return _IDEMPOTENCIA()
+
+# =========================================================
+# INFRAESTRUCTURA: ALMACÉN DE SALIDAS (IMÁGENES FIRMADAS)
+# =========================================================
+
+# Nombres únicos y repartidos en subdirectorios para que ningún directorio
+# crezca sin límite:
+#   OUTPUT_DIR/AAAA/MM/DD/<id[:2]>/cainal_<id>.png   (salidas nuevas)
+#   OUTPUT_DIR/cache/<clave[:2]>/<clave>.png           (cache por payload)
+# El índice SQLite guarda prompt, tamaño y tiempos: la galería del portal
+# pagina sobre él sin listar el disco.
+
+def ruta_salida(id_salida: Optional[str] = None, instante: Optional[float] = None) -> str:
+    """Ruta nueva (o la de `id_salida`) repartida por fecha y hash."""
+    id_salida = id_salida or uuid.uuid4().hex
+    fecha = datetime.fromtimestamp(instante if instante is not None else time.time())
+    return os.path.join(
+        CONFIG["OUTPUT_DIR"], f"{fecha:%Y}", f"{fecha:%m}", f"{fecha:%d}", id_salida[:2],
+        f"cainal_{id_salida}{extension_firma()}"
+    )
+
+class AlmacenSalidas(AlmacenSQLite):
+    """
+    Índice de las imágenes firmadas en SQLite, con desalojo por edad
+    (SALIDAS_RETENCION) y por tamaño total (SALIDAS_MAX_BYTES, las menos
+    usadas primero). La purga es amortizada: una pasada cada 50 registros.
+    """
+    
+    PURGA_CADA = 50
+    
+    def __init__(self, ruta: str, raiz: str, max_bytes: int, retencion: float):
+        super().__init__(ruta)
+        self.raiz = raiz
+        self.max_bytes = max_bytes
+        self.retencion = retencion
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS salidas ("
+            "id TEXT PRIMARY KEY, "
+            "ruta TEXT NOT NULL, "
+            "clave TEXT, "
+            "prompt TEXT, "
+            "bytes INTEGER NOT NULL, "
+            "creado REAL NOT NULL, "
+            "usado REAL NOT NULL, "
+            "firma REAL, "
+            "total REAL, "
+            "trace_id TEXT, "
+            "job_id TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_salidas_creado ON salidas(creado)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_salidas_usado ON salidas(usado)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_salidas_ruta ON salidas(ruta)")
+        self._migrar_plano()
+    
+    def registrar(self, ruta: str, prompt: str, clave: Optional[str] = None,
+                  firma: Optional[float] = None, total: Optional[float] = None,
+                  trace_id: Optional[str] = None, job_id: Optional[str] = None) -> None:
+        """Indexa una imagen recién firmada (una re-firma del mismo cache la reemplaza)."""
+        ahora = time.time()
+        id_salida = os.path.splitext(os.path.basename(ruta))[0].removeprefix("cainal_")
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO salidas "
+                "(id, ruta, clave, prompt, bytes, creado, usado, firma, total, trace_id, job_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (id_salida, ruta, clave, prompt, os.path.getsize(ruta), ahora, ahora,
+                 firma, total, trace_id, job_id)
+            )
+            self._contar_escrituras(ahora)
+    
+    def tocar(self, ruta: str) -> None:
+        """Un acierto del cache: la imagen pasa al final de la fila de desalojo."""
+        with self._lock:
+            self._db.execute("UPDATE salidas SET usado = ? WHERE ruta = ?", (time.time(), ruta))
+    
+    def listar(self, limite: int = 12, cursor: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        Salidas de la más nueva a la más vieja. Regresa la página y el cursor
+        de la siguiente (None si ya no hay más).
+        """
+        where, parametros = ("WHERE rowid < ?", (cursor,)) if cursor is not None else ("", ())
+        with self._lock:
+            filas = self._db.execute(
+                f"SELECT rowid, id, ruta, clave, prompt, bytes, creado, firma, total, trace_id, job_id "
+                f"FROM salidas {where} ORDER BY rowid DESC LIMIT ?",
+                (*parametros, limite + 1)
+            ).fetchall()
+        siguiente = filas[limite - 1][0] if len(filas) > limite else None
+        return [self._a_dict(fila) for fila in filas[:limite]], siguiente
+    
+    def estadisticas(self) -> Dict[str, int]:
+        with self._lock:
+            archivos, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM salidas").fetchone()
+        return {"archivos": archivos, "bytes": total}
+    
+    def _purgar(self, ahora: float) -> int:
+        # Desalojo por edad y por tamaño
+        victimas = []
+        if self.retencion > 0:
+            victimas += self._db.execute(
+                "SELECT id, ruta, bytes FROM salidas WHERE usado < ?", (ahora - self.retencion,)
+            ).fetchall()
+        if self.max_bytes > 0:
+            total = self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM salidas").fetchone()[0]
+            total -= sum(fila[2] for fila in victimas)
+            if total > self.max_bytes:
+                # Bajar al 90% del tope para no purgar en cada registro
+                ya = {fila[0] for fila in victimas}
+                for fila in self._db.execute("SELECT id, ruta, bytes FROM salidas ORDER BY usado"):
+                    if total <= self.max_bytes * 0.9:
+                        break
+                    if fila[0] not in ya:
+                        victimas.append(fila)
+                        total -= fila[2]
+        for _, ruta, _ in victimas:
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+        if victimas:
+            self._db.execute("BEGIN")
+            self._db.executemany("DELETE FROM salidas WHERE id = ?", [(fila[0],) for fila in victimas])
+            self._db.execute("COMMIT")
+        return len(victimas)
+    
+    def _migrar_plano(self) -> None:
+        """
+        Una sola vez, con el índice vacío: indexa las salidas del esquema
+        plano anterior (cainal_<ts>.png en OUTPUT_DIR) y reparte el cache
+        plano (cache/<clave>.png) en sus subdirectorios.
+        """
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM salidas LIMIT 1").fetchone() or not os.path.isdir(self.raiz):
+                return
+            filas = []
+            planos = [(entrada, None) for entrada in os.scandir(self.raiz)]
+            directorio_cache = os.path.join(self.raiz, "cache")
+            if os.path.isdir(directorio_cache):
+                planos += [(entrada, directorio_cache) for entrada in os.scandir(directorio_cache)]
+            for entrada, cache in planos:
+                nombre, extension = os.path.splitext(entrada.name)
+                if not entrada.is_file() or extension not in EXTENSIONES_FIRMA.values():
+                    continue
+                ruta, info = entrada.path, entrada.stat()
+                if cache:
+                    ruta = ruta_cache_imagen(nombre, extension)
+                    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                    try:
+                        os.replace(entrada.path, ruta)
+                    except FileNotFoundError:
+                        # Otro proceso lo migró primero
+                        continue
+                filas.append((nombre.removeprefix("cainal_"), ruta, nombre if cache else None,
+                              info.st_size, info.st_mtime, info.st_mtime))
+            if filas:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO salidas (id, ruta, clave, bytes, creado, usado) VALUES (?, ?, ?, ?, ?, ?)",
+                    filas
+                )
+                self._db.execute("COMMIT")
+                logger.warning("🗂️ %s imágenes del esquema plano indexadas en el almacén de salidas", len(filas))
+    
+    @staticmethod
+    def _a_dict(fila: Tuple[Any, ...]) -> Dict[str, Any]:
+        cursor, id_salida, ruta, clave, prompt, tamano, creado, firma, total, trace_id, job_id = fila
+        return {
+            "id": id_salida,
+            "ruta": ruta,
+            "cache": clave is not None,
+            "prompt": prompt,
+            "bytes": tamano,
+            "creado": datetime.fromtimestamp(creado).isoformat(),
+            "tiempos": {"firma": firma, "total": total},
+            "trace_id": trace_id,
+            "job_id": job_id,
+        }
+
+_SALIDAS = Perezoso(lambda: AlmacenSalidas(
+    CONFIG["SALIDAS_DB"],
+    raiz=CONFIG["OUTPUT_DIR"],
+    max_bytes=CONFIG["SALIDAS_MAX_BYTES"],
+    retencion=CONFIG["SALIDAS_RETENCION"]
+))
+
+def obtener_salidas() -> AlmacenSalidas:
+    """Regresa el almacén de salidas, abriéndolo la primera vez."""
+    return _SALIDAS()
+
+# =========================================================
+# INFRAESTRUCTURA: CARRILES DE ÓRDENES POR MODALIDAD
+# =========================================================
+
+# Cada carril tiene su propia cola y su propio pool de workers, así un
+# render lento de REVE no frena las respuestas rápidas de SambaNova.
+# "texto_con_imagen" recibe la segunda mitad de las órdenes de texto que
+# piden imagen: el worker de texto entrega su parte y se libera.
+CARRILES = {
+    "texto": "WORKERS_TEXTO",
+    "imagen": "WORKERS_IMAGEN",
+    "texto_con_imagen": "WORKERS_TEXTO_IMAGEN",
+}
+
+_ACTIVOS_CARRIL: Dict[str, int] = {carril: 0 for carril in CARRILES}
+_ACTIVOS_LOCK = threading.Lock()
+
+def clasificar_orden(orden: str) -> str:
+    """Carril de entrada de una orden según su prefijo."""
+    return "imagen" if orden.startswith("IMAGEN:") else "texto"
+
+class ColaSaturada(Exception):
+    """La cola rebasó su marca de agua; el cliente debe reintentar en retry_after segundos."""
+    
+    def __init__(self, pendientes: int, retry_after: int):
+        super().__init__(f"Cola saturada ({pendientes} órdenes pendientes)")
+        self.pendientes = pendientes
+        self.retry_after = retry_after
+
+def admitir_ordenes(cantidad: int, prioridad: int = PRIORIDAD_BULK) -> None:
+    """
+    Control de admisión: lanza ColaSaturada si encolar `cantidad` órdenes deja
+    la cola arriba de COLA_MAX_PENDIENTES. El tráfico prioritario tiene
+    COLA_RESERVA_PRIORIDAD lugares extra para no quedarse afuera en una ráfaga.
+    """
+    limite = CONFIG["COLA_MAX_PENDIENTES"]
+    if limite <= 0:
+        return
+    if prioridad < PRIORIDAD_BULK:
+        limite += CONFIG["COLA_RESERVA_PRIORIDAD"]
+    
+    pendientes = obtener_cola().pendientes()
+    if pendientes + cantidad > limite:
+        raise ColaSaturada(pendientes, estimar_retry_after(pendientes + cantidad - limite))
+
+def estimar_retry_after(exceso: int) -> int:
+    """Segundos para que se desalojen `exceso` órdenes al ritmo de drenado observado."""
+    ritmo = obtener_cola().ritmo_drenado()
+    if ritmo <= 0:
+        return CONFIG["COLA_RETRY_AFTER_MAX"]
+    return min(max(1, math.ceil(exceso / ritmo)), CONFIG["COLA_RETRY_AFTER_MAX"])
+
+def encolar_orden(orden: str, usar_cache: bool = True, prioridad: int = PRIORIDAD_BULK,
+                  id_traza: Optional[str] = None, sesion: Optional[str] = None,
+                  callback: Optional[Dict[str, Any]] = None, cliente: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Registra el trabajo y encola la orden en su carril.
+    Regresa el nombre del carril y el id del trabajo.
+    """
+    return encolar_ordenes([(orden, usar_cache)], prioridad, id_traza, sesion, callback, cliente)[0]
+
+def encolar_ordenes(ordenes: List[Tuple[str, bool]], prioridad: int = PRIORIDAD_BULK,
+                    id_traza: Optional[str] = None, sesion: Optional[str] = None,
+                    callback: Optional[Dict[str, Any]] = None,
+                    cliente: Optional[str] = None) -> List[Tuple[str, str]]:
+    """
+    Versión en lote de encolar_orden: todos los trabajos se registran en una
+    transacción y todas las órdenes entran a la cola en otra (todas o ninguna).
+    Lanza ColaSaturada si el lote no cabe bajo la marca de agua.
+    La traza de cada orden es `id_traza` (con sufijo .N en un lote) o su job_id.
+    Con `sesion` las órdenes de texto platican dentro de esa sesión; con
+    `callback` ({"url", "lote"}) el resultado de cada una se manda a esa URL.
+    Los trabajos quedan a nombre de `cliente` (X-Client-Id) para GET /jobs.
+    """
+    admitir_ordenes(len(ordenes), prioridad)
+    
+    trabajos, encoladas = [], []
+    for indice, (orden, usar_cache) in enumerate(ordenes):
+        carril = clasificar_orden(orden)
+        id_trabajo = uuid.uuid4().hex
+        if id_traza:
+            traza = id_traza if len(ordenes) == 1 else f"{id_traza}.{indice}"
+        else:
+            traza = id_trabajo
+        trabajos.append((id_trabajo, carril, orden))
+        payload = {"orden": orden, "cache": usar_cache, "job_id": id_trabajo, "trace_id": traza}
+        if sesion:
+            payload["sesion"] = sesion
+        if callback:
+            payload["callback"] = callback
+        encoladas.append((carril, payload, prioridad))
+    
+    obtener_trabajos().crear_lote(trabajos, cliente)
+    try:
+        obtener_cola().encolar_lote(encoladas)
+    except Exception:
+        # Sin orden en la cola nadie cerraría esos trabajos: se quedarían en_cola para siempre
+        try:
+            obtener_trabajos().descartar_lote([id_trabajo for id_trabajo, _, _ in trabajos])
+        except Exception as e:
+            logger.error("No se pudieron descartar %s trabajos sin orden: %s", len(trabajos), e)
+        raise
+    return [(carril, id_trabajo) for id_trabajo, carril, _ in trabajos]
+
+def profundidad_colas() -> int:
+    """Total de órdenes esperando en todos los carriles."""
+    return sum(obtener_cola().profundidad().values())
+
+def estado_carriles() -> Dict[str, Dict[str, int]]:
+    """Profundidad de cola, workers ocupados y workers totales por carril."""
+    with _ACTIVOS_LOCK:
+        activos = dict(_ACTIVOS_CARRIL)
+    profundidad = obtener_cola().profundidad()
+    return {
+        carril: {
+            "en_cola": profundidad.get(carril, 0),
+            "activos": activos[carril],
+            "workers": CONFIG[clave_workers]
+        }
+        for carril, clave_workers in CARRILES.items()
+    }
+
+# =========================================================
+# INFRAESTRUCTURA: LOOP ASÍNCRONO DEL NÚCLEO
+# =========================================================
+
+# Todas las llamadas a proveedores corren en un solo event loop en segundo
+# plano; Flask, Gradio y los carriles entran a él con ejecutar_async().
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_HILO_LOOP: Optional[threading.Thread] = None
+_LOOP_LOCK = threading.Lock()
+
+def obtener_loop() -> asyncio.AbstractEventLoop:
+    """Regresa el loop del núcleo, arrancándolo la primera vez."""
+    global _LOOP, _HILO_LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            _LOOP.set_task_factory(_fabrica_tareas)
+            _HILO_LOOP = threading.Thread(target=_LOOP.run_forever, name="loop_cainal", daemon=True)
+            _HILO_LOOP.start()
+        return _LOOP
+
+def ejecutar_async(corrutina: Awaitable[Any], prioridad: Optional[int] = None) -> Any:
+    """
+    Corre una corrutina en el loop del núcleo y espera su resultado.
+    Solo para código síncrono; dentro del loop se usa await directo.
+    Con prioridad, las compuertas de los proveedores la atienden con esa clase.
+    """
+    loop = obtener_loop()
+    try:
+        en_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        en_loop = False
+    if en_loop:
+        corrutina.close()
+        raise RuntimeError("ejecutar_async llamado desde el loop del núcleo; usa await")
+    if prioridad is not None:
+        corrutina = _con_prioridad(corrutina, prioridad)
+    return asyncio.run_coroutine_threadsafe(corrutina, loop).result()
+
+async def _con_prioridad(corrutina: Awaitable[Any], prioridad: int) -> Any:
+    """Fija la clase de prioridad de la tarea actual y espera la corrutina."""
+    PRIORIDAD_ACTUAL.set(prioridad)
+    return await corrutina
+
+_FIN_ITERACION = object()
+
+def iterar_async(generador: AsyncIterator[Any], prioridad: Optional[int] = None) -> Iterator[Any]:
+    """
+    Consume un generador asíncrono del núcleo desde código síncrono,
+    entregando cada elemento en cuanto el loop lo produce.
+    """
+    canal: queue.Queue = queue.Queue()
+    
+    async def _bombear():
+        if prioridad is not None:
+            PRIORIDAD_ACTUAL.set(prioridad)
+        try:
+            async for elemento in generador:
+                canal.put(elemento)
+        finally:
+            canal.put(_FIN_ITERACION)
+    
+    futuro = asyncio.run_coroutine_threadsafe(_bombear(), obtener_loop())
+    try:
+        while True:
+            elemento = canal.get()
+            if elemento is _FIN_ITERACION:
+                break
+            yield elemento
+        futuro.result()
+    finally:
+        futuro.cancel()
+
+# =========================================================
+# INFRAESTRUCTURA: COMPUERTAS DE PRIORIDAD POR PROVEEDOR
+# =========================================================
+
+# Clase de prioridad de la tarea en curso; la fijan los carriles (según la
+# orden) y ejecutar_async/iterar_async (portal y streaming del webhook).
+PRIORIDAD_ACTUAL: contextvars.ContextVar[int] = contextvars.ContextVar("prioridad", default=PRIORIDAD_BULK)
+
+class CompuertaPrioridad:
+    """
+    Semáforo asíncrono que, al liberarse un lugar, despierta primero a la
+    prioridad más alta (y entre iguales, a la que lleva más esperando).
+    Solo se usa desde el loop del núcleo.
+    """
+    
+    def __init__(self, capacidad: int):
+        self.capacidad = max(1, capacidad)
+        self._ocupados = 0
+        self._espera: List[Tuple[int, int, asyncio.Future]] = []
+        self._turnos = itertools.count()
+    
+    async def __aenter__(self) -> None:
+        await self.adquirir(PRIORIDAD_ACTUAL.get())
+    
+    async def __aexit__(self, *exc) -> None:
+        self.liberar()
+    
+    async def adquirir(self, prioridad: int) -> None:
+        if self._ocupados < self.capacidad and not self._espera:
+            self._ocupados += 1
+            return
+        futuro = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._espera, (prioridad, next(self._turnos), futuro))
+        try:
+            await futuro
+        except asyncio.CancelledError:
+            if futuro.done() and not futuro.cancelled():
+                # Ya se le había pasado el lugar: devolverlo
+                self.liberar()
+            else:
+                futuro.cancel()
+            raise
+    
+    def liberar(self) -> None:
+        # El lugar pasa directo al siguiente en espera (los cancelados se saltan)
+        while self._espera:
+            _, _, futuro = heapq.heappop(self._espera)
+            if not futuro.done():
+                futuro.set_result(None)
+                return
+        self._ocupados -= 1
+    
+    def estado(self) -> Dict[str, int]:
+        return {
+            "ocupados": self._ocupados,
+            "capacidad": self.capacidad,
+            "en_espera": sum(1 for _, _, futuro in self._espera if not futuro.done())
+        }
+
+# Concurrencia máxima hacia cada proveedor
+CONCURRENCIA_PROVEEDOR = {
+    "sambanova": "SAMBANOVA_CONCURRENCIA",
+    "reve": "REVE_CONCURRENCIA",
+    "eleven": "ELEVEN_CONCURRENCIA",
+}
+
+# Solo se tocan desde el loop del núcleo, no necesitan lock
+_COMPUERTAS: Dict[str, CompuertaPrioridad] = {}
+
+def compuerta(proveedor: str) -> CompuertaPrioridad:
+    """Compuerta de prioridad del proveedor, creada la primera vez."""
+    puerta = _COMPUERTAS.get(proveedor)
+    if puerta is None:
+        puerta = CompuertaPrioridad(CONFIG[CONCURRENCIA_PROVEEDOR[proveedor]])
+        _COMPUERTAS[proveedor] = puerta
+    return puerta
+
+def estado_compuertas() -> Dict[str, Dict[str, int]]:
+    """Ocupación y fila de espera de cada proveedor."""
+    return {proveedor: puerta.estado() for proveedor, puerta in list(_COMPUERTAS.items())}
+
+# =========================================================
+# INFRAESTRUCTURA: CLIENTES HTTP POR PROVEEDOR
+# =========================================================
+
+# Timeout de lectura por proveedor; el de conexión es común (HTTP_CONNECT_TIMEOUT)
+TIMEOUTS_LECTURA = {
+    "sambanova": "SAMBANOVA_TIMEOUT",
+    "reve": "REVE_TIMEOUT",
+    "reve_descarga": "REVE_DOWNLOAD_TIMEOUT",
+    "eleven": "ELEVEN_TIMEOUT",
+    "callback": "CALLBACK_TIMEOUT",
+}
+
+# Clientes que no hablan con un proveedor (no pasan por llamar_proveedor ni su disyuntor)
+CLIENTES_INTERNOS = {"callback"}
+
+# Solo se tocan desde el loop del núcleo, no necesitan lock
+_CLIENTES: Dict[str, httpx.AsyncClient] = {}
+
+def obtener_cliente(proveedor: str) -> httpx.AsyncClient:
+    """
+    Regresa el cliente HTTP asíncrono compartido del proveedor (uno por proveedor).
+    Reutiliza conexiones TCP/TLS entre órdenes en lugar de abrir una por llamada.
+    """
+    cliente = _CLIENTES.get(proveedor)
+    if cliente is None:
+        keepalive = CONFIG["HTTP_POOL_SIZE"] if CONFIG["HTTP_KEEPALIVE"] else 0
+        cliente = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=CONFIG["HTTP_MAX_CONNECTIONS"],
+                max_keepalive_connections=keepalive
+            ),
+            timeout=timeout_proveedor(proveedor)
+        )
+        _CLIENTES[proveedor] = cliente
+        logger.info("Pool HTTP creado para %s (keep-alive %s)", proveedor, keepalive)
+    return cliente
+
+def timeout_proveedor(proveedor: str) -> httpx.Timeout:
+    """Timeout de conexión común y de lectura según el proveedor."""
+    return httpx.Timeout(
+        float(CONFIG[TIMEOUTS_LECTURA[proveedor]]),
+        connect=CONFIG["HTTP_CONNECT_TIMEOUT"]
+    )
+
+async def cerrar_clientes_async() -> None:
+    """Cierra todos los pools HTTP (apagado o cambio de configuración)."""
+    clientes = list(_CLIENTES.values())
+    _CLIENTES.clear()
+    for cliente in clientes:
+        await cliente.aclose()
+
+def cerrar_clientes() -> None:
+    """Versión síncrona de cerrar_clientes_async."""
+    ejecutar_async(cerrar_clientes_async())
+
+# =========================================================
+# INFRAESTRUCTURA: RESILIENCIA POR PROVEEDOR
+# =========================================================
+
+class ProveedorCaido(Exception):
+    """El disyuntor del proveedor está abierto: se falla al instante sin llamarlo."""
+    
+    def __init__(self, proveedor: str, reintentar_en: float):
+        super().__init__(f"{proveedor} en pausa por fallas seguidas, reintento en {math.ceil(reintentar_en)}s")
+        self.proveedor = proveedor
+        self.reintentar_en = reintentar_en
+
+class CubetaTokens:
+    """
+    Limitador de ritmo (token bucket): `ritmo` llamadas por segundo con
+    ráfagas de hasta `capacidad`. Solo se usa desde el loop del núcleo.
+    """
+    
+    def __init__(self, ritmo: float, capacidad: float):
+        self.ritmo = ritmo
+        self.capacidad = capacidad
+        self._tokens = capacidad
+        self._ultimo = time.monotonic()
+    
+    def _rellenar(self) -> None:
+        ahora = time.monotonic()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.ritmo)
+        self._ultimo = ahora
+    
+    async def tomar(self) -> None:
+        """Espera hasta que haya un token y lo consume."""
+        while True:
+            self._rellenar()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.ritmo)
+    
+    def estado(self) -> Dict[str, float]:
+        tokens = min(self.capacidad, self._tokens + (time.monotonic() - self._ultimo) * self.ritmo)
+        return {"ritmo": self.ritmo, "capacidad": self.capacidad, "tokens": round(tokens, 2)}
+
+class Disyuntor:
+    """
+    Circuit breaker de un proveedor. Tras `umbral` fallas seguidas se abre y
+    rechaza al instante durante el enfriamiento; después queda semiabierto y
+    deja pasar una sola sonda: si sale bien se cierra, si falla se reabre.
+    Solo se usa desde el loop del núcleo.
+    """
+    
+    def __init__(self, proveedor: str, umbral: int, enfriamiento: float):
+        self.proveedor = proveedor
+        self.umbral = max(1, umbral)
+        self.enfriamiento = enfriamiento
+        self.estado = "cerrado"
+        self.fallas = 0
+        self.aperturas = 0
+        self.rechazos = 0
+        self._abierto_hasta = 0.0
+        self._sonda_en_vuelo = False
+    
+    def permitir(self) -> None:
+        """Deja pasar la llamada o lanza ProveedorCaido."""
+        if self.estado == "cerrado":
+            return
+        ahora = time.monotonic()
+        if self.estado == "abierto" and ahora >= self._abierto_hasta:
+            self.estado = "semiabierto"
+            logger.info("Disyuntor de %s semiabierto: mandando sonda", self.proveedor)
+        if self.estado == "semiabierto" and not self._sonda_en_vuelo:
+            self._sonda_en_vuelo = True
+            return
+        self.rechazos += 1
+        raise ProveedorCaido(self.proveedor, max(0.0, self._abierto_hasta - ahora))
+    
+    def exito(self) -> None:
+        self.fallas = 0
+        self._sonda_en_vuelo = False
+        if self.estado != "cerrado":
+            logger.info("✅ Disyuntor de %s cerrado: el proveedor volvió", self.proveedor)
+            self.estado = "cerrado"
+    
+    def fallo(self) -> None:
+        self.fallas += 1
+        self._sonda_en_vuelo = False
+        if self.estado == "semiabierto" or (self.estado == "cerrado" and self.fallas >= self.umbral):
+            self.estado = "abierto"
+            self.aperturas += 1
+            self._abierto_hasta = time.monotonic() + self.enfriamiento
+            logger.error("⛔ Disyuntor de %s abierto por %.0fs (%s fallas seguidas)", self.proveedor, self.enfriamiento, self.fallas)
+    
+    def soltar_sonda(self) -> None:
+        """La llamada terminó sin veredicto (429, cancelación): la sonda queda libre."""
+        self._sonda_en_vuelo = False
+    
+    def resumen(self) -> Dict[str, Any]:
+        return {
+            "estado": self.estado,
+            "fallas_seguidas": self.fallas,
+            "aperturas": self.aperturas,
+            "rechazos_rapidos": self.rechazos,
+            "reabre_en": round(max(0.0, self._abierto_hasta - time.monotonic()), 1) if self.estado == "abierto" else 0.0
+        }
+
+# Llamadas por segundo permitidas por proveedor (0 = sin límite)
+RITMO_PROVEEDOR = {
+    "sambanova": "SAMBANOVA_RPS",
+    "reve": "REVE_RPS",
+    "eleven": "ELEVEN_RPS",
+}
+
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+ERRORES_REINTENTABLES = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.ReadError)
+
+# Solo se tocan desde el loop del núcleo, no necesitan lock
+_DISYUNTORES: Dict[str, Disyuntor] = {}
+_CUBETAS: Dict[str, Optional[CubetaTokens]] = {}
+_ESTADISTICAS_PROVEEDOR: Dict[str, Dict[str, int]] = {}
+
+def obtener_disyuntor(proveedor: str) -> Disyuntor:
+    """Disyuntor del proveedor, creado la primera vez."""
+    disyuntor = _DISYUNTORES.get(proveedor)
+    if disyuntor is None:
+        disyuntor = Disyuntor(proveedor, CONFIG["PROVEEDOR_FALLAS_UMBRAL"], CONFIG["PROVEEDOR_ENFRIAMIENTO"])
+        _DISYUNTORES[proveedor] = disyuntor
+    return disyuntor
+
+def cubeta_proveedor(proveedor: str) -> Optional[CubetaTokens]:
+    """Cubeta de tokens del proveedor, o None si no tiene límite de ritmo."""
+    if proveedor not in _CUBETAS:
+        ritmo = CONFIG[RITMO_PROVEEDOR[proveedor]] if proveedor in RITMO_PROVEEDOR else 0
+        _CUBETAS[proveedor] = CubetaTokens(ritmo, max(1.0, ritmo)) if ritmo > 0 else None
+    return _CUBETAS[proveedor]
+
+def _espera_backoff(intento: int) -> float:
+    """Backoff exponencial acotado con jitter completo."""
+    tope = min(CONFIG["PROVEEDOR_BACKOFF_MAX"], CONFIG["PROVEEDOR_BACKOFF_BASE"] * (2 ** intento))
+    return random.uniform(0, tope)
+
+def _espera_retry_after(respuesta: httpx.Response, intento: int) -> Optional[float]:
+    """
+    Segundos antes del siguiente intento: Retry-After si el proveedor lo manda
+    (en segundos o fecha HTTP), si no el backoff. None si pide esperar más
+    que PROVEEDOR_BACKOFF_MAX (no vale la pena retener la orden).
+    """
+    valor = respuesta.headers.get("retry-after")
+    if not valor:
+        return _espera_backoff(intento)
+    try:
+        espera = float(valor)
+    except ValueError:
+        try:
+            espera = parsedate_to_datetime(valor).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return _espera_backoff(intento)
+    if espera > CONFIG["PROVEEDOR_BACKOFF_MAX"]:
+        return None
+    return max(0.0, espera) + random.uniform(0, CONFIG["PROVEEDOR_BACKOFF_BASE"])
+
+@asynccontextmanager
+async def llamar_proveedor(proveedor: str, metodo: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+    """
+    Única salida hacia los proveedores: compuerta de prioridad, cubeta de
+    tokens, disyuntor y reintentos con backoff + jitter que respetan
+    Retry-After (429/5xx y errores de conexión). Entrega la respuesta abierta
+    en streaming; un estatus de error que ya no se reintenta se entrega tal
+    cual para que el motor lo maneje. Lanza ProveedorCaido si el disyuntor
+    está abierto.
+    """
+    inicio = time.perf_counter()
+    with tramo(f"proveedor:{proveedor}") as medicion:
+        try:
+            respuesta, puerta = await _enviar_con_resiliencia(proveedor, metodo, url, kwargs)
+        except BaseException:
+            METRICA_PROVEEDOR.observar(time.perf_counter() - inicio, proveedor)
+            raise
+        medicion.atributos["estatus"] = respuesta.status_code
+        try:
+            yield respuesta
+        finally:
+            await respuesta.aclose()
+            if puerta:
+                puerta.liberar()
+            METRICA_PROVEEDOR.observar(time.perf_counter() - inicio, proveedor)
+
+async def _enviar_con_resiliencia(proveedor: str, metodo: str, url: str,
+                                  kwargs: Dict[str, Any]) -> Tuple[httpx.Response, Optional[CompuertaPrioridad]]:
+    """Intentos de llamar_proveedor; regresa la respuesta con la compuerta aún tomada."""
+    cliente = obtener_cliente(proveedor)
+    disyuntor = obtener_disyuntor(proveedor)
+    cubeta = cubeta_proveedor(proveedor)
+    puerta = compuerta(proveedor) if proveedor in CONCURRENCIA_PROVEEDOR else None
+    estadisticas = _ESTADISTICAS_PROVEEDOR.setdefault(proveedor, {"llamadas": 0, "reintentos": 0, "fallas": 0})
+    intento = 0
+    
+    while True:
+        disyuntor.permitir()
+        tomada = False
+        try:
+            if puerta:
+                await puerta.adquirir(PRIORIDAD_ACTUAL.get())
+                tomada = True
+            if cubeta:
+                await cubeta.tomar()
+            estadisticas["llamadas"] += 1
+            respuesta = await cliente.send(cliente.build_request(metodo, url, **kwargs), stream=True)
+        except httpx.TransportError as e:
+            disyuntor.fallo()
+            estadisticas["fallas"] += 1
+            if tomada:
+                puerta.liberar()
+            if not isinstance(e, ERRORES_REINTENTABLES) or intento >= CONFIG["PROVEEDOR_REINTENTOS"]:
+                raise
+            espera = _espera_backoff(intento)
+            motivo = type(e).__name__
+        except BaseException:
+            disyuntor.soltar_sonda()
+            if tomada:
+                puerta.liberar()
+            raise
+        else:
+            if respuesta.status_code not in CODIGOS_REINTENTABLES:
+                disyuntor.exito()
+                return respuesta, puerta
+            # 5xx cuenta como falla; 429 es el proveedor vivo pidiendo calma
+            if respuesta.status_code >= 500:
+                disyuntor.fallo()
+                estadisticas["fallas"] += 1
+            else:
+                disyuntor.soltar_sonda()
+            espera = _espera_retry_after(respuesta, intento)
+            if espera is None or intento >= CONFIG["PROVEEDOR_REINTENTOS"]:
+                return respuesta, puerta
+            await respuesta.aclose()
+            if tomada:
+                puerta.liberar()
+            motivo = f"HTTP {respuesta.status_code}"
+        
+        intento += 1
+        estadisticas["reintentos"] += 1
+        logger.warning("%s: %s, reintento %s/%s en %.1fs", proveedor, motivo, intento, CONFIG['PROVEEDOR_REINTENTOS'], espera)
+        await asyncio.sleep(espera)
+
+def estado_proveedores() -> Dict[str, Dict[str, Any]]:
+    """Disyuntor, cubeta, compuerta y contadores de cada proveedor."""
+    estado = {}
+    for proveedor in TIMEOUTS_LECTURA:
+        if proveedor in CLIENTES_INTERNOS:
+            continue
+        disyuntor = _DISYUNTORES.get(proveedor) or Disyuntor(proveedor, CONFIG["PROVEEDOR_FALLAS_UMBRAL"], 0)
+        cubeta = _CUBETAS.get(proveedor)
+        puerta = _COMPUERTAS.get(proveedor)
+        estado[proveedor] = {
+            "disyuntor": disyuntor.resumen(),
+            "cubeta": cubeta.estado() if cubeta else None,
+            "compuerta": puerta.estado() if puerta else None,
+            **_ESTADISTICAS_PROVEEDOR.get(proveedor, {"llamadas": 0, "reintentos": 0, "fallas": 0})
+        }
+    return estado
+
+# =========================================================
+# INFRAESTRUCTURA: CACHE DE RESPUESTAS DE TEXTO
+# =========================================================
+
+class CacheRespuestas:
+    """
+    Cache de dos niveles para respuestas de texto: LRU en memoria respaldado
+    por SQLite en disco, ambos con TTL. El disco sobrevive reinicios; al
+    llenarse se recortan primero las entradas más viejas.
+    """
+    
+    def __init__(self, ruta: str, max_memoria: int, max_disco: int, ttl: int):
+        self.max_memoria = max_memoria
+        self.max_disco = max_disco
+        self.ttl = ttl
+        self._memoria: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._escrituras = 0
+        self.contadores = {"hits_memoria": 0, "hits_disco": 0, "misses": 0, "guardados": 0}
+        
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS respuestas ("
+            "clave TEXT PRIMARY KEY, valor TEXT NOT NULL, "
+            "creado REAL NOT NULL, expira REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_respuestas_creado ON respuestas(creado)")
+        self._db.commit()
+    
+    def obtener(self, clave: str) -> Optional[str]:
+        """Regresa la respuesta guardada o None si no está o ya expiró."""
+        ahora = time.time()
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada and entrada[0] > ahora:
+                self._memoria.move_to_end(clave)
+                self.contadores["hits_memoria"] += 1
+                return entrada[1]
+            if entrada:
+                del self._memoria[clave]
+            
+            fila = self._db.execute(
+                "SELECT valor, expira FROM respuestas WHERE clave = ?", (clave,)
+            ).fetchone()
+            if fila and fila[1] > ahora:
+                self._recordar(clave, fila[1], fila[0])
+                self.contadores["hits_disco"] += 1
+                return fila[0]
+            if fila:
+                self._db.execute("DELETE FROM respuestas WHERE clave = ?", (clave,))
+                self._db.commit()
+            
+            self.contadores["misses"] += 1
+            return None
+    
+    def guardar(self, clave: str, valor: str) -> None:
+        """Guarda una respuesta en memoria y en disco."""
+        ahora = time.time()
+        expira = ahora + self.ttl
+        with self._lock:
+            self._recordar(clave, expira, valor)
+            self._db.execute(
+                "INSERT OR REPLACE INTO respuestas (clave, valor, creado, expira) VALUES (?, ?, ?, ?)",
+                (clave, valor, ahora, expira)
+            )
+            self._escrituras += 1
+            # Recorte amortizado: no contar filas en cada escritura
+            if self._escrituras % 100 == 0:
+                self._recortar_disco(ahora)
+            self._db.commit()
+            self.contadores["guardados"] += 1
+    
+    def estadisticas(self) -> Dict[str, Any]:
+        """Contadores de aciertos/fallos y ocupación de la memoria."""
+        with self._lock:
+            datos: Dict[str, Any] = dict(self.contadores)
+            datos["en_memoria"] = len(self._memoria)
+        consultas = datos["hits_memoria"] + datos["hits_disco"] + datos["misses"]
+        datos["tasa_aciertos"] = round((consultas - datos["misses"]) / consultas, 4) if consultas else 0.0
+        return datos
+    
+    def _recordar(self, clave: str, expira: float, valor: str) -> None:
+        self._memoria[clave] = (expira, valor)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_memoria:
+            self._memoria.popitem(last=False)
+    
+    def _recortar_disco(self, ahora: float) -> None:
+        self._db.execute("DELETE FROM respuestas WHERE expira <= ?", (ahora,))
+        self._db.execute(
+            "DELETE FROM respuestas WHERE clave IN ("
+            "SELECT clave FROM respuestas ORDER BY creado DESC LIMIT -1 OFFSET ?)",
+            (self.max_disco,)
+        )
+
+_CACHE_TEXTO = Perezoso(lambda: CacheRespuestas(
+    os.path.join(CONFIG["CACHE_DIR"], "respuestas_texto.sqlite3"),
+    max_memoria=CONFIG["CACHE_TEXTO_MAX_MEMORIA"],
+    max_disco=CONFIG["CACHE_TEXTO_MAX_DISCO"],
+    ttl=CONFIG["CACHE_TEXTO_TTL"]
+))
+
+def obtener_cache_texto() -> CacheRespuestas:
+    """Regresa el cache de respuestas de texto, creándolo la primera vez."""
+    return _CACHE_TEXTO()
+
+_HASH_SYSTEM_PROMPT = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+
+def clave_cache_texto(prompt: str, huella: str = "") -> str:
+    """
+    Clave del cache: modelo, temperatura, hash del SYSTEM_PROMPT y prompt normalizado.
+    Con historial de sesión se agrega su huella: la misma pregunta en otra plática es otra clave.
+    """
+    prompt_normalizado = " ".join(prompt.split())
+    partes = [
+        CONFIG["SAMBANOVA_MODEL"],
+        CONFIG["SAMBANOVA_TEMPERATURE"],
+        _HASH_SYSTEM_PROMPT,
+        prompt_normalizado
+    ]
+    if huella:
+        partes.append(huella)
+    material = json.dumps(partes, ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+# =========================================================
+# INFRAESTRUCTURA: SESIONES DE CONVERSACIÓN (PRESUPUESTO DE TOKENS)
+# =========================================================
+
+# Cada sesión (portal: una por pestaña de Gradio; webhook: session_id) guarda
+# una ventana de turnos recientes más un resumen extractivo de los viejos.
+# Al pasar SESION_PRESUPUESTO tokens, los turnos más viejos se compactan al
+# resumen (primera oración de cada uno) y el resumen a su vez se recorta a
+# SESION_RESUMEN_TOKENS: el payload a SambaNova nunca crece sin límite.
+
+def estimar_tokens(texto: str) -> int:
+    """Tokens aproximados (~4 caracteres por token); no hay tokenizer del modelo a la mano."""
+    return max(1, (len(texto) + 3) // 4)
+
+def _extracto_turno(rol: str, contenido: str, max_chars: int = 200) -> str:
+    """Línea del resumen para un turno: quién habló y su primera oración."""
+    limpio = " ".join(PATRON_IMAGEN.sub("(imagen)", contenido).split())
+    oracion = re.split(r"(?<=[.!?])\s", limpio, maxsplit=1)[0]
+    if len(oracion) > max_chars:
+        oracion = oracion[:max_chars - 1].rstrip() + "…"
+    return f"- {'Usuario' if rol == 'user' else 'CAINAL'}: {oracion}"
+
+class VentanaSesion:
+    """Estado en memoria de una sesión: resumen, turnos vivos y el payload ya armado."""
+    
+    def __init__(self, version: int, resumen: str, turnos: List[Tuple[int, str, str, int]]):
+        self.version = version
+        self.resumen = resumen
+        self.turnos = deque(turnos)  # (n, rol, contenido, tokens)
+        self.tokens = sum(turno[3] for turno in turnos)
+        self._mensajes: Optional[List[Dict[str, str]]] = None
+        self._huella = ""
+    
+    def tokens_totales(self) -> int:
+        return self.tokens + (estimar_tokens(self.resumen) if self.resumen else 0)
+    
+    def mensajes(self) -> Tuple[List[Dict[str, str]], str]:
+        """Mensajes de historial para el payload y su huella (para la clave del cache)."""
+        if self._mensajes is None:
+            mensajes = []
+            if self.resumen:
+                mensajes.append({"role": "system", "content": f"Resumen de lo que ya platicaron:\n{self.resumen}"})
+            mensajes.extend({"role": rol, "content": contenido} for _, rol, contenido, _ in self.turnos)
+            self._mensajes = mensajes
+            material = json.dumps(mensajes, ensure_ascii=False)
+            self._huella = hashlib.sha256(material.encode("utf-8")).hexdigest() if mensajes else ""
+        return self._mensajes, self._huella
+    
+    def agregar(self, n: int, rol: str, contenido: str) -> None:
+        tokens = estimar_tokens(contenido)
+        self.turnos.append((n, rol, contenido, tokens))
+        self.tokens += tokens
+        if self._mensajes is not None:
+            # Armado incremental: solo se agrega el turno nuevo
+            self._mensajes = self._mensajes + [{"role": rol, "content": contenido}]
+            material = json.dumps(self._mensajes, ensure_ascii=False)
+            self._huella = hashlib.sha256(material.encode("utf-8")).hexdigest()
+    
+    def compactar(self, presupuesto: int, max_resumen: int) -> Optional[int]:
+        """
+        Pasa los turnos más viejos al resumen hasta caber en el presupuesto.
+        Regresa el último n compactado (None si no hizo falta).
+        """
+        ultimo = None
+        lineas = self.resumen.splitlines() if self.resumen else []
+        while self.turnos and self.tokens_totales() > presupuesto:
+            n, rol, contenido, tokens = self.turnos.popleft()
+            self.tokens -= tokens
+            lineas.append(_extracto_turno(rol, contenido))
+            # El resumen también tiene tope: se olvida lo más viejo
+            while lineas and estimar_tokens("\n".join(lineas)) > max_resumen:
+                lineas.pop(0)
+            self.resumen = "\n".join(lineas)
+            ultimo = n
+        if ultimo is not None:
+            self._mensajes = None
+        return ultimo
+
+class AlmacenSesiones(AlmacenSQLite):
+    """
+    Sesiones en SQLite (compartidas entre el webhook y los workers de otros
+    procesos) con las ventanas más recientes en memoria. Cada escritura sube
+    la versión de la sesión; la copia en memoria se reutiliza mientras su
+    versión coincida con la del archivo.
+    """
+    
+    PURGA_CADA = 100
+    
+    def __init__(self, ruta: str, presupuesto: int, max_resumen: int, ttl: float, max_memoria: int):
+        super().__init__(ruta)
+        self.presupuesto = presupuesto
+        self.max_resumen = max_resumen
+        self.ttl = ttl
+        self.max_memoria = max_memoria
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sesiones ("
+            "id TEXT PRIMARY KEY, "
+            "resumen TEXT NOT NULL DEFAULT '', "
+            "version INTEGER NOT NULL DEFAULT 0, "
+            "siguiente INTEGER NOT NULL DEFAULT 0, "
+            "actualizado REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS turnos ("
+            "sesion TEXT NOT NULL, "
+            "n INTEGER NOT NULL, "
+            "rol TEXT NOT NULL, "
+            "contenido TEXT NOT NULL, "
+            "PRIMARY KEY (sesion, n))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_sesiones_actualizado ON sesiones(actualizado)")
+        self._ventanas: "OrderedDict[str, VentanaSesion]" = OrderedDict()
+    
+    def contexto(self, sesion: str) -> Tuple[List[Dict[str, str]], str]:
+        """Historial (resumen + ventana) listo para el payload y su huella."""
+        with self._lock:
+            return self._ventana(sesion).mensajes()
+    
+    def agregar_turno(self, sesion: str, pregunta: str, respuesta: str) -> None:
+        """Guarda una pregunta y su respuesta, compactando si se pasa del presupuesto."""
+        ahora = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                ventana = self._ventana(sesion)
+                siguiente = self._db.execute(
+                    "SELECT siguiente FROM sesiones WHERE id = ?", (sesion,)
+                ).fetchone()
+                n = siguiente[0] if siguiente else 0
+                nuevos = [(n, "user", pregunta), (n + 1, "assistant", respuesta)]
+                for turno in nuevos:
+                    ventana.agregar(*turno)
+                compactado = ventana.compactar(self.presupuesto, self.max_resumen)
                 
+                self._db.executemany(
+                    "INSERT INTO turnos (sesion, n, rol, contenido) VALUES (?, ?, ?, ?)",
+                    [(sesion, *turno) for turno in nuevos]
+                )
+                if compactado is not None:
+                    self._db.execute("DELETE FROM turnos WHERE sesion = ? AND n <= ?", (sesion, compactado))
+                self._db.execute(
+                    "INSERT INTO sesiones (id, resumen, version, siguiente, actualizado) VALUES (?, ?, 1, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET resumen = excluded.resumen, version = version + 1, "
+                    "siguiente = excluded.siguiente, actualizado = excluded.actualizado",
+                    (sesion, ventana.resumen, n + 2, ahora)
+                )
+                ventana.version = self._db.execute(
+                    "SELECT version FROM sesiones WHERE id = ?", (sesion,)
+                ).fetchone()[0]
+                self._db.execute("COMMIT")
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                self._ventanas.pop(sesion, None)
+                raise
+            self._contar_escrituras(ahora)
+    
+    def borrar(self, sesion: str) -> None:
+        """Olvida la sesión (nueva plática)."""
+        with self._lock:
+            self._ventanas.pop(sesion, None)
+            self._db.execute("BEGIN")
+            self._db.execute("DELETE FROM turnos WHERE sesion = ?", (sesion,))
+            self._db.execute("DELETE FROM sesiones WHERE id = ?", (sesion,))
+            self._db.execute("COMMIT")
+    
+    def resumen(self, sesion: str) -> Dict[str, Any]:
+        """Tamaño de la sesión: turnos en la ventana, tokens y si ya tiene resumen."""
+        with self._lock:
+            ventana = self._ventana(sesion)
+            return {
+                "turnos": len(ventana.turnos),
+                "tokens": ventana.tokens_totales(),
+                "presupuesto": self.presupuesto,
+                "compactada": bool(ventana.resumen)
+            }
+    
+    def _purgar(self, ahora: float) -> int:
+        # Las sesiones inactivas por más de SESION_TTL
+        vencidas = [fila[0] for fila in self._db.execute(
+            "SELECT id FROM sesiones WHERE actualizado < ?", (ahora - self.ttl,)
+        )]
+        if vencidas:
+            self._db.execute("BEGIN")
+            self._db.executemany("DELETE FROM turnos WHERE sesion = ?", [(s,) for s in vencidas])
+            self._db.executemany("DELETE FROM sesiones WHERE id = ?", [(s,) for s in vencidas])
+            self._db.execute("COMMIT")
+            for sesion in vencidas:
+                self._ventanas.pop(sesion, None)
+        return len(vencidas)
+    
+    def _ventana(self, sesion: str) -> VentanaSesion:
+        """Ventana en memoria si sigue al día; si no (u otro proceso escribió), se lee del archivo."""
+        fila = self._db.execute("SELECT resumen, version FROM sesiones WHERE id = ?", (sesion,)).fetchone()
+        resumen, version = fila if fila else ("", 0)
+        ventana = self._ventanas.get(sesion)
+        if ventana is None or ventana.version != version:
+            turnos = [
+                (n, rol, contenido, estimar_tokens(contenido))
+                for n, rol, contenido in self._db.execute(
+                    "SELECT n, rol, contenido FROM turnos WHERE sesion = ? ORDER BY n", (sesion,)
+                )
+            ]
+            ventana = VentanaSesion(version, resumen, turnos)
+            self._ventanas[sesion] = ventana
+        self._ventanas.move_to_end(sesion)
+        while len(self._ventanas) > self.max_memoria:
+            self._ventanas.popitem(last=False)
+        return ventana
+
+_SESIONES = Perezoso(lambda: AlmacenSesiones(
+    CONFIG["SESION_DB"],
+    presupuesto=CONFIG["SESION_PRESUPUESTO"],
+    max_resumen=CONFIG["SESION_RESUMEN_TOKENS"],
+    ttl=CONFIG["SESION_TTL"],
+    max_memoria=CONFIG["SESION_MAX_MEMORIA"]
+))
+
+def obtener_sesiones() -> AlmacenSesiones:
+    """Regresa el almacén de sesiones, abriéndolo la primera vez."""
+    return _SESIONES()
+
+# =========================================================
+# MOTOR DE TEXTO (SAMBANOVA)
+# =========================================================
+
+PATRON_IMAGEN = re.compile(r"\[GENERA_IMAGEN:(.*?)\]")
+
+def extraer_imagenes(respuesta: str) -> Tuple[str, List[str]]:
+    """
+    Separa las etiquetas [GENERA_IMAGEN:...] de una respuesta de texto.
+    Regresa el texto limpio y las descripciones, en orden (vacía si no hay).
+    """
+    descripciones = PATRON_IMAGEN.findall(respuesta)
+    if not descripciones:
+        return respuesta, []
+    return PATRON_IMAGEN.sub("🔥 Obra forjada", respuesta), descripciones
+
+def _solicitud_sambanova(prompt: str, stream: bool = False,
+                         historial: Optional[List[Dict[str, str]]] = None) -> Tuple[Dict[str, str], Dict[str, Any]]:
+    """Headers y payload de chat completions para SambaNova (con el historial de la sesión, si hay)."""
+    headers = {
+        "Authorization": f"Bearer {CONFIG['SAMBANOVA_KEY']}",
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "model": CONFIG["SAMBANOVA_MODEL"],
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            *(historial or ()),
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": CONFIG["SAMBANOVA_TEMPERATURE"]
+    }
+    if stream:
+        payload["stream"] = True
+    return headers, payload
+
+async def _contexto_sesion(sesion: Optional[str]) -> Tuple[List[Dict[str, str]], str]:
+    """Historial y huella de la sesión (vacíos sin sesión)."""
+    if not sesion:
+        return [], ""
+    return await asyncio.to_thread(obtener_sesiones().contexto, sesion)
+
+async def _recordar_turno(sesion: Optional[str], prompt: str, respuesta: str) -> None:
+    """Guarda el turno en la sesión; los fallos ("⚠️") no se recuerdan."""
+    if not sesion or not respuesta or respuesta.startswith("⚠️"):
+        return
+    try:
+        await asyncio.to_thread(obtener_sesiones().agregar_turno, sesion, prompt, respuesta)
+    except Exception as e:
+        logger.warning("No se pudo guardar el turno de la sesión %s: %s", sesion, e)
+
+@trazado()
+async def generar_texto_cainal_async(prompt: str, uso_webhook: bool = False, usar_cache: bool = True,
+                                     sesion: Optional[str] = None) -> str:
+    """
+    Motor principal de texto con SYSTEM_PROMPT irrompible.
+    Con usar_cache las respuestas exitosas se guardan y se reutilizan.
+    Con sesion se manda el historial (ventana + resumen) y se guarda el turno.
+    """
+    # Validar si la API está configurada
+    if not CONFIG["SAMBANOVA_KEY"]:
+        error_msg = "⚠️ SAMBANOVA_API_KEY no configurada. No se puede generar texto."
+        logger.error(error_msg)
+        return error_msg if not uso_webhook else json.dumps({"error": "api_key_missing", "message": error_msg})
+    
+    historial, huella = await _contexto_sesion(sesion)
+    cache = obtener_cache_texto() if usar_cache and CONFIG["CACHE_TEXTO"] else None
+    if cache:
+        clave = clave_cache_texto(prompt, huella)
+        guardada = await asyncio.to_thread(cache.obtener, clave)
+        if guardada is not None:
+            logger_ordenes.info("Texto servido desde cache")
+            await _recordar_turno(sesion, prompt, guardada)
+            return guardada
+    
+    headers, payload = _solicitud_sambanova(prompt, historial=historial)
+    
+    try:
+        logger_ordenes.info("Solicitando texto a SambaNova: %s...", prompt[:50])
+        async with llamar_proveedor(
+            "sambanova",
+            "POST",
+            CONFIG["SAMBANOVA_URL"],
+            headers=headers,
+            json=payload
+        ) as response:
+            await response.aread()
+        response.raise_for_status()
+        
+        resultado = response.json()["choices"][0]["message"]["content"]
+        logger_ordenes.info("Texto generado exitosamente")
+        if cache:
+            await asyncio.to_thread(cache.guardar, clave, resultado)
+        await _recordar_turno(sesion, prompt, resultado)
+        return resultado
+        
+    except ProveedorCaido as e:
+        registrar_error("texto", "circuit_open")
+        error_msg = f"⚠️ SambaNova anda caído, no le insisto: {str(e)}"
+        logger.error("SambaNova con disyuntor abierto: %s", e)
+        return error_msg if not uso_webhook else json.dumps({"error": "circuit_open", "message": error_msg})
+        
+    except httpx.TimeoutException:
+        registrar_error("texto", "timeout")
+        error_msg = "⚠️ SambaNova no respondió a tiempo, la red anda lenta."
+        logger.error("Timeout en SambaNova")
+        return error_msg if not uso_webhook else json.dumps({"error": "timeout", "message": error_msg})
+        
+    except httpx.HTTPError as e:
+        registrar_error("texto", "connection")
+        error_msg = f"⚠️ Fallo en la conexión con SambaNova: {str(e)}"
+        logger.error("Error de conexión SambaNova: %s", e)
+        return error_msg if not uso_webhook else json.dumps({"error": "connection", "message": error_msg})
+        
+    except Exception as e:
+        registrar_error("texto", "internal")
+        error_msg = f"⚠️ Error interno en el núcleo textual: {str(e)}"
+        logger.error("Error inesperado en generar_texto_cainal: %s", e)
+        return error_msg if not uso_webhook else json.dumps({"error": "internal", "message": error_msg})
+
+def generar_texto_cainal(prompt: str, uso_webhook: bool = False, usar_cache: bool = True,
+                         prioridad: Optional[int] = None, sesion: Optional[str] = None) -> str:
+    """Versión síncrona de generar_texto_cainal_async (Flask, Gradio)."""
+    return ejecutar_async(generar_texto_cainal_async(prompt, uso_webhook, usar_cache, sesion), prioridad)
+
+class FalloStream(str):
+    """
+    Último fragmento de un stream de texto que falló. Sigue siendo el texto
+    "⚠️ ..." para quien solo lo muestra, pero quien junta la respuesta sabe
+    que falló aunque antes hayan llegado fragmentos buenos.
+    """
+
+async def generar_texto_cainal_stream_async(prompt: str, usar_cache: bool = True,
+                                            sesion: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Motor de texto en modo streaming: entrega los fragmentos de la respuesta
+    conforme SambaNova los manda (server-sent events).
+    Los fallos se entregan como un último fragmento FalloStream ("⚠️ ..."),
+    aunque ya hayan salido fragmentos de texto.
+    Un acierto de cache se entrega completo en un solo fragmento.
+    Con sesion, el turno se guarda al terminar la respuesta completa.
+    """
+    if not CONFIG["SAMBANOVA_KEY"]:
+        logger.error("SAMBANOVA_API_KEY no configurada")
+        yield FalloStream("⚠️ SAMBANOVA_API_KEY no configurada. No se puede generar texto.")
+        return
+    
+    historial, huella = await _contexto_sesion(sesion)
+    cache = obtener_cache_texto() if usar_cache and CONFIG["CACHE_TEXTO"] else None
+    if cache:
+        clave = clave_cache_texto(prompt, huella)
+        guardada = await asyncio.to_thread(cache.obtener, clave)
+        if guardada is not None:
+            logger_ordenes.info("Texto servido desde cache (stream)")
+            await _recordar_turno(sesion, prompt, guardada)
+            yield guardada
+            return
+    
+    headers, payload = _solicitud_sambanova(prompt, stream=True, historial=historial)
+    fragmentos = []
+    
+    try:
+        logger_ordenes.info("Streaming de texto a SambaNova: %s...", prompt[:50])
+        async with llamar_proveedor(
+            "sambanova",
+            "POST",
+            CONFIG["SAMBANOVA_URL"],
+            headers=headers,
+            json=payload
+        ) as response:
+            response.raise_for_status()
+            async for linea in response.aiter_lines():
+                if not linea.startswith("data:"):
+                    continue
+                datos = linea[5:].strip()
+                if datos == "[DONE]":
+                    break
+                choices = json.loads(datos).get("choices") or [{}]
+                fragmento = (choices[0].get("delta") or {}).get("content")
+                if fragmento:
+                    fragmentos.append(fragmento)
+                    yield fragmento
+        logger_ordenes.info("Streaming de texto completado")
+        if cache and fragmentos:
+            await asyncio.to_thread(cache.guardar, clave, "".join(fragmentos))
+        await _recordar_turno(sesion, prompt, "".join(fragmentos))
+        
+    except ProveedorCaido as e:
+        registrar_error("texto", "circuit_open")
+        logger.error("SambaNova con disyuntor abierto (stream): %s", e)
+        yield FalloStream(f"⚠️ SambaNova anda caído, no le insisto: {str(e)}")
+        
+    except httpx.TimeoutException:
+        registrar_error("texto", "timeout")
+        logger.error("Timeout en streaming de SambaNova")
+        yield FalloStream("⚠️ SambaNova no respondió a tiempo, la red anda lenta.")
+        
+    except httpx.HTTPError as e:
+        registrar_error("texto", "connection")
+        logger.error("Error de conexión SambaNova (stream): %s", e)
+        yield FalloStream(f"⚠️ Fallo en la conexión con SambaNova: {str(e)}")
+        
+    except Exception as e:
+        registrar_error("texto", "internal")
+        logger.error("Error inesperado en generar_texto_cainal_stream_async: %s", e)
+        yield FalloStream(f"⚠️ Error interno en el núcleo textual: {str(e)}")
+
+def generar_texto_cainal_stream(prompt: str, usar_cache: bool = True,
+                                prioridad: Optional[int] = None, sesion: Optional[str] = None) -> Iterator[str]:
+    """Versión síncrona de generar_texto_cainal_stream_async (Flask, Gradio)."""
+    return iterar_async(generar_texto_cainal_stream_async(prompt, usar_cache, sesion), prioridad)
+
+# =========================================================
+# MOTOR VISUAL (REVE + FIRMA BATUTO-ART)
+# =========================================================
+
+EXTENSIONES_FIRMA = {"PNG": ".png", "WEBP": ".webp", "JPEG": ".jpg"}
+
+def extension_firma() -> str:
+    """Extensión de archivo del formato de salida configurado."""
+    return EXTENSIONES_FIRMA.get(CONFIG["FIRMA_FORMATO"], ".png")
+
+def _opciones_guardado() -> Tuple[str, Dict[str, Any]]:
+    """Formato y parámetros de codificación para Image.save."""
+    formato = CONFIG["FIRMA_FORMATO"] if CONFIG["FIRMA_FORMATO"] in EXTENSIONES_FIRMA else "PNG"
+    if formato == "PNG":
+        return formato, {"compress_level": CONFIG["FIRMA_PNG_COMPRESION"]}
+    return formato, {"quality": CONFIG["FIRMA_CALIDAD"]}
+
+@lru_cache(maxsize=16)
+def _fuente_firma(font_size: int):
+    """Fuente de la firma, cargada una sola vez por tamaño."""
+    from PIL import ImageFont
+    try:
+        # NOTA: Para producción, usar fuente personalizada (ej: graffiti.ttf)
+        # Colocar la fuente en el directorio del proyecto
+        return ImageFont.truetype("arial.ttf", font_size)
+    except OSError:
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=CONFIG["FIRMA_CACHE_SPRITES"])
+def _sprite_firma(width: int, height: int) -> Tuple["Image.Image", Tuple[int, int]]:
+    """
+    Sprite RGBA de la firma (sombra + texto) para un tamaño de imagen,
+    con la posición donde va pegado. Se construye una vez por tamaño.
+    """
+    from PIL import Image, ImageDraw
+    
+    # Tamaño de fuente proporcional
+    font = _fuente_firma(max(18, int(width * 0.05)))
+    
+    # Color Liquid Gold con transparencia
+    gold_color = (255, 215, 0, 255)
+    shadow_color = (0, 0, 0, 160)
+    shadow_offset = 2
+    
+    # Margen proporcional
+    margin_x = int(width * 0.02)
+    margin_y = int(height * 0.02)
+    
+    _, _, derecha, abajo = font.getbbox("BATUTO-ART")
+    sprite = Image.new("RGBA", (derecha + shadow_offset, abajo + shadow_offset), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(sprite)
+    
+    # Sombra
+    draw.text((shadow_offset, shadow_offset), "BATUTO-ART", font=font, fill=shadow_color)
+    
+    # Texto principal
+    draw.text((0, 0), "BATUTO-ART", font=font, fill=gold_color)
+    
+    # Recortar si la imagen es más chica que la firma
+    sprite = sprite.crop((0, 0, min(sprite.width, width - margin_x), min(sprite.height, height - margin_y)))
+    return sprite, (margin_x, margin_y)
+
+def _firmar_imagen(img_data: Union[bytes, IO[bytes]], destino: Optional[str] = None) -> str:
+    """
+    Trabajo de CPU de aplicar_firma_batuto: decodifica, compone la firma y
+    codifica. No toca métricas ni logs, así corre igual en un hilo que en el
+    pool de procesos.
+    """
+    from PIL import Image
+    
+    if isinstance(img_data, (bytes, bytearray)):
+        img_data = BytesIO(img_data)
+    else:
+        img_data.seek(0)
+    img = Image.open(img_data)
+    
+    # Rechazar antes de decodificar: Image.open solo leyó la cabecera
+    if img.width * img.height > CONFIG["IMAGEN_MAX_PIXELES"]:
+        raise ImagenDemasiadoGrande(
+            f"{img.width}x{img.height} excede IMAGEN_MAX_PIXELES ({CONFIG['IMAGEN_MAX_PIXELES']})"
+        )
+    formato, opciones = _opciones_guardado()
+    if formato == "JPEG":
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA"):
+        con_alfa = "A" in img.getbands() or "transparency" in img.info
+        img = img.convert("RGBA" if con_alfa else "RGB")
+    
+    sprite, posicion = _sprite_firma(*img.size)
+    if img.mode == "RGBA":
+        img.alpha_composite(sprite, dest=posicion)
+    else:
+        img.paste(sprite, posicion, sprite)
+    
+    if destino:
+        # Escribir aparte y renombrar: nadie lee un archivo a medias
+        path = destino
+        temporal = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with tramo("guardar", formato=formato):
+            img.save(temporal, formato, **opciones)
+        os.replace(temporal, destino)
+    else:
+        path = ruta_salida()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tramo("guardar", formato=formato):
+            img.save(path, formato, **opciones)
+    return path
+
+@trazado()
+def aplicar_firma_batuto(img_data: Union[bytes, IO[bytes]], destino: Optional[str] = None) -> str:
+    """
+    Aplica firma BATUTO-ART estilo liquid gold a imagen.
+    Acepta bytes o un archivo binario (se lee directo, sin copia extra).
+    Solo se compone la región de la firma, con el sprite cacheado por tamaño.
+    Con destino se guarda ahí (escritura atómica); si no, con un id nuevo
+    repartido por fecha y hash (ruta_salida).
+    """
+    inicio = time.perf_counter()
+    try:
+        path = _firmar_imagen(img_data, destino)
+        METRICA_FIRMA.observar(time.perf_counter() - inicio)
+        logger_ordenes.info("Imagen guardada y firmada: %s", path)
+        return path
+        
+    except Exception as e:
+        logger.error("Error al aplicar firma BATUTO: %s", e)
+        raise
+
+# =========================================================
+# POOL DE PROCESOS PARA LA FIRMA (CPU FUERA DEL GIL)
+# =========================================================
+
+# Decodificar, firmar y codificar es CPU pura con PIL y compite por el GIL
+# con Flask y el loop del núcleo. Con FIRMA_PROCESOS > 0 ese trabajo va a
+# un ProcessPoolExecutor (spawn: el proceso padre tiene hilos vivos).
+_POOL_FIRMA = None
+_POOL_FIRMA_LOCK = threading.Lock()
+
+# Configuración que el proceso hijo necesita igual que el padre aunque se
+# haya cambiado en caliente
+CLAVES_FIRMA = ("FIRMA_FORMATO", "FIRMA_PNG_COMPRESION", "FIRMA_CALIDAD", "IMAGEN_MAX_PIXELES")
+
+def _iniciar_proceso_firma() -> None:
+    """
+    Inicializador de cada proceso del pool. El hijo importa este módulo sin
+    pasar por preparar_proceso(): solo arma su logging, sin archivo propio.
+    """
+    global _ESCRITOR_LOG
+    CONFIG["LOG_ARCHIVO"] = ""
+    _ESCRITOR_LOG = configurar_logging()
+
+def _firmar_en_proceso(datos: bytes, destino: str, ajustes: Dict[str, Any]) -> Tuple[str, float]:
+    """Corre en el proceso hijo; regresa la ruta y los segundos de CPU de la firma."""
+    CONFIG.update(ajustes)
+    inicio = time.perf_counter()
+    path = _firmar_imagen(datos, destino)
+    return path, time.perf_counter() - inicio
+
+def obtener_pool_firma():
+    """Pool de procesos de la firma, o None si FIRMA_PROCESOS es 0."""
+    global _POOL_FIRMA
+    if CONFIG["FIRMA_PROCESOS"] <= 0:
+        return None
+    with _POOL_FIRMA_LOCK:
+        if _POOL_FIRMA is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _POOL_FIRMA = ProcessPoolExecutor(
+                max_workers=CONFIG["FIRMA_PROCESOS"],
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_iniciar_proceso_firma
+            )
+        return _POOL_FIRMA
+
+def cerrar_pool_firma() -> None:
+    global _POOL_FIRMA
+    with _POOL_FIRMA_LOCK:
+        pool, _POOL_FIRMA = _POOL_FIRMA, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+async def aplicar_firma_batuto_async(buffer: IO[bytes], destino: Optional[str] = None) -> str:
+    """
+    Firma fuera del loop del núcleo: en el pool de procesos si hay
+    FIRMA_PROCESOS, si no en un hilo (asyncio.to_thread).
+    """
+    pool = obtener_pool_firma()
+    if pool is None:
+        return await asyncio.to_thread(aplicar_firma_batuto, buffer, destino)
+    
+    from concurrent.futures.process import BrokenProcessPool
+    buffer.seek(0)
+    datos = buffer.read()
+    if not destino:
+        destino = ruta_salida()
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+    ajustes = {clave: CONFIG[clave] for clave in CLAVES_FIRMA}
+    try:
+        with tramo("firma_proceso", bytes=len(datos)):
+            path, segundos = await asyncio.get_running_loop().run_in_executor(
+                pool, _firmar_en_proceso, datos, destino, ajustes
+            )
+    except BrokenProcessPool as e:
+        # Un hijo murió (memoria, señal): el pool ya no sirve, se arma otro
+        cerrar_pool_firma()
+        logger.error("Pool de firma roto, se reinicia: %s", e)
+        raise
+    except Exception as e:
+        logger.error("Error al aplicar firma BATUTO: %s", e)
+        raise
+    METRICA_FIRMA.observar(segundos)
+    logger_ordenes.info("Imagen guardada y firmada: %s", path)
+    return path
+
+# =========================================================
+# INGESTA DE IMÁGENES DE REVE (MEMORIA ACOTADA)
+# =========================================================
+
+class ImagenDemasiadoGrande(ValueError):
+    """La imagen (o su payload) rebasa los límites configurados."""
+
+_BLOQUE_INGESTA = 64 * 1024
+
+def _nuevo_buffer_imagen() -> IO[bytes]:
+    """Buffer en memoria que se pasa a disco al rebasar IMAGEN_SPOOL_MEMORIA."""
+    return tempfile.SpooledTemporaryFile(max_size=CONFIG["IMAGEN_SPOOL_MEMORIA"])
+
+def _verificar_longitud(headers: httpx.Headers, limite: int) -> None:
+    """Rechaza por Content-Length antes de leer el cuerpo."""
+    longitud = headers.get("content-length")
+    if longitud and longitud.isdigit() and int(longitud) > limite:
+        raise ImagenDemasiadoGrande(f"Content-Length {longitud} excede el límite ({limite} bytes)")
+
+async def _leer_limitado(respuesta: httpx.Response, limite: int, destino: Optional[IO[bytes]] = None) -> bytes:
+    """
+    Lee el cuerpo por bloques y corta en cuanto pasa el límite.
+    Con destino los bloques se escriben ahí en lugar de acumularse.
+    """
+    _verificar_longitud(respuesta.headers, limite)
+    bloques, total = [], 0
+    async for bloque in respuesta.aiter_bytes(_BLOQUE_INGESTA):
+        total += len(bloque)
+        if total > limite:
+            raise ImagenDemasiadoGrande(f"La respuesta excede el límite ({limite} bytes)")
+        if destino is not None:
+            destino.write(bloque)
+        else:
+            bloques.append(bloque)
+    return b"".join(bloques)
+
+class _ImagenJSON:
+    """
+    Destino de _leer_limitado para la respuesta JSON de REVE: el valor de
+    "image" (base64) se decodifica al buffer conforme llega, por bloques
+    alineados, y nunca está completo en memoria; el resto del JSON (con
+    "image": "") se junta aparte y se parsea en cerrar().
+    """
+    
+    MAX_ENVOLTORIO = 64 * 1024
+    _ESCAPES = re.compile(rb"\\([/nrt])")
+    
+    def __init__(self, destino: IO[bytes], limite: int):
+        self.destino = destino
+        self.limite = limite
+        self.decodificados = 0
+        self._envoltorio = bytearray()
+        self._profundidad = 0
+        self._en_cadena = self._escape = False
+        self._inicio_cadena = 0
+        self._clave: Optional[bytes] = None
+        self._valor_imagen = self._en_imagen = self._escape_imagen = False
+        self._resto = b""
+    
+    def write(self, bloque: bytes) -> None:
+        i = 0
+        while i < len(bloque):
+            if self._en_imagen:
+                i = self._consumir_imagen(bloque, i)
+            else:
+                self._consumir_envoltorio(bloque[i])
+                i += 1
+    
+    def _consumir_envoltorio(self, c: int) -> None:
+        """Avanza el JSON fuera de la imagen, buscando la clave "image" del objeto raíz."""
+        self._envoltorio.append(c)
+        if len(self._envoltorio) > self.MAX_ENVOLTORIO:
+            raise ValueError("La respuesta de REVE trae demasiado JSON fuera de la imagen")
+        if self._en_cadena:
+            if self._escape:
+                self._escape = False
+            elif c == 0x5C:
+                self._escape = True
+            elif c == 0x22:
+                self._en_cadena = False
+                if self._profundidad == 1:
+                    self._clave = bytes(self._envoltorio[self._inicio_cadena:-1])
+            return
+        if c == 0x22:
+            if self._valor_imagen:
+                self._valor_imagen, self._en_imagen = False, True
+            else:
+                self._en_cadena, self._inicio_cadena = True, len(self._envoltorio)
+        elif c == 0x3A:
+            self._valor_imagen = self._profundidad == 1 and self._clave == b"image"
+        elif c not in b" \t\r\n":
+            if c in b"{[":
+                self._profundidad += 1
+            elif c in b"}]":
+                self._profundidad -= 1
+            self._clave, self._valor_imagen = None, False
+    
+    def _consumir_imagen(self, bloque: bytes, i: int) -> int:
+        """Decodifica el base64 del bloque hasta la comilla que cierra la imagen."""
+        fin = bloque.find(b'"', i)
+        trozo = bloque[i:] if fin < 0 else bloque[i:fin]
+        if self._escape_imagen:
+            trozo, self._escape_imagen = b"\\" + trozo, False
+        if b"\\" in trozo:
+            # Escapes válidos de JSON dentro del base64: \/ y saltos de línea
+            if fin < 0 and (len(trozo) - len(trozo.rstrip(b"\\"))) % 2:
+                trozo, self._escape_imagen = trozo[:-1], True
+            trozo = self._ESCAPES.sub(lambda m: b"/" if m.group(1) == b"/" else b"", trozo)
+            if b"\\" in trozo:
+                raise ValueError("Escape inválido en el base64 de REVE")
+        self._decodificar(trozo)
+        if fin < 0:
+            return len(bloque)
+        self._decodificar(b"", final=True)
+        self._en_imagen = False
+        self._envoltorio.append(0x22)
+        return fin + 1
+    
+    def _decodificar(self, trozo: bytes, final: bool = False) -> None:
+        datos = self._resto + trozo.translate(None, b" \t\r\n")
+        corte = len(datos) if final else len(datos) - len(datos) % 4
+        self._resto = datos[corte:]
+        if not corte:
+            return
+        decodificados = base64.b64decode(datos[:corte])
+        self.decodificados += len(decodificados)
+        if self.decodificados > self.limite:
+            raise ImagenDemasiadoGrande(f"La imagen base64 excede IMAGEN_MAX_BYTES ({self.limite})")
+        self.destino.write(decodificados)
+    
+    def cerrar(self) -> Dict[str, Any]:
+        """El JSON sin la imagen (ValueError si llegó cortado)."""
+        if self._en_imagen or self._en_cadena or self._profundidad:
+            raise ValueError("La respuesta de REVE llegó incompleta")
+        return json.loads(bytes(self._envoltorio))
+
+# Renders en vuelo por clave de payload (solo se tocan desde el loop del núcleo)
+_VUELOS_IMAGEN: Dict[str, asyncio.Future] = {}
+_ESTADISTICAS_IMAGEN = {"hits": 0, "misses": 0, "coalescidas": 0}
+
+def _payload_reve(descripcion: str) -> Dict[str, Any]:
+    """Payload completo de REVE para una descripción."""
+    # Construir prompt visual
+    prompt_visual = CONFIG["IMAGE_TEMPLATE"].replace("{DESC}", descripcion)
+    return {
+        "prompt": prompt_visual,
+        "aspect_ratio": CONFIG["REVE_ASPECT_RATIO"],
+        "quality": CONFIG["REVE_QUALITY"]
+    }
+
+def clave_cache_imagen(payload: Dict[str, Any]) -> str:
+    """Hash del payload de REVE: dirección de contenido de la imagen firmada."""
+    material = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def ruta_cache_imagen(clave: str, extension: Optional[str] = None) -> str:
+    """Ruta de la imagen firmada para una clave de payload (repartida por hash)."""
+    return os.path.join(CONFIG["OUTPUT_DIR"], "cache", clave[:2], f"{clave}{extension or extension_firma()}")
+
+def estadisticas_cache_imagen() -> Dict[str, int]:
+    """Aciertos, renders nuevos y peticiones que se colgaron de un render en vuelo."""
+    return dict(_ESTADISTICAS_IMAGEN)
+
+@trazado()
+async def generar_imagen_cainal_async(descripcion: str, usar_cache: bool = True) -> str:
+    """
+    Genera imagen con REVE y aplica firma BATUTO-ART.
+    Payloads idénticos se sirven del cache en OUTPUT_DIR y las peticiones
+    simultáneas iguales comparten un solo render.
+    """
+    if not CONFIG["REVE_KEY"]:
+        logger.error("No hay API key de REVE configurada")
+        return "⚠️ No hay llave REVE registrada, mi rey. Sin API no hay cuadro."
+    
+    payload = _payload_reve(descripcion)
+    clave = clave_cache_imagen(payload)
+    destino = ruta_cache_imagen(clave) if usar_cache and CONFIG["CACHE_IMAGEN"] else None
+    
+    if destino and os.path.exists(destino):
+        _ESTADISTICAS_IMAGEN["hits"] += 1
+        logger_ordenes.info("Imagen servida desde cache: %s", destino)
+        await asyncio.to_thread(obtener_salidas().tocar, destino)
+        return destino
+    
+    vuelo = _VUELOS_IMAGEN.get(clave)
+    while vuelo is not None:
+        _ESTADISTICAS_IMAGEN["coalescidas"] += 1
+        logger_ordenes.info("Render idéntico en vuelo, esperando: %s...", descripcion[:50])
+        try:
+            return await asyncio.shield(vuelo)
+        except asyncio.CancelledError:
+            # Cancelaron al dueño del render, no a esta espera: se vuelve a
+            # intentar y la primera espera en llegar toma el render
+            if not vuelo.cancelled():
+                raise
+        vuelo = _VUELOS_IMAGEN.get(clave)
+    
+    _ESTADISTICAS_IMAGEN["misses"] += 1
+    vuelo = asyncio.get_running_loop().create_future()
+    _VUELOS_IMAGEN[clave] = vuelo
+    try:
+        resultado = await _renderizar_imagen_async(descripcion, payload, destino, clave if destino else None)
+        vuelo.set_result(resultado)
+        return resultado
+    except asyncio.CancelledError:
+        vuelo.cancel()
+        raise
+    except Exception as e:
+        vuelo.set_exception(e)
+        # Marcada como leída: si nadie esperaba, no se reporta como excepción perdida
+        vuelo.exception()
+        raise
+    finally:
+        _VUELOS_IMAGEN.pop(clave, None)
+
+async def _renderizar_imagen_async(descripcion: str, payload: Dict[str, Any], destino: Optional[str],
+                                   clave: Optional[str] = None) -> str:
+    """
+    Llamada a REVE, descarga y firma de una imagen. Sin destino (cache) la
+    imagen va a una ruta nueva; en ambos casos queda en el almacén de salidas.
+    """
+    headers = {"Authorization": f"Bearer {CONFIG['REVE_KEY']}"}
+    inicio = time.perf_counter()
+    
+    try:
+        logger_ordenes.info("Solicitando imagen a REVE: %s...", descripcion[:50])
+        # El JSON trae la imagen en base64 (~4/3 del binario) más poco envoltorio
+        limite_json = CONFIG["IMAGEN_MAX_BYTES"] * 4 // 3 + 64 * 1024
+        
+        with _nuevo_buffer_imagen() as buffer:
+            async with llamar_proveedor(
+                "reve",
+                "POST",
+                CONFIG["REVE_URL"],
+                headers=headers,
+                json=payload
+            ) as resp:
+                resp.raise_for_status()
+                # El base64 de "image" se decodifica al buffer mientras se lee
+                json_imagen = _ImagenJSON(buffer, CONFIG["IMAGEN_MAX_BYTES"])
+                await _leer_limitado(resp, limite_json, destino=json_imagen)
+                data = json_imagen.cerrar()
+            
+            # Extraer datos de imagen (base64, ya en el buffer, o URL)
+            image_url = data.get("url")
+            
+            if not json_imagen.decodificados and image_url:
+                async with llamar_proveedor("reve_descarga", "GET", image_url) as img_res:
+                    img_res.raise_for_status()
+                    await _leer_limitado(img_res, CONFIG["IMAGEN_MAX_BYTES"], destino=buffer)
+            elif not json_imagen.decodificados:
+                logger.error("REVE no devolvió datos de imagen válidos")
+                return "⚠️ El REVE no mandó ni base64 ni URL, puro aire digital."
+            
+            # Aplicar firma y guardar (trabajo de CPU, fuera del loop)
+            destino = destino or ruta_salida()
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            inicio_firma = time.perf_counter()
+            path_final = await aplicar_firma_batuto_async(buffer, destino)
+            firma = time.perf_counter() - inicio_firma
+        await _indexar_salida(path_final, descripcion, clave, firma, time.perf_counter() - inicio)
+        return path_final
+        
+    except ProveedorCaido as e:
+        registrar_error("imagen", "circuit_open")
+        logger.error("REVE con disyuntor abierto: %s", e)
+        return f"⚠️ El REVE anda caído, no le insisto: {str(e)}"
+        
+    except httpx.TimeoutException:
+        registrar_error("imagen", "timeout")
+        logger.error("Timeout en REVE")
+        return "⚠️ El REVE se tardó de más, la red anda bien troleada."
+        
+    except httpx.HTTPError as e:
+        registrar_error("imagen", "connection")
+        logger.error("Error de conexión REVE: %s", e)
+        return f"⚠️ Fallo en la conexión con REVE: {str(e)}"
+        
+    except ImagenDemasiadoGrande as e:
+        registrar_error("imagen", "too_large")
+        logger.error("Imagen de REVE rechazada por tamaño: %s", e)
+        return f"⚠️ La imagen de REVE viene demasiado pesada: {str(e)}"
+        
+    except Exception as e:
+        registrar_error("imagen", "internal")
+        logger.error("Error inesperado en generar_imagen_cainal: %s", e)
+        return f"⚠️ Fallo en la matriz visual: {str(e)}"
+
+async def _indexar_salida(ruta: str, descripcion: str, clave: Optional[str], firma: float, total: float) -> None:
+    """Anota la imagen en el almacén de salidas; si falla, la imagen igual se entrega."""
+    traza, contexto = TRAZA_ACTUAL.get(), CONTEXTO_LOG.get() or {}
+    try:
+        await asyncio.to_thread(
+            obtener_salidas().registrar, ruta, descripcion, clave, round(firma, 4), round(total, 4),
+            traza.id if traza is not None else None, contexto.get("job_id")
+        )
+    except Exception as e:
+        registrar_error("salidas", "internal")
+        logger.warning("No se pudo indexar la salida %s: %s", ruta, e)
+
+def generar_imagen_cainal(descripcion: str, usar_cache: bool = True, prioridad: Optional[int] = None) -> str:
+    """Versión síncrona de generar_imagen_cainal_async (Flask, Gradio)."""
+    return ejecutar_async(generar_imagen_cainal_async(descripcion, usar_cache), prioridad)
+
+async def generar_imagenes_cainal_stream_async(descripciones: List[str],
+                                               usar_cache: bool = True) -> AsyncIterator[Tuple[int, str]]:
+    """
+    Rinde todas las imágenes de una orden en paralelo (a lo más
+    IMAGENES_PARALELO a la vez) y entrega (índice, ruta o "⚠️") conforme
+    termina cada una. Pasado IMAGENES_MAX_POR_ORDEN las demás se ignoran.
+    """
+    if len(descripciones) > CONFIG["IMAGENES_MAX_POR_ORDEN"]:
+        logger.warning("Orden con %s imágenes; solo se rinden %s", len(descripciones), CONFIG['IMAGENES_MAX_POR_ORDEN'])
+        descripciones = descripciones[:CONFIG["IMAGENES_MAX_POR_ORDEN"]]
+    cupo = asyncio.Semaphore(CONFIG["IMAGENES_PARALELO"])
+    
+    async def _con_cupo(indice: int, descripcion: str) -> Tuple[int, str]:
+        async with cupo:
+            return indice, await generar_imagen_cainal_async(descripcion, usar_cache)
+    
+    tareas = [asyncio.ensure_future(_con_cupo(i, d)) for i, d in enumerate(descripciones)]
+    try:
+        for siguiente in asyncio.as_completed(tareas):
+            yield await siguiente
+    finally:
+        for tarea in tareas:
+            tarea.cancel()
+
+@trazado()
+async def generar_imagenes_cainal_async(descripciones: List[str], usar_cache: bool = True) -> List[str]:
+    """Todas las imágenes de una orden, en el orden de sus etiquetas."""
+    rutas: Dict[int, str] = {}
+    async for indice, ruta in generar_imagenes_cainal_stream_async(descripciones, usar_cache):
+        rutas[indice] = ruta
+    return [rutas[indice] for indice in sorted(rutas)]
+
+def generar_imagenes_cainal(descripciones: List[str], usar_cache: bool = True,
+                            prioridad: Optional[int] = None) -> List[str]:
+    """Versión síncrona de generar_imagenes_cainal_async (Flask, Gradio)."""
+    return ejecutar_async(generar_imagenes_cainal_async(descripciones, usar_cache), prioridad)
+
+# =========================================================
+# MOTOR DE VOZ (ELEVENLABS)
+# =========================================================
+
+@trazado()
+async def generar_voz_cainal_async(texto: str, usar_cache: bool = True) -> Optional[bytes]:
+    """
+    Genera audio a partir de texto usando ElevenLabs.
+    Es el pipeline por fragmentos de generar_voz_cainal_stream_async, cosido
+    en un solo MP3 (los frames MP3 se concatenan sin recodificar).
+    """
+    partes = [audio async for audio in generar_voz_cainal_stream_async(texto, usar_cache)]
+    if not partes:
+        return None
+    logger_ordenes.info("Voz generada exitosamente (%s fragmentos)", len(partes))
+    return b"".join(partes)
+
+def generar_voz_cainal(texto: str, prioridad: Optional[int] = None) -> Optional[bytes]:
+    """Versión síncrona de generar_voz_cainal_async (Gradio)."""
+    return ejecutar_async(generar_voz_cainal_async(texto), prioridad)
+
+async def generar_voz_cainal_stream_async(texto: str, usar_cache: bool = True) -> AsyncIterator[bytes]:
+    """
+    Pipeline de voz: parte el texto en oraciones, sintetiza los fragmentos en
+    paralelo (a lo más ELEVEN_PARALELO a la vez) y entrega el audio de cada
+    uno en orden en cuanto está listo. Si un fragmento falla, el audio se
+    corta ahí (no se brinca una oración).
+    """
+    if not CONFIG["ELEVEN_KEY"]:
+        logger.warning("ElevenLabs API key no configurada")
+        return
+    
+    if not texto.strip():
+        logger.warning("Texto vacío para generación de voz")
+        return
+    
+    fragmentos = _fragmentos_voz(texto)
+    logger_ordenes.info("Generando voz para texto de %s caracteres en %s fragmentos", len(texto), len(fragmentos))
+    cupo = asyncio.Semaphore(CONFIG["ELEVEN_PARALELO"])
+    
+    async def _con_cupo(fragmento: str) -> Optional[bytes]:
+        async with cupo:
+            return await _sintetizar_fragmento_async(fragmento, usar_cache)
+    
+    # El semáforo atiende en orden de llegada: los primeros fragmentos salen primero
+    tareas = [asyncio.ensure_future(_con_cupo(fragmento)) for fragmento in fragmentos]
+    try:
+        for indice, tarea in enumerate(tareas):
+            audio = await tarea
+            if audio is None:
+                logger.error("Voz cortada en el fragmento %s de %s", indice + 1, len(tareas))
+                return
+            yield audio
+    finally:
+        for tarea in tareas:
+            tarea.cancel()
+
+def generar_voz_cainal_stream(texto: str, prioridad: Optional[int] = None) -> Iterator[bytes]:
+    """Versión síncrona de generar_voz_cainal_stream_async (Gradio)."""
+    return iterar_async(generar_voz_cainal_stream_async(texto), prioridad)
+
+PATRON_ORACION = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+def dividir_oraciones(texto: str, max_chars: int) -> List[str]:
+    """
+    Parte el texto en fragmentos de hasta max_chars que terminan en fin de
+    oración. El primero es solo la primera oración, para que el audio empiece
+    rápido; una oración más larga que max_chars se corta en comas o espacios.
+    """
+    fragmentos, actual = [], ""
+    for oracion in PATRON_ORACION.split(texto):
+        for pedazo in _partir_oracion(oracion.strip(), max_chars):
+            if actual and (not fragmentos or len(actual) + 1 + len(pedazo) > max_chars):
+                fragmentos.append(actual)
+                actual = pedazo
+            else:
+                actual = f"{actual} {pedazo}" if actual else pedazo
+    if actual:
+        fragmentos.append(actual)
+    return fragmentos
+
+def _partir_oracion(oracion: str, max_chars: int) -> Iterator[str]:
+    while len(oracion) > max_chars:
+        corte = oracion.rfind(", ", 0, max_chars)
+        if corte <= 0:
+            corte = oracion.rfind(" ", 0, max_chars)
+        corte = corte + 1 if corte > 0 else max_chars
+        yield oracion[:corte].strip()
+        oracion = oracion[corte:].strip()
+    if oracion:
+        yield oracion
+
+def _fragmentos_voz(texto: str) -> List[str]:
+    """Fragmentos a sintetizar, hasta ELEVEN_MAX_CHARS en total (cortando en fragmento completo)."""
+    fragmentos, total = [], 0
+    for fragmento in dividir_oraciones(texto, CONFIG["ELEVEN_FRAGMENTO_CHARS"]):
+        total += len(fragmento)
+        if total > CONFIG["ELEVEN_MAX_CHARS"] and fragmentos:
+            logger.warning("Voz recortada a %s fragmentos por ELEVEN_MAX_CHARS (%s)", len(fragmentos), CONFIG['ELEVEN_MAX_CHARS'])
+            break
+        fragmentos.append(fragmento)
+    return fragmentos
+
+_ESTADISTICAS_VOZ = {"hits": 0, "misses": 0}
+
+def clave_cache_voz(fragmento: str) -> str:
+    """Hash de voz (URL), modelo y texto del fragmento."""
+    material = json.dumps([CONFIG["ELEVEN_URL"], CONFIG["ELEVEN_MODEL"], fragmento], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def ruta_cache_voz(clave: str) -> str:
+    """Ruta del audio cacheado de un fragmento."""
+    return os.path.join(CONFIG["CACHE_DIR"], "voz", f"{clave}.mp3")
+
+def estadisticas_cache_voz() -> Dict[str, int]:
+    """Fragmentos servidos del cache y fragmentos sintetizados."""
+    return dict(_ESTADISTICAS_VOZ)
+
+def _leer_bytes(ruta: str) -> bytes:
+    with open(ruta, "rb") as archivo:
+        return archivo.read()
+
+def _escribir_atomico(ruta: str, datos: bytes) -> None:
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{threading.get_ident()}.tmp"
+    with open(temporal, "wb") as archivo:
+        archivo.write(datos)
+    os.replace(temporal, ruta)
+
+@trazado()
+async def _sintetizar_fragmento_async(fragmento: str, usar_cache: bool = True) -> Optional[bytes]:
+    """Audio de un fragmento: del cache si ya se sintetizó, si no de ElevenLabs."""
+    ruta = ruta_cache_voz(clave_cache_voz(fragmento)) if usar_cache and CONFIG["CACHE_VOZ"] else None
+    if ruta and os.path.exists(ruta):
+        _ESTADISTICAS_VOZ["hits"] += 1
+        return await asyncio.to_thread(_leer_bytes, ruta)
+    _ESTADISTICAS_VOZ["misses"] += 1
+    
+    headers = {
+        "xi-api-key": CONFIG["ELEVEN_KEY"],
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "text": fragmento,
+        "model_id": CONFIG["ELEVEN_MODEL"]
+    }
+    
+    try:
+        async with llamar_proveedor(
+            "eleven",
+            "POST",
+            CONFIG["ELEVEN_URL"],
+            json=payload,
+            headers=headers
+        ) as r:
+            await r.aread()
+        
+        if r.status_code == 200:
+            if ruta:
+                await asyncio.to_thread(_escribir_atomico, ruta, r.content)
+            return r.content
         else:
-            resultado["tipo"] = "texto"
-            respuesta = generar_texto_cainal(orden, uso_webhook=True)
+            registrar_error("voz", "connection")
+            logger.error("Error en ElevenLabs: %s", r.status_code)
+            return None
+            
+    except Exception as e:
+        registrar_error("voz", tipo_error(e))
+        logger.error("Error al generar voz: %s", e)
+        return None
+
+# =========================================================
+# ORQUESTACIÓN: IMÁGENES Y VOZ EN PARALELO
+# =========================================================
+
+async def orquestar_respuesta_async(texto: str, descripciones: List[str], con_voz: bool = True,
+                                    usar_cache: bool = True) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Etapa de orquestación de una respuesta ya escrita: arranca al mismo
+    tiempo los renders de todas sus imágenes y la síntesis de su voz, así
+    el tiempo total es max(imágenes, voz) y no la suma.
+    Entrega ("imagen", (índice, ruta)) y ("audio", bytes) conforme llegan.
+    """
+    canal: asyncio.Queue = asyncio.Queue()
+    
+    async def _imagenes():
+        async for indice_ruta in generar_imagenes_cainal_stream_async(descripciones, usar_cache):
+            await canal.put(("imagen", indice_ruta))
+    
+    async def _voz():
+        async for audio in generar_voz_cainal_stream_async(texto, usar_cache):
+            await canal.put(("audio", audio))
+    
+    async def _avisar_fin(productor: Awaitable[None]):
+        try:
+            await productor
+        except Exception as e:
+            logger.error("Error en la orquestación de imágenes y voz: %s", e)
+        finally:
+            canal.put_nowait(None)
+    
+    productores = []
+    if descripciones:
+        productores.append(_imagenes())
+    if con_voz:
+        productores.append(_voz())
+    tareas = [asyncio.ensure_future(_avisar_fin(productor)) for productor in productores]
+    try:
+        pendientes = len(tareas)
+        while pendientes:
+            evento = await canal.get()
+            if evento is None:
+                pendientes -= 1
+                continue
+            yield evento
+    finally:
+        for tarea in tareas:
+            tarea.cancel()
+
+# =========================================================
+# INFRAESTRUCTURA: ENTREGA DE RESULTADOS POR CALLBACK (OUTBOX)
+# =========================================================
+
+# Una orden con callback_url deja su resultado en un buzón SQLite al cerrar
+# (el worker no espera al receptor). Un repartidor en el loop del núcleo lo
+# drena: reclama entregas vencidas, las junta por destino cuando el cliente
+# lo permitió (callback_lote) y las manda por el pool HTTP "callback" con a
+# lo más CALLBACK_CONCURRENCIA envíos en vuelo. Un fallo reprograma la
+# entrega con backoff (o Retry-After); tras CALLBACK_REINTENTOS queda como
+# fallida. Entrega al menos una vez: el receptor deduplica por job_id.
+
+# Estatus del receptor que vale la pena reintentar (el resto de 4xx es definitivo)
+ESTATUS_CALLBACK_REINTENTABLES = {408, 425, 429}
+
+def validar_callback(url: str) -> str:
+    """URL de callback limpia; ValueError si no es http(s) o su host no está permitido."""
+    url = url.strip()
+    partes = urlsplit(url)
+    if len(url) > 2048 or partes.scheme not in ("http", "https") or not partes.hostname:
+        raise ValueError("callback_url debe ser una URL http(s) completa")
+    try:
+        revisar_destino_callback(partes.hostname)
+    except OSError:
+        raise ValueError(f"callback_url a {partes.hostname}: el host no resuelve")
+    return url
+
+def revisar_destino_callback(host: str) -> None:
+    """
+    Los callbacks salen del worker: un host fuera de CALLBACK_HOSTS (si hay
+    lista) o que resuelve a loopback, red privada, link-local (metadatos de
+    la nube) o reservada lanza ValueError, salvo que esté en CALLBACK_HOSTS.
+    Se revisa al recibir la orden y otra vez al entregar (DNS rebinding).
+    Lanza OSError si el host no resuelve.
+    """
+    host = host.lower().strip("[]")
+    permitidos = CONFIG["CALLBACK_HOSTS"]
+    if host in permitidos:
+        return
+    if permitidos:
+        raise ValueError(f"callback_url a {host} no está permitido (CALLBACK_HOSTS)")
+    for *_, direccion in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP):
+        ip = ipaddress.ip_address(direccion[0].split("%")[0])
+        if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(
+                f"callback_url a {host} resuelve a una dirección interna ({ip}); agrégalo a CALLBACK_HOSTS si es a propósito"
+            )
+
+def cuerpo_callback(resultado: Dict[str, Any], item: Dict[str, Any]) -> Dict[str, Any]:
+    """Lo que recibe el cliente por cada orden terminada (lo mismo que /jobs/<id>, en corto)."""
+    return {
+        "job_id": item.get("job_id"),
+        "trace_id": item.get("trace_id"),
+        "estado": "completado" if resultado["exitoso"] else "fallido",
+        "exitoso": resultado["exitoso"],
+        "tipo": resultado.get("tipo"),
+        "orden": resultado.get("orden", item.get("orden")),
+        "salida": resultado.get("salida"),
+        "error": resultado.get("error"),
+        "timestamp": datetime.now().isoformat()
+    }
+
+class BuzonCallbacks(AlmacenSQLite):
+    """
+    Entregas pendientes en SQLite, compartidas entre procesos: cada una se
+    reclama con un timeout de visibilidad como las órdenes de ColaDurable, se
+    borra al entregarse y se reprograma al fallar. Las fallidas se guardan
+    hasta TRABAJOS_RETENCION para revisarlas.
+    """
+    
+    PURGA_CADA = 200
+    
+    def __init__(self, ruta: str, visibilidad: float, reintentos: int, retencion: float):
+        super().__init__(ruta)
+        self.visibilidad = visibilidad
+        self.reintentos = reintentos
+        self.retencion = retencion
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entregas ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "destino TEXT NOT NULL, "
+            "agrupar INTEGER NOT NULL DEFAULT 0, "
+            "cuerpo TEXT NOT NULL, "
+            "estado TEXT NOT NULL DEFAULT 'pendiente', "
+            "intentos INTEGER NOT NULL DEFAULT 0, "
+            "visible_desde REAL NOT NULL, "
+            "creado REAL NOT NULL, "
+            "error TEXT, "
+            "dueno INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_entregas_visibles ON entregas(estado, visible_desde)")
+    
+    def encolar(self, destino: str, cuerpo: Dict[str, Any], agrupar: bool = False) -> int:
+        """Deja una entrega en el buzón y regresa su id (ya persistida al regresar)."""
+        ahora = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO entregas (destino, agrupar, cuerpo, visible_desde, creado) VALUES (?, ?, ?, ?, ?)",
+                (destino, int(agrupar), json.dumps(cuerpo, ensure_ascii=False), ahora, ahora)
+            )
+        return cursor.lastrowid
+    
+    def reclamar(self, envios: int, lote: int = 1) -> List[List[Dict[str, Any]]]:
+        """
+        Toma las entregas vencidas más viejas que caben en `envios` POSTs
+        (hasta `lote` juntas por destino si el cliente lo permitió) y las
+        esconde mientras se mandan. Solo se reclama lo que sale de inmediato.
+        """
+        if envios <= 0:
+            return []
+        ahora = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                filas = self._db.execute(
+                    "SELECT id, destino, agrupar, cuerpo, intentos, creado FROM entregas "
+                    "WHERE estado = 'pendiente' AND visible_desde <= ? ORDER BY id LIMIT ?",
+                    (ahora, envios * max(1, lote))
+                ).fetchall()
+                candidatas = [
+                    {"id": id_entrega, "destino": destino, "agrupar": bool(agrupar), "cuerpo": cuerpo,
+                     "intentos": intentos + 1, "creado": creado}
+                    for id_entrega, destino, agrupar, cuerpo, intentos, creado in filas
+                ]
+                reclamados = _agrupar_entregas(candidatas, lote)[:envios]
+                ids = [entrega["id"] for envio in reclamados for entrega in envio]
+                if ids:
+                    self._db.executemany(
+                        "UPDATE entregas SET visible_desde = ?, intentos = intentos + 1, dueno = ? WHERE id = ?",
+                        [(ahora + self.visibilidad, os.getpid(), id_entrega) for id_entrega in ids]
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+        return reclamados
+    
+    def confirmar(self, ids: List[int]) -> None:
+        """Entregas recibidas por el destino: salen del buzón."""
+        with self._lock:
+            self._db.executemany("DELETE FROM entregas WHERE id = ?", [(i,) for i in ids])
+    
+    def reprogramar(self, ids: List[int], espera: float, error: str) -> int:
+        """
+        Vuelve a intentar las entregas en `espera` segundos; las que ya
+        agotaron CALLBACK_REINTENTOS quedan fallidas. Regresa cuántas fallaron.
+        """
+        ahora = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            marcas = ",".join("?" * len(ids))
+            fallidas = self._db.execute(
+                f"UPDATE entregas SET estado = 'fallido', error = ? WHERE id IN ({marcas}) AND intentos >= ?",
+                (error, *ids, self.reintentos)
+            ).rowcount
+            self._db.execute(
+                f"UPDATE entregas SET visible_desde = ?, error = ?, dueno = NULL "
+                f"WHERE id IN ({marcas}) AND estado = 'pendiente'",
+                (ahora + espera, error, *ids)
+            )
+            self._db.execute("COMMIT")
+            self._contar_escrituras(ahora, fallidas)
+        return fallidas
+    
+    def descartar(self, ids: List[int], error: str) -> None:
+        """El destino rechazó la entrega para siempre (4xx): queda fallida sin reintentos."""
+        with self._lock:
+            marcas = ",".join("?" * len(ids))
+            self._db.execute(
+                f"UPDATE entregas SET estado = 'fallido', error = ? WHERE id IN ({marcas})", (error, *ids)
+            )
+            self._contar_escrituras(time.time(), len(ids))
+    
+    def recuperar(self) -> int:
+        """Al arrancar: vuelve visibles las entregas que dejó a medias un proceso muerto."""
+        ahora = time.time()
+        with self._lock:
+            duenos = [fila[0] for fila in self._db.execute(
+                "SELECT DISTINCT dueno FROM entregas WHERE estado = 'pendiente' AND visible_desde > ? "
+                "AND dueno IS NOT NULL", (ahora,)
+            )]
+            muertos = [d for d in duenos if d == os.getpid() or not _proceso_vivo(d)]
+            if not muertos:
+                return 0
+            cursor = self._db.execute(
+                f"UPDATE entregas SET visible_desde = ?, dueno = NULL WHERE estado = 'pendiente' "
+                f"AND visible_desde > ? AND dueno IN ({','.join('?' * len(muertos))})",
+                (ahora, ahora, *muertos)
+            )
+        return cursor.rowcount
+    
+    def estadisticas(self) -> Dict[str, int]:
+        """Entregas por estado (pendientes incluye las que están en vuelo)."""
+        with self._lock:
+            filas = self._db.execute("SELECT estado, COUNT(*) FROM entregas GROUP BY estado").fetchall()
+        conteo = dict(filas)
+        return {"pendientes": conteo.get("pendiente", 0), "fallidas": conteo.get("fallido", 0)}
+    
+    def _purgar(self, ahora: float) -> int:
+        # Las fallidas más viejas que la retención (las escrituras que cuentan son los cierres)
+        return self._db.execute(
+            "DELETE FROM entregas WHERE estado = 'fallido' AND creado < ?", (ahora - self.retencion,)
+        ).rowcount
+
+_BUZON = Perezoso(lambda: BuzonCallbacks(
+    CONFIG["CALLBACK_DB"],
+    # Lo reclamado sale de inmediato: basta cubrir un POST con holgura
+    visibilidad=max(60.0, 3 * CONFIG["CALLBACK_TIMEOUT"]),
+    reintentos=CONFIG["CALLBACK_REINTENTOS"],
+    retencion=CONFIG["TRABAJOS_RETENCION"]
+))
+
+def obtener_buzon_callbacks() -> BuzonCallbacks:
+    """Regresa el buzón de callbacks, abriéndolo la primera vez."""
+    return _BUZON()
+
+# Aviso al repartidor de este proceso: (loop, evento); los de otros procesos sondean
+_AVISO_CALLBACKS: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = None
+
+def encolar_callback(callback: Dict[str, Any], cuerpo: Dict[str, Any]) -> None:
+    """Deja el resultado en el buzón y despierta al repartidor (se llama desde hilos)."""
+    obtener_buzon_callbacks().encolar(callback["url"], cuerpo, callback.get("lote", False))
+    aviso = _AVISO_CALLBACKS
+    if aviso is not None:
+        aviso[0].call_soon_threadsafe(aviso[1].set)
+
+def _agrupar_entregas(entregas: List[Dict[str, Any]], lote: int) -> List[List[Dict[str, Any]]]:
+    """Envíos a hacer, en orden: uno por entrega, o hasta `lote` juntas si el destino acepta lotes."""
+    envios, lotes, tamano = [], {}, max(1, lote)
+    for entrega in entregas:
+        if not entrega["agrupar"]:
+            envios.append([entrega])
+            continue
+        lote = lotes.get(entrega["destino"])
+        if lote is None or len(lote) >= tamano:
+            lote = lotes[entrega["destino"]] = []
+            envios.append(lote)
+        lote.append(entrega)
+    return envios
+
+def _espera_callback(intento: int) -> float:
+    """Backoff exponencial acotado con jitter para reintentar una entrega."""
+    tope = min(CONFIG["CALLBACK_BACKOFF_MAX"], CONFIG["CALLBACK_BACKOFF_BASE"] * (2 ** (intento - 1)))
+    return random.uniform(tope / 2, tope)
+
+async def _entregar_async(envio: List[Dict[str, Any]]) -> None:
+    """Un POST al destino con una entrega (el resultado tal cual) o un lote ({"resultados": [...]})."""
+    buzon = obtener_buzon_callbacks()
+    ids = [entrega["id"] for entrega in envio]
+    intento = max(entrega["intentos"] for entrega in envio)
+    if envio[0]["agrupar"]:
+        cuerpo = '{"resultados": [' + ",".join(entrega["cuerpo"] for entrega in envio) + "]}"
+    else:
+        cuerpo = envio[0]["cuerpo"]
+    headers = {
+        "Content-Type": "application/json",
+        "User-Agent": "EL-CAINAL-callbacks",
+        "X-Cainal-Intento": str(intento)
+    }
+    
+    inicio = time.perf_counter()
+    try:
+        await asyncio.to_thread(revisar_destino_callback, urlsplit(envio[0]["destino"]).hostname or "")
+    except ValueError as e:
+        await asyncio.to_thread(buzon.descartar, ids, str(e))
+        METRICA_CALLBACKS.incrementar("fallido", cantidad=len(ids))
+        logger.warning("Callback a %s bloqueado: %s", envio[0]["destino"], e)
+        return
+    except OSError as e:
+        # DNS caído: se reintenta como cualquier error de conexión
+        fallidas = await asyncio.to_thread(buzon.reprogramar, ids, _espera_callback(intento), f"DNS: {e}")
+        METRICA_CALLBACKS.incrementar("reintento", cantidad=len(ids) - fallidas)
+        if fallidas:
+            METRICA_CALLBACKS.incrementar("fallido", cantidad=fallidas)
+        return
+    try:
+        respuesta = await obtener_cliente("callback").post(
+            envio[0]["destino"], content=cuerpo.encode("utf-8"), headers=headers
+        )
+        error, espera = None, None
+        if respuesta.status_code >= 300:
+            error = f"HTTP {respuesta.status_code}"
+            if respuesta.status_code >= 500 or respuesta.status_code in ESTATUS_CALLBACK_REINTENTABLES:
+                espera = _espera_retry_after(respuesta, intento)
+                espera = max(espera or CONFIG["CALLBACK_BACKOFF_MAX"], _espera_callback(intento))
+    except httpx.HTTPError as e:
+        registrar_error("callback", tipo_error(e))
+        error, espera = f"{type(e).__name__}: {e}", _espera_callback(intento)
+    METRICA_CALLBACK.observar(time.perf_counter() - inicio, "lote" if envio[0]["agrupar"] else "individual")
+    
+    if error is None:
+        await asyncio.to_thread(buzon.confirmar, ids)
+        METRICA_CALLBACKS.incrementar("entregado", cantidad=len(ids))
+    elif espera is None:
+        await asyncio.to_thread(buzon.descartar, ids, error)
+        METRICA_CALLBACKS.incrementar("fallido", cantidad=len(ids))
+        logger.warning("Callback rechazado por %s (%s): %s entregas descartadas", envio[0]["destino"], error, len(ids))
+    else:
+        fallidas = await asyncio.to_thread(buzon.reprogramar, ids, espera, error)
+        METRICA_CALLBACKS.incrementar("reintento", cantidad=len(ids) - fallidas)
+        if fallidas:
+            METRICA_CALLBACKS.incrementar("fallido", cantidad=fallidas)
+            logger.warning("Callback a %s sin éxito tras %s intentos: %s entregas fallidas",
+                           envio[0]["destino"], intento, fallidas)
+
+async def _entregar_seguro_async(envio: List[Dict[str, Any]]) -> None:
+    """_entregar_async sin dejar escapar errores (la entrega vuelve sola al vencer su visibilidad)."""
+    try:
+        await _entregar_async(envio)
+    except Exception as e:
+        registrar_error("callback", "internal")
+        logger.error("Error entregando callback a %s: %s", envio[0]["destino"], e)
+
+async def repartir_callbacks_async() -> None:
+    """
+    Repartidor del buzón (uno por proceso worker): despierta con cada
+    resultado nuevo de este proceso o cada CALLBACK_SONDEO segundos
+    (reintentos vencidos, entregas de otros procesos) y manda todo lo vencido
+    sin pasar de CALLBACK_CONCURRENCIA envíos en vuelo. Cada envío reclamado
+    arranca en cuanto se reclama: nada espera turno con la visibilidad corriendo.
+    """
+    global _AVISO_CALLBACKS
+    evento = asyncio.Event()
+    _AVISO_CALLBACKS = (asyncio.get_running_loop(), evento)
+    buzon = obtener_buzon_callbacks()
+    en_vuelo: set = set()
+    
+    while True:
+        try:
+            await asyncio.wait_for(evento.wait(), CONFIG["CALLBACK_SONDEO"])
+            # Un respiro para que se junten más resultados del mismo destino
+            await asyncio.sleep(CONFIG["CALLBACK_ESPERA_LOTE"])
+        except asyncio.TimeoutError:
+            pass
+        evento.clear()
+        
+        while True:
+            libres = CONFIG["CALLBACK_CONCURRENCIA"] - len(en_vuelo)
+            if libres <= 0:
+                await asyncio.wait(en_vuelo, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                envios = await asyncio.to_thread(buzon.reclamar, libres, CONFIG["CALLBACK_LOTE"])
+            except Exception as e:
+                logger.error("Error al reclamar callbacks: %s", e)
+                break
+            for envio in envios:
+                tarea = asyncio.create_task(_entregar_seguro_async(envio))
+                en_vuelo.add(tarea)
+                tarea.add_done_callback(en_vuelo.discard)
+            if len(envios) < libres:
+                break
+
+# =========================================================
+# INFRAESTRUCTURA: WORKER Y WEBHOOK
+# =========================================================
+
+def _nuevo_resultado(orden: str) -> Dict[str, Any]:
+    """Estructura base del resultado de una orden."""
+    return {
+        "orden": orden,
+        "timestamp": datetime.now().isoformat(),
+        "exitoso": False,
+        "tipo": None,
+        "salida": None,
+        "error": None
+    }
+
+@trazado()
+async def _etapa_texto_async(orden: str, resultado: Dict[str, Any], usar_cache: bool = True,
+                             sesion: Optional[str] = None) -> List[str]:
+    """
+    Genera el texto de la orden y llena el resultado.
+    Regresa las descripciones de las imágenes que el texto pide (vacía si ninguna).
+    Un fallo ("⚠️ ...") va a "error", no a "salida": el trabajo queda fallido.
+    """
+    resultado["tipo"] = "texto"
+    respuesta = await generar_texto_cainal_async(orden, usar_cache=usar_cache, sesion=sesion)
+    if respuesta.startswith("⚠️"):
+        resultado["error"] = respuesta
+        return []
+    
+    # Detectar si se solicitaron imágenes en la respuesta
+    respuesta, descripciones = extraer_imagenes(respuesta)
+    if descripciones:
+        resultado["tipo"] = "texto_con_imagen"
+        resultado["salida"] = {"texto": respuesta, "imagen": None, "imagenes": []}
+    else:
+        resultado["salida"] = respuesta
+    
+    resultado["exitoso"] = True
+    return descripciones
+
+@trazado()
+async def _etapa_imagen_embebida_async(resultado: Dict[str, Any], descripciones: List[str],
+                                       usar_cache: bool = True) -> None:
+    """Genera en paralelo todas las imágenes pedidas dentro de una respuesta de texto."""
+    imagenes = await generar_imagenes_cainal_async(descripciones, usar_cache)
+    resultado["salida"]["imagenes"] = imagenes
+    resultado["salida"]["imagen"] = imagenes[0] if imagenes else None
+
+@trazado()
+async def procesar_orden_cainal_async(orden: str, usar_cache: bool = True,
+                                      sesion: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Procesa una orden individual según su tipo.
+    """
+    resultado = _nuevo_resultado(orden)
+    
+    try:
+        if orden.startswith("IMAGEN:"):
+            resultado["tipo"] = "imagen"
+            descripcion = orden.replace("IMAGEN:", "").strip()
+            path_imagen = await generar_imagen_cainal_async(descripcion, usar_cache)
             
-            # Detectar si se solicitó imagen en la respuesta
-            match = re.search(r"\[GENERA_IMAGEN:(.*?)\]", respuesta)
-            if match:
-                resultado["tipo"] = "texto_con_imagen"
-                path_imagen = generar_imagen_cainal(match.group(1))
-                respuesta = re.sub(r"\[GENERA_IMAGEN:.*?\]", "🔥 Obra forjada", respuesta)
-                resultado["salida"] = {"texto": respuesta, "imagen": path_imagen}
+            if path_imagen and not path_imagen.startswith("⚠️"):
+                resultado["exitoso"] = True
+                resultado["salida"] = path_imagen
+                logger_ordenes.info("Imagen generada: %s", path_imagen)
             else:
-                resultado["salida"] = respuesta
+                resultado["error"] = path_imagen
+                logger.error("Error al generar imagen: %s", path_imagen)
                 
-            resultado["exitoso"] = True if not respuesta.startswith("⚠️") else False
+        else:
+            descripciones = await _etapa_texto_async(orden, resultado, usar_cache, sesion)
+            if descripciones:
+                await _etapa_imagen_embebida_async(resultado, descripciones, usar_cache)
             
     except Exception as e:
-        resultado["error"] = str(e)
-        logger.error(f"Error procesando orden: {e}")
+        resultado["error"] = str(e)
+        logger.error("Error procesando orden: %s", e)
+    
+    return resultado
+
+def procesar_orden_cainal(orden: str, usar_cache: bool = True) -> Dict[str, Any]:
+    """Versión síncrona de procesar_orden_cainal_async."""
+    return ejecutar_async(procesar_orden_cainal_async(orden, usar_cache))
+
+def _finalizar_orden(resultado: Dict[str, Any], item: Dict[str, Any]) -> None:
+    """Cierre de una orden ya procesada por cualquier carril."""
+    tipo = resultado.get("tipo") or "desconocido"
+    METRICA_ORDEN.observar(max(0.0, time.time() - item["encolado"]), tipo)
+    METRICA_ORDENES.incrementar(tipo, "exito" if resultado["exitoso"] else "fallo")
+    if resultado["exitoso"]:
+        logger_ordenes.info("✅ Orden completada: %s", resultado['tipo'])
+    else:
+        logger.error("❌ Orden fallida: %s", resultado.get('error', 'Error desconocido'))
+    
+    if item.get("job_id"):
+        obtener_trabajos().cerrar(item["job_id"], resultado)
+    if item.get("callback"):
+        # Solo se deja en el buzón; el repartidor lo manda sin detener al carril
+        encolar_callback(item["callback"], cuerpo_callback(resultado, item))
+
+async def _atender_item_async(carril: str, item: Dict[str, Any]) -> None:
+    """
+    Atiende una orden reclamada de un carril dentro del loop del núcleo.
+    Las órdenes de texto que piden imagen pasan al carril "texto_con_imagen".
+    La orden solo se confirma (ack) al terminar; si algo revienta se queda en
+    la cola y vuelve a salir al vencer su visibilidad. Mientras corre, su
+    visibilidad se renueva para que una orden lenta no la reclame otro.
+    """
+    PRIORIDAD_ACTUAL.set(item.get("prioridad", PRIORIDAD_BULK))
+    CONTEXTO_LOG.set({"orden_id": item["id"], "job_id": item.get("job_id"), "carril": carril})
+    # La traza arranca al encolar: el primer tramo es la espera en la cola
+    traza = obtener_traza(item.get("trace_id") or item.get("job_id") or f"orden-{item['id']}",
+                          item["orden"], item["encolado"])
+    # Un reintento tras un intento fallido sigue en la misma traza, otra vez abierta
+    traza.fin = traza.error = None
+    TRAZA_ACTUAL.set(traza)
+    traza.agregar_tramo("cola_espera", time.perf_counter() - item["espera"], item["espera"],
+                        traza.rama(_clave_rama()), atributos={"carril": carril, "intento": item["intentos"]})
+    latido = asyncio.create_task(_extender_visibilidad_async(item))
+    terminada, error = False, None
+    try:
+        with tramo(f"carril:{carril}", orden_id=item["id"]):
+            terminada = await perfilar_async(_procesar_item_async(carril, item), traza)
+    except asyncio.CancelledError:
+        error = "cancelada"
+        raise
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        registrar_error("worker", "internal")
+        logger.error("💀 ERROR CRÍTICO EN WORKER [%s]: %s", carril, e)
+    finally:
+        latido.cancel()
+        # Solo queda abierta la traza de una orden que pasó a otro carril
+        if terminada or error:
+            cerrar_traza(traza, error)
+
+async def _extender_visibilidad_async(item: Dict[str, Any]) -> None:
+    """Renueva la visibilidad de la orden cada tercio del timeout hasta que la cancelen."""
+    cola = obtener_cola()
+    intervalo = max(1.0, cola.visibilidad / 3)
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            vigente = await asyncio.to_thread(cola.extender, item["id"], item["reclamo"])
+        except Exception as e:
+            logger.warning("No se pudo extender la visibilidad de la orden #%s: %s", item["id"], e)
+            continue
+        if not vigente:
+            logger.warning("La orden #%s ya no es de este worker (venció su visibilidad)", item["id"])
+            return
+
+async def _procesar_item_async(carril: str, item: Dict[str, Any]) -> bool:
+    """
+    Trabajo de _atender_item_async para una orden ya trazada.
+    Regresa False si la orden solo pasó a otro carril (todavía no termina).
+    """
+    cola = obtener_cola()
+    if item.get("job_id") and carril != "texto_con_imagen":
+        await asyncio.to_thread(obtener_trabajos().iniciar, item["job_id"])
     
-    return resultado
+    if item["intentos"] > CONFIG["COLA_MAX_INTENTOS"]:
+        resultado = item.get("resultado") or _nuevo_resultado(item["orden"])
+        resultado["exitoso"] = False
+        resultado["error"] = f"Orden descartada tras {item['intentos'] - 1} intentos"
+    elif carril == "texto":
+        resultado = _nuevo_resultado(item["orden"])
+        descripciones = await _etapa_texto_async(item["orden"], resultado, item.get("cache", True), item.get("sesion"))
+        if descripciones:
+            await asyncio.to_thread(cola.mover, item["id"], "texto_con_imagen", {
+                "orden": item["orden"],
+                "cache": item.get("cache", True),
+                "job_id": item.get("job_id"),
+                "trace_id": item.get("trace_id"),
+                "callback": item.get("callback"),
+                "resultado": resultado,
+                "descripciones": descripciones
+            }, item["reclamo"])
+            return False
+    elif carril == "texto_con_imagen":
+        resultado = item["resultado"]
+        # "descripcion" (una sola) viene de órdenes encoladas antes de la versión multi-imagen
+        descripciones = item.get("descripciones") or [item["descripcion"]]
+        await _etapa_imagen_embebida_async(resultado, descripciones, item.get("cache", True))
+    else:
+        resultado = await procesar_orden_cainal_async(item["orden"], item.get("cache", True), item.get("sesion"))
+    
+    await asyncio.to_thread(_finalizar_orden, resultado, item)
+    if not await asyncio.to_thread(cola.confirmar, item["id"], item["reclamo"]):
+        logger.warning("La orden #%s la reclamó otro worker antes del ack (venció su visibilidad)", item["id"])
+    return True
+
+def _liberar_cupo(carril: str, cupo: threading.BoundedSemaphore, futuro) -> None:
+    """Devuelve el cupo del carril cuando termina una orden."""
+    with _ACTIVOS_LOCK:
+        _ACTIVOS_CARRIL[carril] -= 1
+    cupo.release()
 
-def worker_cainal():
+def worker_cainal(carril: str):
     """
-    Worker principal que procesa órdenes de la cola.
+    Despachador de un carril: reclama órdenes de la cola durable y las corre
+    en el loop del núcleo, con a lo más WORKERS_<CARRIL> órdenes en vuelo.
     """
+    cola = obtener_cola()
+    cupo = threading.BoundedSemaphore(CONFIG[CARRILES[carril]])
+    loop = obtener_loop()
     while True:
-        orden = ORDER_QUEUE.get()
-        logger.info(f"🔥 ORDEN EN COLA: {orden[:100]}...")
-        
+        cupo.acquire()
         try:
-            resultado = procesar_orden_cainal(orden)
-            
-            if resultado["exitoso"]:
-                logger.info(f"✅ Orden completada: {resultado['tipo']}")
-            else:
-                logger.error(f"❌ Orden fallida: {resultado.get('error', 'Error desconocido')}")
-                
+            item = cola.reclamar(carril)
         except Exception as e:
-            logger.error(f"💀 ERROR CRÍTICO EN WORKER: {e}")
-            
-        finally:
-            ORDER_QUEUE.task_done()
+            logger.error("💀 Error al reclamar de la cola [%s]: %s", carril, e)
+            item = None
+            time.sleep(1)
+        if item is None:
+            cupo.release()
+            continue
+        
+        logger_ordenes.info("🔥 ORDEN EN COLA [%s] #%s: %s...", carril, item['id'], item['orden'][:100])
+        METRICA_ESPERA.observar(item["espera"], carril)
+        with _ACTIVOS_LOCK:
+            _ACTIVOS_CARRIL[carril] += 1
+        
+        futuro = asyncio.run_coroutine_threadsafe(_atender_item_async(carril, item), loop)
+        futuro.add_done_callback(partial(_liberar_cupo, carril, cupo))
 
 # =========================================================
 # WEBHOOK FLASK (CANAL EXTERNO)
 # =========================================================
 
-app = Flask(__name__)
+# Las rutas se anotan aquí y la app Flask se arma hasta que alguien la pide
+# (modos webhook/all, gunicorn "app:app" o pruebas con app.app.test_client()).
+# Las de administración (admin=True) las sirve el listener de los modos
+# worker y all, que es donde viven las trazas, perfiles y métricas de las
+# órdenes; en el puerto público del webhook solo existen con ADMIN_TOKEN.
+_RUTAS: List[Tuple[str, Any, Dict[str, Any], bool]] = []
+_APP_FLASK = None
+_APP_ADMIN = None
+_APP_FLASK_LOCK = threading.Lock()
+
+def ruta_webhook(regla: str, admin: bool = False, **opciones: Any):
+    """Como @app.route, pero sin importar Flask al cargar el módulo."""
+    def decorador(funcion):
+        _RUTAS.append((regla, funcion, opciones, admin))
+        return funcion
+    return decorador
+
+def _armar_app_flask(solo_admin: bool):
+    global request, jsonify, Response, stream_with_context
+    from flask import Flask, request, jsonify, Response, stream_with_context
+    aplicacion = Flask(__name__)
+    for regla, funcion, opciones, admin in _RUTAS:
+        if admin:
+            aplicacion.add_url_rule(regla, view_func=_con_token_admin(funcion, publica=not solo_admin), **opciones)
+        elif not solo_admin:
+            aplicacion.add_url_rule(regla, view_func=funcion, **opciones)
+    return aplicacion
+
+def _con_token_admin(funcion, publica: bool):
+    """
+    Envuelve una ruta de administración: con ADMIN_TOKEN exige
+    "Authorization: Bearer <token>" (401 si no); sin token solo responde en
+    el listener de administración (404 en el puerto público). Prender el
+    perfilador o leer las trazas de otros clientes no es para cualquiera.
+    """
+    @wraps(funcion)
+    def vista(*args: Any, **kwargs: Any):
+        token = CONFIG["ADMIN_TOKEN"]
+        if not token and publica:
+            return jsonify({"status": "error", "message": "No existe."}), 404
+        if token and not hmac.compare_digest(
+            request.headers.get("Authorization", "").encode("utf-8"), f"Bearer {token}".encode("utf-8")
+        ):
+            return jsonify({
+                "status": "error",
+                "message": "Ruta de administración: falta el token."
+            }), 401, {"WWW-Authenticate": "Bearer"}
+        return funcion(*args, **kwargs)
+    return vista
+
+def obtener_app_flask():
+    """Regresa la app Flask del webhook, importando Flask y armándola la primera vez."""
+    global _APP_FLASK
+    preparar_proceso()
+    with _APP_FLASK_LOCK:
+        if _APP_FLASK is None:
+            _APP_FLASK = _armar_app_flask(solo_admin=False)
+        return _APP_FLASK
+
+def obtener_app_admin():
+    """Regresa la app Flask con solo las rutas de administración (listener del worker)."""
+    global _APP_ADMIN
+    with _APP_FLASK_LOCK:
+        if _APP_ADMIN is None:
+            _APP_ADMIN = _armar_app_flask(solo_admin=True)
+        return _APP_ADMIN
+
+def __getattr__(nombre: str) -> Any:
+    # `app.app` sigue existiendo para quien importa el módulo, pero perezosa
+    if nombre == "app":
+        return obtener_app_flask()
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
 
-@app.route("/webhook", methods=["POST"])
+PATRON_TRAZA = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+def traza_webhook() -> Optional[str]:
+    """Id de traza que manda el cliente en X-Trace-Id (si es válido)."""
+    id_traza = request.headers.get("X-Trace-Id", "").strip()
+    return id_traza if PATRON_TRAZA.match(id_traza) else None
+
+def sesion_webhook(data: Dict[str, Any]) -> Optional[str]:
+    """
+    Sesión de conversación que manda el cliente en "session_id" (None si no manda).
+    Lanza ValueError si el id no es válido.
+    """
+    sesion = str(data.get("session_id") or "").strip()
+    if not sesion:
+        return None
+    if not PATRON_TRAZA.match(sesion):
+        raise ValueError("session_id inválido: usa letras, números y . _ : - (máximo 128)")
+    return sesion
+
+def callback_webhook(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Callback que pide el cliente: "callback_url" y, si acepta resultados
+    juntos en un solo POST, "callback_lote": true. None si no pide.
+    Lanza ValueError si la URL no sirve.
+    """
+    url = data.get("callback_url")
+    if not url:
+        return None
+    if not isinstance(url, str):
+        raise ValueError("callback_url debe ser texto")
+    return {"url": validar_callback(url), "lote": data.get("callback_lote") is True}
+
+def cliente_webhook() -> str:
+    """X-Client-Id de la petición ("" si el cliente es anónimo)."""
+    return request.headers.get("X-Client-Id", "").strip()
+
+def idempotencia_webhook(prompt: str, usar_cache: bool, sesion: Optional[str],
+                         callback: Optional[Dict[str, Any]]) -> Optional[Tuple[str, str, str, float]]:
+    """
+    Clave de idempotencia de una orden: (clave, huella del payload, origen, ttl).
+    Con Idempotency-Key la clave es la del cliente; sin ella, el hash del
+    payload si IDEMPOTENCIA_DERIVADA_TTL > 0, el cliente se identifica con
+    X-Client-Id (los anónimos no se deduplican entre sí) y la orden no es de
+    una sesión (repetir "sí" en una plática es un turno nuevo, no un reintento).
+    Ambas van por X-Client-Id. Lanza ValueError si el header no es válido.
+    """
+    cliente = cliente_webhook()
+    material = json.dumps([
+        cliente,
+        " ".join(prompt.split()),
+        usar_cache,
+        sesion,
+        callback
+    ], ensure_ascii=False, sort_keys=True)
+    huella = hashlib.sha256(material.encode("utf-8")).hexdigest()
+    
+    clave_cliente = request.headers.get("Idempotency-Key", "").strip()
+    if clave_cliente:
+        if len(clave_cliente) > 255 or not clave_cliente.isprintable():
+            raise ValueError("Idempotency-Key inválida: texto imprimible de hasta 255 caracteres")
+        clave = hashlib.sha256(json.dumps([cliente, clave_cliente]).encode("utf-8")).hexdigest()
+        return f"h:{clave}", huella, "header", CONFIG["IDEMPOTENCIA_TTL"]
+    if CONFIG["IDEMPOTENCIA_DERIVADA_TTL"] > 0 and cliente and not sesion:
+        return f"d:{huella}", huella, "derivada", CONFIG["IDEMPOTENCIA_DERIVADA_TTL"]
+    return None
+
+def _respuesta_duplicada(previa: Dict[str, Any], origen: str, huella: str):
+    """
+    Respuesta a una orden repetida: el mismo trabajo (200), 409 si la
+    original todavía se está encolando o 422 si la Idempotency-Key ya se
+    usó con otro payload.
+    """
+    if previa["huella"] != huella:
+        METRICA_IDEMPOTENCIA.incrementar(origen, "conflicto")
+        return jsonify({
+            "status": "error",
+            "message": "Esa Idempotency-Key ya se usó con otra orden, mi rey.",
+            "timestamp": datetime.now().isoformat()
+        }), 422
+    if previa["job_id"] is None:
+        METRICA_IDEMPOTENCIA.incrementar(origen, "en_curso")
+        return jsonify({
+            "status": "en_curso",
+            "message": "La misma orden se está recibiendo ahorita; reintenta en un segundo.",
+            "timestamp": datetime.now().isoformat()
+        }), 409, {"Retry-After": "1"}
+    
+    METRICA_IDEMPOTENCIA.incrementar(origen, "duplicada")
+    logger_ordenes.info("Orden duplicada (%s) → trabajo %s", origen, previa["job_id"],
+                        extra={"job_id": previa["job_id"], "trace_id": previa["trace_id"]})
+    return jsonify({
+        "status": "duplicado",
+        "message": "Esa orden ya la tengo; aquí va el mismo trabajo.",
+        "duplicada": True,
+        "job_id": previa["job_id"],
+        "status_url": f"/jobs/{previa['job_id']}",
+        "trace_id": previa["trace_id"],
+        "trace_url": f"/traces/{previa['trace_id']}",
+        "tipo": previa["tipo"],
+        "recibida": datetime.fromtimestamp(previa["creado"]).isoformat(),
+        "timestamp": datetime.now().isoformat()
+    }), 200, {"Idempotent-Replayed": "true", "X-Trace-Id": previa["trace_id"]}
+
+def prioridad_webhook() -> int:
+    """Clase de prioridad del cliente según su X-Client-Id (WEBHOOK_CLIENTES_PRIORITARIOS)."""
+    cliente = cliente_webhook()
+    if cliente and cliente in CONFIG["WEBHOOK_CLIENTES_PRIORITARIOS"]:
+        return PRIORIDAD_CLIENTE
+    return PRIORIDAD_BULK
+
+def _respuesta_saturada(e: ColaSaturada):
+    """429 con Retry-After estimado según el ritmo de drenado."""
+    logger.warning("Orden rechazada por cola saturada: %s pendientes, reintento en %ss", e.pendientes, e.retry_after)
+    return jsonify({
+        "status": "saturado",
+        "message": "La cola anda hasta el tope, mi rey. Reintenta al rato.",
+        "retry_after": e.retry_after,
+        "queue_size": e.pendientes,
+        "timestamp": datetime.now().isoformat()
+    }), 429, {"Retry-After": str(e.retry_after)}
+
+# Streams SSE en curso en este proceso (los cuenta cualquier hilo de Flask)
+_STREAMS_ACTIVOS = 0
+_STREAMS_LOCK = threading.Lock()
+
+def tomar_stream() -> bool:
+    """Aparta un lugar para un stream SSE; False si ya hay WEBHOOK_STREAMS_MAX abiertos."""
+    global _STREAMS_ACTIVOS
+    with _STREAMS_LOCK:
+        if 0 < CONFIG["WEBHOOK_STREAMS_MAX"] <= _STREAMS_ACTIVOS:
+            return False
+        _STREAMS_ACTIVOS += 1
+        return True
+
+def soltar_stream() -> None:
+    """Devuelve el lugar de un stream al cerrarse su respuesta."""
+    global _STREAMS_ACTIVOS
+    with _STREAMS_LOCK:
+        _STREAMS_ACTIVOS -= 1
+
+def streams_activos() -> int:
+    with _STREAMS_LOCK:
+        return _STREAMS_ACTIVOS
+
+def _respuesta_streams_llenos():
+    """429 cuando ya no caben más streams SSE en este proceso."""
+    logger.warning("Stream rechazado: %s streams abiertos", streams_activos())
+    return jsonify({
+        "status": "saturado",
+        "message": "Hay demasiados streams abiertos, mi rey. Reintenta o manda la orden sin stream.",
+        "retry_after": 1,
+        "timestamp": datetime.now().isoformat()
+    }), 429, {"Retry-After": "1"}
+
+@ruta_webhook("/webhook", methods=["POST"])
 def webhook_cainal():
     """
     Endpoint para recibir órdenes vía webhook.
+    Con "callback_url" el resultado se manda por POST al terminar la orden.
+    Una orden repetida (Idempotency-Key o mismo payload dentro de la
+    ventana) regresa el trabajo original en lugar de encolarse otra vez.
+    Una orden de texto con "stream": true se atiende en línea por SSE: no
+    crea trabajo (no hay job_id ni /jobs, ni idempotencia ni callback) y el
+    resultado solo viaja en el stream. Pasa por el mismo control de admisión
+    que las encoladas y a lo más hay WEBHOOK_STREAMS_MAX abiertos a la vez.
     """
     try:
         data = request.json or {}
@@ -494,96 +4829,658 @@ def webhook_cainal():
                 "timestamp": datetime.now().isoformat()
             }), 400
         
-        # Validar tipo de orden
-        if prompt.startswith("IMAGEN:"):
-            orden_tipo = "imagen"
-        else:
-            orden_tipo = "texto"
+        try:
+            sesion = sesion_webhook(data)
+            callback = callback_webhook(data)
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e),
+                "timestamp": datetime.now().isoformat()
+            }), 400
+        
+        usar_cache = data.get("cache", True) is not False
+        prioridad = prioridad_webhook()
+        
+        # Órdenes de texto con "stream": true se atienden en línea por SSE
+        if data.get("stream") and clasificar_orden(prompt) == "texto":
+            if callback:
+                return jsonify({
+                    "status": "error",
+                    "message": "Una orden en stream no crea trabajo: callback_url no aplica.",
+                    "timestamp": datetime.now().isoformat()
+                }), 400
+            try:
+                admitir_ordenes(1, prioridad)
+            except ColaSaturada as e:
+                return _respuesta_saturada(e)
+            if not tomar_stream():
+                return _respuesta_streams_llenos()
+            logger_ordenes.info("Webhook en streaming: %s...", prompt[:50])
+            respuesta = Response(
+                stream_with_context(_eventos_stream_webhook(prompt, usar_cache, prioridad, sesion)),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+            # El lugar se suelta al cerrar la respuesta (fin del stream o cliente que se fue)
+            respuesta.call_on_close(soltar_stream)
+            return respuesta
+        
+        # Una orden repetida (misma Idempotency-Key o mismo payload) cae en el trabajo que ya existe
+        try:
+            idempotencia = idempotencia_webhook(prompt, usar_cache, sesion, callback)
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e),
+                "timestamp": datetime.now().isoformat()
+            }), 400
+        if idempotencia:
+            clave, huella, origen, ttl = idempotencia
+            previa = obtener_idempotencia().reservar(clave, huella, ttl)
+            if previa is not None:
+                return _respuesta_duplicada(previa, origen, huella)
         
-        # Encolar orden
-        ORDER_QUEUE.put(prompt)
+        # Encolar orden en el carril de su tipo (o 429 si la cola está llena)
+        id_traza = traza_webhook()
+        try:
+            orden_tipo, id_trabajo = encolar_orden(
+                prompt, usar_cache, prioridad, id_traza, sesion, callback, cliente_webhook()
+            )
+        except Exception as e:
+            # Sin trabajo no hay nada que deduplicar: el reintento del cliente debe pasar
+            if idempotencia:
+                obtener_idempotencia().liberar(clave)
+            if isinstance(e, ColaSaturada):
+                return _respuesta_saturada(e)
+            raise
+        id_traza = id_traza or id_trabajo
+        if idempotencia:
+            obtener_idempotencia().asignar(clave, id_trabajo, orden_tipo, id_traza)
+            METRICA_IDEMPOTENCIA.incrementar(origen, "nueva")
         
-        logger.info(f"Webhook procesado: {orden_tipo} - {prompt[:50]}...")
+        logger_ordenes.info("Webhook procesado: %s - %s...", orden_tipo, prompt[:50],
+                            extra={"job_id": id_trabajo, "trace_id": id_traza})
         
         return jsonify({
             "status": "on_fire",
             "message": "Orden recibida y en procesamiento",
+            "job_id": id_trabajo,
+            "status_url": f"/jobs/{id_trabajo}",
+            "trace_id": id_traza,
+            "trace_url": f"/traces/{id_traza}",
             "tipo": orden_tipo,
+            "prioridad": prioridad,
+            "session_id": sesion,
+            "callback_url": callback["url"] if callback else None,
+            "timestamp": datetime.now().isoformat(),
+            "queue_size": profundidad_colas(),
+            "carriles": {c: e["en_cola"] for c, e in estado_carriles().items()}
+        }), 200, {"X-Trace-Id": id_traza}
+        
+    except Exception as e:
+        logger.error("Error en webhook: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": "Fallo interno en el sistema",
+            "error": str(e)
+        }), 500
+
+def _leer_lote_webhook() -> Tuple[List[Any], bool, Dict[str, Any]]:
+    """
+    Elementos del cuerpo de /webhook/batch, el valor de cache por defecto y
+    las opciones del lote (callback_url, callback_lote).
+    Acepta un arreglo JSON, {"prompts": [...], "cache": ..., ...} o NDJSON.
+    """
+    tipo = request.mimetype or ""
+    if tipo in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        lineas = request.get_data(as_text=True).splitlines()
+        return [json.loads(linea) for linea in lineas if linea.strip()], True, {}
+    
+    data = request.get_json(force=True, silent=True)
+    if data is None:
+        raise ValueError("Cuerpo JSON inválido")
+    if isinstance(data, dict):
+        return data.get("prompts"), data.get("cache", True) is not False, data
+    return data, True, {}
+
+def _validar_lote(elementos: List[Any], cache_defecto: bool) -> Tuple[List[Tuple[str, bool]], List[Dict[str, Any]]]:
+    """Valida todo el lote en una pasada: órdenes listas para encolar y errores por índice."""
+    ordenes, errores = [], []
+    for indice, elemento in enumerate(elementos):
+        if isinstance(elemento, str):
+            prompt, usar_cache = elemento.strip(), cache_defecto
+        elif isinstance(elemento, dict) and isinstance(elemento.get("prompt", ""), str):
+            prompt = elemento.get("prompt", "").strip()
+            usar_cache = elemento.get("cache", cache_defecto) is not False
+        else:
+            errores.append({"indice": indice, "error": "Cada elemento debe ser texto u objeto con prompt"})
+            continue
+        if not prompt:
+            errores.append({"indice": indice, "error": "Prompt vacío"})
+            continue
+        ordenes.append((prompt, usar_cache))
+    return ordenes, errores
+
+@ruta_webhook("/webhook/batch", methods=["POST"])
+def webhook_lote_cainal():
+    """
+    Endpoint para recibir ráfagas de órdenes en una sola petición.
+    El lote se valida completo y se encola de forma atómica: si un elemento
+    falla no entra ninguno.
+    """
+    try:
+        try:
+            elementos, cache_defecto, opciones = _leer_lote_webhook()
+        except ValueError:
+            return jsonify({
+                "status": "error",
+                "message": "El lote no es JSON/NDJSON válido, mi rey.",
+                "timestamp": datetime.now().isoformat()
+            }), 400
+        
+        if not isinstance(elementos, list) or not elementos:
+            return jsonify({
+                "status": "error",
+                "message": "Manda un arreglo de prompts, aunque sea uno.",
+                "timestamp": datetime.now().isoformat()
+            }), 400
+        
+        if len(elementos) > CONFIG["WEBHOOK_LOTE_MAX"]:
+            return jsonify({
+                "status": "error",
+                "message": f"Lote de {len(elementos)} rebasa el máximo de {CONFIG['WEBHOOK_LOTE_MAX']}.",
+                "timestamp": datetime.now().isoformat()
+            }), 413
+        
+        ordenes, errores = _validar_lote(elementos, cache_defecto)
+        if errores:
+            logger.warning("Lote rechazado: %s de %s elementos inválidos", len(errores), len(elementos))
+            return jsonify({
+                "status": "error",
+                "message": "Lote rechazado completo; corrige los elementos marcados.",
+                "errores": errores[:100],
+                "timestamp": datetime.now().isoformat()
+            }), 400
+        
+        try:
+            callback = callback_webhook(opciones)
+        except ValueError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e),
+                "timestamp": datetime.now().isoformat()
+            }), 400
+        
+        id_traza = traza_webhook()
+        try:
+            encoladas = encolar_ordenes(
+                ordenes, prioridad_webhook(), id_traza, callback=callback, cliente=cliente_webhook()
+            )
+        except ColaSaturada as e:
+            return _respuesta_saturada(e)
+        logger.info("Lote de webhook encolado: %s órdenes", len(encoladas))
+        
+        if id_traza and len(encoladas) > 1:
+            trazas = [f"{id_traza}.{indice}" for indice in range(len(encoladas))]
+        else:
+            trazas = [id_traza or id_trabajo for _, id_trabajo in encoladas]
+        return jsonify({
+            "status": "on_fire",
+            "message": "Lote recibido y en procesamiento",
+            "aceptadas": len(encoladas),
+            "jobs": [
+                {"job_id": id_trabajo, "tipo": tipo, "trace_id": traza}
+                for (tipo, id_trabajo), traza in zip(encoladas, trazas)
+            ],
+            "callback_url": callback["url"] if callback else None,
             "timestamp": datetime.now().isoformat(),
-            "queue_size": ORDER_QUEUE.qsize()
+            "queue_size": profundidad_colas()
         }), 200
         
     except Exception as e:
-        logger.error(f"Error en webhook: {e}")
+        logger.error("Error en webhook por lote: %s", e)
         return jsonify({
             "status": "error",
             "message": "Fallo interno en el sistema",
             "error": str(e)
         }), 500
 
+@ruta_webhook("/jobs/<id_trabajo>", methods=["GET"])
+def consultar_trabajo(id_trabajo: str):
+    """
+    Estado y resultado de un trabajo del webhook.
+    """
+    trabajo = obtener_trabajos().obtener(id_trabajo)
+    if trabajo is None:
+        return jsonify({
+            "status": "error",
+            "message": "Ese trabajo no existe o ya se purgó, mi rey."
+        }), 404
+    return jsonify(trabajo), 200
+
+@ruta_webhook("/jobs", methods=["GET"])
+def listar_trabajos():
+    """
+    Listado paginado de los trabajos del cliente (del más nuevo al más
+    viejo), como las claves de idempotencia: por X-Client-Id, obligatorio
+    aquí. Parámetros: limit (1-200), cursor (de la página anterior), estado.
+    """
+    cliente = cliente_webhook()
+    if not cliente:
+        return jsonify({
+            "status": "error",
+            "message": "Manda tu X-Client-Id para listar tus trabajos, mi rey."
+        }), 400
+    try:
+        limite = min(max(int(request.args.get("limit", 50)), 1), 200)
+        cursor = request.args.get("cursor")
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "limit y cursor tienen que ser números."
+        }), 400
+    
+    trabajos, siguiente = obtener_trabajos().listar(limite, cursor, request.args.get("estado"), cliente)
+    return jsonify({"jobs": trabajos, "siguiente": siguiente}), 200
+
+@ruta_webhook("/outputs", admin=True, methods=["GET"])
+def listar_salidas():
+    """
+    Historial paginado de imágenes firmadas (de la más nueva a la más vieja).
+    Parámetros: limit (1-200), cursor (de la página anterior). Es la galería
+    de todo el despliegue (todos los clientes): ruta de administración.
+    """
+    try:
+        limite = min(max(int(request.args.get("limit", 50)), 1), 200)
+        cursor = request.args.get("cursor")
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "limit y cursor tienen que ser números."
+        }), 400
+    
+    salidas, siguiente = obtener_salidas().listar(limite, cursor)
+    return jsonify({"outputs": salidas, "siguiente": siguiente}), 200
+
+@ruta_webhook("/providers", admin=True, methods=["GET"])
+def consultar_proveedores():
+    """
+    Estado de cada proveedor: disyuntor (cerrado/abierto/semiabierto),
+    cubeta de tokens, compuerta de prioridad y contadores de llamadas.
+    """
+    return jsonify({
+        "proveedores": estado_proveedores(),
+        "timestamp": datetime.now().isoformat()
+    }), 200
+
+@ruta_webhook("/traces", admin=True, methods=["GET"])
+def listar_trazas_webhook():
+    """
+    Trazas en memoria de este proceso. Parámetros: limit (1-500) y
+    orden=lentas para ver primero las más lentas.
+    """
+    try:
+        limite = min(max(int(request.args.get("limit", 50)), 1), 500)
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit tiene que ser número."}), 400
+    return jsonify({"traces": listar_trazas(limite, request.args.get("orden") == "lentas")}), 200
+
+@ruta_webhook("/traces/<id_traza>", admin=True, methods=["GET"])
+def consultar_traza(id_traza: str):
+    """
+    Tramos de una orden: cola, carriles, proveedores, firma y guardado.
+    Con ?format=chrome sale en formato de eventos de Chrome (chrome://tracing, Perfetto).
+    """
+    traza = buscar_traza(id_traza)
+    if traza is None:
+        remota = consultar_workers(f"/traces/{id_traza}", dict(request.args))
+        if remota is not None:
+            return Response(remota.content, status=200, mimetype="application/json")
+        return jsonify({
+            "status": "error",
+            "message": "Esa traza no existe, ya se purgó o la atendió otro proceso."
+        }), 404
+    if request.args.get("format") == "chrome":
+        return jsonify(traza.exportar_chrome()), 200
+    return jsonify(traza.exportar()), 200
+
+@ruta_webhook("/profiler", admin=True, methods=["GET", "POST"])
+def configurar_perfilador():
+    """
+    Estado del perfilador y las órdenes capturadas (GET). Con POST se
+    prende/apaga sin redesplegar: {"activo": true, "modo": "cprofile"|"muestreo",
+    "ordenes": N, "intervalo": segundos}. Solo afecta órdenes nuevas.
+    """
+    if request.method == "GET":
+        return jsonify(PERFILADOR.estado()), 200
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        estado = PERFILADOR.configurar(
+            activo=data.get("activo"),
+            modo=data.get("modo"),
+            ordenes=data.get("ordenes"),
+            intervalo=data.get("intervalo")
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify(estado), 200
+
+@ruta_webhook("/profiler/<id_traza>", admin=True, methods=["GET"])
+def consultar_perfil(id_traza: str):
+    """Salida del perfilador para una orden capturada (pstats o pilas colapsadas)."""
+    salida = PERFILADOR.obtener(id_traza)
+    if salida is None:
+        remota = consultar_workers(f"/profiler/{id_traza}")
+        if remota is not None:
+            return Response(remota.content, mimetype="text/plain")
+        return jsonify({
+            "status": "error",
+            "message": "No hay perfil de esa orden; solo se guardan las más lentas."
+        }), 404
+    return Response(salida, mimetype="text/plain")
+
+@ruta_webhook("/metrics", admin=True, methods=["GET"])
+def metricas():
+    """
+    Métricas en formato de texto de Prometheus: latencias por proveedor y por
+    tipo de orden, espera y profundidad de cola, utilización de carriles,
+    aciertos de cache, tiempo de firma y errores por tipo.
+    """
+    return Response(exponer_metricas(), mimetype="text/plain; version=0.0.4")
+
+def consultar_workers(ruta: str, parametros: Optional[Dict[str, str]] = None) -> Optional[httpx.Response]:
+    """
+    Pide `ruta` a los listeners de los workers (WORKER_ADMIN_URLS) y regresa
+    la primera respuesta 200. En modo dividido las órdenes (y sus trazas y
+    perfiles) viven en el worker que las atendió, no en el webhook.
+    """
+    # Una consulta reenviada no se vuelve a reenviar (el worker podría tenerse en la lista)
+    if request.headers.get("X-Cainal-Reenvio"):
+        return None
+    cabeceras = {"X-Cainal-Reenvio": "1"}
+    if CONFIG["ADMIN_TOKEN"]:
+        cabeceras["Authorization"] = f"Bearer {CONFIG['ADMIN_TOKEN']}"
+    for base in CONFIG["WORKER_ADMIN_URLS"]:
+        try:
+            respuesta = httpx.get(f"{base}{ruta}", params=parametros, headers=cabeceras, timeout=2.0)
+        except httpx.HTTPError as e:
+            logger.debug("Listener %s sin respuesta: %s", base, e)
+            continue
+        if respuesta.status_code == 200:
+            return respuesta
+    return None
+
+def _evento_sse(datos: Dict[str, Any], evento: Optional[str] = None) -> str:
+    """Serializa un evento server-sent events."""
+    cabecera = f"event: {evento}\n" if evento else ""
+    return f"{cabecera}data: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+def _eventos_stream_webhook(prompt: str, usar_cache: bool = True,
+                            prioridad: int = PRIORIDAD_BULK, sesion: Optional[str] = None) -> Iterator[str]:
+    """
+    Eventos SSE de una orden de texto en streaming: un evento por fragmento
+    y un evento "final" con el texto ya procesado (y las imágenes, si se pidieron).
+    """
+    acumulado, fallo = [], None
+    for fragmento in generar_texto_cainal_stream(prompt, usar_cache, prioridad, sesion):
+        if isinstance(fragmento, FalloStream):
+            # El error va en su propio evento y no se mezcla con el texto parcial
+            fallo = str(fragmento)
+            yield _evento_sse({"error": fallo}, evento="error")
+            break
+        acumulado.append(fragmento)
+        yield _evento_sse({"delta": fragmento})
+    
+    texto, descripciones = extraer_imagenes("".join(acumulado))
+    imagenes = generar_imagenes_cainal(descripciones, usar_cache, prioridad) if descripciones and not fallo else []
+    yield _evento_sse({
+        "texto": texto,
+        "imagen": imagenes[0] if imagenes else None,
+        "imagenes": imagenes,
+        "exitoso": fallo is None,
+        "error": fallo,
+        "timestamp": datetime.now().isoformat()
+    }, evento="final")
+
 def iniciar_webhook():
     """
     Inicia el servidor Flask para webhooks.
+    Con WEBHOOK_SERVIDOR=gunicorn (y desde el hilo principal) corre bajo
+    gunicorn en varios procesos.
     """
-    logger.info(f"Iniciando webhook en puerto {CONFIG['WEBHOOK_PORT']}")
-    app.run(
+    if CONFIG["WEBHOOK_SERVIDOR"] == "gunicorn":
+        if threading.current_thread() is threading.main_thread():
+            return iniciar_webhook_gunicorn()
+        logger.warning("gunicorn solo corre en el hilo principal (modo webhook); se usa el servidor de Flask")
+    logger.info("Iniciando webhook en puerto %s", CONFIG['WEBHOOK_PORT'])
+    obtener_app_flask().run(
         host="0.0.0.0",
         port=CONFIG["WEBHOOK_PORT"],
         threaded=True,
         use_reloader=False
     )
 
+def iniciar_admin_worker():
+    """
+    Listener de administración de los modos worker y all en WORKER_ADMIN_PORT:
+    las trazas, perfiles, métricas y disyuntores son de cada proceso, y los
+    que atienden órdenes son los workers, no el webhook. Si el puerto está
+    ocupado se avisa y el proceso sigue sin listener.
+    """
+    from werkzeug.serving import make_server
+    
+    try:
+        servidor = make_server("0.0.0.0", CONFIG["WORKER_ADMIN_PORT"], obtener_app_admin(), threaded=True)
+    except OSError as e:
+        logger.error("No se pudo abrir el listener de administración en el puerto %s: %s",
+                     CONFIG["WORKER_ADMIN_PORT"], e)
+        return None
+    threading.Thread(target=servidor.serve_forever, name="admin_worker", daemon=True).start()
+    logger.info("✅ Listener de administración del worker en puerto %s", CONFIG["WORKER_ADMIN_PORT"])
+    return servidor
+
+def iniciar_webhook_gunicorn():
+    """
+    Webhook bajo gunicorn: WEBHOOK_PROCESOS procesos con WEBHOOK_HILOS hilos
+    cada uno. Cada proceso arma su app Flask después del fork (sin preload) y
+    abre su propia conexión a la cola durable; todos encolan en el mismo
+    archivo SQLite y los workers (--modo worker) los ven en COLA_SONDEO.
+    Equivale a: gunicorn -k gthread -w N --threads H "app:obtener_app_flask()"
+    """
+    from gunicorn.app.base import BaseApplication
+    
+    class ServidorWebhook(BaseApplication):
+        def load_config(self):
+            opciones = {
+                "bind": f"0.0.0.0:{CONFIG['WEBHOOK_PORT']}",
+                "workers": CONFIG["WEBHOOK_PROCESOS"],
+                "threads": CONFIG["WEBHOOK_HILOS"],
+                "worker_class": "gthread",
+                "preload_app": False,
+                "proc_name": "cainal_webhook",
+                "loglevel": CONFIG["LOG_LEVEL"].lower(),
+            }
+            for clave, valor in opciones.items():
+                self.cfg.set(clave, valor)
+        
+        def load(self):
+            return obtener_app_flask()
+    
+    logger.info(
+        "Iniciando webhook en puerto %s con gunicorn (%s procesos x %s hilos)",
+        CONFIG['WEBHOOK_PORT'], CONFIG["WEBHOOK_PROCESOS"], CONFIG["WEBHOOK_HILOS"]
+    )
+    ServidorWebhook().run()
+
 # =========================================================
 # INTERFAZ GRADIO (PORTAL HUMANO)
 # =========================================================
 
-def portal_interactivo(mensaje: str, tipo_accion: str) -> Tuple[str, Optional[str]]:
+def portal_interactivo(mensaje: str, tipo_accion: str, sesion: Optional[str] = None) -> Tuple[str, List[str]]:
     """
     Punto de entrada principal para la interfaz humana.
+    Regresa el texto y las rutas de las imágenes (todas las que pidió).
+    Con sesion el cotorreo se acuerda de lo que ya se platicó.
     """
     mensaje = (mensaje or "").strip()
     
     if not mensaje:
         logger.warning("Intento de interacción sin mensaje")
-        return "⚠️ Suelta algo primero, mi rey. No puedo jalar con puro vacío.", None
+        return "⚠️ Suelta algo primero, mi rey. No puedo jalar con puro vacío.", []
     
     try:
         if tipo_accion == "Cotorreo (Texto)":
-            logger.info(f"Interacción de texto: {mensaje[:50]}...")
-            respuesta = generar_texto_cainal(mensaje)
-            
-            # Detectar solicitud de imagen embebida
-            match = re.search(r"\[GENERA_IMAGEN:(.*?)\]", respuesta)
-            if match:
-                logger.info(f"Generando imagen desde texto: {match.group(1)}")
-                path_imagen = generar_imagen_cainal(match.group(1))
-                respuesta = re.sub(r"\[GENERA_IMAGEN:.*?\]", "🔥 Obra forjada", respuesta)
-                return respuesta, path_imagen if os.path.exists(path_imagen) else None
-            
-            return respuesta, None
+            logger_ordenes.info("Interacción de texto: %s...", mensaje[:50])
+            respuesta = generar_texto_cainal(mensaje, prioridad=PRIORIDAD_PORTAL, sesion=sesion)
+            texto, descripciones = extraer_imagenes(respuesta)
+            if not descripciones:
+                return texto, []
+            logger_ordenes.info("Generando %s imágenes desde texto", len(descripciones))
+            imagenes = generar_imagenes_cainal(descripciones, prioridad=PRIORIDAD_PORTAL)
+            return texto, [ruta for ruta in imagenes if os.path.exists(ruta)]
         
         else:  # Arte Visual
-            logger.info(f"Generando imagen: {mensaje[:50]}...")
-            path_imagen = generar_imagen_cainal(mensaje)
+            logger_ordenes.info("Generando imagen: %s...", mensaje[:50])
+            path_imagen = generar_imagen_cainal(mensaje, prioridad=PRIORIDAD_PORTAL)
             
             if isinstance(path_imagen, str) and not os.path.exists(path_imagen):
                 # path_imagen contiene mensaje de error
-                return path_imagen, None
+                return path_imagen, []
             
             mensaje_exito = (
                 "🔥 Amonos, jale visual terminado. "
                 "La pieza ya trae firma BATUTO-ART."
             )
-            return mensaje_exito, path_imagen
+            return mensaje_exito, [path_imagen]
             
     except Exception as e:
-        logger.error(f"Error en portal_interactivo: {e}")
-        return f"⚠️ Fallo en la interacción: {str(e)}", None
+        logger.error("Error en portal_interactivo: %s", e)
+        return f"⚠️ Fallo en la interacción: {str(e)}", []
+
+def _cerrar_respuesta_portal(respuesta: str, con_voz: bool = False) -> Iterator[Tuple[str, List[str], Optional[bytes]]]:
+    """
+    Cierra una respuesta de texto del portal: rinde todas sus imágenes y, a
+    la vez, sintetiza su voz. Entrega la galería cada vez que termina una
+    imagen y cada fragmento de audio en cuanto está listo.
+    """
+    texto, descripciones = extraer_imagenes(respuesta)
+    con_voz = con_voz and not texto.startswith("⚠️")
+    yield texto, [], None
+    if descripciones:
+        logger_ordenes.info("Generando %s imágenes desde texto", len(descripciones))
+    
+    galeria: Dict[int, str] = {}
+    eventos = iterar_async(orquestar_respuesta_async(texto, descripciones, con_voz), PRIORIDAD_PORTAL)
+    for tipo, valor in eventos:
+        if tipo == "imagen":
+            indice, ruta = valor
+            if os.path.exists(ruta):
+                galeria[indice] = ruta
+            yield texto, [galeria[i] for i in sorted(galeria)], None
+        else:
+            yield texto, [galeria[i] for i in sorted(galeria)], valor
+
+def _texto_parcial_visible(acumulado: str) -> str:
+    """Texto parcial para mostrar: etiquetas cerradas sustituidas y sin la etiqueta a medio llegar."""
+    corte = acumulado.rfind("[GENERA_IMAGEN")
+    if corte != -1 and "]" not in acumulado[corte:]:
+        acumulado = acumulado[:corte]
+    return PATRON_IMAGEN.sub("🔥 Obra forjada", acumulado)
+
+def portal_interactivo_stream(mensaje: str, tipo_accion: str, con_voz: bool = False,
+                              sesion: Optional[str] = None) -> Iterator[Tuple[str, List[str], Optional[bytes]]]:
+    """
+    Variante de portal_interactivo que entrega (texto, galería, audio)
+    conforme avanza: el texto parcial mientras llega y, ya completo, las
+    imágenes y la voz (con con_voz) generándose al mismo tiempo.
+    """
+    mensaje_limpio = (mensaje or "").strip()
+    if tipo_accion != "Cotorreo (Texto)" or not mensaje_limpio:
+        texto, imagenes = portal_interactivo(mensaje, tipo_accion, sesion)
+        yield texto, imagenes, None
+        if con_voz and not texto.startswith("⚠️"):
+            for audio in generar_voz_cainal_stream(texto, PRIORIDAD_PORTAL):
+                yield texto, imagenes, audio
+        return
+    
+    try:
+        if CONFIG["SAMBANOVA_STREAM"]:
+            logger_ordenes.info("Interacción de texto en streaming: %s...", mensaje_limpio[:50])
+            acumulado = ""
+            for fragmento in generar_texto_cainal_stream(mensaje_limpio, prioridad=PRIORIDAD_PORTAL, sesion=sesion):
+                if isinstance(fragmento, FalloStream):
+                    # Respuesta a medias: se muestra con el aviso, sin imágenes ni voz
+                    yield f"{_texto_parcial_visible(acumulado)}\n\n{fragmento}".strip(), [], None
+                    return
+                acumulado += fragmento
+                yield _texto_parcial_visible(acumulado), [], None
+        else:
+            logger_ordenes.info("Interacción de texto: %s...", mensaje_limpio[:50])
+            acumulado = generar_texto_cainal(mensaje_limpio, prioridad=PRIORIDAD_PORTAL, sesion=sesion)
+        
+        yield from _cerrar_respuesta_portal(acumulado, con_voz)
+        
+    except Exception as e:
+        logger.error("Error en portal_interactivo_stream: %s", e)
+        yield f"⚠️ Fallo en la interacción: {str(e)}", [], None
+
+def _tasa(aciertos: int, consultas: int) -> str:
+    return f"{aciertos / consultas:.0%} de {consultas}" if consultas else "sin consultas"
+
+def estado_sistema_markdown() -> str:
+    """Panel de estado del portal con valores vivos (se refresca solo)."""
+    lineas = [
+        f"- **API Texto**: {'✅' if CONFIG.get('SAMBANOVA_KEY') else '❌'}",
+        f"- **API Imagen**: {'✅' if CONFIG.get('REVE_KEY') else '❌'}",
+        f"- **API Voz**: {'✅' if CONFIG.get('ELEVEN_KEY') else '❌'}",
+    ]
+    carriles = estado_carriles()
+    total = sum(e["en_cola"] for e in carriles.values())
+    lineas.append(f"- **Órdenes en cola**: {total} (tope {CONFIG['COLA_MAX_PENDIENTES']})")
+    for carril, e in carriles.items():
+        lineas.append(f"  - `{carril}`: {e['en_cola']} en cola, {e['activos']}/{e['workers']} en proceso")
+    
+    texto = _CACHE_TEXTO.abierto.estadisticas() if _CACHE_TEXTO.abierto is not None else None
+    imagen = estadisticas_cache_imagen()
+    voz = estadisticas_cache_voz()
+    lineas.append("- **Cache**:")
+    if texto:
+        consultas = texto["hits_memoria"] + texto["hits_disco"] + texto["misses"]
+        lineas.append(f"  - texto: {_tasa(consultas - texto['misses'], consultas)}")
+    consultas = imagen["hits"] + imagen["coalescidas"] + imagen["misses"]
+    lineas.append(f"  - imagen: {_tasa(consultas - imagen['misses'], consultas)}")
+    lineas.append(f"  - voz: {_tasa(voz['hits'], voz['hits'] + voz['misses'])}")
+    
+    latencias = METRICA_PROVEEDOR.promedios()
+    lineas.append("- **Proveedores**:")
+    for proveedor, e in estado_proveedores().items():
+        cuenta, promedio = latencias.get((proveedor,), (0, 0.0))
+        latencia = f", {promedio * 1000:.0f} ms promedio" if cuenta else ""
+        lineas.append(f"  - {proveedor}: disyuntor {e['disyuntor']['estado']}, {e['llamadas']} llamadas{latencia}")
+    
+    lineas.append(f"- **Salida**: {CONFIG['OUTPUT_DIR']}")
+    return "\n".join(lineas)
+
+def pagina_galeria(pila: List[Optional[int]]) -> Tuple[List[Tuple[str, str]], str, Optional[int]]:
+    """
+    Página del historial para el portal: la de cursor pila[-1] (None es la
+    primera). Regresa las imágenes (ruta, prompt), la leyenda y el cursor de
+    la siguiente página.
+    """
+    salidas, siguiente = obtener_salidas().listar(CONFIG["GALERIA_POR_PAGINA"], pila[-1])
+    imagenes = [(s["ruta"], (s["prompt"] or "")[:80]) for s in salidas if os.path.exists(s["ruta"])]
+    leyenda = f"Página {len(pila)}" + ("" if siguiente else " (la última)") if salidas else "Todavía no hay imágenes."
+    return imagenes, leyenda, siguiente
 
 def crear_interfaz_gradio():
     """
     Construye y retorna la interfaz Gradio.
     """
+    import gradio as gr
+    
     with gr.Blocks(theme=gr.themes.Soft(), title="EL CAINAL 🤪💯") as interface:
         # Cabecera
         gr.Markdown("""
@@ -613,15 +5510,12 @@ def crear_interfaz_gradio():
                 # Botón de acción
                 boton = gr.Button("¡Zúmbale!", variant="primary", size="lg")
                 
+                # El cotorreo se acuerda de la plática de esta pestaña hasta que se borre
+                boton_nueva = gr.Button("🧹 Nueva plática", size="sm")
+                
                 # Estado del sistema
                 with gr.Accordion("📊 Estado del Sistema", open=False):
-                    gr.Markdown(f"""
-                    - **API Texto**: {'✅' if CONFIG.get('SAMBANOVA_KEY') else '❌'}
-                    - **API Imagen**: {'✅' if CONFIG.get('REVE_KEY') else '❌'}
-                    - **API Voz**: {'✅' if CONFIG.get('ELEVEN_KEY') else '❌'}
-                    - **Órdenes en cola**: {ORDER_QUEUE.qsize()}
-                    - **Salida**: {CONFIG['OUTPUT_DIR']}
-                    """)
+                    estado = gr.Markdown(estado_sistema_markdown())
             
             with gr.Column(scale=3):
                 # Salida de texto
@@ -631,10 +5525,10 @@ def crear_interfaz_gradio():
                     interactive=False
                 )
                 
-                # Salida de imagen
-                salida_imagen = gr.Image(
+                # Salida de imágenes (todas las que pida la respuesta)
+                salida_imagen = gr.Gallery(
                     label="Galería BATUTO-ART",
-                    type="filepath",
+                    columns=2,
                     interactive=False
                 )
                 
@@ -642,15 +5536,37 @@ def crear_interfaz_gradio():
                 with gr.Accordion("🎤 Audio (si aplica)", open=False):
                     salida_audio = gr.Audio(
                         label="Voz generada",
-                        type="filepath",
+                        streaming=True,
                         autoplay=False
                     )
+                
+                # Historial paginado desde el índice de salidas (no lista el disco)
+                with gr.Accordion("🖼️ Historial BATUTO-ART", open=False):
+                    historial = gr.Gallery(label="Imágenes anteriores", columns=4, interactive=False)
+                    leyenda_historial = gr.Markdown()
+                    with gr.Row():
+                        boton_anteriores = gr.Button("◀ Más nuevas", size="sm")
+                        boton_recargar = gr.Button("↻ Recargar", size="sm")
+                        boton_siguientes = gr.Button("Más viejas ▶", size="sm")
+                    # Cursores de las páginas visitadas y el de la siguiente
+                    pila_historial = gr.State([None])
+                    siguiente_historial = gr.State(None)
         
         # Conectar eventos
-        def procesar_con_voz(mensaje, tipo):
-            texto, imagen = portal_interactivo(mensaje, tipo)
-            audio = generar_voz_cainal(texto) if texto and not texto.startswith("⚠️") else None
-            return texto, imagen, audio
+        def sesion_portal(request: gr.Request) -> Optional[str]:
+            # Una sesión de conversación por pestaña del navegador
+            hash_sesion = getattr(request, "session_hash", None)
+            return f"portal-{hash_sesion}" if hash_sesion else None
+        
+        def procesar_con_voz(mensaje, tipo, request: gr.Request):
+            # Imágenes y voz arrancan juntas; el audio sale por fragmentos
+            yield from portal_interactivo_stream(mensaje, tipo, con_voz=True, sesion=sesion_portal(request))
+        
+        def nueva_platica(request: gr.Request):
+            sesion = sesion_portal(request)
+            if sesion:
+                obtener_sesiones().borrar(sesion)
+            return "", [], None
         
         boton.click(
             fn=procesar_con_voz,
@@ -664,6 +5580,32 @@ def crear_interfaz_gradio():
             inputs=[entrada, accion],
             outputs=[salida_texto, salida_imagen, salida_audio]
         )
+        
+        boton_nueva.click(fn=nueva_platica, outputs=[salida_texto, salida_imagen, salida_audio])
+        
+        # Navegación del historial
+        def mostrar_pagina(pila):
+            imagenes, leyenda, siguiente = pagina_galeria(pila)
+            return imagenes, leyenda, pila, siguiente
+        
+        def pagina_siguiente(pila, siguiente):
+            return mostrar_pagina(pila + [siguiente] if siguiente else pila)
+        
+        def pagina_anterior(pila):
+            return mostrar_pagina(pila[:-1] if len(pila) > 1 else pila)
+        
+        salidas_historial = [historial, leyenda_historial, pila_historial, siguiente_historial]
+        boton_recargar.click(fn=lambda: mostrar_pagina([None]), outputs=salidas_historial)
+        boton_siguientes.click(fn=pagina_siguiente, inputs=[pila_historial, siguiente_historial],
+                               outputs=salidas_historial)
+        boton_anteriores.click(fn=pagina_anterior, inputs=[pila_historial], outputs=salidas_historial)
+        interface.load(fn=lambda: mostrar_pagina([None]), outputs=salidas_historial)
+        
+        # Estado en vivo (gr.Timer existe desde Gradio 4.40; antes, load con every)
+        if hasattr(gr, "Timer"):
+            gr.Timer(CONFIG["ESTADO_REFRESCO"]).tick(fn=estado_sistema_markdown, outputs=estado)
+        else:
+            interface.load(fn=estado_sistema_markdown, outputs=estado, every=CONFIG["ESTADO_REFRESCO"])
     
     return interface
 
@@ -671,52 +5613,173 @@ def crear_interfaz_gradio():
 # INICIALIZACIÓN Y EJECUCIÓN PRINCIPAL
 # =========================================================
 
-def inicializar_sistema():
+# Modos de ejecución (--modo o CAINAL_MODO):
+#   webhook: solo Flask (encola y sirve /jobs); los workers corren en otro proceso
+#            (con --procesos N, bajo gunicorn en N procesos)
+#   worker:  solo los carriles que drenan la cola durable
+#   portal:  solo la interfaz Gradio
+#   all:     todo en un proceso (comportamiento original)
+MODOS = ("webhook", "worker", "portal", "all")
+
+def normalizar_modo(modo: str) -> str:
+    """Acepta también "webhook-only", "worker_only", etc."""
+    limpio = (modo or "all").strip().lower()
+    for sufijo in ("-only", "_only"):
+        if limpio.endswith(sufijo):
+            limpio = limpio[:-len(sufijo)]
+    if limpio not in MODOS:
+        raise ValueError(f"Modo desconocido: {modo} (usa {', '.join(MODOS)})")
+    return limpio
+
+# Singletons perezosos con conexión SQLite (almacenes y cache de texto)
+ALMACENES = (_COLA, _TRABAJOS, _IDEMPOTENCIA, _SALIDAS, _SESIONES, _BUZON, _CACHE_TEXTO)
+
+def _reiniciar_tras_fork() -> None:
+    """
+    En el hijo de un fork (workers de gunicorn) no sirven las conexiones
+    SQLite, el loop ni los pools del padre: se vuelven a abrir al pedirlos.
+    """
+    global _LOOP, _HILO_LOOP, _POOL_FIRMA, _AVISO_CALLBACKS, _STREAMS_ACTIVOS
+    _STREAMS_ACTIVOS = 0
+    for almacen in ALMACENES:
+        almacen.reiniciar()
+    _AVISO_CALLBACKS = None
+    _LOOP = _HILO_LOOP = None
+    _POOL_FIRMA = None
+    for estado in (_COMPUERTAS, _CLIENTES, _VUELOS_IMAGEN):
+        estado.clear()
+
+_PROCESO_LISTO = False
+_PROCESO_LOCK = threading.Lock()
+
+def preparar_proceso() -> None:
+    """
+    Lo que toca al proceso y no al import: logging (cola + hilo escritor) y
+    su vaciado al salir, los reinicios tras fork y el perfilador si
+    PERFILADOR_ACTIVO. Lo llaman inicializar_sistema y quien arma la app
+    Flask (gunicorn "app:app"); los procesos de la firma (spawn) importan el
+    módulo sin pasar por aquí. Llamarlo de nuevo no hace nada.
+    """
+    global _PROCESO_LISTO, _ESCRITOR_LOG
+    with _PROCESO_LOCK:
+        if _PROCESO_LISTO:
+            return
+        _PROCESO_LISTO = True
+        _ESCRITOR_LOG = configurar_logging()
+        atexit.register(_detener_logging)
+        os.register_at_fork(after_in_child=_reabrir_logging)
+        os.register_at_fork(after_in_child=_reiniciar_tras_fork)
+    if CONFIG["PERFILADOR_ACTIVO"]:
+        PERFILADOR.configurar(activo=True)
+
+def inicializar_sistema(modo: str = "all"):
     """
-    Inicializa todos los componentes del sistema.
+    Inicializa los componentes que necesita el modo de ejecución.
     """
-    logger.info("🔥 INICIANDO SISTEMA EL CAINAL TERMINATOR BATUTO-ART")
+    preparar_proceso()
+    logger.info("🔥 INICIANDO SISTEMA EL CAINAL TERMINATOR BATUTO-ART (modo %s)", modo)
     
     # Validar configuración
     validar_configuracion_inicial()
     
-    # Iniciar worker en segundo plano
-    worker_thread = threading.Thread(target=worker_cainal, daemon=True)
-    worker_thread.start()
-    logger.info("✅ Worker principal iniciado")
+    if modo in ("worker", "all"):
+        # Recuperar órdenes que quedaron a medias en la cola durable
+        recuperadas = obtener_cola().recuperar()
+        if recuperadas:
+            logger.warning("♻️ %s órdenes en proceso recuperadas de la cola durable", recuperadas)
+        
+        recuperadas = obtener_buzon_callbacks().recuperar()
+        if recuperadas:
+            logger.warning("♻️ %s entregas de callback recuperadas del buzón", recuperadas)
+        
+        # Arrancar el loop del núcleo, un despachador por carril y el repartidor de callbacks
+        loop = obtener_loop()
+        asyncio.run_coroutine_threadsafe(repartir_callbacks_async(), loop)
+        for carril, clave_workers in CARRILES.items():
+            threading.Thread(
+                target=worker_cainal,
+                args=(carril,),
+                name=f"worker_{carril}",
+                daemon=True
+            ).start()
+            logger.info("✅ Carril %s iniciado (concurrencia %s)", carril, CONFIG[clave_workers])
+    
+    if modo in ("worker", "all") and CONFIG["WORKER_ADMIN_PORT"] > 0:
+        iniciar_admin_worker()
     
-    # Iniciar webhook en segundo plano
-    webhook_thread = threading.Thread(target=iniciar_webhook, daemon=True)
-    webhook_thread.start()
-    logger.info(f"✅ Webhook iniciado en puerto {CONFIG['WEBHOOK_PORT']}")
+    if modo == "all":
+        # Iniciar webhook en segundo plano (en modo webhook corre en el hilo principal)
+        webhook_thread = threading.Thread(target=iniciar_webhook, daemon=True)
+        webhook_thread.start()
+        logger.info("✅ Webhook iniciado en puerto %s", CONFIG['WEBHOOK_PORT'])
     
     return True
 
 if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="EL CAINAL TERMINATOR BATUTO-ART")
+    parser.add_argument(
+        "--modo",
+        default=CONFIG["MODO"],
+        help=f"Qué corre este proceso: {', '.join(MODOS)} (default: CAINAL_MODO o all)"
+    )
+    parser.add_argument(
+        "--procesos",
+        type=int,
+        help="Modo webhook bajo gunicorn con N procesos (WEBHOOK_SERVIDOR=gunicorn, WEBHOOK_PROCESOS)"
+    )
+    argumentos = parser.parse_args()
+    try:
+        modo = normalizar_modo(argumentos.modo)
+    except ValueError as e:
+        parser.error(str(e))
+    if argumentos.procesos is not None:
+        if argumentos.procesos < 1:
+            parser.error("--procesos debe ser 1 o más")
+        CONFIG["WEBHOOK_SERVIDOR"] = "gunicorn"
+        CONFIG["WEBHOOK_PROCESOS"] = argumentos.procesos
+    
     # Inicializar sistema
-    inicializar_sistema()
+    inicializar_sistema(modo)
     
-    # Crear y lanzar interfaz
     try:
-        interface = crear_interfaz_gradio()
-        logger.info("🚀 Lanzando interfaz Gradio...")
         print("\n" + "="*60)
-        print("🔥 EL CAINAL TERMINATOR BATUTO-ART ONLINE")
+        print(f"🔥 EL CAINAL TERMINATOR BATUTO-ART ONLINE (modo {modo})")
         print("="*60)
         print(f"📁 Salidas: {CONFIG['OUTPUT_DIR']}")
-        print(f"🌐 Webhook: http://localhost:{CONFIG['WEBHOOK_PORT']}/webhook")
-        print(f"👤 Interfaz: Gradio (se abrirá automáticamente)")
+        if modo in ("webhook", "all"):
+            print(f"🌐 Webhook: http://localhost:{CONFIG['WEBHOOK_PORT']}/webhook")
+        if modo == "webhook" and CONFIG["WEBHOOK_SERVIDOR"] == "gunicorn":
+            print(f"🧵 gunicorn: {CONFIG['WEBHOOK_PROCESOS']} procesos x {CONFIG['WEBHOOK_HILOS']} hilos")
+        if modo in ("worker", "all"):
+            print(f"⚙️ Carriles: {', '.join(f'{c} x{CONFIG[w]}' for c, w in CARRILES.items())}")
+            if CONFIG["WORKER_ADMIN_PORT"] > 0:
+                print(f"📈 Admin: http://localhost:{CONFIG['WORKER_ADMIN_PORT']}/metrics (/traces, /providers, /profiler, /outputs)")
+            if CONFIG["FIRMA_PROCESOS"] > 0:
+                print(f"🖌️ Firma: pool de {CONFIG['FIRMA_PROCESOS']} procesos")
+        if modo in ("portal", "all"):
+            print(f"👤 Interfaz: Gradio en el puerto {CONFIG['GRADIO_PORT']}")
         print("="*60 + "\n")
         
-        interface.launch(
-            server_name="0.0.0.0",
-            server_port=7860,
-            share=False,
-            show_error=True
-        )
+        if modo in ("portal", "all"):
+            # Crear y lanzar interfaz
+            interface = crear_interfaz_gradio()
+            logger.info("🚀 Lanzando interfaz Gradio...")
+            interface.launch(
+                server_name="0.0.0.0",
+                server_port=CONFIG["GRADIO_PORT"],
+                share=False,
+                show_error=True
+            )
+        elif modo == "webhook":
+            iniciar_webhook()
+        else:
+            # Los carriles son hilos daemon: el hilo principal solo los sostiene
+            threading.Event().wait()
     except KeyboardInterrupt:
         logger.info("Sistema detenido por usuario")
         print("\n🔥 EL CAINAL TERMINATOR APAGADO CON HONOR")
     except Exception as e:
-        logger.error(f"Error fatal al lanzar interfaz: {e}")
+        logger.error("Error fatal al arrancar (modo %s): %s", modo, e)
         print(f"💀 ERROR CRÍTICO: {e}")
\ No newline at end of file
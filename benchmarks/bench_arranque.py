@@ -0,0 +1,82 @@
+# =========================================================
+# BENCHMARK: TIEMPO DE ARRANQUE Y MEMORIA POR MODO DE EJECUCIÓN
+# =========================================================
+#
+# Para cada modo (webhook, worker, portal, all) lanza un proceso limpio que
+# importa app.py, deja listo lo que ese modo necesita (app Flask, loop y
+# cola, interfaz Gradio) y reporta el tiempo de import, el tiempo hasta
+# estar listo, el RSS y qué módulos pesados terminaron cargados.
+# "referencia" importa de entrada Flask, Gradio y PIL como antes.
+#
+#   python benchmarks/bench_arranque.py --repeticiones 3
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODOS = ["webhook", "worker", "portal", "all", "referencia"]
+
+SONDA = r"""
+import json, resource, sys, time
+modo = sys.argv[1]
+inicio = time.perf_counter()
+if modo == "referencia":
+    import flask, gradio, PIL.Image, PIL.ImageDraw, PIL.ImageFont
+import app
+importado = time.perf_counter()
+if modo in ("webhook", "all"):
+    app.obtener_app_flask()
+if modo in ("worker", "all"):
+    app.obtener_loop()
+    app.obtener_cola()
+if modo in ("portal", "all", "referencia"):
+    app.crear_interfaz_gradio()
+listo = time.perf_counter()
+with open("/proc/self/status") as estado:
+    rss = next(int(l.split()[1]) for l in estado if l.startswith("VmRSS:")) / 1024
+print(json.dumps({
+    "import_s": importado - inicio,
+    "listo_s": listo - inicio,
+    "rss_mib": rss,
+    "pico_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "cargados": [m for m in ("flask", "gradio", "PIL") if m in sys.modules],
+}))
+"""
+
+
+def medir(modo: str, directorio: str) -> dict:
+    entorno = dict(os.environ, LOG_LEVEL="CRITICAL", PYTHONPATH=RAIZ, CAINAL_MODO=modo,
+                   DATA_DIR=os.path.join(directorio, "datos"), CACHE_DIR=os.path.join(directorio, "cache"))
+    salida = subprocess.run(
+        [sys.executable, "-c", SONDA, modo], cwd=directorio, env=entorno,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(salida.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Arranque y memoria por modo de ejecución")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix="cainal_arranque_")
+    print(f"{'modo':<11} {'import':>9} {'listo':>9} {'RSS':>9} {'pico':>9}  módulos pesados")
+    for modo in MODOS:
+        corridas = [medir(modo, directorio) for _ in range(args.repeticiones)]
+        mediana = {clave: statistics.median(c[clave] for c in corridas)
+                   for clave in ("import_s", "listo_s", "rss_mib", "pico_rss_mib")}
+        print(
+            f"{modo:<11} {mediana['import_s']:8.2f}s {mediana['listo_s']:8.2f}s "
+            f"{mediana['rss_mib']:6.0f} MiB {mediana['pico_rss_mib']:6.0f} MiB  "
+            f"{', '.join(corridas[0]['cargados']) or '-'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
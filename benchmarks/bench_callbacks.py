@@ -0,0 +1,114 @@
+# =========================================================
+# BENCHMARK: ENTREGAS DE CALLBACK POR MINUTO (BUZÓN + REPARTIDOR)
+# =========================================================
+#
+# Contra un receptor local (proveedores_falsos.py, POST /callback/<destino>)
+# deja N resultados en el buzón desde varios hilos, como lo harían los
+# carriles al cerrar órdenes, y mide:
+#   - lo que le cuesta a un worker dejar su resultado (encolar_callback)
+#   - entregas por minuto de punta a punta y POSTs hechos
+# en modo individual (un POST por resultado) y en lote (callback_lote).
+# Con --errores el receptor falla al azar y se ven los reintentos.
+#
+#   python benchmarks/bench_callbacks.py --entregas 5000 --destinos 20
+#   python benchmarks/bench_callbacks.py --latencia 0.05 --errores 0.05
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from proveedores_falsos import arrancar  # noqa: E402
+
+
+def medir(app, falsos, lote: bool, args, directorio: str) -> dict:
+    app.CONFIG["CALLBACK_DB"] = os.path.join(directorio, f"callbacks_{'lote' if lote else 'individual'}.sqlite3")
+    app._BUZON.reiniciar()
+    repartidor = asyncio.run_coroutine_threadsafe(app.repartir_callbacks_async(), app.obtener_loop())
+    while app._AVISO_CALLBACKS is None:
+        time.sleep(0.01)
+
+    falsos.recibidos.clear()
+    falsos.jobs_recibidos.clear()
+    peticiones_antes = falsos.contadores.get("callback", {}).get("peticiones", 0)
+    cuerpo = {"estado": "completado", "exitoso": True, "tipo": "texto", "salida": "x" * args.bytes}
+
+    costos = []
+
+    def productor(indice: int):
+        propios = []
+        for n in range(indice, args.entregas, args.hilos):
+            callback = {"url": f"{falsos.base}/callback/{n % args.destinos}", "lote": lote}
+            inicio = time.perf_counter()
+            app.encolar_callback(callback, dict(cuerpo, job_id=f"job-{n}"))
+            propios.append(time.perf_counter() - inicio)
+        costos.extend(propios)
+
+    inicio = time.perf_counter()
+    hilos = [threading.Thread(target=productor, args=(i,)) for i in range(args.hilos)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    limite = time.monotonic() + args.limite
+    while len(falsos.jobs_recibidos) < args.entregas and time.monotonic() < limite:
+        time.sleep(0.01)
+    duracion = time.perf_counter() - inicio
+    repartidor.cancel()
+
+    costos.sort()
+    return {
+        "entregadas": len(falsos.jobs_recibidos),
+        "por_minuto": len(falsos.jobs_recibidos) / duracion * 60,
+        "posts": falsos.contadores.get("callback", {}).get("peticiones", 0) - peticiones_antes,
+        "encolar_p50": costos[len(costos) // 2] * 1000,
+        "encolar_p99": costos[min(len(costos) - 1, int(len(costos) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Entregas de callback por minuto")
+    parser.add_argument("--entregas", type=int, default=5000)
+    parser.add_argument("--destinos", type=int, default=20, help="URLs de callback distintas")
+    parser.add_argument("--hilos", type=int, default=8, help="Hilos que dejan resultados (carriles)")
+    parser.add_argument("--latencia", type=float, default=0.02, help="Latencia del receptor")
+    parser.add_argument("--errores", type=float, default=0.0, help="Fracción de POSTs que fallan con 503")
+    parser.add_argument("--bytes", type=int, default=500, help="Tamaño de la salida de cada resultado")
+    parser.add_argument("--concurrencia", type=int, default=32, help="CALLBACK_CONCURRENCIA")
+    parser.add_argument("--limite", type=float, default=300, help="Segundos máximos esperando entregas")
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix="cainal_callbacks_")
+    os.environ.update(
+        LOG_LEVEL="WARNING", LOG_ARCHIVO="", DATA_DIR=os.path.join(directorio, "datos"),
+        CALLBACK_CONCURRENCIA=str(args.concurrencia), CALLBACK_SONDEO="0.2",
+        # El receptor es local: loopback solo se permite por lista explícita
+        CALLBACK_HOSTS="127.0.0.1",
+        # Reintentos rápidos para que el benchmark no espere minutos
+        CALLBACK_BACKOFF_BASE="0.05", CALLBACK_BACKOFF_MAX="1",
+    )
+    os.chdir(directorio)
+    falsos = arrancar(latencia=args.latencia, errores=args.errores)
+    import app
+
+    print(f"{args.entregas} resultados a {args.destinos} destinos, receptor con {args.latencia:g}s "
+          f"y {args.errores:.0%} de errores")
+    print(f"{'modo':<11} {'entregadas':>10} {'por minuto':>12} {'POSTs':>7} {'encolar p50':>12} {'encolar p99':>12}")
+    for lote in (False, True):
+        r = medir(app, falsos, lote, args, directorio)
+        print(
+            f"{'lote' if lote else 'individual':<11} {r['entregadas']:10d} {r['por_minuto']:12,.0f} {r['posts']:7d} "
+            f"{r['encolar_p50']:10.2f}ms {r['encolar_p99']:10.2f}ms"
+        )
+    falsos.apagar()
+
+
+if __name__ == "__main__":
+    main()
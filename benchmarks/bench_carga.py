@@ -0,0 +1,334 @@
+# =========================================================
+# BENCHMARK: CARGA DE PUNTA A PUNTA CONTRA PROVEEDORES FALSOS
+# =========================================================
+#
+# Levanta SambaNova, REVE y ElevenLabs falsos (proveedores_falsos.py), apunta
+# el CAINAL a ellos y dispara órdenes a un ritmo fijo (lazo abierto: la
+# latencia se mide desde el instante programado, así una cola que se atora
+# sí se nota) contra:
+#   - /webhook por HTTP real (admisión) hasta que el worker cierra el trabajo
+#   - portal_interactivo (o el stream con voz usando --voz)
+#
+# Reporta throughput, p50/p95/p99 y pico de memoria (RSS), guarda el
+# resultado en benchmarks/resultados/<escenario>_<fecha>.json y lo compara
+# contra la corrida anterior del mismo escenario.
+#
+#   python benchmarks/bench_carga.py --ritmo 20 --duracion 15 --latencia 0.3
+#   python benchmarks/bench_carga.py --escenario errores --errores 0.05 --reve-modo url
+#   python benchmarks/bench_carga.py --modo portal --voz --imagenes 2
+
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from proveedores_falsos import arrancar  # noqa: E402
+
+RESULTADOS = os.path.join(RAIZ, "benchmarks", "resultados")
+
+# Métricas que se comparan entre corridas: (ruta, más alto es mejor)
+COMPARABLES = [
+    ("webhook.admision_ms.p50", False), ("webhook.admision_ms.p99", False),
+    ("webhook.punta_a_punta_ms.p50", False), ("webhook.punta_a_punta_ms.p95", False),
+    ("webhook.punta_a_punta_ms.p99", False), ("webhook.throughput", True),
+    ("portal.latencia_ms.p50", False), ("portal.latencia_ms.p95", False),
+    ("portal.latencia_ms.p99", False), ("portal.throughput", True),
+    ("memoria.pico_rss_mib", False),
+]
+
+
+def percentiles(valores: list) -> dict:
+    if not valores:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordenados = sorted(valores)
+
+    def rango(p):
+        return round(ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))], 2)
+    return {"p50": rango(0.50), "p95": rango(0.95), "p99": rango(0.99), "max": round(ordenados[-1], 2)}
+
+
+def rss_mib() -> float:
+    with open("/proc/self/status") as estado:
+        for linea in estado:
+            if linea.startswith("VmRSS:"):
+                return int(linea.split()[1]) / 1024
+    return 0.0
+
+
+def pico_rss_mib() -> float:
+    # ru_maxrss viene en KiB en Linux y en bytes en macOS
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+def disparar(ritmo: float, duracion: float, hilos: int, funcion) -> list:
+    """
+    Lazo abierto: la orden i se programa en inicio + i/ritmo y se entrega al
+    pool a esa hora aunque las anteriores no hayan terminado.
+    Regresa [(i, programado_pared, resultado)].
+    """
+    total = max(1, int(ritmo * duracion))
+    resultados = [None] * total
+    inicio_perf, inicio_pared = time.perf_counter(), time.time()
+
+    def tarea(i, programado_perf):
+        resultados[i] = (i, inicio_pared + (programado_perf - inicio_perf), funcion(i, programado_perf))
+
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        for i in range(total):
+            programado = inicio_perf + i / ritmo
+            retraso = programado - time.perf_counter()
+            if retraso > 0:
+                time.sleep(retraso)
+            pool.submit(tarea, i, programado)
+    return resultados
+
+
+def orden_de_prueba(i: int, mezcla_imagen: float) -> str:
+    azar = random.Random(i)
+    if azar.random() < mezcla_imagen:
+        return f"IMAGEN: mural de prueba {i}"
+    return f"Ponte un cotorreo de carga número {i}"
+
+
+def correr_webhook(app, args) -> dict:
+    import httpx
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    servidor = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{servidor.server_port}/webhook"
+    cliente = httpx.Client(limits=httpx.Limits(max_connections=args.hilos), timeout=30)
+
+    def enviar(i, programado):
+        respuesta = cliente.post(url, json={"prompt": orden_de_prueba(i, args.mezcla_imagen), "cache": args.con_cache})
+        admision = (time.perf_counter() - programado) * 1000
+        id_trabajo = respuesta.json().get("job_id") if respuesta.status_code == 200 else None
+        return respuesta.status_code, admision, id_trabajo
+
+    inicio = time.time()
+    enviados = disparar(args.ritmo, args.duracion, args.hilos, enviar)
+    fin_envio = time.time()
+
+    # Esperar a que los workers cierren todos los trabajos aceptados
+    trabajos = app.obtener_trabajos()
+    pendientes = {id_trabajo: programado for _, programado, (_, _, id_trabajo) in enviados if id_trabajo}
+    terminados, fallidos = {}, 0
+    limite = time.time() + args.espera_max
+    while pendientes and time.time() < limite:
+        for id_trabajo in list(pendientes):
+            trabajo = trabajos.obtener(id_trabajo)
+            if trabajo and trabajo["estado"] in ("completado", "fallido"):
+                programado = pendientes.pop(id_trabajo)
+                terminado = datetime.fromisoformat(trabajo["creado"]).timestamp() + trabajo["tiempos"]["total"]
+                terminados[id_trabajo] = (terminado - programado) * 1000
+                fallidos += trabajo["estado"] == "fallido"
+        time.sleep(0.05)
+    fin = time.time()
+    servidor.shutdown()
+    cliente.close()
+
+    codigos = {}
+    for _, _, (codigo, _, _) in enviados:
+        codigos[str(codigo)] = codigos.get(str(codigo), 0) + 1
+    return {
+        "enviadas": len(enviados),
+        "ritmo_envio": round(len(enviados) / max(fin_envio - inicio, 1e-9), 2),
+        "codigos": codigos,
+        "completadas": len(terminados) - fallidos,
+        "fallidas": fallidos,
+        "sin_terminar": len(pendientes),
+        "throughput": round(len(terminados) / max(fin - inicio, 1e-9), 2),
+        "admision_ms": percentiles([admision for _, _, (_, admision, _) in enviados]),
+        "punta_a_punta_ms": percentiles(list(terminados.values())),
+    }
+
+
+def correr_portal(app, args) -> dict:
+    def atender(i, programado):
+        orden = orden_de_prueba(i, args.mezcla_imagen)
+        tipo = "Arte Visual (Imagen)" if orden.startswith("IMAGEN:") else "Cotorreo (Texto)"
+        mensaje = orden.replace("IMAGEN:", "").strip()
+        if args.voz:
+            texto = ""
+            for texto, _, _ in app.portal_interactivo_stream(mensaje, tipo, con_voz=True):
+                pass
+        else:
+            texto, _ = app.portal_interactivo(mensaje, tipo)
+        return (time.perf_counter() - programado) * 1000, not texto.startswith("⚠️")
+
+    inicio = time.time()
+    atendidas = disparar(args.ritmo, args.duracion, args.hilos, atender)
+    fin = time.time()
+    exitosas = sum(1 for _, _, (_, ok) in atendidas if ok)
+    return {
+        "enviadas": len(atendidas),
+        "exitosas": exitosas,
+        "fallidas": len(atendidas) - exitosas,
+        "throughput": round(len(atendidas) / max(fin - inicio, 1e-9), 2),
+        "latencia_ms": percentiles([latencia for _, _, (latencia, _) in atendidas]),
+    }
+
+
+def valor(datos: dict, ruta: str):
+    for parte in ruta.split("."):
+        if not isinstance(datos, dict) or parte not in datos:
+            return None
+        datos = datos[parte]
+    return datos
+
+
+def comparar(actual: dict, referencia: str, umbral: float) -> None:
+    if referencia == "ultimo":
+        previos = sorted(glob.glob(os.path.join(RESULTADOS, f"{actual['escenario']}_*.json")))
+        previos = [ruta for ruta in previos if os.path.basename(ruta) != actual["archivo"]]
+        if not previos:
+            print("\nSin corrida anterior de este escenario para comparar.")
+            return
+        referencia = previos[-1]
+    with open(referencia, encoding="utf-8") as archivo:
+        anterior = json.load(archivo)
+
+    print(f"\nContra {os.path.basename(referencia)} ({anterior.get('commit') or 'sin commit'}):")
+    distintos = [
+        clave for clave, ahora in actual["parametros"].items()
+        if clave not in ("comparar", "umbral") and anterior.get("parametros", {}).get(clave) != ahora
+    ]
+    if distintos:
+        print(f"  ⚠️ parámetros distintos, la comparación no es pareja: {', '.join(distintos)}")
+    regresiones = 0
+    for ruta, mas_es_mejor in COMPARABLES:
+        antes, ahora = valor(anterior["resultados"], ruta), valor(actual["resultados"], ruta)
+        if not antes or ahora is None:
+            continue
+        cambio = (ahora - antes) / antes
+        peor = cambio < -umbral if mas_es_mejor else cambio > umbral
+        regresiones += peor
+        marca = "  ⚠️ regresión" if peor else ""
+        print(f"  {ruta:<32} {antes:>10} → {ahora:>10} ({cambio:+.1%}){marca}")
+    if regresiones:
+        print(f"{regresiones} métricas empeoraron más de {umbral:.0%}")
+
+
+def commit_actual() -> str:
+    try:
+        return subprocess.run(
+            ["git", "-C", RAIZ, "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga de punta a punta contra proveedores falsos")
+    parser.add_argument("--escenario", default="base", help="Nombre para agrupar y comparar corridas")
+    parser.add_argument("--modo", choices=["webhook", "portal", "ambos"], default="ambos")
+    parser.add_argument("--ritmo", type=float, default=20, help="Órdenes por segundo")
+    parser.add_argument("--duracion", type=float, default=10, help="Segundos de disparo por modo")
+    parser.add_argument("--hilos", type=int, default=64, help="Clientes concurrentes máximos")
+    parser.add_argument("--mezcla-imagen", type=float, default=0.2, help="Fracción de órdenes IMAGEN:")
+    parser.add_argument("--voz", action="store_true", help="Portal con voz (portal_interactivo_stream)")
+    parser.add_argument("--con-cache", action="store_true", help="Deja encendidos los caches")
+    parser.add_argument("--espera-max", type=float, default=120, help="Segundos para drenar el webhook")
+    # Perillas de los proveedores falsos
+    parser.add_argument("--latencia", type=float, default=0.2, help="Segundos por llamada")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Variación relativa de la latencia")
+    parser.add_argument("--errores", type=float, default=0.0, help="Fracción de respuestas 503")
+    parser.add_argument("--texto-chars", type=int, default=600)
+    parser.add_argument("--imagenes", type=int, default=0, help="Etiquetas [GENERA_IMAGEN] por respuesta")
+    parser.add_argument("--imagen", default="576x1024", help="Resolución de la imagen falsa")
+    parser.add_argument("--audio-kb", type=int, default=64)
+    parser.add_argument("--reve-modo", choices=["b64", "url"], default="b64")
+    parser.add_argument("--token-ms", type=float, default=0.0, help="Pausa entre trozos del streaming")
+    # Resultados
+    parser.add_argument("--comparar", default="ultimo", help="JSON de referencia, 'ultimo' o 'no'")
+    parser.add_argument("--umbral", type=float, default=0.10, help="Cambio que cuenta como regresión")
+    args = parser.parse_args()
+
+    ancho, alto = (int(lado) for lado in args.imagen.lower().split("x"))
+    falsos = arrancar(
+        latencia=args.latencia, jitter=args.jitter, errores=args.errores, texto_chars=args.texto_chars,
+        imagenes=args.imagenes, imagen=(ancho, alto), audio_kb=args.audio_kb,
+        reve_modo=args.reve_modo, token_ms=args.token_ms
+    )
+    falsos.configurar_entorno()
+    directorio = tempfile.mkdtemp(prefix="cainal_carga_")
+    cache = "1" if args.con_cache else "0"
+    os.environ.update({
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "CRITICAL"),
+        "OUTPUT_DIR": os.path.join(directorio, "salida"),
+        "CACHE_DIR": os.path.join(directorio, "cache"),
+        "DATA_DIR": os.path.join(directorio, "datos"),
+        "CACHE_TEXTO": cache, "CACHE_IMAGEN": cache, "CACHE_VOZ": cache,
+    })
+    os.chdir(directorio)
+    rss_inicial = rss_mib()
+    import app
+
+    for carril in app.CARRILES:
+        threading.Thread(target=app.worker_cainal, args=(carril,), daemon=True).start()
+
+    resultados = {}
+    if args.modo in ("webhook", "ambos"):
+        print(f"Webhook: {args.ritmo:g} órdenes/s durante {args.duracion:g}s...")
+        resultados["webhook"] = correr_webhook(app, args)
+    if args.modo in ("portal", "ambos"):
+        print(f"Portal: {args.ritmo:g} órdenes/s durante {args.duracion:g}s...")
+        resultados["portal"] = correr_portal(app, args)
+    resultados["memoria"] = {
+        "rss_inicial_mib": round(rss_inicial, 1),
+        "rss_final_mib": round(rss_mib(), 1),
+        "pico_rss_mib": round(pico_rss_mib(), 1),
+    }
+    falsos.apagar()
+
+    for modo in ("webhook", "portal"):
+        if modo in resultados:
+            datos = resultados[modo]
+            latencias = datos.get("punta_a_punta_ms") or datos.get("latencia_ms")
+            print(
+                f"  {modo:>7}: {datos['throughput']:8.2f} órdenes/s | p50 {latencias['p50']} ms | "
+                f"p95 {latencias['p95']} ms | p99 {latencias['p99']} ms | fallidas {datos['fallidas']}"
+            )
+    if "webhook" in resultados:
+        print(f"  admisión webhook: p50 {resultados['webhook']['admision_ms']['p50']} ms, "
+              f"códigos {resultados['webhook']['codigos']}")
+    print(f"  memoria: pico RSS {resultados['memoria']['pico_rss_mib']} MiB "
+          f"(proveedores falsos incluidos, mismo proceso)")
+
+    os.makedirs(RESULTADOS, exist_ok=True)
+    fecha = datetime.now()
+    ruta = os.path.join(RESULTADOS, f"{args.escenario}_{fecha.strftime('%Y%m%d_%H%M%S')}.json")
+    corrida = {
+        "escenario": args.escenario,
+        "fecha": fecha.isoformat(),
+        "commit": commit_actual(),
+        "archivo": os.path.basename(ruta),
+        "parametros": vars(args),
+        "resultados": resultados,
+        "proveedores_falsos": falsos.contadores,
+    }
+    with open(ruta, "w", encoding="utf-8") as archivo:
+        json.dump(corrida, archivo, indent=2, ensure_ascii=False)
+    print(f"Resultado guardado en {os.path.relpath(ruta, RAIZ)}")
+
+    if args.comparar != "no":
+        comparar(corrida, args.comparar, args.umbral)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# =========================================================
+# BENCHMARK: ENCOLADOS POR SEGUNDO EN LA COLA DURABLE
+# =========================================================
+#
+# Mide ColaDurable en un archivo SQLite temporal:
+#   - encolados secuenciales (un commit por orden)
+#   - encolados concurrentes desde N hilos (commit agrupado)
+#   - encolar_lote de 1,000 órdenes en una transacción
+#   - reclamar + confirmar (ritmo de drenado)
+#
+#   python benchmarks/bench_cola_durable.py --ordenes 5000 --hilos 16
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+PAYLOAD = {"orden": "Ponte un cotorreo sobre arquitectura distribuida", "cache": True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encolados por segundo en la cola durable")
+    parser.add_argument("--ordenes", type=int, default=5000)
+    parser.add_argument("--hilos", type=int, default=16)
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix="cainal_cola_")
+    os.environ["LOG_LEVEL"] = "WARNING"
+    os.chdir(directorio)
+    import app
+
+    cola = app.ColaDurable(os.path.join(directorio, "cola.sqlite3"), visibilidad=300)
+
+    inicio = time.perf_counter()
+    for _ in range(args.ordenes):
+        cola.encolar("texto", PAYLOAD)
+    secuencial = args.ordenes / (time.perf_counter() - inicio)
+
+    por_hilo = args.ordenes // args.hilos
+    hilos = [
+        threading.Thread(target=lambda: [cola.encolar("texto", PAYLOAD) for _ in range(por_hilo)])
+        for _ in range(args.hilos)
+    ]
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    concurrente = por_hilo * args.hilos / (time.perf_counter() - inicio)
+
+    lotes = max(1, args.ordenes // 1000)
+    inicio = time.perf_counter()
+    for _ in range(lotes):
+        cola.encolar_lote([("texto", PAYLOAD, app.PRIORIDAD_BULK)] * 1000)
+    en_lote = lotes * 1000 / (time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    drenadas = 0
+    while drenadas < args.ordenes:
+        orden = cola.reclamar("texto", espera=0)
+        cola.confirmar(orden["id"], orden["reclamo"])
+        drenadas += 1
+    drenado = drenadas / (time.perf_counter() - inicio)
+
+    print(f"encolar secuencial          : {secuencial:10,.0f} órdenes/s")
+    print(f"encolar {args.hilos:>2} hilos (agrupado) : {concurrente:10,.0f} órdenes/s")
+    print(f"encolar_lote x1000          : {en_lote:10,.0f} órdenes/s")
+    print(f"reclamar + confirmar        : {drenado:10,.0f} órdenes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# =========================================================
+# BENCHMARK: IMÁGENES FIRMADAS POR SEGUNDO (RESOLUCIONES 9:16)
+# =========================================================
+#
+# Compara la firma original (fuente recargada, conversión completa a RGBA,
+# dibujo sobre toda la imagen) contra aplicar_firma_batuto con el sprite
+# cacheado, para cada formato de salida.
+#
+#   python benchmarks/bench_firma.py --segundos 3
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+RESOLUCIONES = [(576, 1024), (720, 1280), (1080, 1920), (1440, 2560)]
+FORMATOS = [("PNG", {"FIRMA_PNG_COMPRESION": 6}), ("PNG", {"FIRMA_PNG_COMPRESION": 1}),
+            ("WEBP", {"FIRMA_CALIDAD": 90}), ("JPEG", {"FIRMA_CALIDAD": 90})]
+
+
+def imagen_prueba(ancho: int, alto: int) -> bytes:
+    from PIL import Image
+    img = Image.linear_gradient("L").resize((ancho, alto)).convert("RGB")
+    buffer = BytesIO()
+    img.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def firma_original(img_data: bytes, destino: str) -> None:
+    """Copia de la firma previa al sprite cacheado, como referencia."""
+    from PIL import Image, ImageDraw, ImageFont
+    img = Image.open(BytesIO(img_data)).convert("RGBA")
+    draw = ImageDraw.Draw(img)
+    width, height = img.size
+    font_size = max(18, int(width * 0.05))
+    try:
+        font = ImageFont.truetype("arial.ttf", font_size)
+    except OSError:
+        font = ImageFont.load_default()
+    margin_x, margin_y = int(width * 0.02), int(height * 0.02)
+    draw.text((margin_x + 2, margin_y + 2), "BATUTO-ART", font=font, fill=(0, 0, 0, 160))
+    draw.text((margin_x, margin_y), "BATUTO-ART", font=font, fill=(255, 215, 0, 255))
+    img.save(destino, "PNG")
+
+
+def por_segundo(funcion, segundos: float) -> float:
+    funcion()
+    hechas, inicio = 0, time.perf_counter()
+    while time.perf_counter() - inicio < segundos:
+        funcion()
+        hechas += 1
+    return hechas / (time.perf_counter() - inicio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Imágenes firmadas por segundo")
+    parser.add_argument("--segundos", type=float, default=2.0)
+    args = parser.parse_args()
+
+    salida = tempfile.mkdtemp(prefix="cainal_firma_")
+    os.environ["LOG_LEVEL"] = "WARNING"
+    os.environ["OUTPUT_DIR"] = salida
+    os.chdir(salida)
+    import app
+
+    destino = os.path.join(salida, "firma")
+    for ancho, alto in RESOLUCIONES:
+        datos = imagen_prueba(ancho, alto)
+        print(f"\n{ancho}x{alto}")
+        tasa = por_segundo(lambda: firma_original(datos, destino + ".png"), args.segundos)
+        print(f"  {'original PNG':<22} {tasa:8.1f} img/s")
+        for formato, ajustes in FORMATOS:
+            app.CONFIG["FIRMA_FORMATO"] = formato
+            app.CONFIG.update(ajustes)
+            ruta = destino + app.extension_firma()
+            tasa = por_segundo(lambda: app.aplicar_firma_batuto(datos, ruta), args.segundos)
+            etiqueta = f"sprite {formato} " + " ".join(f"{k.split('_')[-1].lower()}={v}" for k, v in ajustes.items())
+            print(f"  {etiqueta:<22} {tasa:8.1f} img/s  ({os.path.getsize(ruta) // 1024} KiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# =========================================================
+# BENCHMARK: PICO DE MEMORIA POR ORDEN DE IMAGEN
+# =========================================================
+#
+# Levanta un REVE falso (modo base64 y modo URL) que regresa una imagen
+# pesada y mide con tracemalloc el pico de memoria Python por orden de
+# generar_imagen_cainal, contra la ingesta anterior (todo en memoria).
+# También verifica que un payload que rebasa IMAGEN_MAX_BYTES se rechace.
+#
+#   python benchmarks/bench_memoria_imagen.py --ancho 2160 --alto 3840
+
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+ESTADO = {"modo": "b64", "png": b""}
+
+
+class ReveFalso(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _enviar(self, cuerpo: bytes, tipo: str):
+        self.send_response(200)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if ESTADO["modo"] == "url":
+            url = f"http://127.0.0.1:{self.server.server_port}/imagen.png"
+            self._enviar(json.dumps({"url": url}).encode(), "application/json")
+        else:
+            cuerpo = b'{"image": "' + base64.b64encode(ESTADO["png"]) + b'"}'
+            self._enviar(cuerpo, "application/json")
+
+    def do_GET(self):
+        self._enviar(ESTADO["png"], "image/png")
+
+    def log_message(self, *args):
+        pass
+
+
+class ServidorSilencioso(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # El cliente corta a propósito las descargas que rebasan el límite
+        pass
+
+
+def ingesta_anterior(app, descripcion: str) -> str:
+    """Referencia: JSON completo, bytes decodificados y copia para PIL, todo en memoria."""
+    import httpx
+    respuesta = httpx.post(app.CONFIG["REVE_URL"], json=app._payload_reve(descripcion), timeout=60)
+    datos = respuesta.json()
+    if datos.get("image"):
+        image_bytes = base64.b64decode(datos["image"])
+    else:
+        image_bytes = httpx.get(datos["url"], timeout=60).content
+    return app.aplicar_firma_batuto(image_bytes, os.path.join(app.CONFIG["OUTPUT_DIR"], "anterior.png"))
+
+
+def pico_mib(funcion) -> float:
+    tracemalloc.start()
+    funcion()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return pico / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pico de memoria por orden de imagen")
+    parser.add_argument("--ancho", type=int, default=2160)
+    parser.add_argument("--alto", type=int, default=3840)
+    args = parser.parse_args()
+
+    from PIL import Image
+    buffer = BytesIO()
+    Image.effect_noise((args.ancho, args.alto), 64).convert("RGB").save(buffer, "PNG", compress_level=1)
+    ESTADO["png"] = buffer.getvalue()
+
+    servidor = ServidorSilencioso(("127.0.0.1", 0), ReveFalso)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    salida = tempfile.mkdtemp(prefix="cainal_memoria_")
+    os.environ.update({
+        "REVE_URL": f"http://127.0.0.1:{servidor.server_port}/v1/image/create",
+        "REVE_API_KEY": "bench",
+        "LOG_LEVEL": "CRITICAL",
+        "OUTPUT_DIR": salida,
+        "CACHE_IMAGEN": "0",
+    })
+    os.chdir(salida)
+    import app
+
+    print(f"Imagen de prueba: {args.ancho}x{args.alto}, {len(ESTADO['png']) / (1024 * 1024):.1f} MiB PNG")
+    for modo in ("b64", "url"):
+        ESTADO["modo"] = modo
+        app.generar_imagen_cainal("calentamiento")
+        anterior = pico_mib(lambda: ingesta_anterior(app, "orden"))
+        actual = pico_mib(lambda: app.generar_imagen_cainal("orden"))
+        print(f"  {modo:>4}: anterior {anterior:7.1f} MiB | streaming {actual:7.1f} MiB")
+
+    app.CONFIG["IMAGEN_MAX_BYTES"] = len(ESTADO["png"]) // 2
+    for modo in ("b64", "url"):
+        ESTADO["modo"] = modo
+        print(f"  límite {modo:>4}: {app.generar_imagen_cainal('rechazo')[:60]}")
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
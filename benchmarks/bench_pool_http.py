@@ -0,0 +1,85 @@
+# =========================================================
+# BENCHMARK: POOL KEEP-ALIVE VS CONEXIÓN NUEVA POR ORDEN
+# =========================================================
+#
+# Levanta un SambaNova falso en localhost y mide la latencia por orden de
+# generar_texto_cainal con HTTP_KEEPALIVE encendido y apagado.
+# En local solo se ahorra el handshake TCP; contra la API real también se
+# ahorra el handshake TLS, así que la diferencia en producción es mayor.
+#
+#   python benchmarks/bench_pool_http.py --ordenes 500
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+RESPUESTA = json.dumps({"choices": [{"message": {"content": "Simón, jale listo."}}]}).encode()
+
+
+class SambaNovaFalso(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPUESTA)))
+        self.end_headers()
+        self.wfile.write(RESPUESTA)
+
+    def log_message(self, *args):
+        pass
+
+
+def medir(app, ordenes: int, keepalive: bool):
+    app.CONFIG["HTTP_KEEPALIVE"] = keepalive
+    app.cerrar_clientes()
+    app.generar_texto_cainal("calentamiento")
+    tiempos = []
+    for i in range(ordenes):
+        inicio = time.perf_counter()
+        app.generar_texto_cainal(f"orden {i}")
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return tiempos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pool keep-alive vs conexión nueva")
+    parser.add_argument("--ordenes", type=int, default=500)
+    args = parser.parse_args()
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), SambaNovaFalso)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    os.environ["SAMBANOVA_URL"] = f"http://127.0.0.1:{servidor.server_port}/v1/chat/completions"
+    os.environ["SAMBANOVA_API_KEY"] = "bench"
+    os.environ["LOG_LEVEL"] = "WARNING"
+    os.chdir(tempfile.mkdtemp(prefix="cainal_bench_"))
+    import app
+
+    sin_pool = medir(app, args.ordenes, keepalive=False)
+    con_pool = medir(app, args.ordenes, keepalive=True)
+    servidor.shutdown()
+
+    for nombre, tiempos in (("conexión nueva", sin_pool), ("pool keep-alive", con_pool)):
+        print(
+            f"{nombre:>16}: media {statistics.mean(tiempos):.3f} ms | "
+            f"p50 {statistics.median(tiempos):.3f} ms | "
+            f"p95 {sorted(tiempos)[int(len(tiempos) * 0.95)]:.3f} ms"
+        )
+    ahorro = statistics.mean(sin_pool) - statistics.mean(con_pool)
+    print(f"Ahorro por orden: {ahorro:.3f} ms ({ahorro / statistics.mean(sin_pool):.0%})")
+
+
+if __name__ == "__main__":
+    main()
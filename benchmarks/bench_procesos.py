@@ -0,0 +1,186 @@
+# =========================================================
+# BENCHMARK: ÓRDENES POR SEGUNDO CON 1, 2, 4 Y 8 PROCESOS
+# =========================================================
+#
+# Para cada N levanta, contra proveedores falsos (proveedores_falsos.py):
+#   - el webhook bajo gunicorn con N procesos (app.py --modo webhook --procesos N)
+#   - un worker (app.py --modo worker) que firma en un pool de N procesos
+# los dos sobre la misma cola durable, y manda órdenes de texto cuya
+# respuesta trae una imagen: la firma (decodificar + codificar PNG) es el
+# trabajo de CPU. La fila "hilos" es la referencia: servidor de Flask y
+# firma en hilos, todo bajo un GIL por proceso.
+#
+# Reporta admisiones/s del webhook y órdenes terminadas/s de punta a punta.
+# Más procesos que núcleos (os.cpu_count()) no pueden escalar.
+#
+#   python benchmarks/bench_procesos.py --procesos 1,2,4,8 --ordenes 200
+#   python benchmarks/bench_procesos.py --imagen 1080x1920 --latencia 0.3
+
+import argparse
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from proveedores_falsos import arrancar  # noqa: E402
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def esperar_listo(base: str, procesos: list, limite: float = 60.0):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        for proceso in procesos:
+            if proceso.poll() is not None:
+                raise RuntimeError(f"El proceso {proceso.args} terminó con código {proceso.returncode}")
+        try:
+            # /providers es ruta de administración: el puerto público ya no
+            # la sirve; cualquier respuesta de /jobs/<id> dice que ya escucha
+            if httpx.get(f"{base}/jobs/listo", timeout=1).status_code == 404:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("El webhook no respondió a tiempo")
+
+
+def terminados(ruta_db: str) -> tuple:
+    """(terminados, fallidos, hora del último cierre) según el almacén de trabajos."""
+    if not os.path.exists(ruta_db):
+        return 0, 0, None
+    with sqlite3.connect(ruta_db, timeout=5) as db:
+        return db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(estado = 'fallido'), 0), MAX(terminado) "
+            "FROM trabajos WHERE terminado IS NOT NULL"
+        ).fetchone()
+
+
+def mandar(base: str, cantidad: int, concurrencia: int, desde: int) -> list:
+    """Manda `cantidad` órdenes al webhook y regresa las latencias de admisión (ms)."""
+    locales = threading.local()
+
+    def una(i):
+        if not hasattr(locales, "cliente"):
+            locales.cliente = httpx.Client(timeout=30)
+        inicio = time.perf_counter()
+        respuesta = locales.cliente.post(f"{base}/webhook", json={"prompt": f"Cotorreo {desde + i}", "cache": False})
+        respuesta.raise_for_status()
+        return (time.perf_counter() - inicio) * 1000
+
+    with ThreadPoolExecutor(concurrencia) as pool:
+        return list(pool.map(una, range(cantidad)))
+
+
+def esperar_terminados(ruta_db: str, total: int, limite: float) -> tuple:
+    fin = time.monotonic() + limite
+    while True:
+        cerrados, fallidos, ultimo = terminados(ruta_db)
+        if cerrados >= total or time.monotonic() > fin:
+            return cerrados, fallidos, ultimo
+        time.sleep(0.1)
+
+
+def medir(etiqueta: str, procesos: int, args) -> dict:
+    directorio = tempfile.mkdtemp(prefix=f"cainal_procesos_{etiqueta}_")
+    puerto = puerto_libre()
+    base = f"http://127.0.0.1:{puerto}"
+    entorno = dict(
+        os.environ,
+        LOG_LEVEL="WARNING", LOG_ARCHIVO="", WEBHOOK_PORT=str(puerto),
+        DATA_DIR=os.path.join(directorio, "datos"), OUTPUT_DIR=os.path.join(directorio, "salida"),
+        CACHE_DIR=os.path.join(directorio, "cache"),
+        CACHE_TEXTO="0", CACHE_IMAGEN="0", CACHE_VOZ="0",
+        WORKERS_TEXTO=str(args.workers), WORKERS_IMAGEN=str(args.workers),
+        WORKERS_TEXTO_IMAGEN=str(args.workers), REVE_CONCURRENCIA=str(args.workers),
+        FIRMA_PROCESOS=str(procesos if etiqueta != "hilos" else 0),
+    )
+    webhook = [sys.executable, os.path.join(RAIZ, "app.py"), "--modo", "webhook"]
+    if etiqueta != "hilos":
+        webhook += ["--procesos", str(procesos)]
+    worker = [sys.executable, os.path.join(RAIZ, "app.py"), "--modo", "worker"]
+    hijos = [
+        subprocess.Popen(comando, cwd=directorio, env=entorno,
+                         stdout=subprocess.DEVNULL, stderr=open(os.path.join(directorio, f"{nombre}.err"), "w"))
+        for nombre, comando in (("webhook", webhook), ("worker", worker))
+    ]
+    ruta_db = os.path.join(directorio, "datos", "trabajos.sqlite3")
+    try:
+        esperar_listo(base, hijos)
+        # Calentamiento: levanta los procesos del pool y los clientes HTTP
+        calentamiento = max(4, 2 * procesos)
+        mandar(base, calentamiento, args.concurrencia, 0)
+        esperar_terminados(ruta_db, calentamiento, args.limite)
+
+        inicio = time.time()
+        admision = mandar(base, args.ordenes, args.concurrencia, calentamiento)
+        fin_admision = time.time()
+        cerrados, fallidos, ultimo = esperar_terminados(ruta_db, calentamiento + args.ordenes, args.limite)
+        cerrados -= calentamiento
+        admision.sort()
+        return {
+            "admitidas_s": args.ordenes / (fin_admision - inicio),
+            "admision_p50": admision[len(admision) // 2],
+            "admision_p99": admision[min(len(admision) - 1, int(len(admision) * 0.99))],
+            "ordenes_s": cerrados / ((ultimo or time.time()) - inicio),
+            "terminadas": cerrados,
+            "fallidas": fallidos,
+        }
+    finally:
+        for hijo in hijos:
+            hijo.terminate()
+        for hijo in hijos:
+            try:
+                hijo.wait(10)
+            except subprocess.TimeoutExpired:
+                hijo.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Órdenes por segundo según el número de procesos")
+    parser.add_argument("--procesos", default="1,2,4,8", help="Lista de N a medir")
+    parser.add_argument("--ordenes", type=int, default=200)
+    parser.add_argument("--concurrencia", type=int, default=32, help="Clientes HTTP simultáneos")
+    parser.add_argument("--workers", type=int, default=16, help="Órdenes en vuelo por carril")
+    parser.add_argument("--latencia", type=float, default=0.1, help="Latencia de los proveedores falsos")
+    parser.add_argument("--imagen", default="576x1024", help="Tamaño de la imagen de REVE (AxB)")
+    parser.add_argument("--limite", type=float, default=600, help="Segundos máximos esperando a los workers")
+    parser.add_argument("--sin-referencia", action="store_true", help="No medir la fila 'hilos'")
+    args = parser.parse_args()
+
+    ancho, alto = (int(lado) for lado in args.imagen.lower().split("x"))
+    falsos = arrancar(latencia=args.latencia, imagenes=1, imagen=(ancho, alto), texto_chars=300)
+    falsos.configurar_entorno()
+
+    corridas = [] if args.sin_referencia else [("hilos", 1)]
+    corridas += [(str(int(n)), int(n)) for n in args.procesos.split(",")]
+    nucleos = os.cpu_count() or 1
+    print(f"{args.ordenes} órdenes con imagen {args.imagen}, latencia {args.latencia:g}s, {nucleos} núcleos")
+    print(f"{'procesos':>8} {'admitidas/s':>12} {'adm p50':>9} {'adm p99':>9} {'órdenes/s':>10} {'fallidas':>9}")
+    for etiqueta, procesos in corridas:
+        r = medir(etiqueta, procesos, args)
+        aviso = "  (más procesos que núcleos)" if procesos > nucleos else ""
+        print(
+            f"{etiqueta:>8} {r['admitidas_s']:12.1f} {r['admision_p50']:7.1f}ms {r['admision_p99']:7.1f}ms "
+            f"{r['ordenes_s']:10.2f} {r['fallidas']:9d}{aviso}"
+        )
+        if r["terminadas"] < args.ordenes:
+            print(f"         solo terminaron {r['terminadas']} de {args.ordenes} dentro de --limite")
+    falsos.apagar()
+
+
+if __name__ == "__main__":
+    main()
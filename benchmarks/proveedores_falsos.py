@@ -0,0 +1,242 @@
+# =========================================================
+# PROVEEDORES FALSOS PARA BENCHMARKS (SIN GASTAR CRÉDITO)
+# =========================================================
+#
+# Servidor HTTP local que se hace pasar por SambaNova (JSON y streaming
+# SSE), REVE (modo base64 y modo URL) y ElevenLabs, con latencia, tasa de
+# errores y tamaño de respuesta configurables, y que además recibe callbacks
+# (POST /callback/<destino>, cuenta resultados por destino; con
+# fallar_callback() un destino responde un estatus dado las siguientes N
+# veces). Lo usan los benchmarks que necesitan el pipeline completo y las
+# pruebas de tests/:
+#
+#   from proveedores_falsos import arrancar
+#   falsos = arrancar(latencia=0.2, errores=0.02, texto_chars=800)
+#   falsos.configurar_entorno()   # SAMBANOVA_URL, REVE_URL, ELEVEN_URL
+#   ...
+#   falsos.apagar()
+
+import base64
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+PALABRAS = ("simón", "carnal", "jale", "barrio", "arte", "neón", "calle", "ritmo", "oro", "fierro")
+
+
+def texto_relleno(caracteres: int, semilla: int) -> str:
+    """Texto de `caracteres` aproximados, distinto por semilla (no pega en el cache)."""
+    azar = random.Random(semilla)
+    palabras, largo = [], 0
+    while largo < caracteres:
+        palabra = azar.choice(PALABRAS)
+        palabras.append(palabra)
+        largo += len(palabra) + 1
+    return " ".join(palabras)
+
+
+def imagen_png(ancho: int, alto: int) -> bytes:
+    """PNG de ruido (no comprime casi nada, como una foto real)."""
+    from PIL import Image
+    buffer = BytesIO()
+    Image.effect_noise((ancho, alto), 64).convert("RGB").save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+class ManejadorFalso(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _enviar(self, codigo: int, cuerpo: bytes, tipo: str = "application/json"):
+        self.send_response(codigo)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _esperar_y_fallar(self, proveedor: str) -> bool:
+        """Aplica la latencia simulada; regresa True si ya respondió con error."""
+        falsos = self.server.falsos
+        falsos.contar(proveedor, "peticiones")
+        latencia = falsos.latencia * random.uniform(1 - falsos.jitter, 1 + falsos.jitter)
+        if latencia > 0:
+            time.sleep(latencia)
+        if random.random() < falsos.errores:
+            falsos.contar(proveedor, "errores")
+            self._enviar(503, b'{"error": "servicio no disponible (falso)"}')
+            return True
+        return False
+
+    def do_POST(self):
+        cuerpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.startswith("/sambanova"):
+            self._sambanova(cuerpo)
+        elif self.path.startswith("/reve"):
+            self._reve()
+        elif self.path.startswith("/eleven"):
+            self._eleven()
+        elif self.path.startswith("/callback"):
+            self._callback(cuerpo)
+        else:
+            self._enviar(404, b"{}")
+
+    def do_GET(self):
+        if self.path.startswith("/imagen/"):
+            self.server.falsos.contar("reve_descarga", "peticiones")
+            self._enviar(200, self.server.falsos.png, "image/png")
+        else:
+            self._enviar(404, b"{}")
+
+    def _sambanova(self, cuerpo: dict):
+        if self._esperar_y_fallar("sambanova"):
+            return
+        texto = self.server.falsos.respuesta_texto()
+        if not cuerpo.get("stream"):
+            respuesta = {"choices": [{"message": {"content": texto}}]}
+            self._enviar(200, json.dumps(respuesta, ensure_ascii=False).encode())
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        palabras = texto.split(" ")
+        for inicio in range(0, len(palabras), 4):
+            delta = " ".join(palabras[inicio:inicio + 4]) + " "
+            self._trozo(f"data: {json.dumps({'choices': [{'delta': {'content': delta}}]}, ensure_ascii=False)}\n\n")
+            if self.server.falsos.token_ms:
+                time.sleep(self.server.falsos.token_ms / 1000)
+        self._trozo("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _trozo(self, datos: str):
+        datos = datos.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(datos), datos))
+        self.wfile.flush()
+
+    def _reve(self):
+        if self._esperar_y_fallar("reve"):
+            return
+        falsos = self.server.falsos
+        if falsos.reve_modo == "url":
+            url = f"{falsos.base}/imagen/{next(falsos.secuencia)}.png"
+            self._enviar(200, json.dumps({"url": url}).encode())
+        else:
+            self._enviar(200, falsos.reve_b64)
+
+    def _eleven(self):
+        if self._esperar_y_fallar("eleven"):
+            return
+        self._enviar(200, self.server.falsos.audio, "audio/mpeg")
+
+    def _callback(self, cuerpo: dict):
+        if self._esperar_y_fallar("callback"):
+            return
+        estatus = self.server.falsos.falla_callback(self.path)
+        if estatus is not None:
+            self._enviar(estatus, b'{"error": "rechazado (falso)"}')
+            return
+        resultados = cuerpo.get("resultados", [cuerpo]) if isinstance(cuerpo, dict) else []
+        self.server.falsos.recibir(self.path, resultados)
+        self._enviar(200, b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+class ServidorSilencioso(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clientes que cortan (timeouts, límites de tamaño) no son noticia
+        pass
+
+
+class ProveedoresFalsos:
+    """Servidor falso en marcha y sus perillas (se pueden cambiar en caliente)."""
+
+    def __init__(self, latencia: float = 0.0, jitter: float = 0.2, errores: float = 0.0,
+                 texto_chars: int = 600, imagenes: int = 1, imagen: tuple = (576, 1024),
+                 audio_kb: int = 64, reve_modo: str = "b64", token_ms: float = 0.0):
+        self.latencia = latencia
+        self.jitter = jitter
+        self.errores = errores
+        self.texto_chars = texto_chars
+        self.imagenes = imagenes
+        self.reve_modo = reve_modo
+        self.token_ms = token_ms
+        self.png = imagen_png(*imagen)
+        self.png_b64 = base64.b64encode(self.png)
+        # Armado una sola vez: el servidor no asigna memoria por respuesta
+        # (las pruebas miden con tracemalloc el pico del proceso completo)
+        self.reve_b64 = b'{"image": "' + self.png_b64 + b'"}'
+        self.audio = b"ID3" + os.urandom(max(0, audio_kb * 1024 - 3))
+        self.secuencia = itertools.count()
+        self.contadores = {}
+        self.recibidos = {}
+        self.jobs_recibidos = set()
+        self.resultados = {}
+        self.fallas_callback = {}
+        self._lock = threading.Lock()
+        self.servidor = ServidorSilencioso(("127.0.0.1", 0), ManejadorFalso)
+        self.servidor.falsos = self
+        self.base = f"http://127.0.0.1:{self.servidor.server_port}"
+        threading.Thread(target=self.servidor.serve_forever, name="proveedores_falsos", daemon=True).start()
+
+    def respuesta_texto(self) -> str:
+        numero = next(self.secuencia)
+        etiquetas = "".join(f" [GENERA_IMAGEN: escena {numero}-{i}]" for i in range(self.imagenes))
+        return texto_relleno(self.texto_chars, numero) + "." + etiquetas
+
+    def contar(self, proveedor: str, campo: str):
+        with self._lock:
+            datos = self.contadores.setdefault(proveedor, {"peticiones": 0, "errores": 0})
+            datos[campo] += 1
+
+    def recibir(self, destino: str, resultados: list):
+        """Anota los resultados que llegaron por callback (y el último de cada job_id)."""
+        with self._lock:
+            self.recibidos[destino] = self.recibidos.get(destino, 0) + len(resultados)
+            for resultado in resultados:
+                if isinstance(resultado, dict):
+                    self.jobs_recibidos.add(resultado.get("job_id"))
+                    self.resultados[resultado.get("job_id")] = resultado
+
+    def fallar_callback(self, destino: str, estatus: int, veces: int = 1):
+        """Las siguientes `veces` entregas a `destino` (ej. "/callback/a") responden `estatus`."""
+        with self._lock:
+            self.fallas_callback[destino] = [estatus, veces]
+
+    def falla_callback(self, destino: str):
+        """Estatus forzado para esta entrega a `destino`, o None si se recibe normal."""
+        with self._lock:
+            falla = self.fallas_callback.get(destino)
+            if not falla:
+                return None
+            falla[1] -= 1
+            if falla[1] <= 0:
+                del self.fallas_callback[destino]
+            return falla[0]
+
+    def configurar_entorno(self):
+        """Apunta la configuración del CAINAL a este servidor (antes de `import app`)."""
+        os.environ.update({
+            "SAMBANOVA_URL": f"{self.base}/sambanova/v1/chat/completions",
+            "REVE_URL": f"{self.base}/reve/v1/image/create",
+            "ELEVEN_URL": f"{self.base}/eleven/v1/text-to-speech/aria",
+            "SAMBANOVA_API_KEY": "bench",
+            "REVE_API_KEY": "bench",
+            "ELEVEN_API_KEY": "bench",
+        })
+
+    def apagar(self):
+        self.servidor.shutdown()
+
+
+def arrancar(**opciones) -> ProveedoresFalsos:
+    return ProveedoresFalsos(**opciones)
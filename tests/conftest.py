@@ -0,0 +1,66 @@
+# =========================================================
+# PRUEBAS: ENTORNO COMPARTIDO
+# =========================================================
+#
+# Todo corre contra los proveedores falsos de benchmarks/ (también reciben
+# los callbacks) y con los almacenes SQLite, el cache y las salidas en un
+# directorio temporal por prueba: nada toca las llaves reales ni los datos
+# de datos_cainal/.
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "benchmarks"))
+
+from proveedores_falsos import arrancar  # noqa: E402
+
+FALSOS = arrancar()
+FALSOS.configurar_entorno()
+_TEMPORAL = tempfile.mkdtemp(prefix="cainal_pruebas_")
+os.environ.update(
+    LOG_LEVEL="WARNING", LOG_ARCHIVO="", DATA_DIR=_TEMPORAL,
+    CACHE_DIR=os.path.join(_TEMPORAL, "cache"), OUTPUT_DIR=os.path.join(_TEMPORAL, "salida"),
+    # El receptor es local: loopback solo se permite por lista explícita
+    CALLBACK_HOSTS="127.0.0.1",
+)
+
+import app as cainal  # noqa: E402
+
+# Archivos de los almacenes, en tmp_path en cada prueba
+ARCHIVOS = (
+    ("COLA_DB", "cola"),
+    ("TRABAJOS_DB", "trabajos"),
+    ("CALLBACK_DB", "callbacks"),
+    ("IDEMPOTENCIA_DB", "idempotencia"),
+    ("SALIDAS_DB", "salidas"),
+    ("SESION_DB", "sesiones"),
+)
+
+
+@pytest.fixture
+def falsos():
+    """Receptor de callbacks (y proveedores) falso, limpio para cada prueba."""
+    FALSOS.recibidos.clear()
+    FALSOS.jobs_recibidos.clear()
+    FALSOS.resultados.clear()
+    FALSOS.fallas_callback.clear()
+    yield FALSOS
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """El módulo app con almacenes, cache de texto y salidas nuevos en tmp_path."""
+    for clave, archivo in ARCHIVOS:
+        monkeypatch.setitem(cainal.CONFIG, clave, str(tmp_path / f"{archivo}.sqlite3"))
+    monkeypatch.setitem(cainal.CONFIG, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setitem(cainal.CONFIG, "OUTPUT_DIR", str(tmp_path / "salida"))
+    for almacen in cainal.ALMACENES:
+        almacen.reiniciar()
+    yield cainal
+    for almacen in cainal.ALMACENES:
+        almacen.reiniciar()
@@ -0,0 +1,62 @@
+# Rutas de administración (/metrics, /traces, /providers, /profiler): solo
+# en el listener de administración, o en el puerto público con ADMIN_TOKEN.
+
+import pytest
+
+RUTAS_ADMIN = ("/metrics", "/traces", "/providers", "/profiler")
+
+
+@pytest.fixture
+def publica(app):
+    return app.obtener_app_flask().test_client()
+
+
+@pytest.fixture
+def admin(app):
+    return app.obtener_app_admin().test_client()
+
+
+@pytest.mark.parametrize("ruta", RUTAS_ADMIN)
+def test_puerto_publico_sin_token_no_las_sirve(app, publica, ruta):
+    assert publica.get(ruta).status_code == 404
+
+
+def test_post_al_perfilador_publico_no_lo_prende(app, publica):
+    respuesta = publica.post("/profiler", json={"activo": True})
+
+    assert respuesta.status_code == 404
+    assert app.PERFILADOR.activo is False
+
+
+def test_con_token_el_puerto_publico_lo_exige(app, publica, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "ADMIN_TOKEN", "secreto")
+
+    sin_token = publica.get("/metrics")
+    assert sin_token.status_code == 401
+    assert sin_token.headers["WWW-Authenticate"] == "Bearer"
+    assert publica.get("/metrics", headers={"Authorization": "Bearer otro"}).status_code == 401
+
+    respuesta = publica.get("/metrics", headers={"Authorization": "Bearer secreto"})
+    assert respuesta.status_code == 200
+    assert b"cainal_" in respuesta.data
+
+
+def test_listener_de_administracion(app, admin, monkeypatch):
+    assert admin.get("/metrics").status_code == 200
+    # Solo lleva las rutas de administración
+    assert admin.post("/webhook", json={"orden": "hola"}).status_code == 404
+
+    monkeypatch.setitem(app.CONFIG, "ADMIN_TOKEN", "secreto")
+    assert admin.get("/traces").status_code == 401
+    assert admin.get("/traces", headers={"Authorization": "Bearer secreto"}).status_code == 200
+
+
+def test_traza_de_una_orden_cerrada_con_error(app, admin):
+    traza = app.obtener_traza("traza-prueba", "hola")
+    traza.agregar_tramo("etapa", traza.inicio_perf, 0.01, rama=1)
+    app.cerrar_traza(traza, error="reventó")
+
+    datos = admin.get("/traces/traza-prueba").get_json()
+    assert datos["terminada"] is True and datos["error"] == "reventó"
+    assert [t["nombre"] for t in datos["tramos"]] == ["etapa"]
+    assert "traza-prueba" in [t["trace_id"] for t in admin.get("/traces").get_json()["traces"]]
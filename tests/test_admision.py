@@ -0,0 +1,91 @@
+# Control de admisión y clases de prioridad: arriba de COLA_MAX_PENDIENTES el
+# webhook responde 429 con Retry-After según el ritmo de drenado, los clientes
+# prioritarios tienen su reserva y salen antes de la cola, y la compuerta de
+# cada proveedor despierta primero a la prioridad más alta.
+
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def saturable(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "COLA_MAX_PENDIENTES", 3)
+    monkeypatch.setitem(app.CONFIG, "COLA_RESERVA_PRIORIDAD", 2)
+    monkeypatch.setitem(app.CONFIG, "COLA_RETRY_AFTER_MAX", 60)
+    monkeypatch.setitem(app.CONFIG, "WEBHOOK_CLIENTES_PRIORITARIOS", {"vip"})
+    return app.obtener_app_flask().test_client()
+
+
+def test_arriba_del_tope_responde_429(app, saturable):
+    for n in range(3):
+        assert saturable.post("/webhook", json={"prompt": f"orden {n}"}).status_code == 200
+
+    respuesta = saturable.post("/webhook", json={"prompt": "una más"})
+
+    assert respuesta.status_code == 429
+    # Sin ritmo de drenado todavía se pide el máximo
+    assert respuesta.headers["Retry-After"] == "60"
+    assert respuesta.get_json()["queue_size"] == 3
+    assert app.profundidad_colas() == 3
+
+
+def test_retry_after_sigue_el_ritmo_de_drenado(app, saturable, monkeypatch):
+    app.encolar_ordenes([(f"orden {n}", True) for n in range(3)])
+    monkeypatch.setattr(app.obtener_cola(), "ritmo_drenado", lambda: 2.0)
+
+    respuesta = saturable.post("/webhook/batch", json=["a", "b", "c", "d", "e"])
+
+    # 5 órdenes de más a 2 por segundo
+    assert (respuesta.status_code, respuesta.headers["Retry-After"]) == (429, "3")
+
+
+def test_los_prioritarios_usan_la_reserva(app, saturable):
+    app.encolar_ordenes([(f"orden {n}", True) for n in range(3)])
+    vip = {"X-Client-Id": "vip"}
+
+    assert saturable.post("/webhook", json={"prompt": "otro"}, headers={"X-Client-Id": "x"}).status_code == 429
+    assert saturable.post("/webhook/batch", json=["a", "b"], headers=vip).status_code == 200
+    assert saturable.post("/webhook", json={"prompt": "c"}, headers=vip).status_code == 429
+
+
+def test_prioridad_y_antiguedad(app):
+    cola = app.obtener_cola()
+    cola.encolar("texto", {"orden": "bulk-1"}, app.PRIORIDAD_BULK)
+    cola.encolar("texto", {"orden": "cliente"}, app.PRIORIDAD_CLIENTE)
+    cola.encolar("texto", {"orden": "bulk-2"}, app.PRIORIDAD_BULK)
+    cola.encolar("texto", {"orden": "portal"}, app.PRIORIDAD_PORTAL)
+
+    salida = [cola.reclamar("texto", espera=0)["orden"] for _ in range(4)]
+    assert salida == ["portal", "cliente", "bulk-1", "bulk-2"]
+
+
+def test_compuerta_despierta_primero_a_la_prioridad_alta(app):
+    async def escenario():
+        puerta = app.CompuertaPrioridad(1)
+        orden = []
+
+        async def pedir(nombre, prioridad):
+            await puerta.adquirir(prioridad)
+            orden.append(nombre)
+            await asyncio.sleep(0.01)
+            puerta.liberar()
+
+        await puerta.adquirir(app.PRIORIDAD_BULK)
+        tareas = [
+            asyncio.ensure_future(pedir("bulk", app.PRIORIDAD_BULK)),
+            asyncio.ensure_future(pedir("cancelada", app.PRIORIDAD_PORTAL)),
+            asyncio.ensure_future(pedir("cliente", app.PRIORIDAD_CLIENTE)),
+            asyncio.ensure_future(pedir("portal", app.PRIORIDAD_PORTAL)),
+        ]
+        await asyncio.sleep(0.01)
+        assert puerta.estado()["en_espera"] == 4
+        tareas[1].cancel()
+        puerta.liberar()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        return orden, puerta.estado()
+
+    orden, estado = app.ejecutar_async(escenario())
+
+    assert orden == ["portal", "cliente", "bulk"]
+    assert (estado["ocupados"], estado["en_espera"]) == (0, 0)
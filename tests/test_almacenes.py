@@ -0,0 +1,71 @@
+# Base de los almacenes SQLite: conexión WAL compartible, purga amortizada
+# y singletons perezosos que se reabren tras un fork.
+
+import os
+import time
+
+
+def _almacen(app, ruta, cada):
+    """Almacén mínimo sobre la base, que anota en qué escritura purgó."""
+    class Almacen(app.AlmacenSQLite):
+        PURGA_CADA = cada
+
+        def __init__(self, ruta):
+            super().__init__(ruta)
+            self.purgas = []
+
+        def _purgar(self, ahora):
+            self.purgas.append(self._escrituras)
+            return 0
+
+    return Almacen(ruta)
+
+
+def test_conexion_en_wal_con_espera(app, tmp_path):
+    almacen = _almacen(app, str(tmp_path / "sub" / "a.sqlite3"), 0)
+
+    assert almacen._db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert almacen._db.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+    assert almacen._db.isolation_level is None
+
+
+def test_purga_amortizada_al_cruzar_cada_multiplo(app, tmp_path):
+    almacen = _almacen(app, str(tmp_path / "a.sqlite3"), 10)
+    for _ in range(25):
+        almacen._contar_escrituras(time.time())
+    assert almacen.purgas == [10, 20]
+
+    # Un cierre en lote que brinca el múltiplo también purga (una vez)
+    almacen._contar_escrituras(time.time(), 12)
+    assert almacen.purgas == [10, 20, 37]
+    almacen._contar_escrituras(time.time(), 0)
+    assert almacen.purgas == [10, 20, 37]
+
+
+def test_purga_real_de_trabajos_vencidos(app, monkeypatch):
+    trabajos = app.obtener_trabajos()
+    monkeypatch.setattr(trabajos, "retencion", 0)
+    app.encolar_orden("hola")
+    (trabajo,), _ = trabajos.listar()
+    trabajos.cerrar(trabajo["id"], {"exitoso": True, "tipo": "texto", "salida": "ok"})
+
+    assert trabajos.purgar() == 1
+    assert trabajos.obtener(trabajo["id"]) is None
+
+
+def test_singleton_perezoso_se_reabre_tras_fork(app):
+    assert app._COLA.abierto is None
+    cola = app.obtener_cola()
+    assert app.obtener_cola() is cola and app._COLA.abierto is cola
+
+    lectura, escritura = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            app._reiniciar_tras_fork()
+            os.write(escritura, b"1" if app._COLA.abierto is None and app.obtener_cola() is not cola else b"0")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(lectura, 1) == b"1"
+    assert app.obtener_cola() is cola
@@ -0,0 +1,66 @@
+# Arnés de carga: los proveedores falsos responden como los reales (JSON,
+# SSE, base64 o URL, 503 a la tasa pedida) y bench_carga dispara en lazo
+# abierto, resume percentiles y marca regresiones contra la corrida anterior.
+
+import base64
+import json
+
+import httpx
+from bench_carga import comparar, disparar, percentiles
+
+
+def test_sambanova_falso_en_json_y_en_streaming(falsos):
+    url = f"{falsos.base}/sambanova/v1/chat/completions"
+    completo = httpx.post(url, json={}).json()["choices"][0]["message"]["content"]
+    assert "[GENERA_IMAGEN:" in completo
+
+    with httpx.stream("POST", url, json={"stream": True}) as respuesta:
+        eventos = [linea[6:] for linea in respuesta.iter_lines() if linea.startswith("data: ")]
+    assert eventos[-1] == "[DONE]"
+    texto = "".join(json.loads(evento)["choices"][0]["delta"]["content"] for evento in eventos[:-1])
+    assert "[GENERA_IMAGEN:" in texto
+
+
+def test_reve_falso_en_base64_y_en_url(falsos, monkeypatch):
+    url = f"{falsos.base}/reve/v1/image/create"
+    assert base64.b64decode(httpx.post(url, json={}).json()["image"]) == falsos.png
+
+    monkeypatch.setattr(falsos, "reve_modo", "url")
+    imagen = httpx.post(url, json={}).json()["url"]
+    assert httpx.get(imagen).content == falsos.png
+
+
+def test_tasa_de_errores_y_contadores(falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "errores", 1.0)
+    antes = dict(falsos.contadores.get("eleven", {"peticiones": 0, "errores": 0}))
+
+    assert httpx.post(f"{falsos.base}/eleven/v1/text-to-speech/aria", json={}).status_code == 503
+    assert falsos.contadores["eleven"] == {"peticiones": antes["peticiones"] + 1, "errores": antes["errores"] + 1}
+
+
+def test_disparo_en_lazo_abierto():
+    resultados = disparar(ritmo=40, duracion=0.25, hilos=4, funcion=lambda i, programado: i * 2)
+
+    assert [resultado for _, _, resultado in resultados] == [i * 2 for i in range(10)]
+    programados = [programado for _, programado, _ in resultados]
+    assert all(abs(b - a - 1 / 40) < 1e-6 for a, b in zip(programados, programados[1:]))
+
+
+def test_percentiles_y_regresiones(tmp_path, capsys):
+    assert percentiles(list(range(1, 101))) == {"p50": 51, "p95": 96, "p99": 100, "max": 100}
+    assert percentiles([])["p50"] is None
+
+    anterior = tmp_path / "base_anterior.json"
+    anterior.write_text(json.dumps({
+        "parametros": {"ritmo": 20},
+        "resultados": {"webhook": {"throughput": 20.0, "punta_a_punta_ms": {"p50": 100}}},
+    }))
+    actual = {
+        "escenario": "base", "archivo": "base_actual.json", "parametros": {"ritmo": 20},
+        "resultados": {"webhook": {"throughput": 19.5, "punta_a_punta_ms": {"p50": 150}}},
+    }
+    comparar(actual, str(anterior), umbral=0.10)
+
+    salida = capsys.readouterr().out
+    assert "1 métricas empeoraron más de 10%" in salida
+    assert "webhook.punta_a_punta_ms.p50" in salida and "regresión" in salida
@@ -0,0 +1,57 @@
+# Cache de imágenes firmadas por hash del payload y renders en vuelo
+# compartidos: órdenes simultáneas iguales cuestan una sola llamada a REVE.
+
+import asyncio
+import os
+
+
+def _renders(falsos) -> int:
+    return falsos.contadores.get("reve", {}).get("peticiones", 0)
+
+
+def test_payload_repetido_sale_del_cache(app, falsos):
+    antes, hits = _renders(falsos), app.estadisticas_cache_imagen()["hits"]
+
+    ruta = app.generar_imagen_cainal("gato neón")
+    assert os.path.exists(ruta)
+    assert app.generar_imagen_cainal("gato neón") == ruta
+    assert _renders(falsos) == antes + 1
+    assert app.estadisticas_cache_imagen()["hits"] == hits + 1
+
+    # Sin cache cada orden es un render nuevo con su propia ruta
+    assert app.generar_imagen_cainal("gato neón", usar_cache=False) != ruta
+    assert _renders(falsos) == antes + 2
+
+
+def test_renders_simultaneos_se_comparten(app, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "latencia", 0.2)
+    antes, coalescidas = _renders(falsos), app.estadisticas_cache_imagen()["coalescidas"]
+
+    async def cuatro_iguales():
+        return await asyncio.gather(*(app.generar_imagen_cainal_async("perro oro") for _ in range(4)))
+
+    rutas = app.ejecutar_async(cuatro_iguales())
+
+    assert len(set(rutas)) == 1 and os.path.exists(rutas[0])
+    assert _renders(falsos) == antes + 1
+    assert app.estadisticas_cache_imagen()["coalescidas"] == coalescidas + 3
+
+
+def test_cancelar_al_dueno_no_tumba_a_los_que_esperan(app, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "latencia", 0.2)
+    antes = _renders(falsos)
+
+    async def dueno_cancelado():
+        dueno = asyncio.ensure_future(app.generar_imagen_cainal_async("fierro"))
+        await asyncio.sleep(0.05)
+        espera = asyncio.ensure_future(app.generar_imagen_cainal_async("fierro"))
+        await asyncio.sleep(0.05)
+        dueno.cancel()
+        return await espera
+
+    ruta = app.ejecutar_async(dueno_cancelado())
+
+    assert os.path.exists(ruta)
+    # La espera tomó el render tras la cancelación
+    assert _renders(falsos) == antes + 2
+    assert app._VUELOS_IMAGEN == {}
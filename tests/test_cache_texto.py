@@ -0,0 +1,53 @@
+# Cache de respuestas de texto: LRU en memoria sobre SQLite en disco, con
+# TTL; solo guarda respuestas exitosas y la clave ignora espacios de más.
+
+import time
+
+
+def _peticiones(falsos) -> int:
+    return falsos.contadores.get("sambanova", {}).get("peticiones", 0)
+
+
+def test_la_segunda_orden_igual_no_llama_al_proveedor(app, falsos):
+    primera = app.generar_texto_cainal("hola  carnal")
+    antes = _peticiones(falsos)
+
+    assert app.generar_texto_cainal(" hola carnal ") == primera
+    assert _peticiones(falsos) == antes
+    assert app.obtener_cache_texto().estadisticas()["hits_memoria"] == 1
+
+    app.generar_texto_cainal("hola carnal", usar_cache=False)
+    assert _peticiones(falsos) == antes + 1
+
+
+def test_los_fallos_no_se_guardan(app, falsos, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "PROVEEDOR_REINTENTOS", 0)
+    monkeypatch.setattr(falsos, "errores", 1.0)
+    assert app.generar_texto_cainal("hola").startswith("⚠️")
+
+    monkeypatch.setattr(falsos, "errores", 0.0)
+    assert not app.generar_texto_cainal("hola").startswith("⚠️")
+
+
+def test_el_disco_sobrevive_un_reinicio(app, tmp_path):
+    ruta = str(tmp_path / "respuestas.sqlite3")
+    app.CacheRespuestas(ruta, max_memoria=10, max_disco=100, ttl=60).guardar("clave", "valor")
+
+    nuevo = app.CacheRespuestas(ruta, max_memoria=10, max_disco=100, ttl=60)
+    assert nuevo.obtener("clave") == "valor"
+    assert nuevo.obtener("clave") == "valor"
+    assert (nuevo.contadores["hits_disco"], nuevo.contadores["hits_memoria"]) == (1, 1)
+
+
+def test_lru_en_memoria_y_ttl(app, tmp_path):
+    cache = app.CacheRespuestas(str(tmp_path / "r.sqlite3"), max_memoria=2, max_disco=100, ttl=0.2)
+    for clave in ("a", "b", "c"):
+        cache.guardar(clave, clave.upper())
+
+    # "a" salió de la memoria pero sigue en disco
+    assert cache.estadisticas()["en_memoria"] == 2
+    assert cache.obtener("a") == "A" and cache.contadores["hits_disco"] == 1
+
+    time.sleep(0.25)
+    assert cache.obtener("b") is None
+    assert cache._db.execute("SELECT COUNT(*) FROM respuestas WHERE clave = 'b'").fetchone()[0] == 0
@@ -0,0 +1,184 @@
+# Buzón de callbacks (outbox): entrega, reintentos con backoff, descarte de
+# 4xx y recuperación de lo que dejó a medias un proceso muerto.
+
+import asyncio
+import subprocess
+import sys
+import time
+
+
+def _resultado(job_id: str) -> dict:
+    return {"job_id": job_id, "estado": "completado", "exitoso": True, "salida": "listo"}
+
+
+def _entregar(app, envios):
+    for envio in envios:
+        app.ejecutar_async(app._entregar_async(envio))
+
+
+def _backoff(monkeypatch, app, segundos: float):
+    # Sin Retry-After la espera es la mayor entre el backoff de proveedores y el de callbacks
+    for clave in ("CALLBACK_BACKOFF_BASE", "CALLBACK_BACKOFF_MAX", "PROVEEDOR_BACKOFF_BASE", "PROVEEDOR_BACKOFF_MAX"):
+        monkeypatch.setitem(app.CONFIG, clave, segundos)
+
+
+def _pid_muerto() -> int:
+    proceso = subprocess.Popen([sys.executable, "-c", "pass"])
+    proceso.wait()
+    return proceso.pid
+
+
+def test_entrega_y_confirma(app, falsos):
+    buzon = app.obtener_buzon_callbacks()
+    buzon.encolar(f"{falsos.base}/callback/a", _resultado("job-1"))
+
+    _entregar(app, buzon.reclamar(10))
+
+    assert falsos.jobs_recibidos == {"job-1"}
+    assert buzon.estadisticas() == {"pendientes": 0, "fallidas": 0}
+
+
+def test_5xx_se_reprograma_con_backoff(app, falsos, monkeypatch):
+    _backoff(monkeypatch, app, 0.2)
+    buzon = app.obtener_buzon_callbacks()
+    buzon.encolar(f"{falsos.base}/callback/b", _resultado("job-2"))
+    falsos.fallar_callback("/callback/b", 503)
+
+    antes = time.time()
+    _entregar(app, buzon.reclamar(10))
+
+    visible_desde, intentos, error = buzon._db.execute(
+        "SELECT visible_desde, intentos, error FROM entregas"
+    ).fetchone()
+    assert (intentos, error) == (1, "HTTP 503")
+    assert visible_desde >= antes + 0.1
+    # Mientras corre el backoff no se vuelve a reclamar
+    assert buzon.reclamar(10) == []
+
+    time.sleep(max(0.0, visible_desde - time.time()) + 0.01)
+    envios = buzon.reclamar(10)
+    assert envios[0][0]["intentos"] == 2
+    _entregar(app, envios)
+    assert falsos.jobs_recibidos == {"job-2"}
+    assert buzon.estadisticas() == {"pendientes": 0, "fallidas": 0}
+
+
+def test_agota_reintentos(app, falsos, monkeypatch):
+    _backoff(monkeypatch, app, 0.0)
+    buzon = app.obtener_buzon_callbacks()
+    monkeypatch.setattr(buzon, "reintentos", 2)
+    buzon.encolar(f"{falsos.base}/callback/c", _resultado("job-3"))
+    falsos.fallar_callback("/callback/c", 500, veces=5)
+
+    _entregar(app, buzon.reclamar(10))
+    _entregar(app, buzon.reclamar(10))
+
+    assert buzon.estadisticas() == {"pendientes": 0, "fallidas": 1}
+    assert buzon.reclamar(10) == []
+    assert not falsos.jobs_recibidos
+
+
+def test_4xx_se_descarta_sin_reintentos(app, falsos):
+    buzon = app.obtener_buzon_callbacks()
+    buzon.encolar(f"{falsos.base}/callback/d", _resultado("job-4"))
+    falsos.fallar_callback("/callback/d", 404)
+
+    _entregar(app, buzon.reclamar(10))
+
+    assert buzon.estadisticas() == {"pendientes": 0, "fallidas": 1}
+    estado, error = buzon._db.execute("SELECT estado, error FROM entregas").fetchone()
+    assert (estado, error) == ("fallido", "HTTP 404")
+
+
+def test_429_se_reintenta(app, falsos, monkeypatch):
+    _backoff(monkeypatch, app, 0.0)
+    buzon = app.obtener_buzon_callbacks()
+    buzon.encolar(f"{falsos.base}/callback/e", _resultado("job-5"))
+    falsos.fallar_callback("/callback/e", 429)
+
+    _entregar(app, buzon.reclamar(10))
+    assert buzon.estadisticas() == {"pendientes": 1, "fallidas": 0}
+    _entregar(app, buzon.reclamar(10))
+    assert falsos.jobs_recibidos == {"job-5"}
+
+
+def test_destino_interno_se_bloquea(app, falsos, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "CALLBACK_HOSTS", set())
+    buzon = app.obtener_buzon_callbacks()
+    buzon.encolar(f"{falsos.base}/callback/f", _resultado("job-6"))
+
+    _entregar(app, buzon.reclamar(10))
+
+    assert buzon.estadisticas() == {"pendientes": 0, "fallidas": 1}
+    assert not falsos.jobs_recibidos
+
+
+def test_recupera_entregas_de_un_dueno_muerto(app, falsos):
+    buzon = app.obtener_buzon_callbacks()
+    buzon.encolar(f"{falsos.base}/callback/g", _resultado("job-7"))
+    assert len(buzon.reclamar(10)) == 1
+    assert buzon.reclamar(10) == []
+
+    # Reclamada por otro proceso que sigue vivo: no se toca
+    vivo = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        buzon._db.execute("UPDATE entregas SET dueno = ?", (vivo.pid,))
+        assert buzon.recuperar() == 0
+    finally:
+        vivo.kill()
+        vivo.wait()
+
+    buzon._db.execute("UPDATE entregas SET dueno = ?", (_pid_muerto(),))
+    assert buzon.recuperar() == 1
+    _entregar(app, buzon.reclamar(10))
+    assert falsos.jobs_recibidos == {"job-7"}
+
+
+def test_reclamar_respeta_envios_y_lote(app, falsos):
+    buzon = app.obtener_buzon_callbacks()
+    for n in range(30):
+        buzon.encolar(f"{falsos.base}/callback/h", _resultado(f"job-{n}"), agrupar=True)
+
+    assert buzon.reclamar(0, 10) == []
+    envios = buzon.reclamar(2, 10)
+    assert [len(envio) for envio in envios] == [10, 10]
+
+    _entregar(app, envios)
+    assert falsos.recibidos["/callback/h"] == 20
+    assert buzon.estadisticas()["pendientes"] == 10
+
+
+def test_repartidor_entrega_individuales_y_lotes(app, falsos, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "CALLBACK_SONDEO", 0.05)
+    monkeypatch.setattr(app, "_AVISO_CALLBACKS", None)
+    repartidor = asyncio.run_coroutine_threadsafe(app.repartir_callbacks_async(), app.obtener_loop())
+    try:
+        for n in range(20):
+            lote = n % 2 == 0
+            app.encolar_callback({"url": f"{falsos.base}/callback/r{int(lote)}", "lote": lote},
+                                 _resultado(f"job-{n}"))
+        # El receptor anota antes de que el repartidor confirme: se esperan las dos cosas
+        buzon = app.obtener_buzon_callbacks()
+        limite = time.monotonic() + 10
+        while time.monotonic() < limite and (
+            len(falsos.jobs_recibidos) < 20 or buzon.estadisticas()["pendientes"]
+        ):
+            time.sleep(0.02)
+    finally:
+        repartidor.cancel()
+
+    assert falsos.jobs_recibidos == {f"job-{n}" for n in range(20)}
+    assert buzon.estadisticas() == {"pendientes": 0, "fallidas": 0}
+
+
+def test_orden_fallida_llega_como_fallida(app, falsos, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "SAMBANOVA_KEY", "")
+    _, id_trabajo = app.encolar_orden("hola", callback={"url": f"{falsos.base}/callback/i", "lote": False})
+    item = app.obtener_cola().reclamar("texto", espera=0)
+    app.ejecutar_async(app._atender_item_async("texto", item))
+
+    _entregar(app, app.obtener_buzon_callbacks().reclamar(10))
+
+    cuerpo = falsos.resultados[id_trabajo]
+    assert (cuerpo["estado"], cuerpo["exitoso"], cuerpo["salida"]) == ("fallido", False, None)
+    assert "SAMBANOVA_API_KEY" in cuerpo["error"]
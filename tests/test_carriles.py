@@ -0,0 +1,50 @@
+# Carriles por modalidad: cada orden entra al carril de su tipo, el texto que
+# pide imagen entrega su parte y pasa a "texto_con_imagen", y un carril
+# atiende hasta WORKERS_<CARRIL> órdenes a la vez.
+
+import os
+import threading
+import time
+
+
+def _atender(app, carril: str) -> None:
+    item = app.obtener_cola().reclamar(carril, espera=0)
+    app.ejecutar_async(app._atender_item_async(carril, item))
+
+
+def test_cada_orden_entra_a_su_carril(app):
+    app.encolar_orden("IMAGEN: un gallo de oro")
+    app.encolar_orden("hola")
+
+    assert app.obtener_cola().profundidad() == {"imagen": 1, "texto": 1}
+
+
+def test_texto_con_imagen_pasa_de_carril(app, falsos):
+    _, id_trabajo = app.encolar_orden("hola", usar_cache=False)
+
+    _atender(app, "texto")
+    # El worker de texto ya se liberó; la imagen espera en su propio carril
+    assert app.obtener_cola().profundidad() == {"texto_con_imagen": 1}
+    assert app.obtener_trabajos().obtener(id_trabajo)["estado"] == "procesando"
+
+    _atender(app, "texto_con_imagen")
+    trabajo = app.obtener_trabajos().obtener(id_trabajo)
+    assert (trabajo["estado"], trabajo["tipo"]) == ("completado", "texto_con_imagen")
+    assert trabajo["salida"]["texto"] and os.path.isfile(trabajo["salida"]["imagen"])
+
+
+def test_el_carril_atiende_en_paralelo(app, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "imagenes", 0)
+    monkeypatch.setattr(falsos, "latencia", 0.3)
+    monkeypatch.setitem(app.CONFIG, "WORKERS_TEXTO", 4)
+    ids = [app.encolar_orden(f"orden {n}", usar_cache=False)[1] for n in range(4)]
+
+    inicio = time.monotonic()
+    threading.Thread(target=app.worker_cainal, args=("texto",), daemon=True).start()
+    trabajos = app.obtener_trabajos()
+    while any(trabajos.obtener(i)["estado"] != "completado" for i in ids):
+        assert time.monotonic() - inicio < 5
+        time.sleep(0.02)
+
+    # Cuatro llamadas de ~0.3 s en serie tardarían más de 1 s
+    assert time.monotonic() - inicio < 0.9
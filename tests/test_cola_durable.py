@@ -0,0 +1,84 @@
+# Cola durable: reclamo con visibilidad, ack con token de reclamo, extensión
+# de la visibilidad, lotes atómicos y recuperación.
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+@pytest.fixture
+def cola(app, tmp_path):
+    return app.ColaDurable(str(tmp_path / "cola.sqlite3"), visibilidad=0.3, sondeo=0.01)
+
+
+def test_reclamar_esconde_y_confirmar_borra(cola):
+    id_orden = cola.encolar("texto", {"orden": "hola"})
+
+    orden = cola.reclamar("texto", espera=0)
+    assert (orden["id"], orden["orden"], orden["intentos"]) == (id_orden, "hola", 1)
+    assert cola.reclamar("texto", espera=0) is None
+
+    assert cola.confirmar(orden["id"], orden["reclamo"])
+    assert cola.profundidad() == {}
+    assert cola._db.execute("SELECT COUNT(*) FROM ordenes").fetchone()[0] == 0
+
+
+def test_visibilidad_vencida_vuelve_a_salir(cola):
+    cola.encolar("texto", {"orden": "hola"})
+    primera = cola.reclamar("texto", espera=0)
+
+    time.sleep(0.35)
+    segunda = cola.reclamar("texto", espera=0)
+    assert segunda["id"] == primera["id"] and segunda["intentos"] == 2
+
+    # El dueño anterior ya no puede confirmar, extender ni mover la orden
+    assert not cola.confirmar(primera["id"], primera["reclamo"])
+    assert not cola.extender(primera["id"], primera["reclamo"])
+    assert not cola.mover(primera["id"], "imagen", {"orden": "x"}, primera["reclamo"])
+    assert cola.confirmar(segunda["id"], segunda["reclamo"])
+
+
+def test_extender_mantiene_la_orden_escondida(cola):
+    cola.encolar("texto", {"orden": "lenta"})
+    orden = cola.reclamar("texto", espera=0)
+
+    for _ in range(3):
+        time.sleep(0.15)
+        assert cola.extender(orden["id"], orden["reclamo"])
+    assert cola.reclamar("texto", espera=0) is None
+    assert cola.confirmar(orden["id"], orden["reclamo"])
+
+
+def test_mover_pasa_la_orden_a_otro_carril(cola):
+    cola.encolar("texto", {"orden": "con imagen"})
+    orden = cola.reclamar("texto", espera=0)
+
+    assert cola.mover(orden["id"], "texto_con_imagen", {"orden": "con imagen", "paso": 2}, orden["reclamo"])
+    movida = cola.reclamar("texto_con_imagen", espera=0)
+    assert (movida["id"], movida["paso"], movida["intentos"]) == (orden["id"], 2, 1)
+    assert not cola.confirmar(orden["id"], orden["reclamo"])
+    assert cola.confirmar(movida["id"], movida["reclamo"])
+
+
+def test_encolar_lote_es_atomico_y_ordenado(cola):
+    ids = cola.encolar_lote([("texto", {"orden": f"o{n}"}, 2) for n in range(50)])
+
+    assert ids == sorted(ids) and len(set(ids)) == 50
+    assert [cola.reclamar("texto", espera=0)["orden"] for _ in range(50)] == [f"o{n}" for n in range(50)]
+
+
+def test_recuperar_respeta_duenos_vivos(cola):
+    cola.encolar("texto", {"orden": "a medias"})
+    cola.reclamar("texto", espera=0)
+
+    vivo = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        cola._db.execute("UPDATE ordenes SET dueno = ?", (vivo.pid,))
+        assert cola.recuperar() == 0
+    finally:
+        vivo.kill()
+        vivo.wait()
+    assert cola.recuperar() == 1
+    assert cola.reclamar("texto", espera=0)["intentos"] == 2
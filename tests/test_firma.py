@@ -0,0 +1,53 @@
+# Firma BATUTO-ART: sprite cacheado por tamaño que solo toca la esquina de
+# la firma, y formato de salida configurable (PNG, WEBP, JPEG).
+
+import io
+
+import pytest
+from PIL import Image
+
+
+def _png(tamano=(320, 480), modo="RGB", color=(10, 20, 30)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new(modo, tamano, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_sprite_por_tamano_y_solo_en_la_esquina(app, tmp_path):
+    app._sprite_firma.cache_clear()
+    original = Image.open(io.BytesIO(_png()))
+
+    for n in range(3):
+        app.aplicar_firma_batuto(_png(), str(tmp_path / f"firma{n}.png"))
+    app.aplicar_firma_batuto(_png((640, 480)), str(tmp_path / "otra.png"))
+
+    info = app._sprite_firma.cache_info()
+    assert (info.misses, info.hits) == (2, 2)
+
+    firmada = Image.open(tmp_path / "firma0.png").convert("RGB")
+    sprite, (x, y) = app._sprite_firma(320, 480)
+    caja = (x, y, x + sprite.width, y + sprite.height)
+    assert firmada.crop(caja).tobytes() != original.crop(caja).tobytes()
+    # Fuera de la región del sprite la imagen queda igual
+    resto = firmada.copy()
+    resto.paste((0, 0, 0), caja)
+    referencia = original.copy()
+    referencia.paste((0, 0, 0), caja)
+    assert resto.tobytes() == referencia.tobytes()
+
+
+@pytest.mark.parametrize("formato, extension", [("PNG", ".png"), ("WEBP", ".webp"), ("JPEG", ".jpg")])
+def test_formato_de_salida(app, monkeypatch, formato, extension):
+    monkeypatch.setitem(app.CONFIG, "FIRMA_FORMATO", formato)
+
+    ruta = app.aplicar_firma_batuto(_png(modo="RGBA", color=(10, 20, 30, 255)))
+
+    assert ruta.endswith(extension)
+    assert Image.open(ruta).format == formato
+
+
+def test_imagen_con_demasiados_pixeles_se_rechaza(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "IMAGEN_MAX_PIXELES", 320 * 480 - 1)
+
+    with pytest.raises(app.ImagenDemasiadoGrande):
+        app.aplicar_firma_batuto(_png())
@@ -0,0 +1,102 @@
+# Idempotencia de /webhook: Idempotency-Key, claves derivadas (opt-in),
+# reservas pendientes con plazo corto y liberación cuando no se encola.
+
+import time
+
+import pytest
+
+
+@pytest.fixture
+def cliente(app):
+    return app.obtener_app_flask().test_client()
+
+
+def _ordenes_en_cola(app) -> int:
+    return app.obtener_cola()._db.execute("SELECT COUNT(*) FROM ordenes").fetchone()[0]
+
+
+def test_misma_clave_regresa_el_trabajo_original(app, cliente):
+    cabeceras = {"Idempotency-Key": "pedido-1"}
+    primera = cliente.post("/webhook", json={"prompt": "hola"}, headers=cabeceras)
+    segunda = cliente.post("/webhook", json={"prompt": "hola"}, headers=cabeceras)
+
+    assert primera.status_code == 200 and segunda.status_code == 200
+    assert segunda.get_json()["status"] == "duplicado"
+    assert segunda.get_json()["job_id"] == primera.get_json()["job_id"]
+    assert _ordenes_en_cola(app) == 1
+
+
+def test_misma_clave_con_otro_payload_es_422(app, cliente):
+    cabeceras = {"Idempotency-Key": "pedido-2"}
+    cliente.post("/webhook", json={"prompt": "hola"}, headers=cabeceras)
+    respuesta = cliente.post("/webhook", json={"prompt": "adiós"}, headers=cabeceras)
+
+    assert respuesta.status_code == 422
+    assert _ordenes_en_cola(app) == 1
+
+
+def test_la_clave_es_por_cliente(app, cliente):
+    cliente.post("/webhook", json={"prompt": "hola"}, headers={"Idempotency-Key": "k", "X-Client-Id": "a"})
+    respuesta = cliente.post("/webhook", json={"prompt": "hola"}, headers={"Idempotency-Key": "k", "X-Client-Id": "b"})
+
+    assert respuesta.get_json()["status"] != "duplicado"
+    assert _ordenes_en_cola(app) == 2
+
+
+def test_sin_header_no_se_deriva_por_defecto(app, cliente):
+    for _ in range(2):
+        assert cliente.post("/webhook", json={"prompt": "sí"}).get_json()["status"] != "duplicado"
+    assert _ordenes_en_cola(app) == 2
+
+
+def test_clave_derivada_solo_con_cliente_y_sin_sesion(app, cliente, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "IDEMPOTENCIA_DERIVADA_TTL", 300)
+    cabeceras = {"X-Client-Id": "tienda"}
+
+    # Con X-Client-Id el mismo payload se deduplica
+    cliente.post("/webhook", json={"prompt": "hola"}, headers=cabeceras)
+    assert cliente.post("/webhook", json={"prompt": "hola"}, headers=cabeceras).get_json()["status"] == "duplicado"
+    # Los anónimos no se deduplican entre sí
+    cliente.post("/webhook", json={"prompt": "hola"})
+    assert cliente.post("/webhook", json={"prompt": "hola"}).get_json()["status"] != "duplicado"
+    # Repetir un turno en una sesión es otra orden
+    for _ in range(2):
+        respuesta = cliente.post("/webhook", json={"prompt": "sí", "session_id": "s1"}, headers=cabeceras)
+        assert respuesta.get_json()["status"] != "duplicado"
+
+    assert _ordenes_en_cola(app) == 5
+
+
+def test_reserva_pendiente_responde_409_y_vence_pronto(app, monkeypatch):
+    idempotencia = app.obtener_idempotencia()
+    assert idempotencia.reservar("h:x", "huella", ttl=3600) is None
+    en_curso = idempotencia.reservar("h:x", "huella", ttl=3600)
+    assert en_curso is not None and en_curso["job_id"] is None
+
+    with app.obtener_app_flask().test_request_context():
+        _, estatus, cabeceras = app._respuesta_duplicada(en_curso, "header", "huella")
+    assert estatus == 409 and cabeceras["Retry-After"] == "1"
+
+    # Una reserva sin trabajo (proceso caído) no bloquea la clave todo el TTL
+    monkeypatch.setitem(app.CONFIG, "IDEMPOTENCIA_RESERVA", 0.05)
+    time.sleep(0.1)
+    assert idempotencia.reservar("h:x", "huella", ttl=3600) is None
+
+    # Ya asignada, dura todo el TTL
+    idempotencia.asignar("h:x", "job-1", "texto", "traza-1")
+    time.sleep(0.1)
+    assert idempotencia.reservar("h:x", "huella", ttl=3600)["job_id"] == "job-1"
+
+
+def test_orden_rechazada_libera_la_clave(app, cliente, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "COLA_MAX_PENDIENTES", 1)
+    monkeypatch.setitem(app.CONFIG, "COLA_RESERVA_PRIORIDAD", 0)
+    cliente.post("/webhook", json={"prompt": "primera"})
+
+    cabeceras = {"Idempotency-Key": "pedido-3"}
+    assert cliente.post("/webhook", json={"prompt": "hola"}, headers=cabeceras).status_code == 429
+
+    app.obtener_cola()._db.execute("DELETE FROM ordenes")
+    monkeypatch.setattr(app.obtener_cola(), "_conteo", (0.0, 0))
+    respuesta = cliente.post("/webhook", json={"prompt": "hola"}, headers=cabeceras)
+    assert respuesta.status_code == 200 and respuesta.get_json()["status"] != "duplicado"
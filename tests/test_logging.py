@@ -0,0 +1,40 @@
+# Logging no bloqueante: con varios procesos cada uno escribe su propio
+# archivo (RotatingFileHandler no rota bien un archivo compartido).
+
+import logging
+import os
+import sys
+
+
+def test_con_varios_procesos_el_archivo_lleva_pid(app, monkeypatch):
+    monkeypatch.delenv("LOG_ARCHIVO", raising=False)
+    monkeypatch.delitem(sys.modules, "gunicorn", raising=False)
+    assert app.cargar_configuracion()["LOG_ARCHIVO"] == "cainal_operativo.log"
+
+    monkeypatch.setenv("WEBHOOK_SERVIDOR", "gunicorn")
+    monkeypatch.setenv("WEBHOOK_PROCESOS", "4")
+    assert app.cargar_configuracion()["LOG_ARCHIVO"] == "cainal_operativo.{pid}.log"
+
+
+def test_archivo_por_proceso(app):
+    assert app.archivo_log_por_proceso("logs/cainal.log") == "logs/cainal.{pid}.log"
+    assert app.archivo_log_por_proceso("cainal.{pid}.log") == "cainal.{pid}.log"
+    assert app.archivo_log_por_proceso("") == ""
+
+
+def test_hijo_de_fork_no_escribe_el_archivo_del_padre(app, tmp_path, monkeypatch):
+    app.preparar_proceso()
+    monkeypatch.setitem(app.CONFIG, "LOG_ARCHIVO", str(tmp_path / "cainal.log"))
+    monkeypatch.setitem(app.CONFIG, "LOG_CONSOLA", False)
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            logging.getLogger("EL_CAINAL").warning("desde el hijo")
+            app._ESCRITOR_LOG.stop()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert "desde el hijo" in (tmp_path / f"cainal.{pid}.log").read_text(encoding="utf-8")
+    assert not (tmp_path / "cainal.log").exists()
@@ -0,0 +1,51 @@
+# /webhook/batch: un lote (arreglo JSON, objeto con "prompts" o NDJSON) se
+# valida completo y entra a la cola de forma atómica, con un trabajo por
+# orden en su carril.
+
+import json
+
+
+def _cliente(app):
+    return app.obtener_app_flask().test_client()
+
+
+def test_lote_json_encola_cada_orden_en_su_carril(app):
+    respuesta = _cliente(app).post(
+        "/webhook/batch", json={"prompts": ["hola", {"prompt": "IMAGEN: un gallo", "cache": False}]},
+        headers={"X-Client-Id": "a"}
+    )
+
+    datos = respuesta.get_json()
+    assert respuesta.status_code == 200 and datos["aceptadas"] == 2
+    assert [job["tipo"] for job in datos["jobs"]] == ["texto", "imagen"]
+    assert app.obtener_cola().profundidad() == {"texto": 1, "imagen": 1}
+    for job in datos["jobs"]:
+        assert app.obtener_trabajos().obtener(job["job_id"])["estado"] == "en_cola"
+
+
+def test_lote_ndjson(app):
+    cuerpo = "\n".join(json.dumps({"prompt": f"orden {n}"}) for n in range(3)) + "\n"
+
+    respuesta = _cliente(app).post("/webhook/batch", data=cuerpo, content_type="application/x-ndjson")
+
+    assert respuesta.get_json()["aceptadas"] == 3
+    assert app.profundidad_colas() == 3
+
+
+def test_un_elemento_invalido_rechaza_el_lote_completo(app):
+    respuesta = _cliente(app).post("/webhook/batch", json=["hola", "  ", 7, "adiós"])
+
+    assert respuesta.status_code == 400
+    assert [error["indice"] for error in respuesta.get_json()["errores"]] == [1, 2]
+    assert app.profundidad_colas() == 0
+    assert app.obtener_trabajos().listar()[0] == []
+
+
+def test_limites_del_lote(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "WEBHOOK_LOTE_MAX", 2)
+    cliente = _cliente(app)
+
+    assert cliente.post("/webhook/batch", json=["a", "b", "c"]).status_code == 413
+    assert cliente.post("/webhook/batch", json=[]).status_code == 400
+    assert cliente.post("/webhook/batch", data="{no", content_type="application/json").status_code == 400
+    assert app.profundidad_colas() == 0
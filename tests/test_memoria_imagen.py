@@ -0,0 +1,73 @@
+# Ingesta de imágenes de REVE con memoria acotada: el pico de memoria
+# Python por orden no crece con la imagen, ni en modo base64 ni en modo URL.
+
+import base64
+import io
+import tracemalloc
+
+import pytest
+from proveedores_falsos import arrancar
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture(scope="module")
+def reve_grande():
+    """REVE falso con una imagen de ~3 MiB de PNG (~4 MiB en base64)."""
+    falsos = arrancar(imagen=(1080, 1920))
+    yield falsos
+    falsos.apagar()
+
+
+@pytest.fixture
+def reve(app, reve_grande, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "REVE_URL", f"{reve_grande.base}/reve/v1/image/create")
+    monkeypatch.setitem(app.CONFIG, "CACHE_IMAGEN", False)
+    monkeypatch.setitem(app.CONFIG, "IMAGEN_SPOOL_MEMORIA", 256 * 1024)
+    return reve_grande
+
+
+def _pico(funcion):
+    tracemalloc.start()
+    try:
+        resultado = funcion()
+        return resultado, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize("modo", ["b64", "url"])
+def test_pico_de_memoria_por_orden(app, reve, monkeypatch, modo):
+    monkeypatch.setattr(reve, "reve_modo", modo)
+    # La primera orden carga PIL, el cliente HTTP y el hilo de firma
+    assert not app.generar_imagen_cainal("calentamiento").startswith("⚠️")
+
+    ruta, pico = _pico(lambda: app.generar_imagen_cainal("orden"))
+
+    assert not ruta.startswith("⚠️")
+    # Ni el PNG ni su base64 llegan a estar completos en memoria
+    assert pico < min(len(reve.png) / 2, 2 * MIB), f"pico {pico / MIB:.2f} MiB"
+
+
+@pytest.mark.parametrize("modo", ["b64", "url"])
+def test_imagen_que_rebasa_el_limite_se_rechaza(app, reve, monkeypatch, modo):
+    monkeypatch.setattr(reve, "reve_modo", modo)
+    monkeypatch.setitem(app.CONFIG, "IMAGEN_MAX_BYTES", len(reve.png) // 2)
+
+    assert "demasiado pesada" in app.generar_imagen_cainal("rechazo")
+
+
+def test_base64_con_escapes_y_en_trozos(app):
+    datos = bytes(range(256)) * 40
+    texto = base64.b64encode(datos).decode()
+    # Saltos de línea cada 76 y "/" escapada, como la mandan algunos encoders de JSON
+    texto = "\\n".join(texto[i:i + 76] for i in range(0, len(texto), 76)).replace("/", "\\/")
+    cuerpo = ('{"meta": {"image": "no"}, "image": "' + texto + '", "url": null}').encode()
+
+    buffer = io.BytesIO()
+    imagen = app._ImagenJSON(buffer, limite=len(datos))
+    for inicio in range(0, len(cuerpo), 7):
+        imagen.write(cuerpo[inicio:inicio + 7])
+
+    assert buffer.getvalue() == datos
+    assert imagen.cerrar() == {"meta": {"image": "no"}, "image": "", "url": None}
@@ -0,0 +1,58 @@
+# /metrics: histogramas acumulativos y contadores en formato de texto de
+# Prometheus, y las series que mueve una orden atendida de punta a punta.
+
+import pytest
+
+
+def _valor(texto: str, serie: str) -> float:
+    """Valor de una serie exacta (nombre con etiquetas) de la exposición; 0 si no está."""
+    for linea in texto.splitlines():
+        nombre, _, valor = linea.rpartition(" ")
+        if nombre == serie:
+            return float(valor)
+    return 0.0
+
+
+def test_histograma_acumulativo(app):
+    histograma = app.Histograma("prueba_segundos", "Prueba.", ("ruta",), limites=(0.1, 1.0))
+    for valor in (0.05, 0.1, 0.5, 3.0):
+        histograma.observar(valor, 'a"b')
+
+    texto = "\n".join(histograma.exponer())
+
+    assert "# TYPE prueba_segundos histogram" in texto
+    # Etiquetas escapadas y cubetas acumuladas (le incluye el límite)
+    assert _valor(texto, 'prueba_segundos_bucket{ruta="a\\"b",le="0.1"}') == 2
+    assert _valor(texto, 'prueba_segundos_bucket{ruta="a\\"b",le="1"}') == 3
+    assert _valor(texto, 'prueba_segundos_bucket{ruta="a\\"b",le="+Inf"}') == 4
+    assert _valor(texto, 'prueba_segundos_sum{ruta="a\\"b"}') == pytest.approx(3.65)
+    assert _valor(texto, 'prueba_segundos_count{ruta="a\\"b"}') == 4
+    assert histograma.promedios() == {('a"b',): (4, pytest.approx(3.65 / 4))}
+
+
+def test_contador(app):
+    contador = app.Contador("prueba_total", "Prueba.", ("tipo",))
+    contador.incrementar("x")
+    contador.incrementar("x", cantidad=2)
+
+    assert contador.exponer()[-1] == 'prueba_total{tipo="x"} 3'
+
+
+def test_una_orden_mueve_las_series(app, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "imagenes", 0)
+    admin = app.obtener_app_admin().test_client()
+    antes = admin.get("/metrics").get_data(as_text=True)
+
+    app.encolar_orden("hola", usar_cache=False)
+    assert _valor(admin.get("/metrics").get_data(as_text=True), 'cainal_cola_profundidad{carril="texto"}') == 1
+    item = app.obtener_cola().reclamar("texto", espera=0)
+    app.ejecutar_async(app._atender_item_async("texto", item))
+
+    respuesta = admin.get("/metrics")
+    despues = respuesta.get_data(as_text=True)
+    assert respuesta.mimetype == "text/plain"
+    for serie in ('cainal_ordenes_total{tipo="texto",resultado="exito"}',
+                  'cainal_orden_latencia_segundos_count{tipo="texto"}',
+                  'cainal_proveedor_latencia_segundos_count{proveedor="sambanova"}'):
+        assert _valor(despues, serie) == _valor(antes, serie) + 1, serie
+    assert _valor(despues, 'cainal_cola_profundidad{carril="texto"}') == 0
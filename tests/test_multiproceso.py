@@ -0,0 +1,91 @@
+# Varios procesos sobre la misma cola durable: el webhook bajo gunicorn con
+# N procesos, la firma en un pool de procesos (spawn) y el ritmo de drenado
+# que ven todos para estimar Retry-After.
+
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+from PIL import Image
+
+from conftest import RAIZ
+
+
+@pytest.fixture
+def pool_firma(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "FIRMA_PROCESOS", 1)
+    yield app.obtener_pool_firma()
+    app.cerrar_pool_firma()
+
+
+def test_la_firma_corre_en_otro_proceso(app, pool_firma, monkeypatch):
+    assert pool_firma.submit(os.getpid).result(timeout=60) != os.getpid()
+
+    # La configuración cambiada en caliente viaja con cada imagen
+    monkeypatch.setitem(app.CONFIG, "FIRMA_FORMATO", "WEBP")
+    ruta = app.generar_imagen_cainal("gallo de oro", usar_cache=False)
+
+    assert ruta.endswith(".webp") and Image.open(ruta).format == "WEBP"
+    assert app.obtener_salidas().listar()[0][0]["ruta"] == ruta
+
+
+def test_ritmo_de_drenado_compartido(app, tmp_path):
+    cola = app.ColaDurable(str(tmp_path / "cola.sqlite3"), visibilidad=0.3)
+    otra = app.ColaDurable(str(tmp_path / "cola.sqlite3"), visibilidad=0.3)
+    assert otra.ritmo_drenado() == 0.0
+
+    for _ in range(10):
+        cola.encolar("texto", {"orden": "x"})
+        orden = cola.reclamar("texto", espera=0)
+        cola.confirmar(orden["id"], orden["reclamo"])
+
+    # Otra conexión (otro proceso) ve los acks de esta
+    assert otra.ritmo_drenado(max_edad=0) > 0
+
+
+def _puerto_libre() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_webhook_bajo_gunicorn_encola_en_la_cola_compartida(tmp_path):
+    pytest.importorskip("gunicorn")
+    puerto = _puerto_libre()
+    base = f"http://127.0.0.1:{puerto}"
+    entorno = dict(os.environ, WEBHOOK_PORT=str(puerto), DATA_DIR=str(tmp_path), LOG_ARCHIVO="")
+    webhook = subprocess.Popen(
+        [sys.executable, os.path.join(RAIZ, "app.py"), "--modo", "webhook", "--procesos", "2"],
+        cwd=tmp_path, env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        fin = time.monotonic() + 60
+        while True:
+            assert webhook.poll() is None and time.monotonic() < fin, "el webhook no arrancó"
+            try:
+                if httpx.get(f"{base}/jobs/listo", timeout=1).status_code == 404:
+                    break
+            except httpx.HTTPError:
+                time.sleep(0.2)
+
+        with ThreadPoolExecutor(8) as pool:
+            respuestas = list(pool.map(
+                lambda n: httpx.post(f"{base}/webhook", json={"prompt": f"orden {n}"}, timeout=10), range(20)
+            ))
+        assert [respuesta.status_code for respuesta in respuestas] == [200] * 20
+
+        # Los dos procesos escribieron en los mismos archivos
+        with sqlite3.connect(tmp_path / "cola.sqlite3") as cola:
+            assert cola.execute("SELECT COUNT(*) FROM ordenes").fetchone()[0] == 20
+        with sqlite3.connect(tmp_path / "trabajos.sqlite3") as trabajos:
+            ids = {fila[0] for fila in trabajos.execute("SELECT id FROM trabajos")}
+        assert ids == {respuesta.json()["job_id"] for respuesta in respuestas}
+    finally:
+        webhook.terminate()
+        webhook.wait(10)
@@ -0,0 +1,55 @@
+# Núcleo asíncrono: las llamadas a proveedores corren juntas en un solo loop
+# en segundo plano, al que el código síncrono entra con ejecutar_async() e
+# iterar_async().
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+
+def test_llamadas_concurrentes_en_el_loop_del_nucleo(app, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "latencia", 0.3)
+    hilos = set()
+
+    async def orden(n):
+        hilos.add(threading.current_thread().name)
+        return await app.generar_texto_cainal_async(f"orden {n}", usar_cache=False)
+
+    async def todas():
+        return await asyncio.gather(*(orden(n) for n in range(6)))
+
+    inicio = time.monotonic()
+    respuestas = app.ejecutar_async(todas())
+
+    assert all(not r.startswith("⚠️") for r in respuestas)
+    assert hilos == {"loop_cainal"}
+    # Seis llamadas de ~0.3 s en serie tardarían más de 1.4 s
+    assert time.monotonic() - inicio < 0.9
+
+
+def test_ejecutar_async_desde_el_loop_es_error(app):
+    async def adentro():
+        return app.ejecutar_async(asyncio.sleep(0))
+
+    with pytest.raises(RuntimeError, match="usa await"):
+        app.ejecutar_async(adentro())
+
+
+def test_iterar_async_entrega_conforme_se_produce(app):
+    entregas = []
+
+    async def generador():
+        for n in range(3):
+            await asyncio.sleep(0.05)
+            yield n, time.monotonic()
+        raise ValueError("se acabó mal")
+
+    with pytest.raises(ValueError, match="se acabó mal"):
+        for n, producido in app.iterar_async(generador()):
+            entregas.append((n, time.monotonic() - producido))
+
+    assert [n for n, _ in entregas] == [0, 1, 2]
+    # Cada elemento llega en cuanto sale, no al terminar el generador
+    assert all(retraso < 0.04 for _, retraso in entregas)
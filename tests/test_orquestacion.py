@@ -0,0 +1,76 @@
+# Orquestación de una respuesta: todas las etiquetas [GENERA_IMAGEN] se rinden
+# en paralelo (con tope por orden) y la voz se sintetiza al mismo tiempo que
+# las imágenes, no después.
+
+import os
+import time
+
+
+async def _eventos(app, texto, descripciones):
+    return [evento async for evento in app.orquestar_respuesta_async(texto, descripciones, usar_cache=False)]
+
+
+def _intervalos(app, monkeypatch, *nombres) -> dict:
+    """
+    Anota (inicio, fin) de cada llamada a las corrutinas `nombres` del módulo:
+    el traslape se ve en los intervalos y no depende de cuánto CPU tome la firma.
+    """
+    intervalos = {nombre: [] for nombre in nombres}
+    for nombre in nombres:
+        original = getattr(app, nombre)
+
+        async def medida(*args, _original=original, _nombre=nombre, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return await _original(*args, **kwargs)
+            finally:
+                intervalos[_nombre].append((inicio, time.perf_counter()))
+
+        monkeypatch.setattr(app, nombre, medida)
+    return intervalos
+
+
+def _traslapan(a: tuple, b: tuple) -> bool:
+    return a[0] < b[1] and b[0] < a[1]
+
+
+def test_extraer_todas_las_etiquetas(app):
+    texto, descripciones = app.extraer_imagenes("Va. [GENERA_IMAGEN: un gallo] y [GENERA_IMAGEN: un perro]")
+
+    assert descripciones == [" un gallo", " un perro"]
+    assert "GENERA_IMAGEN" not in texto
+
+
+def test_imagenes_de_una_orden_en_paralelo(app, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "latencia", 0.3)
+    monkeypatch.setitem(app.CONFIG, "IMAGENES_PARALELO", 4)
+    intervalos = _intervalos(app, monkeypatch, "_renderizar_imagen_async")
+
+    rutas = app.generar_imagenes_cainal([f"escena {n}" for n in range(4)], usar_cache=False)
+
+    # Los cuatro renders arrancaron antes de que terminara el primero
+    renders = intervalos["_renderizar_imagen_async"]
+    assert len(renders) == 4
+    assert max(inicio for inicio, _ in renders) < min(fin for _, fin in renders)
+    assert len(set(rutas)) == 4 and all(os.path.isfile(ruta) for ruta in rutas)
+
+
+def test_tope_de_imagenes_por_orden(app, falsos, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "IMAGENES_MAX_POR_ORDEN", 2)
+    antes = falsos.contadores.get("reve", {}).get("peticiones", 0)
+
+    assert len(app.generar_imagenes_cainal([f"escena {n}" for n in range(5)], usar_cache=False)) == 2
+    assert falsos.contadores["reve"]["peticiones"] == antes + 2
+
+
+def test_voz_e_imagenes_se_traslapan(app, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "latencia", 0.3)
+    intervalos = _intervalos(app, monkeypatch, "_renderizar_imagen_async", "_sintetizar_fragmento_async")
+
+    eventos = app.ejecutar_async(_eventos(app, "Qué onda carnal.", ["gallo de oro"]))
+
+    (render,), (voz,) = intervalos["_renderizar_imagen_async"], intervalos["_sintetizar_fragmento_async"]
+    assert _traslapan(render, voz)
+    assert sorted(tipo for tipo, _ in eventos) == ["audio", "imagen"]
+    (indice, ruta), = [valor for tipo, valor in eventos if tipo == "imagen"]
+    assert indice == 0 and os.path.isfile(ruta)
@@ -0,0 +1,44 @@
+# Pool HTTP por proveedor: un cliente compartido por proveedor que reutiliza
+# la conexión keep-alive entre órdenes (y abre una por llamada sin keep-alive).
+
+import pytest
+from proveedores_falsos import ManejadorFalso
+
+
+@pytest.fixture
+def conexiones(app, monkeypatch):
+    """Conexiones TCP que abre el servidor falso durante la prueba."""
+    abiertas = []
+    original = ManejadorFalso.setup
+
+    def contar(manejador):
+        abiertas.append(manejador.client_address)
+        original(manejador)
+
+    monkeypatch.setattr(ManejadorFalso, "setup", contar)
+    # Sin conexiones vivas de pruebas anteriores
+    app.cerrar_clientes()
+    yield abiertas
+    app.cerrar_clientes()
+
+
+def test_un_cliente_por_proveedor(app):
+    sambanova = app.obtener_cliente("sambanova")
+
+    assert app.obtener_cliente("sambanova") is sambanova
+    assert app.obtener_cliente("reve") is not sambanova
+
+
+def test_keep_alive_reutiliza_la_conexion(app, conexiones):
+    for n in range(3):
+        assert not app.generar_texto_cainal(f"orden {n}", usar_cache=False).startswith("⚠️")
+
+    assert len(conexiones) == 1
+
+
+def test_sin_keep_alive_abre_una_por_llamada(app, conexiones, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "HTTP_KEEPALIVE", False)
+    for n in range(3):
+        assert not app.generar_texto_cainal(f"orden {n}", usar_cache=False).startswith("⚠️")
+
+    assert len(conexiones) == 3
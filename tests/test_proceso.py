@@ -0,0 +1,29 @@
+# Importar app no arranca nada del proceso (logging, hooks de fork): los
+# procesos de la firma lo importan con spawn y solo preparar_proceso() lo hace.
+
+import os
+import subprocess
+import sys
+
+from conftest import RAIZ
+
+SONDA = """
+import logging, threading
+import app
+hilos = sorted(h.name for h in threading.enumerate())
+print(len(logging.getLogger().handlers), app._ESCRITOR_LOG is None, "logging_escritor" in hilos)
+app.preparar_proceso()
+app.preparar_proceso()
+hilos = [h.name for h in threading.enumerate()]
+print(len(logging.getLogger().handlers), app._ESCRITOR_LOG is None, hilos.count("logging_escritor"))
+"""
+
+
+def test_importar_no_configura_el_proceso():
+    salida = subprocess.run(
+        [sys.executable, "-c", SONDA], cwd=RAIZ, env=os.environ.copy(),
+        capture_output=True, text=True, timeout=60, check=True
+    ).stdout.split("\n")
+
+    assert salida[0] == "0 True False"
+    assert salida[1] == "1 False 1"
@@ -0,0 +1,97 @@
+# Resiliencia por proveedor: disyuntor (cerrado, abierto, semiabierto con una
+# sola sonda), cubeta de tokens, reintentos con backoff y Retry-After.
+
+import time
+
+import httpx
+import pytest
+
+
+def _peticiones(falsos) -> int:
+    return falsos.contadores.get("sambanova", {}).get("peticiones", 0)
+
+
+@pytest.fixture
+def proveedores(app, monkeypatch):
+    """Disyuntores, cubetas y contadores nuevos para la prueba."""
+    monkeypatch.setattr(app, "_DISYUNTORES", {})
+    monkeypatch.setattr(app, "_CUBETAS", {})
+    monkeypatch.setattr(app, "_ESTADISTICAS_PROVEEDOR", {})
+    monkeypatch.setitem(app.CONFIG, "PROVEEDOR_BACKOFF_BASE", 0.01)
+    return app
+
+
+def test_disyuntor_abre_sonda_y_cierra(app):
+    disyuntor = app.Disyuntor("prueba", umbral=2, enfriamiento=0.1)
+    disyuntor.fallo()
+    disyuntor.permitir()
+    disyuntor.fallo()
+    assert disyuntor.estado == "abierto"
+    with pytest.raises(app.ProveedorCaido):
+        disyuntor.permitir()
+
+    time.sleep(0.12)
+    disyuntor.permitir()
+    assert disyuntor.estado == "semiabierto"
+    # Una sola sonda a la vez
+    with pytest.raises(app.ProveedorCaido):
+        disyuntor.permitir()
+    disyuntor.fallo()
+    assert (disyuntor.estado, disyuntor.aperturas) == ("abierto", 2)
+
+    time.sleep(0.12)
+    disyuntor.permitir()
+    disyuntor.exito()
+    assert (disyuntor.estado, disyuntor.rechazos) == ("cerrado", 2)
+
+
+def test_cubeta_limita_el_ritmo(app):
+    cubeta = app.CubetaTokens(ritmo=20, capacidad=2)
+
+    async def seis():
+        inicio = time.perf_counter()
+        for _ in range(6):
+            await cubeta.tomar()
+        return time.perf_counter() - inicio
+
+    # Las 2 de la ráfaga pasan; las otras 4 esperan 1/20 s cada una
+    assert 0.18 <= app.ejecutar_async(seis()) < 0.5
+
+
+def test_proveedor_caido_falla_sin_llamarlo(proveedores, falsos, monkeypatch):
+    app = proveedores
+    monkeypatch.setitem(app.CONFIG, "PROVEEDOR_FALLAS_UMBRAL", 2)
+    monkeypatch.setitem(app.CONFIG, "PROVEEDOR_REINTENTOS", 0)
+    monkeypatch.setattr(falsos, "errores", 1.0)
+    antes = _peticiones(falsos)
+
+    for _ in range(3):
+        assert app.generar_texto_cainal("hola", usar_cache=False).startswith("⚠️")
+
+    assert _peticiones(falsos) == antes + 2
+    estado = app.estado_proveedores()["sambanova"]
+    assert estado["disyuntor"]["estado"] == "abierto"
+    assert estado["disyuntor"]["rechazos_rapidos"] == 1
+
+
+def test_reintentos_hasta_que_el_proveedor_responde(proveedores, falsos, monkeypatch):
+    app = proveedores
+    monkeypatch.setitem(app.CONFIG, "PROVEEDOR_REINTENTOS", 2)
+    monkeypatch.setattr(falsos, "errores", 1.0)
+    antes = _peticiones(falsos)
+
+    assert app.generar_texto_cainal("hola", usar_cache=False).startswith("⚠️")
+
+    assert _peticiones(falsos) == antes + 3
+    assert app.estado_proveedores()["sambanova"]["reintentos"] == 2
+
+
+def test_espera_de_retry_after(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "PROVEEDOR_BACKOFF_BASE", 0.5)
+    monkeypatch.setitem(app.CONFIG, "PROVEEDOR_BACKOFF_MAX", 20)
+
+    assert 3 <= app._espera_retry_after(httpx.Response(429, headers={"Retry-After": "3"}), 0) <= 3.5
+    # Pedir más que PROVEEDOR_BACKOFF_MAX ya no se reintenta
+    assert app._espera_retry_after(httpx.Response(429, headers={"Retry-After": "60"}), 0) is None
+    # Sin header: backoff exponencial con jitter, acotado
+    assert 0 <= app._espera_retry_after(httpx.Response(503), 3) <= 4
@@ -0,0 +1,90 @@
+# Almacén de salidas: imágenes repartidas por fecha y hash, índice SQLite
+# paginado, desalojo por edad y por tamaño (las menos usadas primero) y
+# migración del esquema plano anterior.
+
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def salidas(app, tmp_path):
+    def abrir(max_bytes=0, retencion=0):
+        return app.AlmacenSalidas(str(tmp_path / "salidas.sqlite3"), str(tmp_path / "salida"), max_bytes, retencion)
+    return abrir
+
+
+def _imagen(app, tamano=1000) -> str:
+    ruta = app.ruta_salida()
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with open(ruta, "wb") as archivo:
+        archivo.write(b"\0" * tamano)
+    return ruta
+
+
+def test_ruta_repartida_por_fecha_y_hash(app):
+    instante = time.mktime((2026, 3, 9, 12, 0, 0, 0, 0, -1))
+
+    ruta = app.ruta_salida("ab12cd", instante)
+
+    relativa = os.path.relpath(ruta, app.CONFIG["OUTPUT_DIR"])
+    assert relativa == os.path.join("2026", "03", "09", "ab", f"cainal_ab12cd{app.extension_firma()}")
+
+
+def test_listado_paginado(app, salidas):
+    almacen = salidas()
+    rutas = [_imagen(app) for _ in range(5)]
+    for n, ruta in enumerate(rutas):
+        almacen.registrar(ruta, f"prompt {n}", job_id=f"job{n}")
+
+    pagina, cursor = almacen.listar(limite=3)
+    resto, fin = almacen.listar(limite=3, cursor=cursor)
+
+    assert [s["ruta"] for s in pagina + resto] == rutas[::-1] and fin is None
+    assert (pagina[0]["prompt"], pagina[0]["job_id"], pagina[0]["bytes"]) == ("prompt 4", "job4", 1000)
+    assert almacen.estadisticas() == {"archivos": 5, "bytes": 5000}
+
+
+def test_desalojo_por_tamano_respeta_el_uso(app, salidas):
+    almacen = salidas(max_bytes=2500)
+    rutas = [_imagen(app) for _ in range(4)]
+    for n, ruta in enumerate(rutas):
+        almacen.registrar(ruta, "x")
+        almacen._db.execute("UPDATE salidas SET usado = ? WHERE ruta = ?", (n, ruta))
+    # La más vieja se acaba de usar: se van la segunda y la tercera
+    almacen.tocar(rutas[0])
+
+    # Baja al 90% del tope
+    assert almacen.purgar() == 2
+
+    assert [os.path.exists(ruta) for ruta in rutas] == [True, False, False, True]
+    assert almacen.estadisticas() == {"archivos": 2, "bytes": 2000}
+
+
+def test_desalojo_por_edad(app, salidas):
+    almacen = salidas(retencion=60)
+    vieja, nueva = _imagen(app), _imagen(app)
+    almacen.registrar(vieja, "x")
+    almacen.registrar(nueva, "x")
+    almacen._db.execute("UPDATE salidas SET usado = usado - 120 WHERE ruta = ?", (vieja,))
+
+    assert almacen.purgar() == 1
+    assert not os.path.exists(vieja) and os.path.exists(nueva)
+
+
+def test_migracion_del_esquema_plano(app, salidas):
+    raiz = app.CONFIG["OUTPUT_DIR"]
+    clave = "f" * 64
+    os.makedirs(os.path.join(raiz, "cache"))
+    for ruta in (os.path.join(raiz, "cainal_1700000000.png"), os.path.join(raiz, "cache", f"{clave}.png")):
+        with open(ruta, "wb") as archivo:
+            archivo.write(b"\0" * 10)
+
+    almacen = salidas()
+
+    filas, _ = almacen.listar()
+    assert {fila["id"] for fila in filas} == {"1700000000", clave}
+    # El cache plano se repartió por los dos primeros caracteres de la clave
+    assert os.path.isfile(app.ruta_cache_imagen(clave, ".png"))
+    assert not os.path.exists(os.path.join(raiz, "cache", f"{clave}.png"))
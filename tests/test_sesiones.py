@@ -0,0 +1,96 @@
+# Sesiones de conversación: el historial viaja en cada orden y cambia la
+# clave del cache, los turnos viejos se compactan a un resumen dentro del
+# presupuesto de tokens, otro proceso ve lo escrito y las órdenes de una
+# misma sesión salen de la cola en serie.
+
+import pytest
+
+
+@pytest.fixture
+def sesiones(tmp_path):
+    def abrir(app, presupuesto=3000, max_resumen=600, ttl=3600):
+        return app.AlmacenSesiones(str(tmp_path / "sesiones.sqlite3"), presupuesto, max_resumen, ttl, 10)
+    return abrir
+
+
+def _texto(app, prompt, sesion=None):
+    return app.ejecutar_async(app.generar_texto_cainal_async(prompt, sesion=sesion))
+
+
+def test_el_historial_viaja_y_cambia_la_clave_del_cache(app, falsos):
+    primera = _texto(app, "hola", "s1")
+    antes = falsos.contadores["sambanova"]["peticiones"]
+
+    # Mismo prompt con otro historial: no sale del cache
+    segunda = _texto(app, "hola", "s1")
+    assert segunda != primera
+    assert falsos.contadores["sambanova"]["peticiones"] == antes + 1
+
+    mensajes, huella = app.obtener_sesiones().contexto("s1")
+    assert [m["role"] for m in mensajes] == ["user", "assistant", "user", "assistant"]
+    assert mensajes[1]["content"] == primera and huella
+    # Sin sesión no se recuerda nada
+    _texto(app, "suelto")
+    assert app.obtener_sesiones().contexto("suelto") == ([], "")
+
+
+def test_compactacion_dentro_del_presupuesto(app, sesiones):
+    almacen = sesiones(app, presupuesto=60, max_resumen=30)
+    for n in range(6):
+        almacen.agregar_turno("s", f"Pregunta {n}. " + "relleno " * 10, f"Respuesta {n}. " + "relleno " * 10)
+
+    mensajes, _ = almacen.contexto("s")
+    estado = almacen.resumen("s")
+    assert estado["compactada"] and estado["tokens"] <= 60
+    assert mensajes[0]["role"] == "system" and "- Usuario: Pregunta" in mensajes[0]["content"]
+    assert app.estimar_tokens(mensajes[0]["content"].split("\n", 1)[1]) <= 30
+    # Lo más nuevo sigue completo en la ventana
+    assert mensajes[-1]["content"].startswith("Respuesta 5.")
+
+
+def test_otro_proceso_ve_los_turnos(app, sesiones):
+    webhook, worker = sesiones(app), sesiones(app)
+    assert worker.contexto("s") == ([], "")
+
+    webhook.agregar_turno("s", "hola", "qué onda")
+
+    assert [m["content"] for m in worker.contexto("s")[0]] == ["hola", "qué onda"]
+    worker.agregar_turno("s", "otra", "va")
+    assert len(webhook.contexto("s")[0]) == 4
+
+
+def test_sesiones_vencidas_y_borradas(app, sesiones):
+    almacen = sesiones(app, ttl=60)
+    almacen.agregar_turno("vieja", "a", "b")
+    almacen.agregar_turno("nueva", "a", "b")
+    almacen._db.execute("UPDATE sesiones SET actualizado = actualizado - 120 WHERE id = 'vieja'")
+
+    assert almacen.purgar() == 1
+    assert almacen.contexto("vieja") == ([], "")
+    almacen.borrar("nueva")
+    assert almacen.contexto("nueva") == ([], "")
+
+
+def test_session_id_del_webhook(app):
+    cliente = app.obtener_app_flask().test_client()
+
+    assert cliente.post("/webhook", json={"prompt": "hola", "session_id": "no válido!"}).status_code == 400
+    datos = cliente.post("/webhook", json={"prompt": "hola", "session_id": "s-1"}).get_json()
+    assert datos["session_id"] == "s-1"
+    assert app.obtener_cola().reclamar("texto", espera=0)["sesion"] == "s-1"
+
+
+def test_ordenes_de_una_sesion_salen_en_serie(app, tmp_path):
+    cola = app.ColaDurable(str(tmp_path / "cola.sqlite3"), visibilidad=0.3, sondeo=0.01)
+    cola.encolar("texto", {"orden": "turno 1", "sesion": "s1"})
+    cola.encolar("texto", {"orden": "turno 2", "sesion": "s1"})
+    cola.encolar("texto", {"orden": "otra", "sesion": "s2"})
+
+    primera = cola.reclamar("texto", espera=0)
+    assert primera["orden"] == "turno 1"
+    # El turno 2 espera al 1; la otra sesión no
+    assert cola.reclamar("texto", espera=0)["orden"] == "otra"
+    assert cola.reclamar("texto", espera=0) is None
+
+    cola.confirmar(primera["id"], primera["reclamo"])
+    assert cola.reclamar("texto", espera=0)["orden"] == "turno 2"
@@ -0,0 +1,90 @@
+# /webhook con "stream": true: fragmentos por SSE, fallos en su propio
+# evento y el mismo control de admisión que las órdenes encoladas.
+
+import json
+
+import pytest
+
+
+@pytest.fixture
+def cliente(app):
+    return app.obtener_app_flask().test_client()
+
+
+def _eventos(respuesta):
+    """Lista de (evento, datos) de un cuerpo SSE."""
+    eventos = []
+    for bloque in respuesta.get_data(as_text=True).strip().split("\n\n"):
+        evento, datos = None, None
+        for linea in bloque.splitlines():
+            if linea.startswith("event: "):
+                evento = linea[7:]
+            elif linea.startswith("data: "):
+                datos = json.loads(linea[6:])
+        eventos.append((evento, datos))
+    return eventos
+
+
+def _stream(cliente, **extra):
+    respuesta = cliente.post("/webhook", json={"prompt": "hola", "stream": True, "cache": False, **extra})
+    try:
+        return respuesta.status_code, _eventos(respuesta) if respuesta.status_code == 200 else respuesta.get_json()
+    finally:
+        respuesta.close()
+
+
+def test_stream_entrega_fragmentos_y_final(app, cliente, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "imagenes", 0)
+
+    estatus, eventos = _stream(cliente)
+
+    assert estatus == 200
+    deltas = [datos["delta"] for evento, datos in eventos if evento is None]
+    evento, final = eventos[-1]
+    assert len(deltas) > 1 and evento == "final"
+    assert final["exitoso"] is True and final["error"] is None
+    assert final["texto"] == "".join(deltas)
+    # Sin trabajo ni orden en la cola
+    assert app.obtener_trabajos().listar()[0] == [] and app.profundidad_colas() == 0
+    assert app.streams_activos() == 0
+
+
+def test_stream_fallido_manda_evento_de_error(app, cliente, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "SAMBANOVA_KEY", "")
+
+    estatus, eventos = _stream(cliente)
+
+    assert estatus == 200
+    assert [evento for evento, _ in eventos] == ["error", "final"]
+    final = eventos[-1][1]
+    assert final["exitoso"] is False and "SAMBANOVA_API_KEY" in final["error"]
+    assert final["imagenes"] == []
+
+
+def test_stream_respeta_el_control_de_admision(app, cliente, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "COLA_MAX_PENDIENTES", 1)
+    monkeypatch.setitem(app.CONFIG, "COLA_RESERVA_PRIORIDAD", 0)
+    app.encolar_orden("ya encolada")
+
+    estatus, cuerpo = _stream(cliente)
+
+    assert estatus == 429 and cuerpo["status"] == "saturado"
+    assert app.streams_activos() == 0
+
+
+def test_tope_de_streams_abiertos(app, cliente, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "WEBHOOK_STREAMS_MAX", 1)
+    assert app.tomar_stream()
+    try:
+        estatus, cuerpo = _stream(cliente)
+        assert estatus == 429 and "stream" in cuerpo["message"]
+    finally:
+        app.soltar_stream()
+
+    assert _stream(cliente)[0] == 200
+    assert app.streams_activos() == 0
+
+
+def test_stream_con_callback_es_400(cliente, falsos):
+    estatus, cuerpo = _stream(cliente, callback_url=f"{falsos.base}/callback/s")
+    assert estatus == 400
@@ -0,0 +1,93 @@
+# Almacén de trabajos (/jobs): estados de una orden de punta a punta,
+# fallos del proveedor registrados como "fallido" (no como salida),
+# trabajos que no se quedan en_cola si su orden no entró a la cola y
+# listados que no muestran lo de otros clientes.
+
+import pytest
+
+
+def _atender(app, carril: str) -> None:
+    """Reclama la siguiente orden del carril y la atiende como lo haría un worker."""
+    item = app.obtener_cola().reclamar(carril, espera=0)
+    app.ejecutar_async(app._atender_item_async(carril, item))
+
+
+def test_orden_de_texto_completada(app, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "imagenes", 0)
+    _, id_trabajo = app.encolar_orden("hola", usar_cache=False)
+    assert app.obtener_trabajos().obtener(id_trabajo)["estado"] == "en_cola"
+
+    _atender(app, "texto")
+
+    trabajo = app.obtener_trabajos().obtener(id_trabajo)
+    assert (trabajo["estado"], trabajo["tipo"], trabajo["error"]) == ("completado", "texto", None)
+    assert trabajo["salida"] and not trabajo["salida"].startswith("⚠️")
+    assert trabajo["tiempos"]["total"] is not None
+    assert app.profundidad_colas() == 0
+
+
+def test_fallo_del_proveedor_no_es_salida(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "SAMBANOVA_KEY", "")
+
+    resultado = app.procesar_orden_cainal("hola")
+
+    assert resultado["exitoso"] is False
+    assert resultado["salida"] is None
+    assert resultado["error"].startswith("⚠️")
+
+
+def test_orden_de_texto_fallida_queda_fallida(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "SAMBANOVA_KEY", "")
+    _, id_trabajo = app.encolar_orden("hola")
+
+    _atender(app, "texto")
+
+    trabajo = app.obtener_trabajos().obtener(id_trabajo)
+    assert trabajo["estado"] == "fallido"
+    assert trabajo["salida"] is None
+    assert "SAMBANOVA_API_KEY" in trabajo["error"]
+    # Se confirma igual: un fallo del proveedor no se reintenta desde la cola
+    assert app.profundidad_colas() == 0
+
+
+def test_listado_paginado_y_por_estado(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "SAMBANOVA_KEY", "")
+    ids = [app.encolar_orden(f"orden {n}")[1] for n in range(5)]
+    _atender(app, "texto")
+
+    trabajos = app.obtener_trabajos()
+    pagina, cursor = trabajos.listar(limite=3)
+    assert [t["id"] for t in pagina] == ids[:1:-1]
+    resto, fin = trabajos.listar(limite=3, cursor=cursor)
+    assert [t["id"] for t in resto] == ids[1::-1] and fin is None
+    assert [t["id"] for t in trabajos.listar(estado="fallido")[0]] == [ids[0]]
+
+
+def test_fallo_al_encolar_descarta_los_trabajos(app, monkeypatch):
+    def falla(*args, **kwargs):
+        raise RuntimeError("disco lleno")
+
+    monkeypatch.setattr(app.obtener_cola(), "encolar_lote", falla)
+    with pytest.raises(RuntimeError):
+        app.encolar_ordenes([("uno", True), ("dos", True)])
+
+    trabajos, _ = app.obtener_trabajos().listar()
+    assert trabajos == []
+
+
+def test_listado_de_jobs_por_cliente(app):
+    cliente = app.obtener_app_flask().test_client()
+    mios = cliente.post("/webhook", json={"prompt": "hola"}, headers={"X-Client-Id": "a"}).get_json()
+    cliente.post("/webhook", json={"prompt": "hola"}, headers={"X-Client-Id": "b"})
+    cliente.post("/webhook", json={"prompt": "hola"})
+
+    assert cliente.get("/jobs").status_code == 400
+    trabajos = cliente.get("/jobs", headers={"X-Client-Id": "a"}).get_json()["jobs"]
+    assert [t["id"] for t in trabajos] == [mios["job_id"]]
+    # El trabajo por id sigue a la mano de quien tiene el job_id
+    assert cliente.get(f"/jobs/{mios['job_id']}").status_code == 200
+
+
+def test_outputs_solo_en_el_listener_de_administracion(app):
+    assert app.obtener_app_flask().test_client().get("/outputs").status_code == 404
+    assert app.obtener_app_admin().test_client().get("/outputs").get_json()["outputs"] == []
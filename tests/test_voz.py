@@ -0,0 +1,67 @@
+# Voz por fragmentos: el texto se parte en fin de oración, los fragmentos se
+# sintetizan en paralelo, el audio sale en orden y cada fragmento se cachea.
+
+import time
+
+import pytest
+
+TEXTO = "Qué onda carnal. El barrio suena a neón y oro. Ritmo de calle, puro fierro. Ahí nos vidrios!"
+
+
+def _llamadas(falsos) -> int:
+    return falsos.contadores.get("eleven", {}).get("peticiones", 0)
+
+
+@pytest.fixture
+def voz(app, monkeypatch):
+    monkeypatch.setitem(app.CONFIG, "ELEVEN_FRAGMENTO_CHARS", 40)
+    monkeypatch.setitem(app.CONFIG, "ELEVEN_PARALELO", 4)
+    return app
+
+
+def test_fragmentos_en_fin_de_oracion(app):
+    fragmentos = app.dividir_oraciones(TEXTO, 40)
+
+    # El primero es solo la primera oración, para que el audio empiece rápido
+    assert fragmentos[0] == "Qué onda carnal."
+    assert all(len(fragmento) <= 40 for fragmento in fragmentos)
+    assert " ".join(fragmentos) == TEXTO
+    assert app.dividir_oraciones("uno, dos, tres, cuatro, cinco", 12) == ["uno, dos,", "tres,", "cuatro,", "cinco"]
+
+
+def test_tope_total_de_caracteres(voz, monkeypatch):
+    monkeypatch.setitem(voz.CONFIG, "ELEVEN_MAX_CHARS", 50)
+
+    assert voz._fragmentos_voz(TEXTO) == ["Qué onda carnal.", "El barrio suena a neón y oro."]
+
+
+def test_fragmentos_en_paralelo_y_en_orden(voz, falsos, monkeypatch):
+    monkeypatch.setattr(falsos, "latencia", 0.3)
+    fragmentos = voz._fragmentos_voz(TEXTO)
+    antes = _llamadas(falsos)
+
+    inicio = time.perf_counter()
+    audio = voz.ejecutar_async(voz.generar_voz_cainal_async(TEXTO, usar_cache=False))
+
+    assert len(fragmentos) == 4
+    assert time.perf_counter() - inicio < 0.3 * 2.5
+    assert audio == falsos.audio * len(fragmentos)
+    assert _llamadas(falsos) == antes + len(fragmentos)
+
+
+def test_cache_por_fragmento(voz, falsos):
+    voz.generar_voz_cainal("Qué onda carnal. Simón.")
+    antes, hits = _llamadas(falsos), voz.estadisticas_cache_voz()["hits"]
+
+    # Un texto nuevo que repite una oración solo sintetiza lo que falta
+    assert voz.generar_voz_cainal("Qué onda carnal. Jale nuevo.") == falsos.audio * 2
+    assert _llamadas(falsos) == antes + 1
+    assert voz.estadisticas_cache_voz()["hits"] == hits + 1
+
+
+def test_sin_audio_si_el_proveedor_falla(voz, falsos, monkeypatch):
+    monkeypatch.setattr(voz, "_DISYUNTORES", {})
+    monkeypatch.setitem(voz.CONFIG, "PROVEEDOR_REINTENTOS", 0)
+    monkeypatch.setattr(falsos, "errores", 1.0)
+
+    assert voz.ejecutar_async(voz.generar_voz_cainal_async(TEXTO, usar_cache=False)) is None